@@ -3,14 +3,18 @@
 AI-логика и интеграция с OpenAI.
 Версия 3.0 с улучшениями: персонализация, умный детектор, динамический контент
 """
+import hashlib
 import logging
 import time
-from ai.knowledge import find_relevant_info
-from openai import OpenAI
-from core.config import OPENAI_API_KEY
+from datetime import date
+from ai.knowledge import find_relevant_info, content_version
+from core.config import (
+    OPENAI_API_KEY, AI_MAX_CONCURRENCY, AI_REQUEST_DEADLINE, AI_HEDGE_REQUESTS, AI_PROMPT_TOKEN_BUDGET,
+)
 
 # Модули AI System v2.x
-from ai.retry_handler import retry_with_backoff, get_user_friendly_error
+from ai.retry_handler import get_user_friendly_error
+from ai.gateway import AIGateway, AIRequestSuperseded
 from ai.knowledge_cache import cached_knowledge_base
 from ai.response_validator import validate_ai_response, sanitize_user_input, check_response_quality
 from ai.conversation_context import conversation_context
@@ -22,17 +26,20 @@ from ai.fallback_responses import fallback_responses
 from ai.user_memory import user_memory
 from ai.smart_intent_detector import smart_detector
 from ai.dynamic_content import dynamic_content
+from ai.response_cache import response_cache, normalize_bar_state
+from ai import prompt_builder as pb
 
-# Инициализация OpenAI клиента
-openai_client = None
-if OPENAI_API_KEY:
-    try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
-        logging.info("OpenAI клиент успешно инициализирован")
-    except Exception as e:
-        logging.error(f"Ошибка инициализации OpenAI клиента: {e}")
-        openai_client = None
-else:
+# Шлюз к OpenAI: очередь с ограничением параллельности, дедлайны, повторы без
+# блокировки потока; клиент AsyncOpenAI создаётся при первом запросе
+ai_gateway = AIGateway(
+    api_key=OPENAI_API_KEY,
+    max_concurrency=AI_MAX_CONCURRENCY,
+    deadline=AI_REQUEST_DEADLINE,
+    hedge=AI_HEDGE_REQUESTS,
+)
+# Сборщик промпта: статичные части собраны заранее, контекст урезается до бюджета
+prompt_builder = pb.PromptBuilder(token_budget=AI_PROMPT_TOKEN_BUDGET)
+if not OPENAI_API_KEY:
     logging.warning("OPENAI_API_KEY не установлен. AI функции будут недоступны.")
 
 logger = logging.getLogger("evgenich_ai")
@@ -53,7 +60,7 @@ def get_ai_recommendation(
     model: str = "gpt-4o",
     temperature: float = 0.95,  # Увеличиваем для большего разнообразия!
     max_tokens: int = 150,  # Больше места для разных формулировок
-) -> str:
+) -> str | None:
     """
     Получить рекомендацию от AI с использованием всех улучшений
     
@@ -73,14 +80,15 @@ def get_ai_recommendation(
         max_tokens: Максимум токенов
         
     Returns:
-        Ответ AI
+        Ответ AI или None, если запрос снят из очереди более новым
+        сообщением того же пользователя (отвечать не нужно)
     """
     start_time = time.time()
     
     logger.info(f"Получен запрос от пользователя {user_id}: {user_query[:100]}...")
     
     # Проверяем доступность API ключа
-    if not openai_client:
+    if not ai_gateway.available:
         logger.error("OpenAI клиент не инициализирован")
         return "Товарищ, мой мыслительный аппарат не подключён к сети. Попроси администратора настроить подключение к AI."
     
@@ -104,6 +112,14 @@ def get_ai_recommendation(
         f"сущности: {detected_intent.entities})"
     )
     
+    # Типовой вопрос (адрес, часы, караоке...) — отвечаем по общему промпту
+    # без истории и персональных данных гостя, такой ответ можно отдать любому
+    cache_key = response_cache.make_key(
+        detected_intent, user_query,
+        concept=user_concept, is_group_chat=is_group_chat, bar_context=bar_context,
+        emotion=emotion, user_type=user_type, content_version=content_version(),
+    )
+    
     # ВАЖНО: НЕ используем fallback для обычных запросов!
     # Пусть AI общается живо и естественно.
     # Fallback только как запасной вариант при сбоях API.
@@ -114,128 +130,112 @@ def get_ai_recommendation(
     
     updates_string = f"Спецпредложение сегодня: {daily_updates.get('special', 'нет')}. В стоп‑листе: {daily_updates.get('stop-list', 'ничего')}" if daily_updates else "нет оперативных данных"
     
-    # Создаем расширенный контекст с информацией о баре и пользователе
-    extended_context = f"{updates_string}\n"
+    # Секции контекста с приоритетами: при нехватке бюджета токенов
+    # первыми выбрасываются секции с наибольшим приоритетом
+    sections = [pb.PromptSection("updates", updates_string)]
     if bar_context:
-        extended_context += f"\nКонтекст бара: {bar_context}\n"
+        # В общем промпте — состояние бара без текущего времени, как в ключе кеша
+        bar_text = normalize_bar_state(bar_context) if cache_key is not None else bar_context
+        sections.append(pb.PromptSection("bar", f"Контекст бара: {bar_text}", pb.PRIORITY_BAR))
     
     # ========== AI SYSTEM v3.0: ПЕРСОНАЛИЗАЦИЯ ==========
     
     # Получаем персонализированный контекст из памяти о пользователе
-    if user_id:
+    if user_id and cache_key is None:
         personalization = user_memory.get_personalization_context(user_id)
         if personalization:
-            extended_context += f"\n{personalization}\n"
+            sections.append(pb.PromptSection("personalization", personalization, pb.PRIORITY_PERSONALIZATION))
             logger.debug(f"📝 Персонализация для {user_id}: {personalization[:50]}...")
     
-    # Добавляем динамический контент (акции, мероприятия)
-    dynamic_ctx = dynamic_content.get_context_for_ai()
+    # Добавляем динамический контент (акции, мероприятия) — пересобирается
+    # только при изменении контента или со сменой дня
+    dynamic_ctx = prompt_builder.fragment(
+        ("dynamic", dynamic_content.version, date.today()), dynamic_content.get_context_for_ai,
+    )
     if dynamic_ctx:
-        extended_context += f"\n{dynamic_ctx}\n"
+        sections.append(pb.PromptSection("dynamic_content", dynamic_ctx, pb.PRIORITY_DYNAMIC))
         logger.debug(f"📢 Динамический контент добавлен")
     
     # ========== КОНЕЦ v3.0 БЛОКА ==========
     
     # Персонализация по типу гостя (legacy)
-    user_type_context = ""
-    if user_type == "new":
-        user_type_context = "Это новый гость, расскажи подробнее о баре, будь особенно гостеприимным."
-    elif user_type == "regular":
-        user_type_context = "Это постоянный гость, общайся как со старым знакомым."
-    elif user_type == "vip":
-        user_type_context = "Это VIP-гость, который часто у нас бывает! Особое уважение и внимание."
-    
+    user_type_context = pb.USER_TYPE_HINTS.get(user_type, "")
     if user_type_context:
-        extended_context += f"\n{user_type_context}\n"
+        sections.append(pb.PromptSection("user_type", user_type_context, pb.PRIORITY_USER_TYPE))
     
     # Добавляем предпочтения пользователя
-    if preferences:
-        extended_context += f"\n{preferences}\n"
+    if preferences and cache_key is None:
+        sections.append(pb.PromptSection("preferences", preferences, pb.PRIORITY_PREFERENCES))
     
     # Если это групповой чат и вопрос о бронировании - направить на кнопку
     if is_group_chat:
-        extended_context += (
-            "\n🔔 ГРУППОВОЙ ЧАТ!\n\n"
-            "💬 БРОНИРОВАНИЕ: Каждый раз формулируй ПО-НОВОМУ!\n\n"
-            "🎯 КНОПКА: Будет прямо в сообщении. Говори просто: \"жми кнопку\" (БЕЗ уточнений где).\n\n"
-            "📋 УЖЕ ОСТАВИЛ ЗАЯВКУ:\n"
-            "Скажи: Отдел видит, свяжутся через 30-40 мин. (Варьируй слова!)\n\n"
-            "📋 СПРАШИВАЕТ КАК:\n"
-            "Скажи: Жми кнопку → откроется форма → отдел свяжется. (Разные формулировки!)\n\n"
-            "📋 ВОЛНУЕТСЯ:\n"
-            "Успокой. Заявку видят, ответят. Можно позвонить +7(812)237-59-50.\n\n"
-            "📋 НЕ ВИДИТ КНОПКУ:\n"
-            "Скажи: Кнопка в сообщении - '📍 Забронировать стол'.\n\n"
-            "❌ НЕ пиши '[START_BOOKING_FLOW]' в группе!\n"
-        )
+        sections.append(pb.PromptSection("group_booking", pb.GROUP_BOOKING_HINT))
     
     # Адаптация по эмоции
     if emotion and emotion.get('emotion') != 'neutral':
-        emotion_name = emotion['emotion']
-        emotion_context = ""
-        if emotion_name == 'joy':
-            emotion_context = "Гость в хорошем настроении."
-        elif emotion_name == 'sadness':
-            emotion_context = "Гость грустит. Будь деликатным."
-        elif emotion_name == 'anger':
-            emotion_context = "Гость недоволен. Будь терпеливым и постарайся помочь."
-        elif emotion_name == 'surprise':
-            emotion_context = "Гость удивлен. Поддержи его интерес."
-        
+        emotion_context = pb.EMOTION_HINTS.get(emotion['emotion'], "")
         if emotion_context:
-            extended_context += f"\n{emotion_context}\n"
-    
-    messages: list[dict[str, str]] = [
-        {"role": "system", "content": create_system_prompt(extended_context, user_concept, is_group_chat)}
-    ]
+            sections.append(pb.PromptSection("emotion", emotion_context, pb.PRIORITY_EMOTION))
     
-    # НОВОЕ: Используем автоматический контекст разговора
-    if user_id:
-        stored_context = conversation_context.get_context(user_id)
-        if stored_context:
-            messages.extend(stored_context)
-            logger.debug(f"Использован сохранённый контекст: {len(stored_context)} сообщений")
+    # НОВОЕ: Используем автоматический контекст разговора (в общем промпте истории нет)
+    history: list[dict[str, str]] = []
+    if user_id and cache_key is None:
+        history = conversation_context.get_context(user_id)
+        if history:
+            logger.debug(f"Использован сохранённый контекст: {len(history)} сообщений")
     # Если передан ручной контекст (обратная совместимость)
-    elif conversation_history:
-        messages.extend(conversation_history[-10:])
+    elif conversation_history and cache_key is None:
+        history = conversation_history[-10:]
     
-    user_content = (
-        f"Вопрос: '{user_query}'\n\n"
-        f"Информация:\n---\n{relevant_context}\n---\n"
-        "⚠️ Каждый раз ПО-НОВОМУ! Варьируй слова, структуру, стиль."
+    prompt = prompt_builder.build(
+        user_concept=user_concept,
+        is_group_chat=is_group_chat,
+        sections=sections,
+        history=history,
+        question=user_query,
+        knowledge=relevant_context,
     )
-    messages.append({"role": "user", "content": user_content})
+    messages = prompt.messages
     
-    # НОВОЕ: Вызов API с retry логикой
-    def api_call():
-        """Обёртка для вызова API"""
-        return openai_client.chat.completions.create(
+    if cache_key is not None:
+        # Ключ — намерение и системная часть общего промпта: в пуле только
+        # ответы, сгенерированные ровно по такому промпту
+        cache_key = cache_key + (hashlib.sha1(messages[0]["content"].encode("utf-8")).hexdigest(),)
+        cached = response_cache.get(cache_key)
+        ai_metrics.log_cache_lookup(
+            user_id=user_id,
+            hit=cached is not None,
             model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
+            saved_prompt_tokens=cached[1] if cached else 0,
+            saved_completion_tokens=cached[2] if cached else 0,
         )
+        if cached:
+            if user_id:
+                conversation_context.add_message(user_id, "user", user_query)
+                conversation_context.add_message(user_id, "assistant", cached[0])
+            logger.info(f"Ответ из кеша для намерения {detected_intent.name} за {time.time() - start_time:.3f}s")
+            return cached[0]
+    
+    ai_metrics.log_prompt_sections(
+        user_id=user_id,
+        section_tokens=prompt.section_tokens,
+        budget=prompt.budget,
+        dropped=prompt.dropped,
+        truncated=prompt.truncated,
+    )
     
     try:
-        logger.info("Отправка запроса в OpenAI API с retry логикой...")
+        logger.info("Отправка запроса в OpenAI API через шлюз...")
         
-        # Используем retry handler
-        completion = retry_with_backoff(
-            func=api_call,
-            max_retries=3,
-            fallback_response=None
+        # Повторы, дедлайн и очередь — внутри шлюза; поток не спит между попытками
+        completion = ai_gateway.complete_sync(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            user_id=user_id,
         )
         
-        if completion is None:
-            # НОВОЕ: Используем fallback ответ только при ошибке (force=True)
-            logger.warning("API не ответил после retry, используем fallback")
-            fallback_response = fallback_responses.get_response(
-                detected_intent.name,
-                detected_intent.entities,
-                chat_type="group" if is_group_chat else "private"
-            )
-            return fallback_response
-        
         response_text = completion.choices[0].message.content
         response_time = time.time() - start_time
         
@@ -276,9 +276,20 @@ def get_ai_recommendation(
             conversation_context.add_message(user_id, "user", user_query)
             conversation_context.add_message(user_id, "assistant", validated_response)
         
+        # В пул кеша — только ответы на общий промпт (cache_key задан только для него)
+        if cache_key is not None:
+            response_cache.put(
+                cache_key, validated_response,
+                completion.usage.prompt_tokens, completion.usage.completion_tokens,
+            )
+        
         logger.info(f"Ответ успешно получен и валидирован за {response_time:.2f}s")
         return validated_response
         
+    except AIRequestSuperseded:
+        logger.info(f"Запрос пользователя {user_id} отменён: пришло более новое сообщение")
+        return None
+        
     except Exception as exc:
         response_time = time.time() - start_time
         logger.error(f"Ошибка при обращении к OpenAI API: {exc}", exc_info=True)
@@ -313,101 +324,8 @@ def get_ai_recommendation(
             return get_user_friendly_error(exc)
 
 def create_system_prompt(updates_string: str, user_concept: str = "evgenich", is_group_chat: bool = False) -> str:
-    # Базовые концепции - КОРОТКИЕ И ЯСНЫЕ
-    concepts = {
-        "evgenich": {
-            "name": "Евгенич",
-            "description": "Владелец бара. Друг, а не продавец.",
-            "style": "Просто отвечай. БЕЗ 'залетай', 'приходи'.",
-            "examples": ["Невский 53 😊", "Да, бесплатное 🎤", "С 12 до 6 🌙"]
-        },
-        "rvv": {
-            "name": "РВВ",
-            "description": "Фанат 90-х.",
-            "style": "Живые фразы. БЕЗ рекламы.",
-            "examples": ["Музыка 90-х 🎶", "Спой что хочешь 🎤"]
-        }
-    }
-    
-    concept = concepts.get(user_concept, concepts["evgenich"])
-    
-    # КОРОТКИЙ промпт - ТОЛЬКО СУТЬ
-    base_prompt = (
-        f"Ты {concept['name']} - {concept['description']}\n\n"
-        f"СТИЛЬ: {concept['style']}\n\n"
-        f"❌ ЗАПРЕЩЕНО: «Залетай!», «Приходи!», «Ждём!», «У нас...», призывы.\n\n"
-        f"✅ ОТВЕЧАЙ: Коротко, по делу, как друг.\n"
-        f"Примеры: {', '.join(concept['examples'])}\n\n"
-        f"- Смайлики добавляй, но 1-2 штуки, не больше\n\n"
-        f"# ИНФОРМАЦИЯ (используй только если спросят):\n"
-        f"📍 Адреса: СПб (Невский 53, Рубинштейна 9), МСК (Пятницкая 30)\n"
-        f"📞 Телефон: +7 (812) 237-59-50\n"
-        f"🕐 Часы: 12:00 - 6:00\n"
-        f"🎤 Караоке бесплатное\n"
-        f"🌐 Сайт: spb.evgenich.bar\n"
-        f"🎉 Афиша мероприятий: Если спрашивают про мероприятия/концерты - направь на https://spb.evgenich.bar (там актуальная афиша)\n\n"
-        f"💳 🚨 КРИТИЧЕСКИ ВАЖНО ПРО ВХОД 🚨\n"
-        f"⛔ СТРОГО ЗАПРЕЩЕНО говорить: 'вход свободный', 'вход бесплатный', 'входа нет', 'можно просто зайти'!\n"
-        f"⛔ НИКОГДА не пиши что вход бесплатный или свободный!\n"
-        f"✅ Если спрашивают про вход/стоимость входа:\n"
-        f"   1. Скажи что стоимость зависит от дня/времени/мероприятия\n"
-        f"   2. Предложи оставить заявку на spb.evgenich.bar\n"
-        f"   3. Или скажи что менеджер в чате ответит\n"
-        f"   4. Можно предложить позвонить +7 (812) 237-59-50\n"
-        f"Примеры ПРАВИЛЬНЫХ ответов:\n"
-        f"   - 'Стоимость зависит от дня и мероприятия. Оставь заявку на spb.evgenich.bar - там подскажут! 😊'\n"
-        f"   - 'Цена входа меняется. Лучше уточни на сайте или менеджер в чате ответит 👍'\n"
-        f"   - 'Зависит от дня. Позвони +7 (812) 237-59-50 или оставь заявку на сайте'\n\n"
-        f"# СЕГОДНЯ\n"
-        f"{updates_string}\n\n"
-    )
-    
-    # Специфика для ГРУППОВЫХ ЧАТОВ
-    if is_group_chat:
-        group_instructions = (
-            f"# ЭТО ГРУППОВОЙ ЧАТ!\n"
-            f"Это общий чат гостей. Отвечай только когда спрашивают.\n\n"
-            f"# БРОНИРОВАНИЕ В ГРУППЕ (ОЧЕНЬ ВАЖНО!):\n"
-            f"Когда гость хочет забронировать столик:\n"
-            f"1. НЕ говори что записал или забронировал - ты НЕ бронируешь!\n"
-            f"2. Направь на КНОПКУ которая появится после твоего ответа\n"
-            f"3. Объясни: нажмет кнопку → заполнит форму → отдел бронирования свяжется\n"
-            f"4. Говори КАЖДЫЙ РАЗ ПО-РАЗНОМУ! Будь креативным!\n\n"
-            f"ПРИМЕРЫ ХОРОШИХ ОТВЕТОВ (используй разные варианты!):\n"
-            f"- «Жми кнопку ниже, заполни форму - девчонки из отдела бронирования свяжутся! 😊»\n"
-            f"- «Для брони нажми кнопку 👇 Заполнишь заявку - наши быстро ответят»\n"
-            f"- «Кнопка появится ниже! Заполняй форму, отдел бронирования напишет 👍»\n"
-            f"- «Товарищ, жми кнопку что ниже. Форма откроется, заполнишь - девчонки перезвонят 😊»\n"
-            f"- «Смотри кнопку под сообщением! Нажми, заполни - отдел бронирования свяжется быстро»\n"
-            f"- «Кликай кнопку ниже 👇 Там форма. Заполнишь - наши напишут или позвонят»\n\n"
-            f"❌ ЗАПРЕЩЕНО:\n"
-            f"- «Окей, записываю!», «Забронировал!», «На 21:30 для пятерых» - ты НЕ бронируешь!\n"
-            f"- Одинаковые фразы каждый раз - МЕНЯЙ формулировки!\n"
-            f"- [START_BOOKING_FLOW] в группе - это только для личных чатов!\n\n"
-            f"✅ ГЛАВНОЕ: Направь на кнопку + объясни что будет дальше. Но каждый раз РАЗНЫМИ словами!\n\n"
-            f"# ДРУГИЕ СИТУАЦИИ:\n"
-            f"- Уже заполнил форму → «Девчонки видят заявку, скоро свяжутся 👍»\n"
-            f"- Волнуется → «Ответят быстро, не переживай 😊»\n"
-            f"- Адрес/часы → Ответь коротко\n"
-            f"- Просто общаются → НЕ вмешивайся\n\n"
-            f"# ПОМНИ:\n"
-            f"Ты не бронируешь сам - ты направляешь на кнопку и объясняешь процесс!\n"
-        )
-        return base_prompt + group_instructions
-    
-    # Специфика для ЛИЧНЫХ ЧАТОВ
-    else:
-        private_instructions = (
-            f"# ЭТО ЛИЧНЫЙ ЧАТ\n\n"
-            f"# БРОНИРОВАНИЕ:\n"
-            f"Если гость хочет забронировать → ответь: `[START_BOOKING_FLOW]`\n\n"
-            f"# ДРУГИЕ ВОПРОСЫ:\n"
-            f"Отвечай по-дружески, но БЕЗ рекламы.\n"
-            f"НЕ добавляй «залетай», «приходи» и прочие призывы!\n\n"
-            f"# ПОМНИ:\n"
-            f"Ты друг, а не продавец. Просто общайся.\n"
-        )
-        return base_prompt + private_instructions
+    # Статичные части собираются один раз на концепцию и тип чата (ai.prompt_builder)
+    return pb.system_prompt(updates_string, user_concept, is_group_chat)
 
 def analyze_guest_preferences(user_id: int) -> str:
     """
@@ -19,13 +19,15 @@ class DynamicContent:
     
     def __init__(self, storage_file: str = "data/dynamic_content.json"):
         self.storage_file = Path(storage_file)
-        self.storage_file.parent.mkdir(exist_ok=True)
         self.content = {
             "promotions": [],  # Акции
             "events": [],  # Мероприятия
             "specials": [],  # Специальные предложения
             "announcements": [],  # Объявления
         }
+        # Увеличивается при каждом изменении — по нему индекс базы знаний
+        # понимает, что контент нужно переиндексировать
+        self.version = 0
         self._load()
     
     def _load(self):
@@ -37,13 +39,13 @@ class DynamicContent:
                 logger.info(f"📢 Загружен динамический контент: {len(self.content.get('promotions', []))} акций, {len(self.content.get('events', []))} мероприятий")
             except Exception as e:
                 logger.error(f"Ошибка загрузки dynamic_content: {e}")
-        else:
-            # Создаём файл с начальными данными
-            self._save()
+        # Нет файла — работаем с пустым контентом, файл появится при первом изменении
     
     def _save(self):
         """Сохранить контент"""
+        self.version += 1
         try:
+            self.storage_file.parent.mkdir(exist_ok=True, parents=True)
             with open(self.storage_file, 'w', encoding='utf-8') as f:
                 json.dump(self.content, f, ensure_ascii=False, indent=2)
         except Exception as e:
@@ -0,0 +1,242 @@
+# /ai/gateway.py
+"""
+Асинхронный шлюз к OpenAI.
+
+Раньше get_ai_recommendation вызывал синхронный клиент, а retry_with_backoff
+между повторами делал time.sleep — поток обработки обновлений простаивал
+секундами. Теперь все запросы идут через один asyncio-цикл в фоновом потоке
+и AsyncOpenAI:
+
+- одновременно выполняется не больше max_concurrency запросов (семафор),
+  остальные ждут в очереди;
+- у каждого запроса общий дедлайн на ожидание, повторы и паузы между ними;
+  паузы — asyncio.sleep, они не держат ни поток, ни слот семафора;
+- хеджирование (опционально): если ответ не пришёл за p95 последних
+  задержек и есть свободный слот, отправляется второй такой же запрос,
+  берётся первый успешный ответ, второй отменяется;
+- если пользователь прислал новое сообщение, его ещё не начатый запрос
+  снимается из очереди (AIRequestSuperseded) — отвечать на устаревший
+  вопрос незачем.
+
+Синхронные вызывающие используют complete_sync — тонкую обёртку над тем же циклом.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from openai import APIConnectionError, APIError, AsyncOpenAI, RateLimitError
+
+logger = logging.getLogger("evgenich_ai")
+
+
+class AIRequestSuperseded(Exception):
+    """Запрос снят из очереди: пользователь прислал более новое сообщение"""
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (RateLimitError, APIConnectionError)):
+        return True
+    if isinstance(exc, APIError):
+        return (getattr(exc, "status_code", None) or 0) >= 500
+    return False
+
+
+class AIGateway:
+    def __init__(self, api_key: Optional[str] = None, client=None, max_concurrency: int = 8,
+                 deadline: float = 20.0, hedge: bool = False, max_retries: int = 3,
+                 initial_delay: float = 1.0, backoff_factor: float = 2.0,
+                 hedge_min_samples: int = 20, latency_window: int = 200):
+        self.api_key = api_key
+        self.max_concurrency = max(1, max_concurrency)
+        self.deadline = deadline
+        self.hedge = hedge
+        self.max_retries = max(1, max_retries)
+        self.initial_delay = initial_delay
+        self.backoff_factor = backoff_factor
+        self.hedge_min_samples = hedge_min_samples
+
+        self._client = client
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._start_lock = threading.Lock()
+        self._queued: Dict[int, asyncio.Task] = {}
+        self._superseded = set()
+        self._latencies = deque(maxlen=latency_window)
+        self._stats = {"requests": 0, "completed": 0, "failed": 0, "timeouts": 0, "superseded": 0,
+                       "retries": 0, "hedged": 0, "hedge_wins": 0, "waiting": 0, "in_flight": 0}
+
+    @property
+    def available(self) -> bool:
+        return self._client is not None or bool(self.api_key)
+
+    # --- Цикл событий ---
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is not None:
+            return self._loop
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+
+                threading.Thread(target=run, name="ai-gateway", daemon=True).start()
+                ready.wait()
+                self._loop = loop
+        return self._loop
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=self.api_key)
+        return self._client
+
+    # --- Публичный API ---
+
+    async def complete(self, *, messages: List[Dict[str, str]], model: str, temperature: float,
+                       max_tokens: int, user_id: int = 0, deadline: Optional[float] = None) -> Any:
+        """chat.completions.create с очередью, дедлайном, повторами и хеджированием"""
+        request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        self._stats["requests"] += 1
+        try:
+            result = await asyncio.wait_for(self._complete(request, user_id), timeout=deadline or self.deadline)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise
+        except AIRequestSuperseded:
+            self._stats["superseded"] += 1
+            raise
+        except Exception:
+            self._stats["failed"] += 1
+            raise
+        self._stats["completed"] += 1
+        return result
+
+    def complete_sync(self, **kwargs) -> Any:
+        """Синхронная обёртка над complete() для вызова из потоков бота"""
+        future = asyncio.run_coroutine_threadsafe(self.complete(**kwargs), self._ensure_loop())
+        try:
+            # Дедлайн соблюдается внутри complete(); запас — на случай зависшего цикла
+            return future.result(timeout=(kwargs.get("deadline") or self.deadline) + 5)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def supersede(self, user_id: int):
+        """Снять из очереди ещё не начатый запрос пользователя (потокобезопасно)"""
+        if self._loop is not None and user_id:
+            self._loop.call_soon_threadsafe(self._cancel_queued, user_id)
+
+    # --- Очередь ---
+
+    def _cancel_queued(self, user_id: int):
+        task = self._queued.pop(user_id, None)
+        if task is not None and not task.done():
+            self._superseded.add(task)
+            task.cancel()
+
+    async def _complete(self, request: Dict[str, Any], user_id: int) -> Any:
+        task = asyncio.current_task()
+        if user_id:
+            self._cancel_queued(user_id)
+            self._queued[user_id] = task
+        self._stats["waiting"] += 1
+        try:
+            await self._semaphore.acquire()
+        except asyncio.CancelledError:
+            if task in self._superseded:
+                raise AIRequestSuperseded(f"Запрос пользователя {user_id} заменён более новым")
+            raise
+        finally:
+            self._stats["waiting"] -= 1
+            self._superseded.discard(task)
+            if user_id and self._queued.get(user_id) is task:
+                del self._queued[user_id]
+
+        self._stats["in_flight"] += 1
+        try:
+            return await self._with_retries(request)
+        finally:
+            self._stats["in_flight"] -= 1
+            self._semaphore.release()
+
+    async def _with_retries(self, request: Dict[str, Any]) -> Any:
+        delay = self.initial_delay
+        for attempt in range(self.max_retries):
+            try:
+                return await self._attempt(request)
+            except Exception as e:
+                if attempt == self.max_retries - 1 or not _is_retryable(e):
+                    raise
+                logger.warning(f"AI шлюз | Ошибка API (попытка {attempt + 1}/{self.max_retries}), "
+                               f"повтор через {delay:.1f}s: {e}")
+                self._stats["retries"] += 1
+                await asyncio.sleep(delay)
+                delay *= self.backoff_factor
+
+    # --- Хеджирование ---
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    async def _call(self, request: Dict[str, Any]) -> Any:
+        started = time.monotonic()
+        result = await self._get_client().chat.completions.create(**request)
+        self._latencies.append(time.monotonic() - started)
+        return result
+
+    async def _attempt(self, request: Dict[str, Any]) -> Any:
+        primary = asyncio.ensure_future(self._call(request))
+        hedge = None
+        try:
+            hedge_delay = self._hedge_delay()
+            if hedge_delay is None:
+                return await primary
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+            # Второй запрос — только если есть свободный слот, чужую очередь не тормозим
+            if done or self._semaphore.locked():
+                return await primary
+
+            await self._semaphore.acquire()
+            self._stats["hedged"] += 1
+            try:
+                hedge = asyncio.ensure_future(self._call(request))
+                pending = {primary, hedge}
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for finished in done:
+                        if finished.exception() is None:
+                            if finished is hedge:
+                                self._stats["hedge_wins"] += 1
+                            return finished.result()
+                # Оба запроса упали — отдаём ошибку основного
+                raise primary.exception()
+            finally:
+                self._semaphore.release()
+        finally:
+            for call in (primary, hedge):
+                if call is not None and not call.done():
+                    call.cancel()
+
+    # --- Метрики ---
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        latencies = sorted(self._latencies)
+        if latencies:
+            stats["p50_ms"] = round(latencies[len(latencies) // 2] * 1000)
+            stats["p95_ms"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000)
+        stats["max_concurrency"] = self.max_concurrency
+        stats["hedge"] = self.hedge
+        return stats
@@ -0,0 +1,171 @@
+# /ai/intent_matcher.py
+"""
+Скомпилированный матчер ключевых слов и фраз для SmartIntentDetector.
+
+Старый путь на каждое сообщение делал `keyword in text` по всем ключам и
+SequenceMatcher для каждой пары «слово сообщения × ключевое слово × намерение».
+Здесь всё, что зависит только от паттернов, считается один раз:
+
+- точные вхождения всех фраз и ключевых слов ищутся одним проходом
+  автомата Ахо–Корасик;
+- для fuzzy-сравнения ключи разложены по длине и по составу символов:
+  SequenceMatcher.ratio() не может превысить 2·min(len)/(сумма длин) и
+  2·|пересечение мультимножеств символов|/(сумма длин), поэтому пары,
+  у которых эти оценки ниже порога, отбрасываются без вызова difflib.
+  Оставшиеся пары считаются тем же SequenceMatcher — результат совпадает
+  со старым до последнего знака;
+- результат fuzzy-сравнения для слова кешируется (слова в чатах повторяются).
+
+Сверка со старой реализацией — tests/test_intent_matcher.py.
+"""
+
+from collections import Counter, deque
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import Dict, Iterable, List, Set, Tuple
+
+# Слова и ключи короче этой длины в fuzzy-сравнении не участвуют
+MIN_FUZZY_LEN = 4
+
+
+class AhoCorasick:
+    """Автомат Ахо–Корасик: все (в том числе перекрывающиеся) вхождения паттернов за один проход."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Set[str]] = [set()]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+            state = nxt
+        self._out[state].add(pattern)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def find_all(self, text: str) -> Set[str]:
+        """Множество паттернов, встречающихся в text как подстроки."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Set[str] = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class CompiledIntentMatcher:
+    """Предкомпилированные паттерны всех намерений"""
+
+    def __init__(self, intent_patterns: Dict[str, Dict], fuzzy_threshold: float,
+                 word_cache_size: int = 4096):
+        self.fuzzy_threshold = fuzzy_threshold
+        # Порядок намерений сохраняем — от него зависит выбор при равных (priority, confidence)
+        self.intents: List[Tuple[str, int]] = [(name, cfg["priority"]) for name, cfg in intent_patterns.items()]
+
+        # Точные вхождения: паттерн -> намерения, где он фраза / ключевое слово
+        self._phrase_owners: Dict[str, Set[str]] = {}
+        self._keyword_owners: Dict[str, Set[str]] = {}
+        for name, cfg in intent_patterns.items():
+            for phrase in cfg.get("phrases", []):
+                self._phrase_owners.setdefault(phrase, set()).add(name)
+            for keyword in cfg["keywords"]:
+                self._keyword_owners.setdefault(keyword, set()).add(name)
+        self._automaton = AhoCorasick(set(self._phrase_owners) | set(self._keyword_owners))
+
+        # Fuzzy: уникальные ключи длиной >= MIN_FUZZY_LEN, сгруппированные по длине
+        by_length: Dict[int, Dict[str, Set[str]]] = {}
+        for keyword, owners in self._keyword_owners.items():
+            if len(keyword) >= MIN_FUZZY_LEN:
+                by_length.setdefault(len(keyword), {})[keyword] = owners
+        self._fuzzy_by_length: Dict[int, List[Tuple[str, Counter, Set[str]]]] = {
+            length: [(kw, Counter(kw), owners) for kw, owners in keywords.items()]
+            for length, keywords in by_length.items()
+        }
+
+        self._fuzzy_word = lru_cache(maxsize=word_cache_size)(self._fuzzy_word_uncached)
+
+    def _fuzzy_word_uncached(self, word: str) -> Dict[str, float]:
+        """Лучший ratio >= порога для слова по каждому намерению."""
+        threshold = self.fuzzy_threshold
+        len_word = len(word)
+        word_chars = None
+        best: Dict[str, float] = {}
+        for length, keywords in self._fuzzy_by_length.items():
+            total = len_word + length
+            if 2.0 * min(len_word, length) / total < threshold:
+                continue
+            if word_chars is None:
+                word_chars = Counter(word)
+            for keyword, keyword_chars, owners in keywords:
+                common = sum(min(count, word_chars[char]) for char, count in keyword_chars.items())
+                if 2.0 * common / total < threshold:
+                    continue
+                score = SequenceMatcher(None, word, keyword).ratio()
+                if score < threshold:
+                    continue
+                for name in owners:
+                    if score > best.get(name, 0.0):
+                        best[name] = score
+        return best
+
+    def match(self, message_lower: str) -> List[Dict]:
+        """
+        Совпадения по всем намерениям — то же, что цикл в SmartIntentDetector.detect:
+        [{'intent', 'confidence', 'priority'}, ...] в порядке объявления намерений.
+        """
+        hits = self._automaton.find_all(message_lower)
+        phrase_hits: Set[str] = set()
+        keyword_hits: Set[str] = set()
+        for pattern in hits:
+            phrase_hits |= self._phrase_owners.get(pattern, set())
+            keyword_hits |= self._keyword_owners.get(pattern, set())
+
+        fuzzy: Dict[str, float] = {}
+        if len(phrase_hits | keyword_hits) < len(self.intents):
+            for word in message_lower.split():
+                if len(word) < MIN_FUZZY_LEN:
+                    continue
+                for name, score in self._fuzzy_word(word).items():
+                    if score > fuzzy.get(name, 0.0):
+                        fuzzy[name] = score
+
+        results = []
+        for name, priority in self.intents:
+            if name in phrase_hits:
+                confidence = 0.95
+            elif name in keyword_hits:
+                confidence = 1.0
+            elif name in fuzzy:
+                confidence = max(0.7, fuzzy[name])
+            else:
+                continue
+            results.append({"intent": name, "confidence": confidence, "priority": priority})
+        return results
+
+    def cache_info(self):
+        return self._fuzzy_word.cache_info()
@@ -3,31 +3,62 @@
 Работа с базой знаний для AI.
 """
 
+import datetime
+import logging
+
 from ai.knowledge_base import KNOWLEDGE_BASE_TEXT
+from ai.knowledge_index import KnowledgeIndex
+from ai.dynamic_content import dynamic_content
+
+logger = logging.getLogger("evgenich_ai")
+
+# Индекс строится один раз при импорте; динамический контент (акции, мероприятия,
+# объявления из admin_content) переиндексируется отдельно при его изменении
+knowledge_index = KnowledgeIndex()
+knowledge_index.set_source("base", KNOWLEDGE_BASE_TEXT.split('\n'))
+
+_dynamic_state = None
+
+
+def _dynamic_lines():
+    for promo in dynamic_content.get_active_promotions():
+        yield f"Акция «{promo['title']}»: {promo['description']}"
+    for event in dynamic_content.get_upcoming_events(30):
+        yield f"Мероприятие {event['date']} в {event['time']} «{event['title']}»: {event['description']}"
+    for ann in dynamic_content.get_active_announcements():
+        yield f"Объявление: {ann['text']}"
+
 
+def _sync_dynamic_content():
+    """Переиндексирует динамический контент, если он изменился (или сменился день)."""
+    global _dynamic_state
+    state = (dynamic_content.version, datetime.date.today())
+    if state == _dynamic_state:
+        return
+    try:
+        knowledge_index.set_source("dynamic", _dynamic_lines())
+        _dynamic_state = state
+    except Exception as e:
+        logger.error(f"Ошибка индексации динамического контента: {e}")
 
-def find_relevant_info(query: str) -> str:
+
+def content_version() -> tuple:
+    """
+    Версия всего, что AI знает о баре: база знаний, динамический контент, дата.
+    Меняется при любом их изменении — по ней сбрасываются закешированные ответы.
     """
-    Находит релевантную информацию в базе знаний по ключевым словам из запроса.
+    _sync_dynamic_content()
+    return (knowledge_index.version, dynamic_content.version, datetime.date.today().isoformat())
+
+
+def find_relevant_info(query: str, top_k: int = 10) -> str:
     """
-    query_lower = query.lower()
-    query_words = {word.lower() for word in query.split()}
-    relevant_context = []
-    
-    # Поиск в основной базе знаний
-    for line in KNOWLEDGE_BASE_TEXT.split('\n'):
-        if any(word in line.lower() for word in query_words):
-            relevant_context.append(line)
-    
+    Находит релевантную информацию в базе знаний (BM25 по индексу строк).
+    """
+    _sync_dynamic_content()
+    relevant_context = knowledge_index.search(query, top_k=top_k)
+
     if not relevant_context:
         return "Ничего конкретного не нашлось, но я всё равно попробую помочь."
-    
-    # Убираем дубликаты и объединяем
-    seen = set()
-    unique_context = []
-    for ctx in relevant_context:
-        if ctx not in seen:
-            seen.add(ctx)
-            unique_context.append(ctx)
-    
-    return "\n".join(unique_context[:10])
+
+    return "\n".join(relevant_context)
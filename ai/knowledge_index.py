@@ -0,0 +1,148 @@
+# /ai/knowledge_index.py
+"""
+Инвертированный индекс базы знаний с ранжированием BM25.
+
+Раньше find_relevant_info на каждый запрос заново резал текст базы знаний
+на строки и искал подстроки: N строк × M слов запроса. Теперь строки
+токенизируются и стеммятся один раз, а запрос читает только списки
+вхождений своих терминов.
+
+- Лёгкий стеммер для русского (отсечение окончаний), поэтому «настойки»,
+  «настойку» и «настойкой» находят одну и ту же строку.
+- Документы сгруппированы по источникам ("base", "dynamic" ...): источник
+  можно переиндексировать отдельно, не трогая остальные.
+
+Микробенчмарк против старой реализации: python -m utils.micro_benchmarks knowledge
+"""
+
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+_TOKEN_RE = re.compile(r"[а-яёa-z0-9]+")
+
+# Служебные слова не несут смысла для поиска и есть почти в каждой строке
+_STOPWORDS = frozenset("""
+а без бы в во вам вас ваш все всё вы где да для до же за и из или им их к как
+ко когда кто ли мне мы на над не нет но ну о об однако от по под при про с со
+так там то тоже тут у уже чем что чтобы это этот я ты он она оно они вот есть
+мой моя мое моё твой свой его её ее ей ему нам нас наш можно будет быть был
+the a an and or of to in on for is are
+""".split())
+
+# Окончания русских слов, от длинных к коротким
+_RU_ENDINGS = tuple(sorted(set("""
+ами ями ого его ому ему ыми ими ая яя ое ее ые ие ой ей ий ый ую юю ом ем
+ам ям ах ях ов ев ью ия ие ии ию ея ёт ет ут ют ат ят ит ишь ешь ем им
+ете ите ила ило или ыла ыло ыли ала ало али яла яло яли ена ено ены
+ться тся ать ять ить еть уть ешься ишься ся сь
+а я о е ё ы и у ю ь й
+""".split()), key=len, reverse=True))
+
+_MIN_STEM_LEN = 3
+
+
+def stem(word: str) -> str:
+    """Приводит слово к основе: нижний регистр, ё → е, отсечение окончания."""
+    word = word.lower().replace("ё", "е")
+    if not word.isalpha() or word.isascii():
+        return word
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM_LEN:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на основы слов, отбрасывая служебные слова."""
+    return [stem(token) for token in _TOKEN_RE.findall(text.lower()) if token not in _STOPWORDS]
+
+
+class KnowledgeIndex:
+    """BM25-индекс по строкам базы знаний"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._docs: Dict[int, Tuple[str, str, int]] = {}   # doc_id -> (источник, строка, длина)
+        self._sources: Dict[str, List[int]] = {}
+        self._postings: Dict[str, Dict[int, int]] = {}     # термин -> {doc_id: частота}
+        self._total_len = 0
+        self._next_id = 0
+        # Растёт при каждом изменении индекса (по нему сбрасываются кеши ответов)
+        self.version = 0
+
+    def set_source(self, source: str, lines: Iterable[str]):
+        """Заменяет документы источника (старые вхождения удаляются, новые добавляются)."""
+        with self._lock:
+            self.remove_source(source)
+            doc_ids = []
+            seen = set()
+            for line in lines:
+                line = line.strip()
+                if not line or line in seen:
+                    continue
+                seen.add(line)
+                terms = Counter(tokenize(line))
+                if not terms:
+                    continue
+                doc_id = self._next_id
+                self._next_id += 1
+                length = sum(terms.values())
+                self._docs[doc_id] = (source, line, length)
+                self._total_len += length
+                for term, tf in terms.items():
+                    self._postings.setdefault(term, {})[doc_id] = tf
+                doc_ids.append(doc_id)
+            self._sources[source] = doc_ids
+            self.version += 1
+
+    def remove_source(self, source: str):
+        with self._lock:
+            if source in self._sources:
+                self.version += 1
+            for doc_id in self._sources.pop(source, []):
+                _, line, length = self._docs.pop(doc_id)
+                self._total_len -= length
+                for term in set(tokenize(line)):
+                    postings = self._postings.get(term)
+                    if postings is not None:
+                        postings.pop(doc_id, None)
+                        if not postings:
+                            del self._postings[term]
+
+    def search(self, query: str, top_k: int = 10) -> List[str]:
+        """Возвращает до top_k строк, отсортированных по убыванию BM25."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs:
+                return []
+            avg_len = self._total_len / n_docs
+            scores: Dict[int, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc_id, tf in postings.items():
+                    length = self._docs[doc_id][2]
+                    norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_len))
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * norm
+            # При равном счёте — порядок строк в базе знаний
+            best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+            return [self._docs[doc_id][1] for doc_id, _ in best]
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "documents": len(self._docs),
+                "terms": len(self._postings),
+                "sources": len(self._sources),
+            }
@@ -1,15 +1,51 @@
 # /ai/metrics.py
 """
 Сбор метрик использования AI (токены, стоимость, время ответа)
+
+Сырые записи пишутся в JSONL с ротацией по дням (logs/ai_metrics.YYYY-MM-DD.jsonl).
+Статистика считается не чтением файла, а по агрегатам в памяти (за день и за
+пользователя в день), которые периодически сохраняются в таблицы
+ai_metrics_daily / ai_metrics_user_daily (SQLite или PostgreSQL).
+
+Перенос старых логов в агрегаты: python -m ai.metrics --backfill [файлы...]
 """
+import atexit
 import logging
 import json
-from datetime import datetime, date
+import threading
+import time
+from datetime import datetime, date, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
 logger = logging.getLogger("evgenich_ai")
 
+_DAILY_COUNTERS = (
+    "total_requests", "successful_requests", "failed_requests", "prompt_tokens",
+    "completion_tokens", "total_tokens", "cost_usd", "response_time_sum_ms",
+    "response_time_count", "unique_users",
+    # Кеш ответов (ai.response_cache): обращения, попадания и сэкономленное
+    "cache_lookups", "cache_hits", "cache_saved_tokens", "cache_saved_cost_usd",
+)
+
+
+def _empty_day() -> Dict[str, float]:
+    return {name: 0 for name in _DAILY_COUNTERS}
+
+
+def _empty_user_day() -> Dict[str, float]:
+    return {"requests": 0, "tokens": 0, "cost_usd": 0.0}
+
+
+def _default_store():
+    """Хранилище агрегатов — core.database (SQLite или PostgreSQL)."""
+    try:
+        from core import database
+        return database
+    except Exception as e:
+        logger.warning(f"AIMetrics: БД недоступна, агрегаты только в памяти ({e})")
+        return None
+
 
 class AIMetrics:
     """
@@ -35,14 +71,39 @@ class AIMetrics:
         }
     }
     
-    def __init__(self, log_file: str = "logs/ai_metrics.jsonl"):
+    def __init__(self, log_file: str = "logs/ai_metrics.jsonl", store=None,
+                 flush_interval: float = 30.0, memory_days: int = 35,
+                 raw_retention_days: int = 30):
         """
         Args:
-            log_file: Путь к файлу для логирования метрик
+            log_file: Базовый путь лога (сырые записи пишутся в <имя>.<дата>.jsonl рядом;
+                сам файл — старый формат без ротации, читается только при backfill)
+            store: Хранилище агрегатов (по умолчанию core.database)
+            flush_interval: Как часто сохранять изменённые агрегаты, секунд
+            memory_days: За сколько последних дней агрегаты подгружаются при старте и держатся в памяти
+            raw_retention_days: Сколько дней хранить сырые JSONL (0 — не удалять)
         """
         self.log_file = Path(log_file)
         self.log_file.parent.mkdir(exist_ok=True, parents=True)
-        logger.info(f"AIMetrics инициализирован, лог: {self.log_file}")
+        self.store = store
+        self.flush_interval = flush_interval
+        self.memory_days = memory_days
+        self.raw_retention_days = raw_retention_days
+        
+        self._lock = threading.RLock()
+        self._daily: Dict[str, Dict[str, float]] = {}
+        self._user_days: Dict[int, Dict[str, Dict[str, float]]] = {}
+        self._dirty_days = set()
+        self._dirty_users = set()
+        self._loaded = False
+        self._loaded_from: Optional[str] = None
+        self._raw_day: Optional[str] = None
+        # Токены по секциям промпта (ai.prompt_builder): день → секция → суммы.
+        # Только в памяти и в сырых JSONL — для анализа роста prompt_tokens
+        self._prompt_sections: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self._flush_thread: Optional[threading.Thread] = None
+        
+        logger.info(f"AIMetrics инициализирован, лог: {self._raw_path(date.today().isoformat())}")
     
     def log_request(
         self,
@@ -85,8 +146,14 @@ class AIMetrics:
             "error": error
         }
         
+        self._ensure_loaded()
+        with self._lock:
+            self._apply(self._daily, self._user_days, metric)
+            self._dirty_days.add(metric["date"])
+            self._dirty_users.add((metric["date"], user_id or 0))
+        
         try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
+            with open(self._raw_path(metric["date"]), 'a', encoding='utf-8') as f:
                 f.write(json.dumps(metric, ensure_ascii=False) + '\n')
             
             logger.debug(
@@ -95,6 +162,124 @@ class AIMetrics:
             )
         except Exception as e:
             logger.error(f"Ошибка записи метрики: {e}")
+        
+        if metric["date"] != self._raw_day:
+            self._raw_day = metric["date"]
+            self._cleanup_raw_logs()
+    
+    def log_cache_lookup(
+        self,
+        user_id: int,
+        hit: bool,
+        model: str = "gpt-4o",
+        saved_prompt_tokens: int = 0,
+        saved_completion_tokens: int = 0,
+    ) -> None:
+        """
+        Залогировать обращение к кешу ответов
+        
+        Args:
+            user_id: ID пользователя
+            hit: Ответ выдан из кеша (запроса к API не было)
+            model: Модель, которой был бы сделан запрос
+            saved_prompt_tokens: Токены запроса, которые стоил бы ответ
+            saved_completion_tokens: Токены ответа, которые стоил бы ответ
+        """
+        saved_tokens = saved_prompt_tokens + saved_completion_tokens if hit else 0
+        saved_cost = self._calculate_cost(model, saved_prompt_tokens, saved_completion_tokens) if hit else 0.0
+        metric = {
+            "type": "cache",
+            "timestamp": datetime.now().isoformat(),
+            "date": date.today().isoformat(),
+            "user_id": user_id,
+            "model": model,
+            "hit": hit,
+            "saved_tokens": saved_tokens,
+            "saved_cost_usd": round(saved_cost, 6),
+        }
+        
+        self._ensure_loaded()
+        with self._lock:
+            self._apply(self._daily, self._user_days, metric)
+            self._dirty_days.add(metric["date"])
+        
+        try:
+            with open(self._raw_path(metric["date"]), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(metric, ensure_ascii=False) + '\n')
+        except Exception as e:
+            logger.error(f"Ошибка записи метрики кеша: {e}")
+    
+    def log_prompt_sections(
+        self,
+        user_id: int,
+        section_tokens: Dict[str, int],
+        budget: int = 0,
+        dropped: Iterable[str] = (),
+        truncated: Iterable[str] = (),
+    ) -> None:
+        """
+        Залогировать состав промпта по секциям
+        
+        Args:
+            user_id: ID пользователя
+            section_tokens: Токены каждой вошедшей в промпт секции (локальный подсчёт)
+            budget: Бюджет токенов промпта (0 — без ограничения)
+            dropped: Секции, выброшенные из-за бюджета
+            truncated: Секции, урезанные из-за бюджета (история, база знаний)
+        """
+        dropped = list(dropped)
+        truncated = list(truncated)
+        metric = {
+            "type": "prompt",
+            "timestamp": datetime.now().isoformat(),
+            "date": date.today().isoformat(),
+            "user_id": user_id,
+            "sections": dict(section_tokens),
+            "total_tokens": sum(section_tokens.values()),
+            "budget": budget,
+            "dropped": dropped,
+            "truncated": truncated,
+        }
+        
+        with self._lock:
+            day = self._prompt_sections.setdefault(metric["date"], {})
+            for name, tokens in section_tokens.items():
+                agg = day.setdefault(name, {"tokens": 0, "count": 0, "dropped": 0, "truncated": 0})
+                agg["tokens"] += tokens
+                agg["count"] += 1
+            for name in dropped:
+                day.setdefault(name, {"tokens": 0, "count": 0, "dropped": 0, "truncated": 0})["dropped"] += 1
+            for name in truncated:
+                day.setdefault(name, {"tokens": 0, "count": 0, "dropped": 0, "truncated": 0})["truncated"] += 1
+            for old_day in [d for d in self._prompt_sections if d < (date.today() - timedelta(days=self.memory_days)).isoformat()]:
+                del self._prompt_sections[old_day]
+        
+        try:
+            with open(self._raw_path(metric["date"]), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(metric, ensure_ascii=False) + '\n')
+        except Exception as e:
+            logger.error(f"Ошибка записи метрики промпта: {e}")
+    
+    def get_prompt_section_stats(self, target_date: Optional[date] = None) -> Dict[str, dict]:
+        """
+        Средние токены по секциям промпта за день (с момента запуска процесса)
+        
+        Returns:
+            {секция: {"avg_tokens", "count", "dropped", "truncated"}}, по убыванию средних токенов
+        """
+        target_date_str = (target_date or date.today()).isoformat()
+        with self._lock:
+            day = {name: dict(agg) for name, agg in self._prompt_sections.get(target_date_str, {}).items()}
+        stats = {
+            name: {
+                "avg_tokens": round(agg["tokens"] / agg["count"], 1) if agg["count"] else 0.0,
+                "count": agg["count"],
+                "dropped": agg["dropped"],
+                "truncated": agg["truncated"],
+            }
+            for name, agg in day.items()
+        }
+        return dict(sorted(stats.items(), key=lambda item: -item[1]["avg_tokens"]))
     
     def _calculate_cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
         """
@@ -133,70 +318,32 @@ class AIMetrics:
             target_date = date.today()
         
         target_date_str = target_date.isoformat()
+        self._ensure_loaded(target_date_str)
         
-        stats = {
+        with self._lock:
+            day = dict(self._daily.get(target_date_str) or _empty_day())
+        
+        avg_response_time = (day["response_time_sum_ms"] / day["response_time_count"]
+                             if day["response_time_count"] else 0.0)
+        cache_hit_rate = day["cache_hits"] / day["cache_lookups"] if day["cache_lookups"] else 0.0
+        return {
             "date": target_date_str,
-            "total_requests": 0,
-            "successful_requests": 0,
-            "failed_requests": 0,
-            "total_tokens": 0,
-            "prompt_tokens": 0,
-            "completion_tokens": 0,
-            "total_cost_usd": 0.0,
-            "avg_response_time_ms": 0.0,
-            "unique_users": set()
+            "total_requests": day["total_requests"],
+            "successful_requests": day["successful_requests"],
+            "failed_requests": day["failed_requests"],
+            "total_tokens": day["total_tokens"],
+            "prompt_tokens": day["prompt_tokens"],
+            "completion_tokens": day["completion_tokens"],
+            "total_cost_usd": round(day["cost_usd"], 4),
+            "avg_response_time_ms": round(avg_response_time, 2),
+            "unique_users": day["unique_users"],
+            "cache_lookups": day["cache_lookups"],
+            "cache_hits": day["cache_hits"],
+            "cache_hit_rate": round(cache_hit_rate, 3),
+            "cache_saved_tokens": day["cache_saved_tokens"],
+            "cache_saved_cost_usd": round(day["cache_saved_cost_usd"], 4),
+            "prompt_sections": self.get_prompt_section_stats(target_date),
         }
-        
-        if not self.log_file.exists():
-            return self._finalize_stats(stats)
-        
-        response_times = []
-        
-        try:
-            with open(self.log_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        metric = json.loads(line)
-                        
-                        if metric.get("date") != target_date_str:
-                            continue
-                        
-                        stats["total_requests"] += 1
-                        
-                        if metric.get("success", True):
-                            stats["successful_requests"] += 1
-                        else:
-                            stats["failed_requests"] += 1
-                        
-                        stats["total_tokens"] += metric.get("total_tokens", 0)
-                        stats["prompt_tokens"] += metric.get("prompt_tokens", 0)
-                        stats["completion_tokens"] += metric.get("completion_tokens", 0)
-                        stats["total_cost_usd"] += metric.get("cost_usd", 0)
-                        stats["unique_users"].add(metric.get("user_id"))
-                        
-                        if "response_time_ms" in metric:
-                            response_times.append(metric["response_time_ms"])
-                    
-                    except json.JSONDecodeError:
-                        continue
-                    except Exception as e:
-                        logger.warning(f"Ошибка обработки строки метрики: {e}")
-                        continue
-        
-        except Exception as e:
-            logger.error(f"Ошибка чтения файла метрик: {e}")
-        
-        if response_times:
-            stats["avg_response_time_ms"] = sum(response_times) / len(response_times)
-        
-        return self._finalize_stats(stats)
-    
-    def _finalize_stats(self, stats: dict) -> dict:
-        """Финализировать статистику (конвертировать set в int)"""
-        stats["unique_users"] = len(stats["unique_users"])
-        stats["total_cost_usd"] = round(stats["total_cost_usd"], 4)
-        stats["avg_response_time_ms"] = round(stats["avg_response_time_ms"], 2)
-        return stats
     
     def get_user_stats(self, user_id: int, days: int = 7) -> dict:
         """
@@ -209,9 +356,8 @@ class AIMetrics:
         Returns:
             dict со статистикой пользователя
         """
-        from datetime import timedelta
-        
         cutoff_date = (date.today() - timedelta(days=days)).isoformat()
+        self._ensure_loaded(cutoff_date)
         
         stats = {
             "user_id": user_id,
@@ -222,30 +368,13 @@ class AIMetrics:
             "avg_tokens_per_request": 0
         }
         
-        if not self.log_file.exists():
-            return stats
-        
-        try:
-            with open(self.log_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        metric = json.loads(line)
-                        
-                        if metric.get("user_id") != user_id:
-                            continue
-                        
-                        if metric.get("date", "") < cutoff_date:
-                            continue
-                        
-                        stats["total_requests"] += 1
-                        stats["total_tokens"] += metric.get("total_tokens", 0)
-                        stats["total_cost_usd"] += metric.get("cost_usd", 0)
-                    
-                    except:
-                        continue
-        
-        except Exception as e:
-            logger.error(f"Ошибка чтения статистики пользователя: {e}")
+        with self._lock:
+            for day, agg in self._user_days.get(user_id, {}).items():
+                if day < cutoff_date:
+                    continue
+                stats["total_requests"] += agg["requests"]
+                stats["total_tokens"] += agg["tokens"]
+                stats["total_cost_usd"] += agg["cost_usd"]
         
         if stats["total_requests"] > 0:
             stats["avg_tokens_per_request"] = stats["total_tokens"] // stats["total_requests"]
@@ -253,7 +382,258 @@ class AIMetrics:
         stats["total_cost_usd"] = round(stats["total_cost_usd"], 4)
         
         return stats
+    
+    # --- Агрегаты ---
+    
+    @staticmethod
+    def _apply(daily: Dict, user_days: Dict, metric: dict) -> None:
+        """Добавить одну запись метрики в агрегаты"""
+        if metric.get("type") == "prompt":
+            # Состав промпта в суточные счётчики не входит
+            return
+        
+        day_key = metric.get("date")
+        user_id = metric.get("user_id") or 0
+        day = daily.setdefault(day_key, _empty_day())
+        
+        if metric.get("type") == "cache":
+            day["cache_lookups"] += 1
+            if metric.get("hit"):
+                day["cache_hits"] += 1
+                day["cache_saved_tokens"] += metric.get("saved_tokens", 0)
+                day["cache_saved_cost_usd"] += metric.get("saved_cost_usd", 0)
+            return
+        
+        day["total_requests"] += 1
+        if metric.get("success", True):
+            day["successful_requests"] += 1
+        else:
+            day["failed_requests"] += 1
+        day["total_tokens"] += metric.get("total_tokens", 0)
+        day["prompt_tokens"] += metric.get("prompt_tokens", 0)
+        day["completion_tokens"] += metric.get("completion_tokens", 0)
+        day["cost_usd"] += metric.get("cost_usd", 0)
+        if "response_time_ms" in metric:
+            day["response_time_sum_ms"] += metric["response_time_ms"]
+            day["response_time_count"] += 1
+        
+        per_user = user_days.setdefault(user_id, {})
+        user_day = per_user.get(day_key)
+        if user_day is None:
+            user_day = per_user[day_key] = _empty_user_day()
+            day["unique_users"] += 1
+        user_day["requests"] += 1
+        user_day["tokens"] += metric.get("total_tokens", 0)
+        user_day["cost_usd"] += metric.get("cost_usd", 0)
+    
+    def _ensure_loaded(self, since: Optional[str] = None) -> None:
+        """
+        Подгрузить агрегаты из хранилища: при первом обращении — за memory_days,
+        дальше — только недостающий более ранний период.
+
+        Если хранилище недоступно, загрузка повторяется при следующем обращении,
+        а до неё агрегаты не сохраняются (flush) — иначе счётчики, начатые с нуля,
+        затёрли бы сохранённые.
+        """
+        loaded_from = self._loaded_from
+        if self._loaded and loaded_from is not None and (since is None or since >= loaded_from):
+            return
+        with self._lock:
+            try:
+                if not self._loaded:
+                    if self.store is None:
+                        self.store = _default_store()
+                    default_from = (date.today() - timedelta(days=self.memory_days)).isoformat()
+                    date_from = min(since, default_from) if since else default_from
+                    self._load_range(date_from, None, merge=True)
+                    self._loaded_from = date_from
+                    self._loaded = True
+                    self._start_flusher()
+                elif since is not None and since < self._loaded_from:
+                    day_before = (date.fromisoformat(self._loaded_from) - timedelta(days=1)).isoformat()
+                    self._load_range(since, day_before)
+                    self._loaded_from = since
+            except Exception as e:
+                logger.error(f"AIMetrics: не удалось загрузить агрегаты, повторю при следующем обращении: {e}")
+    
+    def _load_range(self, date_from: str, date_to: Optional[str], merge: bool = False) -> None:
+        """
+        Добавить в память агрегаты из хранилища. Уже загруженные дни не затираются;
+        с merge=True (первая загрузка) счётчики, накопленные до неё, складываются
+        с сохранёнными.
+        """
+        if self.store is None:
+            return
+        daily_rows, user_rows = self.store.load_ai_metrics_rollup(date_from, date_to)
+        # Пользователи, посчитанные и в памяти, и в хранилище: unique_users не удваиваем
+        overlap: Dict[str, int] = {}
+        for row in user_rows:
+            stored = {
+                "requests": row["requests"] or 0,
+                "tokens": row["tokens"] or 0,
+                "cost_usd": row["cost_usd"] or 0.0,
+            }
+            per_user = self._user_days.setdefault(row["user_id"], {})
+            fresh = per_user.get(row["date"])
+            if fresh is None:
+                per_user[row["date"]] = stored
+            elif merge:
+                for name, value in stored.items():
+                    fresh[name] += value
+                overlap[row["date"]] = overlap.get(row["date"], 0) + 1
+        for row in daily_rows:
+            stored = {name: row.get(name) or 0 for name in _DAILY_COUNTERS}
+            fresh = self._daily.get(row["date"])
+            if fresh is None:
+                self._daily[row["date"]] = stored
+            elif merge:
+                for name, value in stored.items():
+                    fresh[name] += value
+                fresh["unique_users"] -= overlap.get(row["date"], 0)
+        if daily_rows:
+            logger.info(f"AIMetrics: загружены агрегаты за {len(daily_rows)} дн. начиная с {date_from}")
+    
+    def flush(self) -> None:
+        """Сохранить изменённые агрегаты в хранилище (только после загрузки сохранённых)"""
+        if self.store is None or not self._loaded:
+            return
+        with self._lock:
+            days, self._dirty_days = self._dirty_days, set()
+            users, self._dirty_users = self._dirty_users, set()
+            daily_rows = [dict(self._daily[d], date=d) for d in days]
+            user_rows = [dict(self._user_days[uid][d], date=d, user_id=uid) for d, uid in users]
+        if daily_rows or user_rows:
+            try:
+                self.store.save_ai_metrics_rollup(daily_rows, user_rows)
+            except Exception as e:
+                logger.error(f"AIMetrics: ошибка сохранения агрегатов: {e}")
+                with self._lock:
+                    self._dirty_days |= days
+                    self._dirty_users |= users
+        self._prune()
+
+    def _prune(self) -> None:
+        """
+        Выгрузить из памяти сохранённые агрегаты старше memory_days: они остаются
+        в хранилище и при запросе за старый период подгружаются снова.
+        """
+        cutoff = (date.today() - timedelta(days=self.memory_days)).isoformat()
+        with self._lock:
+            if not self._loaded:
+                return
+            dirty_user_days = {d for d, _ in self._dirty_users}
+            for day in [d for d in self._daily if d < cutoff and d not in self._dirty_days]:
+                del self._daily[day]
+            for user_id in list(self._user_days):
+                per_user = self._user_days[user_id]
+                for day in [d for d in per_user if d < cutoff and d not in dirty_user_days]:
+                    del per_user[day]
+                if not per_user:
+                    del self._user_days[user_id]
+            if self._loaded_from < cutoff:
+                self._loaded_from = cutoff
+    
+    def _start_flusher(self) -> None:
+        if self.store is None or self._flush_thread is not None:
+            return
+        
+        def loop():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+        
+        self._flush_thread = threading.Thread(target=loop, name="ai-metrics-flush", daemon=True)
+        self._flush_thread.start()
+        atexit.register(self.flush)
+    
+    # --- Сырые логи ---
+    
+    def _raw_path(self, day: str) -> Path:
+        return self.log_file.with_name(f"{self.log_file.stem}.{day}{self.log_file.suffix}")
+    
+    def _raw_files(self) -> List[Path]:
+        return sorted(self.log_file.parent.glob(f"{self.log_file.stem}.*{self.log_file.suffix}"))
+    
+    def _cleanup_raw_logs(self) -> None:
+        """Удалить сырые логи старше raw_retention_days (агрегаты остаются в БД)"""
+        if not self.raw_retention_days or self.store is None:
+            return
+        cutoff = (date.today() - timedelta(days=self.raw_retention_days)).isoformat()
+        for path in self._raw_files():
+            day = path.stem[len(self.log_file.stem) + 1:]
+            if day < cutoff:
+                try:
+                    path.unlink()
+                    logger.info(f"AIMetrics: удалён старый лог {path.name}")
+                except Exception as e:
+                    logger.warning(f"AIMetrics: не удалось удалить {path}: {e}")
+    
+    def backfill_from_jsonl(self, paths: Optional[Iterable[str]] = None) -> Tuple[int, int]:
+        """
+        Пересчитать агрегаты по сырым JSONL-логам и сохранить их.
+        
+        Дни, встретившиеся в логах, пересчитываются целиком (повторный запуск
+        не удваивает значения). По умолчанию читаются старый ai_metrics.jsonl
+        и все суточные файлы.
+        
+        Returns:
+            (количество записей, количество дней)
+        """
+        if paths is None:
+            files = ([self.log_file] if self.log_file.exists() else []) + self._raw_files()
+        else:
+            files = [Path(p) for p in paths]
+        
+        daily: Dict[str, Dict[str, float]] = {}
+        user_days: Dict[int, Dict[str, Dict[str, float]]] = {}
+        processed = 0
+        for path in files:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            metric = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if not metric.get("date"):
+                            continue
+                        self._apply(daily, user_days, metric)
+                        processed += 1
+            except Exception as e:
+                logger.error(f"AIMetrics: ошибка чтения {path}: {e}")
+        
+        self._ensure_loaded(min(daily) if daily else None)
+        if not self._loaded:
+            raise RuntimeError("AIMetrics: агрегаты не загружены из хранилища, backfill отменён")
+        with self._lock:
+            for day_key, agg in daily.items():
+                self._daily[day_key] = agg
+                self._dirty_days.add(day_key)
+            for per_user in self._user_days.values():
+                for day_key in daily:
+                    per_user.pop(day_key, None)
+            for user_id, per_user in user_days.items():
+                for day_key, agg in per_user.items():
+                    self._user_days.setdefault(user_id, {})[day_key] = agg
+                    self._dirty_users.add((day_key, user_id))
+        self.flush()
+        
+        logger.info(f"AIMetrics: backfill — {processed} записей за {len(daily)} дн. из {len(files)} файлов")
+        return processed, len(daily)
 
 
 # Глобальный экземпляр
 ai_metrics = AIMetrics()
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == "--backfill":
+        logging.basicConfig(level=logging.INFO)
+        from core.database import init_db
+        init_db()
+        records, days = ai_metrics.backfill_from_jsonl(sys.argv[2:] or None)
+        print(f"Перенесено {records} записей за {days} дн.")
+    else:
+        print("Использование: python -m ai.metrics --backfill [файлы...]")
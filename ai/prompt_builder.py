@@ -0,0 +1,390 @@
+# /ai/prompt_builder.py
+"""
+Сборка промпта для OpenAI с бюджетом токенов.
+
+Раньше системный промпт (~полторы тысячи токенов) собирался f-строкой на
+каждый запрос, а контекст дописывался конкатенацией — prompt_tokens рос
+вместе с акциями, памятью о госте и историей, и никто этого не видел.
+
+Теперь:
+- статичные части промпта (роль, правила, инструкции группы/лички)
+  собираются и считаются в токенах один раз на (концепцию, тип чата);
+- неизменные фрагменты контекста (подсказки по типу гостя, эмоции, правила
+  брони в группе) и дорогие в сборке (динамический контент) кешируются;
+- у каждой секции есть приоритет: если промпт не влезает в бюджет,
+  первыми выбрасываются наименее важные секции, старые сообщения истории
+  и нижние строки найденной в базе знаний информации;
+- по каждой секции считаются токены — они уходят в AIMetrics.
+
+Токены считаются локально: tiktoken, если установлен, иначе грубой оценкой
+(с запасом, чтобы бюджет не превышался).
+"""
+
+import logging
+import math
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # токенизатор опционален
+    tiktoken = None
+
+logger = logging.getLogger("evgenich_ai")
+
+# Приоритеты секций: 0 — обязательная, чем больше число, тем раньше выбрасывается
+PRIORITY_REQUIRED = 0
+PRIORITY_KNOWLEDGE = 1
+PRIORITY_BAR = 2
+PRIORITY_PERSONALIZATION = 3
+PRIORITY_DYNAMIC = 4
+PRIORITY_PREFERENCES = 4
+PRIORITY_HISTORY = 5
+PRIORITY_USER_TYPE = 6
+PRIORITY_EMOTION = 7
+
+# Служебные токены chat-формата: на каждое сообщение и на начало ответа
+_TOKENS_PER_MESSAGE = 3
+_TOKENS_REPLY_PRIMING = 3
+
+
+# --- Токенизатор ---
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+_PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is not None or _encoding_failed or tiktoken is None:
+        return _encoding
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                _encoding_failed = True
+                logger.warning(f"Токенизатор tiktoken недоступен, используется оценка: {e}")
+    return _encoding
+
+
+def _estimate_tokens(text: str) -> int:
+    """Оценка без токенизатора: латиница ~4 символа на токен, кириллица ~3, знак — токен"""
+    tokens = 0
+    for piece in _PIECE_RE.findall(text):
+        if piece.isascii():
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += math.ceil(len(piece) / 3)
+    return tokens
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте (результат кешируется — фрагменты повторяются)"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return _estimate_tokens(text)
+
+
+def tokenizer_name() -> str:
+    return "tiktoken/o200k_base" if _get_encoding() is not None else "estimate"
+
+
+# --- Статичные секции ---
+
+CONCEPTS = {
+    "evgenich": {
+        "name": "Евгенич",
+        "description": "Владелец бара. Друг, а не продавец.",
+        "style": "Просто отвечай. БЕЗ 'залетай', 'приходи'.",
+        "examples": ["Невский 53 😊", "Да, бесплатное 🎤", "С 12 до 6 🌙"]
+    },
+    "rvv": {
+        "name": "РВВ",
+        "description": "Фанат 90-х.",
+        "style": "Живые фразы. БЕЗ рекламы.",
+        "examples": ["Музыка 90-х 🎶", "Спой что хочешь 🎤"]
+    }
+}
+
+_GROUP_INSTRUCTIONS = (
+    "# ЭТО ГРУППОВОЙ ЧАТ!\n"
+    "Это общий чат гостей. Отвечай только когда спрашивают.\n\n"
+    "# БРОНИРОВАНИЕ В ГРУППЕ (ОЧЕНЬ ВАЖНО!):\n"
+    "Когда гость хочет забронировать столик:\n"
+    "1. НЕ говори что записал или забронировал - ты НЕ бронируешь!\n"
+    "2. Направь на КНОПКУ которая появится после твоего ответа\n"
+    "3. Объясни: нажмет кнопку → заполнит форму → отдел бронирования свяжется\n"
+    "4. Говори КАЖДЫЙ РАЗ ПО-РАЗНОМУ! Будь креативным!\n\n"
+    "ПРИМЕРЫ ХОРОШИХ ОТВЕТОВ (используй разные варианты!):\n"
+    "- «Жми кнопку ниже, заполни форму - девчонки из отдела бронирования свяжутся! 😊»\n"
+    "- «Для брони нажми кнопку 👇 Заполнишь заявку - наши быстро ответят»\n"
+    "- «Кнопка появится ниже! Заполняй форму, отдел бронирования напишет 👍»\n"
+    "- «Товарищ, жми кнопку что ниже. Форма откроется, заполнишь - девчонки перезвонят 😊»\n"
+    "- «Смотри кнопку под сообщением! Нажми, заполни - отдел бронирования свяжется быстро»\n"
+    "- «Кликай кнопку ниже 👇 Там форма. Заполнишь - наши напишут или позвонят»\n\n"
+    "❌ ЗАПРЕЩЕНО:\n"
+    "- «Окей, записываю!», «Забронировал!», «На 21:30 для пятерых» - ты НЕ бронируешь!\n"
+    "- Одинаковые фразы каждый раз - МЕНЯЙ формулировки!\n"
+    "- [START_BOOKING_FLOW] в группе - это только для личных чатов!\n\n"
+    "✅ ГЛАВНОЕ: Направь на кнопку + объясни что будет дальше. Но каждый раз РАЗНЫМИ словами!\n\n"
+    "# ДРУГИЕ СИТУАЦИИ:\n"
+    "- Уже заполнил форму → «Девчонки видят заявку, скоро свяжутся 👍»\n"
+    "- Волнуется → «Ответят быстро, не переживай 😊»\n"
+    "- Адрес/часы → Ответь коротко\n"
+    "- Просто общаются → НЕ вмешивайся\n\n"
+    "# ПОМНИ:\n"
+    "Ты не бронируешь сам - ты направляешь на кнопку и объясняешь процесс!\n"
+)
+
+_PRIVATE_INSTRUCTIONS = (
+    "# ЭТО ЛИЧНЫЙ ЧАТ\n\n"
+    "# БРОНИРОВАНИЕ:\n"
+    "Если гость хочет забронировать → ответь: `[START_BOOKING_FLOW]`\n\n"
+    "# ДРУГИЕ ВОПРОСЫ:\n"
+    "Отвечай по-дружески, но БЕЗ рекламы.\n"
+    "НЕ добавляй «залетай», «приходи» и прочие призывы!\n\n"
+    "# ПОМНИ:\n"
+    "Ты друг, а не продавец. Просто общайся.\n"
+)
+
+
+@lru_cache(maxsize=None)
+def static_sections(user_concept: str = "evgenich", is_group_chat: bool = False) -> Tuple[str, str]:
+    """
+    Статичные части системного промпта: (начало до «# СЕГОДНЯ», инструкции
+    для типа чата). Собираются один раз на концепцию и тип чата.
+    """
+    concept = CONCEPTS.get(user_concept, CONCEPTS["evgenich"])
+
+    # КОРОТКИЙ промпт - ТОЛЬКО СУТЬ
+    head = (
+        f"Ты {concept['name']} - {concept['description']}\n\n"
+        f"СТИЛЬ: {concept['style']}\n\n"
+        "❌ ЗАПРЕЩЕНО: «Залетай!», «Приходи!», «Ждём!», «У нас...», призывы.\n\n"
+        "✅ ОТВЕЧАЙ: Коротко, по делу, как друг.\n"
+        f"Примеры: {', '.join(concept['examples'])}\n\n"
+        "- Смайлики добавляй, но 1-2 штуки, не больше\n\n"
+        "# ИНФОРМАЦИЯ (используй только если спросят):\n"
+        "📍 Адреса: СПб (Невский 53, Рубинштейна 9), МСК (Пятницкая 30)\n"
+        "📞 Телефон: +7 (812) 237-59-50\n"
+        "🕐 Часы: 12:00 - 6:00\n"
+        "🎤 Караоке бесплатное\n"
+        "🌐 Сайт: spb.evgenich.bar\n"
+        "🎉 Афиша мероприятий: Если спрашивают про мероприятия/концерты - направь на https://spb.evgenich.bar (там актуальная афиша)\n\n"
+        "💳 🚨 КРИТИЧЕСКИ ВАЖНО ПРО ВХОД 🚨\n"
+        "⛔ СТРОГО ЗАПРЕЩЕНО говорить: 'вход свободный', 'вход бесплатный', 'входа нет', 'можно просто зайти'!\n"
+        "⛔ НИКОГДА не пиши что вход бесплатный или свободный!\n"
+        "✅ Если спрашивают про вход/стоимость входа:\n"
+        "   1. Скажи что стоимость зависит от дня/времени/мероприятия\n"
+        "   2. Предложи оставить заявку на spb.evgenich.bar\n"
+        "   3. Или скажи что менеджер в чате ответит\n"
+        "   4. Можно предложить позвонить +7 (812) 237-59-50\n"
+        "Примеры ПРАВИЛЬНЫХ ответов:\n"
+        "   - 'Стоимость зависит от дня и мероприятия. Оставь заявку на spb.evgenich.bar - там подскажут! 😊'\n"
+        "   - 'Цена входа меняется. Лучше уточни на сайте или менеджер в чате ответит 👍'\n"
+        "   - 'Зависит от дня. Позвони +7 (812) 237-59-50 или оставь заявку на сайте'\n\n"
+        "# СЕГОДНЯ\n"
+    )
+    return head, _GROUP_INSTRUCTIONS if is_group_chat else _PRIVATE_INSTRUCTIONS
+
+
+def system_prompt(updates_string: str, user_concept: str = "evgenich", is_group_chat: bool = False) -> str:
+    """Полный системный промпт без бюджета (для обратной совместимости)"""
+    head, tail = static_sections(user_concept, is_group_chat)
+    return f"{head}{updates_string}\n\n{tail}"
+
+
+# --- Неизменные фрагменты контекста ---
+
+USER_TYPE_HINTS = {
+    "new": "Это новый гость, расскажи подробнее о баре, будь особенно гостеприимным.",
+    "regular": "Это постоянный гость, общайся как со старым знакомым.",
+    "vip": "Это VIP-гость, который часто у нас бывает! Особое уважение и внимание.",
+}
+
+EMOTION_HINTS = {
+    "joy": "Гость в хорошем настроении.",
+    "sadness": "Гость грустит. Будь деликатным.",
+    "anger": "Гость недоволен. Будь терпеливым и постарайся помочь.",
+    "surprise": "Гость удивлен. Поддержи его интерес.",
+}
+
+GROUP_BOOKING_HINT = (
+    "🔔 ГРУППОВОЙ ЧАТ!\n\n"
+    "💬 БРОНИРОВАНИЕ: Каждый раз формулируй ПО-НОВОМУ!\n\n"
+    "🎯 КНОПКА: Будет прямо в сообщении. Говори просто: \"жми кнопку\" (БЕЗ уточнений где).\n\n"
+    "📋 УЖЕ ОСТАВИЛ ЗАЯВКУ:\n"
+    "Скажи: Отдел видит, свяжутся через 30-40 мин. (Варьируй слова!)\n\n"
+    "📋 СПРАШИВАЕТ КАК:\n"
+    "Скажи: Жми кнопку → откроется форма → отдел свяжется. (Разные формулировки!)\n\n"
+    "📋 ВОЛНУЕТСЯ:\n"
+    "Успокой. Заявку видят, ответят. Можно позвонить +7(812)237-59-50.\n\n"
+    "📋 НЕ ВИДИТ КНОПКУ:\n"
+    "Скажи: Кнопка в сообщении - '📍 Забронировать стол'.\n\n"
+    "❌ НЕ пиши '[START_BOOKING_FLOW]' в группе!"
+)
+
+_QUESTION_TEMPLATE = "Вопрос: '{question}'\n\nИнформация:\n---\n{knowledge}\n---\n⚠️ Каждый раз ПО-НОВОМУ! Варьируй слова, структуру, стиль."
+_NO_KNOWLEDGE = "Ничего конкретного не нашлось, но я всё равно попробую помочь."
+
+
+@dataclass
+class PromptSection:
+    """Секция контекста системного промпта (после «# СЕГОДНЯ»)"""
+    name: str
+    text: str
+    priority: int = PRIORITY_REQUIRED
+
+
+@dataclass
+class BuiltPrompt:
+    messages: List[Dict[str, str]]
+    section_tokens: Dict[str, int]
+    total_tokens: int
+    budget: int
+    dropped: List[str] = field(default_factory=list)
+    truncated: List[str] = field(default_factory=list)
+
+
+class PromptBuilder:
+    """Сборщик промпта с бюджетом токенов и кешем фрагментов"""
+
+    def __init__(self, token_budget: int = 3000, fragment_cache_size: int = 256):
+        # 0 — без ограничения
+        self.token_budget = token_budget
+        self.fragment_cache_size = fragment_cache_size
+        self._fragments: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"builds": 0, "over_budget": 0, "dropped_sections": 0,
+                       "fragment_hits": 0, "fragment_misses": 0}
+
+    def fragment(self, key: Hashable, factory: Callable[[], str]) -> str:
+        """
+        Фрагмент контекста из кеша. Ключ должен включать всё, от чего зависит
+        текст (например, версию динамического контента и дату).
+        """
+        with self._lock:
+            text = self._fragments.get(key)
+            if text is not None:
+                self._fragments.move_to_end(key)
+                self._stats["fragment_hits"] += 1
+                return text
+        text = factory() or ""
+        with self._lock:
+            self._stats["fragment_misses"] += 1
+            self._fragments[key] = text
+            while len(self._fragments) > self.fragment_cache_size:
+                self._fragments.popitem(last=False)
+        return text
+
+    def build(self, *, user_concept: str, is_group_chat: bool, sections: List[PromptSection],
+              history: List[Dict[str, str]], question: str, knowledge: str,
+              token_budget: Optional[int] = None) -> BuiltPrompt:
+        """
+        Собирает messages для chat.completions в рамках бюджета токенов.
+
+        Обязательны статичный промпт, секции с приоритетом 0 и сам вопрос.
+        Остальное добавляется по возрастанию приоритета, пока влезает:
+        секции — целиком, история — от новых сообщений к старым,
+        база знаний — по строкам в порядке релевантности.
+        """
+        budget = self.token_budget if token_budget is None else token_budget
+        head, tail = static_sections(user_concept, is_group_chat)
+        sections = [s for s in sections if s.text]
+        history = [m for m in history if m.get("content")]
+        knowledge_lines = [] if knowledge == _NO_KNOWLEDGE else [line for line in knowledge.split("\n") if line.strip()]
+
+        section_tokens: Dict[str, int] = {
+            "system_static": count_tokens(head) + count_tokens(tail),
+            "question": count_tokens(_QUESTION_TEMPLATE.format(question=question, knowledge="")),
+        }
+        overhead = _TOKENS_REPLY_PRIMING + _TOKENS_PER_MESSAGE * 2
+        used = section_tokens["system_static"] + section_tokens["question"] + overhead
+
+        # Кандидаты: (приоритет, порядок, вид, индекс, токены)
+        candidates = []
+        for i, section in enumerate(sections):
+            # +1 — перевод строки между секциями
+            tokens = count_tokens(section.text) + 1
+            if section.priority <= PRIORITY_REQUIRED:
+                used += tokens
+                section_tokens[section.name] = tokens
+            else:
+                candidates.append((section.priority, i, "section", i, tokens))
+        for rank, line in enumerate(knowledge_lines):
+            candidates.append((PRIORITY_KNOWLEDGE, rank, "knowledge", rank, count_tokens(line) + 1))
+        for age, message in enumerate(reversed(history)):
+            tokens = count_tokens(message["content"]) + _TOKENS_PER_MESSAGE
+            candidates.append((PRIORITY_HISTORY, age, "history", len(history) - 1 - age, tokens))
+        candidates.sort(key=lambda c: (c[0], c[1]))
+
+        kept_sections = {i for i, s in enumerate(sections) if s.priority <= PRIORITY_REQUIRED}
+        kept_knowledge = 0
+        kept_history = 0
+        stopped = set()
+        dropped: List[str] = []
+        for priority, _, kind, index, tokens in candidates:
+            # История и база знаний берутся только непрерывным префиксом
+            if kind in stopped:
+                continue
+            if budget and used + tokens > budget:
+                if kind == "section":
+                    dropped.append(sections[index].name)
+                else:
+                    stopped.add(kind)
+                continue
+            used += tokens
+            if kind == "section":
+                kept_sections.add(index)
+                section_tokens[sections[index].name] = tokens
+            elif kind == "knowledge":
+                kept_knowledge += 1
+                section_tokens["knowledge"] = section_tokens.get("knowledge", 0) + tokens
+            else:
+                kept_history += 1
+                section_tokens["history"] = section_tokens.get("history", 0) + tokens
+
+        truncated = []
+        if kept_knowledge < len(knowledge_lines):
+            truncated.append("knowledge")
+        if kept_history < len(history):
+            truncated.append("history")
+
+        context = "\n\n".join(s.text for i, s in enumerate(sections) if i in kept_sections)
+        messages = [{"role": "system", "content": f"{head}{context}\n\n{tail}"}]
+        if kept_history:
+            messages.extend(history[-kept_history:])
+        knowledge_text = "\n".join(knowledge_lines[:kept_knowledge]) or _NO_KNOWLEDGE
+        messages.append({"role": "user", "content": _QUESTION_TEMPLATE.format(question=question, knowledge=knowledge_text)})
+
+        with self._lock:
+            self._stats["builds"] += 1
+            self._stats["dropped_sections"] += len(dropped)
+            if budget and used > budget:
+                self._stats["over_budget"] += 1
+        if budget and used > budget:
+            logger.warning(f"Промпт превышает бюджет даже без необязательных секций: {used} > {budget} токенов")
+        elif dropped or truncated:
+            logger.info(f"Промпт урезан до бюджета {budget}: выброшены {dropped}, укорочены {truncated}")
+
+        return BuiltPrompt(messages=messages, section_tokens=section_tokens, total_tokens=used,
+                           budget=budget, dropped=dropped, truncated=truncated)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["fragments"] = len(self._fragments)
+        stats["token_budget"] = self.token_budget
+        stats["tokenizer"] = tokenizer_name()
+        return stats
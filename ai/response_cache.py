@@ -0,0 +1,144 @@
+# /ai/response_cache.py
+"""
+Кеш ответов AI на типовые вопросы (адрес, часы работы, караоке, бронь...).
+
+Такие вопросы почти одинаковы, но каждый стоил полного запроса к gpt-4o.
+Если SmartIntentDetector уверенно распознал намерение, а сообщение короткое,
+ответ берётся из кеша по ключу:
+
+    (намерение, нормализованные сущности, бар и его текущее состояние,
+     концепция, тип чата, эмоция, тип гостя, версия контента)
+
+На каждый ключ копится пул из pool_size разных ответов модели, и они
+выдаются по кругу — стиль «каждый раз по-новому» сохраняется. Изредка
+(refresh_probability) даже при полном пуле идём в модель и заменяем самый
+старый вариант, чтобы пул не застаивался.
+
+Версия контента (ai.knowledge.content_version) меняется при изменении базы
+знаний, динамического контента (акции, мероприятия) и со сменой дня —
+старые ключи просто перестают совпадать и вытесняются по LRU.
+
+Для типового вопроса ai.assistant строит отдельный общий промпт — без
+истории разговора, персонализации и предпочтений гостя — и к ключу
+добавляет отпечаток его системной части. В пул попадают и из него
+выдаются только ответы на такой промпт, поэтому их можно показывать
+любому гостю.
+"""
+
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# Намерения с «фактическими» ответами, одинаковыми для всех гостей
+CACHEABLE_INTENTS = frozenset({"address", "work_hours", "karaoke", "booking", "events", "price_inquiry"})
+
+_CLOCK_RE = re.compile(r"\b\d{1,2}:\d{2}\b")
+
+
+def normalize_bar_state(bar_context: str) -> str:
+    """Состояние бара без текущего времени: день, открыт/закрыт, загруженность"""
+    return " ".join(_CLOCK_RE.sub("", bar_context or "").split())
+
+
+class ResponseCache:
+    """Пулы вариантов ответа по ключу намерения"""
+
+    def __init__(self, pool_size: int = 4, min_confidence: float = 0.9, max_words: int = 8,
+                 ttl: float = 6 * 3600, max_keys: int = 500, refresh_probability: float = 0.1,
+                 intents=CACHEABLE_INTENTS):
+        self.pool_size = pool_size
+        self.min_confidence = min_confidence
+        self.max_words = max_words
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.refresh_probability = refresh_probability
+        self.intents = frozenset(intents)
+
+        self._pools: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._stats = {"lookups": 0, "hits": 0, "fills": 0, "refreshes": 0, "saved_tokens": 0}
+
+    def make_key(self, intent, query: str, *, concept: str, is_group_chat: bool, bar_context: str,
+                 emotion: Optional[dict], user_type: str, content_version: tuple) -> Optional[Tuple]:
+        """
+        Ключ кеша или None, если вопрос не типовой (намерение не из списка,
+        низкая уверенность, длинное сообщение с подробностями).
+        """
+        if intent.name not in self.intents or intent.confidence < self.min_confidence:
+            return None
+        if len(query.split()) > self.max_words:
+            return None
+        entities = tuple(sorted((name, str(value).lower()) for name, value in intent.entities.items()))
+        emotion_name = (emotion or {}).get("emotion", "neutral")
+        return (intent.name, entities, normalize_bar_state(bar_context), concept,
+                "group" if is_group_chat else "private", emotion_name, user_type, content_version)
+
+    def get(self, key: Optional[Tuple]) -> Optional[Tuple[str, int, int]]:
+        """
+        Вариант ответа из пула: (текст, prompt_tokens, completion_tokens) —
+        сколько стоил этот ответ, когда его генерировала модель.
+        None — пул ещё не заполнен или пора его освежить: нужен запрос к модели.
+        """
+        if key is None:
+            return None
+        with self._lock:
+            self._stats["lookups"] += 1
+            pool = self._pools.get(key)
+            if pool is None:
+                return None
+            if time.monotonic() - pool["created"] > self.ttl:
+                del self._pools[key]
+                return None
+            self._pools.move_to_end(key)
+            variants = pool["variants"]
+            if len(variants) < self.pool_size:
+                return None
+            if self._random.random() < self.refresh_probability:
+                self._stats["refreshes"] += 1
+                return None
+            variant = variants[pool["next"] % len(variants)]
+            pool["next"] += 1
+            self._stats["hits"] += 1
+            self._stats["saved_tokens"] += variant[1] + variant[2]
+            return variant
+
+    def put(self, key: Optional[Tuple], text: str, prompt_tokens: int, completion_tokens: int):
+        """Добавляет ответ модели в пул ключа (при полном пуле — вместо самого старого)"""
+        if key is None or not text:
+            return
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = {"variants": [], "next": 0, "oldest": 0, "created": time.monotonic()}
+                while len(self._pools) > self.max_keys:
+                    self._pools.popitem(last=False)
+            variants: List[Tuple[str, int, int]] = pool["variants"]
+            if any(existing[0] == text for existing in variants):
+                return
+            variant = (text, prompt_tokens, completion_tokens)
+            if len(variants) < self.pool_size:
+                variants.append(variant)
+            else:
+                variants[pool["oldest"] % len(variants)] = variant
+                pool["oldest"] += 1
+            self._stats["fills"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._pools.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["keys"] = len(self._pools)
+            stats["full_pools"] = sum(1 for pool in self._pools.values() if len(pool["variants"]) >= self.pool_size)
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 3) if stats["lookups"] else 0.0
+        return stats
+
+
+# Глобальный экземпляр
+response_cache = ResponseCache()
@@ -10,6 +10,8 @@ import logging
 from typing import Tuple, Dict, List, Optional, NamedTuple
 from difflib import SequenceMatcher
 
+from ai.intent_matcher import CompiledIntentMatcher
+
 logger = logging.getLogger("evgenich_ai")
 
 
@@ -140,13 +142,26 @@ class SmartIntentDetector:
         
         # Порог для fuzzy matching (0.0 - 1.0)
         self.fuzzy_threshold = 0.75
+        
+        # Паттерны компилируются один раз (после изменения intent_patterns — вызвать compile())
+        self._matcher = None
+        self.compile()
+    
+    def compile(self):
+        """Пересобрать скомпилированный матчер по текущим intent_patterns"""
+        self._matcher = CompiledIntentMatcher(self.intent_patterns, self.fuzzy_threshold)
     
     def _fuzzy_match(self, word: str, pattern: str) -> float:
         """Проверить похожесть слов (для опечаток)"""
         return SequenceMatcher(None, word.lower(), pattern.lower()).ratio()
     
     def _check_fuzzy_keywords(self, text: str, keywords: List[str]) -> Tuple[bool, float]:
-        """Проверить ключевые слова с учётом опечаток"""
+        """
+        Проверить ключевые слова с учётом опечаток.
+        
+        Эталонная (медленная) реализация: detect() использует CompiledIntentMatcher,
+        а этот метод нужен для сверки в tests/test_intent_matcher.py.
+        """
         text_lower = text.lower()
         text_words = text_lower.split()
         
@@ -193,31 +208,12 @@ class SmartIntentDetector:
         if not message_lower:
             return DetectedIntent("unknown", 0.0, {}, 99)
         
-        results = []
+        if self._matcher.fuzzy_threshold != self.fuzzy_threshold:
+            self.compile()
         
-        for intent_name, config in self.intent_patterns.items():
-            keywords = config["keywords"]
-            phrases = config.get("phrases", [])
-            priority = config["priority"]
-            
-            # Проверяем фразы (точное совпадение подстроки)
-            phrase_match = any(phrase in message_lower for phrase in phrases)
-            
-            # Проверяем ключевые слова с fuzzy matching
-            keyword_match, keyword_score = self._check_fuzzy_keywords(message_lower, keywords)
-            
-            if phrase_match:
-                confidence = 0.95
-            elif keyword_match:
-                confidence = max(0.7, keyword_score)
-            else:
-                continue
-            
-            results.append({
-                "intent": intent_name,
-                "confidence": confidence,
-                "priority": priority,
-            })
+        # Фразы (точное совпадение подстроки) и ключевые слова с fuzzy matching
+        # по всем намерениям сразу — см. ai/intent_matcher.py
+        results = self._matcher.match(message_lower)
         
         if not results:
             return DetectedIntent("general", 0.5, {}, 99)
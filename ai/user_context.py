@@ -0,0 +1,160 @@
+# /ai/user_context.py
+"""
+Снимок контекста пользователя для AI-хендлера.
+
+Раньше на одно личное сообщение handle_text_query делал отдельные запросы
+get_conversation_history, get_user_concept и find_user_by_id (в режиме
+PostgreSQL — два одинаковых запроса к users), каждый со своим соединением.
+Теперь всё это читается одним запросом (database.get_user_ai_context) и
+держится в памяти:
+
+- снимки лежат в LRU на max_users пользователей и живут ttl секунд;
+- новые реплики диалога (log_turn) пишутся в БД и сразу дописываются
+  в историю снимка, поэтому следующий вопрос того же гостя не читает БД;
+- любая запись в строку пользователя (статус, концепция, имя, контакт...)
+  сбрасывает его снимок через database.add_user_change_listener.
+
+Время обращений к БД на сообщение — до и после: python -m utils.micro_benchmarks user-context
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from ai.user_preferences import format_preferences_text
+
+logger = logging.getLogger("evgenich_ai")
+
+
+@dataclass
+class UserContext:
+    """Всё, из чего собирается промпт для одного пользователя"""
+    user_id: int
+    user: Optional[Dict[str, Any]]
+    concept: str
+    history: List[Dict[str, str]]
+    preferences: Dict[str, Any] = field(default_factory=dict)
+    loaded_at: float = 0.0
+
+    @property
+    def preferences_text(self) -> str:
+        return format_preferences_text(self.preferences)
+
+
+class UserContextService:
+    """LRU + TTL кеш снимков контекста поверх core.database"""
+
+    def __init__(self, store=None, max_users: int = 2000, ttl: float = 300.0, history_limit: int = 12):
+        self.store = store
+        self.max_users = max_users
+        self.ttl = ttl
+        self.history_limit = history_limit
+
+        self._snapshots: "OrderedDict[int, UserContext]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._subscribed = False
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "invalidations": 0,
+                       "db_reads": 0, "db_writes": 0, "db_time": 0.0}
+
+    def _get_store(self):
+        if self.store is None:
+            from core import database
+            self.store = database
+        if not self._subscribed:
+            self._subscribed = True
+            self.store.add_user_change_listener(self.invalidate)
+        return self.store
+
+    def get(self, user_id: int) -> UserContext:
+        """Снимок контекста пользователя (из кеша или одним запросом к БД)"""
+        now = time.monotonic()
+        with self._lock:
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is not None:
+                if now - snapshot.loaded_at < self.ttl:
+                    self._snapshots.move_to_end(user_id)
+                    self._stats["hits"] += 1
+                    return self._copy(snapshot)
+                del self._snapshots[user_id]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+
+        store = self._get_store()
+        started = time.perf_counter()
+        data = store.get_user_ai_context(user_id, history_limit=self.history_limit)
+        elapsed = time.perf_counter() - started
+
+        snapshot = UserContext(
+            user_id=user_id,
+            user=data["user"],
+            concept=data["concept"],
+            history=data["history"],
+            loaded_at=now,
+        )
+        with self._lock:
+            self._stats["db_reads"] += 1
+            self._stats["db_time"] += elapsed
+            self._snapshots[user_id] = snapshot
+            self._snapshots.move_to_end(user_id)
+            while len(self._snapshots) > self.max_users:
+                self._snapshots.popitem(last=False)
+            return self._copy(snapshot)
+
+    def log_turn(self, user_id: int, role: str, text: str):
+        """Записывает реплику в историю диалога (БД + снимок в кеше)"""
+        store = self._get_store()
+        started = time.perf_counter()
+        store.log_conversation_turn(user_id, role, text)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats["db_writes"] += 1
+            self._stats["db_time"] += elapsed
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is not None:
+                snapshot.history.append({"role": role, "content": text})
+                del snapshot.history[:-self.history_limit]
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            if self._snapshots.pop(user_id, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    @staticmethod
+    def _copy(snapshot: UserContext) -> UserContext:
+        # Снимок в кеше общий для потоков — наружу отдаём копию списков
+        return UserContext(
+            user_id=snapshot.user_id,
+            user=dict(snapshot.user) if snapshot.user else None,
+            concept=snapshot.concept,
+            history=list(snapshot.history),
+            preferences=dict(snapshot.preferences),
+            loaded_at=snapshot.loaded_at,
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            db_calls = stats["db_reads"] + stats["db_writes"]
+            return {
+                "cached_users": len(self._snapshots),
+                "hits": stats["hits"],
+                "misses": stats["misses"],
+                "expired": stats["expired"],
+                "invalidations": stats["invalidations"],
+                "hit_rate": round(stats["hits"] / lookups, 3) if lookups else 0.0,
+                "db_reads": stats["db_reads"],
+                "db_writes": stats["db_writes"],
+                "avg_db_ms": round(stats["db_time"] / db_calls * 1000, 3) if db_calls else 0.0,
+            }
+
+
+# Глобальный экземпляр
+user_context = UserContextService()
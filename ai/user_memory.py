@@ -5,9 +5,14 @@
 AI System v3.0
 """
 
+import atexit
 import json
 import logging
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
 from pathlib import Path
@@ -15,51 +20,194 @@ from pathlib import Path
 logger = logging.getLogger("evgenich_ai")
 
 
+class _UnavailableProfile(dict):
+    """Временный профиль, когда сохранённый не удалось прочитать: не кешируется и не сохраняется."""
+
+
+def _default_profile() -> Dict[str, Any]:
+    return {
+        "first_seen": datetime.now().isoformat(),
+        "name": None,
+        "preferred_bar": None,  # "nevsky" или "rubinshteina"
+        "favorite_drinks": [],
+        "bookings_count": 0,
+        "last_visit": None,
+        "notes": [],  # Заметки о госте
+        "conversation_style": "formal",  # formal/casual
+    }
+
+
 class UserMemory:
-    """Долгосрочная память о пользователях"""
+    """
+    Долгосрочная память о пользователях
+    
+    Профили хранятся в таблице ai_user_memory (SQLite или PostgreSQL через
+    core.database) и подгружаются по требованию; в памяти держится не больше
+    max_cached профилей (LRU). Изменения помечают профиль «грязным», а фоновый
+    поток сохраняет накопившиеся профили одной пачкой раз в flush_interval
+    секунд. Старый data/user_memory.json переносится в таблицу при первом
+    обращении. Если БД недоступна — работаем по-старому, с JSON-файлом.
+    """
     
-    def __init__(self, storage_file: str = "data/user_memory.json"):
+    def __init__(self, storage_file: str = "data/user_memory.json", store=None,
+                 max_cached: int = 5000, flush_interval: float = 5.0):
         self.storage_file = Path(storage_file)
         self.storage_file.parent.mkdir(exist_ok=True)
-        self.memory: Dict[int, Dict[str, Any]] = {}
-        self._load()
+        self.store = store
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        
+        self.memory: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+        self._ready = False
+    
+    def _ensure_ready(self):
+        """Подключить хранилище и перенести старый JSON (один раз, при первом обращении)"""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            self._ready = True
+            if self.store is None:
+                try:
+                    from core import database
+                    self.store = database
+                except Exception as e:
+                    logger.warning(f"UserMemory: БД недоступна, память хранится в {self.storage_file} ({e})")
+            if self.store is None:
+                self._load()
+            else:
+                self._migrate_json()
+            self._flush_thread = threading.Thread(target=self._flush_loop, name="user-memory-flush", daemon=True)
+            self._flush_thread.start()
+            atexit.register(self.flush)
     
     def _load(self):
-        """Загрузить память из файла"""
+        """Загрузить память из файла (режим без БД)"""
         if self.storage_file.exists():
             try:
                 with open(self.storage_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
                     # Конвертируем ключи обратно в int
-                    self.memory = {int(k): v for k, v in data.items()}
+                    self.memory = OrderedDict((int(k), v) for k, v in data.items())
                 logger.info(f"📚 Загружена память о {len(self.memory)} пользователях")
             except Exception as e:
                 logger.error(f"Ошибка загрузки памяти: {e}")
-                self.memory = {}
+                self.memory = OrderedDict()
+    
+    def _migrate_json(self):
+        """Перенести data/user_memory.json в таблицу и переименовать файл"""
+        if not self.storage_file.exists():
+            return
+        try:
+            with open(self.storage_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            profiles = {int(k): v for k, v in data.items()}
+            batch_size = 500
+            items = list(profiles.items())
+            for i in range(0, len(items), batch_size):
+                self.store.save_user_memory_profiles(dict(items[i:i + batch_size]))
+            os.replace(self.storage_file, str(self.storage_file) + ".migrated")
+            logger.info(f"📚 Память о {len(profiles)} пользователях перенесена из {self.storage_file} в БД")
+        except Exception as e:
+            logger.error(f"Ошибка переноса памяти из JSON: {e}")
     
-    def _save(self):
-        """Сохранить память в файл"""
+    def _save(self, user_id: int, profile: Optional[Dict[str, Any]] = None):
+        """Пометить профиль изменённым (запись — фоновой пачкой)"""
+        if isinstance(profile, _UnavailableProfile):
+            # Настоящий профиль в БД не прочитался — не затираем его значениями по умолчанию
+            return
+        with self._lock:
+            if profile is not None and user_id not in self.memory:
+                # Профиль успели вытеснить из кеша, пока его меняли
+                self.memory[user_id] = profile
+            self._dirty.add(user_id)
+        self._wakeup.set()
+    
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait()
+            # Debounce: собираем изменения за flush_interval в одну запись
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"UserMemory: ошибка фонового сохранения: {e}")
+    
+    def flush(self):
+        """Сохранить все изменённые профили"""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            if self.store is None:
+                snapshot = json.dumps(self.memory, ensure_ascii=False)
+            else:
+                batch = {uid: json.loads(json.dumps(self.memory[uid])) for uid in dirty if uid in self.memory}
         try:
-            with open(self.storage_file, 'w', encoding='utf-8') as f:
-                json.dump(self.memory, f, ensure_ascii=False, indent=2)
+            if self.store is None:
+                tmp_path = str(self.storage_file) + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.storage_file)
+            else:
+                self.store.save_user_memory_profiles(batch)
+            logger.debug(f"UserMemory: сохранено {len(dirty)} профилей")
         except Exception as e:
             logger.error(f"Ошибка сохранения памяти: {e}")
+            with self._lock:
+                self._dirty |= dirty
+            return
+        with self._lock:
+            self._evict()
+    
+    def _evict(self):
+        """Выгрузить из кеша самые давние сохранённые профили сверх max_cached"""
+        if self.store is None:
+            return
+        overflow = len(self.memory) - self.max_cached
+        if overflow <= 0:
+            return
+        for uid in list(self.memory):
+            if overflow <= 0:
+                break
+            if uid in self._dirty:
+                continue
+            del self.memory[uid]
+            overflow -= 1
     
     def get_user_profile(self, user_id: int) -> Dict[str, Any]:
         """Получить профиль пользователя"""
-        if user_id not in self.memory:
-            self.memory[user_id] = {
-                "first_seen": datetime.now().isoformat(),
-                "name": None,
-                "preferred_bar": None,  # "nevsky" или "rubinshteina"
-                "favorite_drinks": [],
-                "bookings_count": 0,
-                "last_visit": None,
-                "notes": [],  # Заметки о госте
-                "conversation_style": "formal",  # formal/casual
-            }
-            self._save()
-        return self.memory[user_id]
+        self._ensure_ready()
+        with self._lock:
+            profile = self.memory.get(user_id)
+            if profile is not None:
+                self.memory.move_to_end(user_id)
+                return profile
+        
+        try:
+            stored = self.store.load_user_memory_profile(user_id) if self.store is not None else None
+        except Exception as e:
+            logger.error(f"UserMemory: профиль {user_id} недоступен, работаем без него: {e}")
+            return _UnavailableProfile(_default_profile())
+        with self._lock:
+            # Пока читали из БД, профиль мог появиться из другого потока
+            if user_id in self.memory:
+                self.memory.move_to_end(user_id)
+                return self.memory[user_id]
+            if stored is not None:
+                self.memory[user_id] = stored
+            else:
+                self.memory[user_id] = _default_profile()
+                self._save(user_id)
+            if len(self.memory) > self.max_cached:
+                self._evict()
+            return self.memory[user_id]
     
     def remember_name(self, user_id: int, name: str):
         """Запомнить имя пользователя"""
@@ -71,7 +219,7 @@ class UserMemory:
             bad_words = ["хочу", "буду", "могу", "там", "тут", "это", "как", "что", "где"]
             if clean_name.lower() not in bad_words and len(clean_name) > 2:
                 profile["name"] = clean_name
-                self._save()
+                self._save(user_id, profile)
                 logger.info(f"📝 Запомнил имя для {user_id}: {clean_name}")
     
     def remember_preferred_bar(self, user_id: int, bar: str):
@@ -81,11 +229,11 @@ class UserMemory:
         
         if any(word in bar_lower for word in ["невский", "nevsky", "невского", "53", "маяковская"]):
             profile["preferred_bar"] = "nevsky"
-            self._save()
+            self._save(user_id, profile)
             logger.info(f"📍 Запомнил бар для {user_id}: Невский")
         elif any(word in bar_lower for word in ["рубинштейна", "rubinshteina", "рубина", "9"]):
             profile["preferred_bar"] = "rubinshteina"
-            self._save()
+            self._save(user_id, profile)
             logger.info(f"📍 Запомнил бар для {user_id}: Рубинштейна")
     
     def remember_drink(self, user_id: int, drink: str):
@@ -97,7 +245,7 @@ class UserMemory:
             profile["favorite_drinks"].append(drink_clean)
             # Храним только последние 5
             profile["favorite_drinks"] = profile["favorite_drinks"][-5:]
-            self._save()
+            self._save(user_id, profile)
             logger.info(f"🥃 Запомнил напиток для {user_id}: {drink_clean}")
     
     def increment_bookings(self, user_id: int):
@@ -105,7 +253,7 @@ class UserMemory:
         profile = self.get_user_profile(user_id)
         profile["bookings_count"] += 1
         profile["last_visit"] = datetime.now().isoformat()
-        self._save()
+        self._save(user_id, profile)
         logger.info(f"📊 Бронирований у {user_id}: {profile['bookings_count']}")
     
     def add_note(self, user_id: int, note: str):
@@ -117,7 +265,7 @@ class UserMemory:
         })
         # Храним последние 10 заметок
         profile["notes"] = profile["notes"][-10:]
-        self._save()
+        self._save(user_id, profile)
     
     def get_personalization_context(self, user_id: int) -> str:
         """Получить контекст для персонализации ответов AI"""
@@ -224,11 +372,19 @@ class UserMemory:
     
     def get_stats(self) -> Dict[str, Any]:
         """Получить статистику по памяти"""
-        total = len(self.memory)
-        with_names = sum(1 for u in self.memory.values() if u.get("name"))
-        with_bars = sum(1 for u in self.memory.values() if u.get("preferred_bar"))
-        with_drinks = sum(1 for u in self.memory.values() if u.get("favorite_drinks"))
-        vip = sum(1 for u in self.memory.values() if u.get("bookings_count", 0) >= 10)
+        self._ensure_ready()
+        if self.store is not None:
+            # Сначала досохраняем изменения, чтобы агрегат в БД был актуальным
+            self.flush()
+            return self.store.get_user_memory_stats()
+        
+        with self._lock:
+            profiles = list(self.memory.values())
+        total = len(profiles)
+        with_names = sum(1 for u in profiles if u.get("name"))
+        with_bars = sum(1 for u in profiles if u.get("preferred_bar"))
+        with_drinks = sum(1 for u in profiles if u.get("favorite_drinks"))
+        vip = sum(1 for u in profiles if u.get("bookings_count", 0) >= 10)
         
         return {
             "total_users": total,
@@ -2,41 +2,82 @@
 """
 Система памяти о предпочтениях пользователя
 """
+import copy
 import json
 import logging
+import os
+import threading
 from datetime import datetime
 
 logger = logging.getLogger("user_preferences")
 
 PREFERENCES_FILE = "user_preferences.json"
 
-def load_preferences() -> dict:
-    """Загружает предпочтения пользователей из файла"""
+# Файл перечитывается только если изменился на диске (по mtime),
+# а не на каждое сообщение пользователя
+_cache = {"mtime": None, "data": {}}
+_lock = threading.RLock()
+
+
+def _file_mtime():
+    try:
+        return os.stat(PREFERENCES_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _load_cached() -> dict:
+    """Общий закешированный словарь предпочтений (перечитывается, если файл изменился). Только под _lock."""
+    mtime = _file_mtime()
+    if mtime is not None and mtime == _cache["mtime"]:
+        return _cache["data"]
     try:
         with open(PREFERENCES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            data = json.load(f)
     except FileNotFoundError:
-        return {}
+        data = {}
     except Exception as e:
         logger.error(f"Ошибка загрузки предпочтений: {e}")
         return {}
+    _cache["mtime"] = mtime
+    _cache["data"] = data
+    return data
+
+
+def load_preferences() -> dict:
+    """Загружает предпочтения пользователей (из памяти, если файл не менялся); возвращает копию"""
+    with _lock:
+        return copy.deepcopy(_load_cached())
 
 
 def save_preferences(preferences: dict):
     """Сохраняет предпочтения пользователей в файл"""
-    try:
-        with open(PREFERENCES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(preferences, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения предпочтений: {e}")
+    with _lock:
+        try:
+            with open(PREFERENCES_FILE, 'w', encoding='utf-8') as f:
+                json.dump(preferences, f, ensure_ascii=False, indent=2)
+            _cache["mtime"] = _file_mtime()
+            _cache["data"] = preferences
+        except Exception as e:
+            logger.error(f"Ошибка сохранения предпочтений: {e}")
+
+
+def extract_preferences_from_text(user_id: int, text: str) -> dict:
+    """
+    Извлекает предпочтения из текста пользователя. Возвращает копию
+    предпочтений гостя — общий кеш вызывающий изменить не может
+    """
+    with _lock:
+        return copy.deepcopy(_extract_preferences(user_id, text))
 
 
-def extract_preferences_from_text(user_id: int, text: str):
+def _extract_preferences(user_id: int, text: str) -> dict:
     """
-    Извлекает предпочтения из текста пользователя
+    Извлекает предпочтения из текста пользователя (вызывается под _lock:
+    изменяет общий закешированный словарь)
     """
     text_lower = text.lower()
-    preferences = load_preferences()
+    preferences = _load_cached()
     
     if str(user_id) not in preferences:
         preferences[str(user_id)] = {
@@ -108,21 +149,27 @@ def extract_preferences_from_text(user_id: int, text: str):
 
 
 def get_user_preferences(user_id: int) -> dict:
-    """Получает предпочтения пользователя"""
-    preferences = load_preferences()
-    return preferences.get(str(user_id), {
+    """Получает предпочтения пользователя (копию)"""
+    with _lock:
+        prefs = _load_cached().get(str(user_id))
+        if prefs is not None:
+            return copy.deepcopy(prefs)
+    return {
         "favorite_drinks": [],
         "favorite_food": [],
         "interests": [],
         "dislikes": [],
         "special_dates": []
-    })
+    }
 
 
 def get_preferences_text(user_id: int) -> str:
     """Формирует текстовое описание предпочтений для AI"""
-    prefs = get_user_preferences(user_id)
-    
+    return format_preferences_text(get_user_preferences(user_id))
+
+
+def format_preferences_text(prefs: dict) -> str:
+    """Текст предпочтений для AI по уже загруженному словарю предпочтений"""
     if not any([prefs.get("favorite_drinks"), prefs.get("favorite_food"), prefs.get("dislikes")]):
         return ""
     
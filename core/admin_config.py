@@ -1,110 +1,144 @@
 """
 Модуль для чтения конфигурации из админ-панели
 Бот читает настройки из web/admin_config/
+
+Файлы держатся в памяти (core/config_store.py) и перечитываются, только
+когда веб-панель их меняет; возвращаемые значения — общие снимки только
+для чтения.
 """
-import json
 import os
-import logging
+import threading
+
+from .config_store import JsonFileStore
 
 # Путь к конфигам админ-панели
 CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'web', 'admin_config')
 
+# Значения по умолчанию, пока файла нет
+DEFAULT_TEXTS = {
+    'greeting_start': 'Привет! 🍷',
+    'main_menu': 'Выберите действие:',
+    'booking_start': 'Отлично! Давайте забронируем стол.',
+    'ask_name': 'Как вас зовут?',
+    'ask_phone': 'Укажите ваш телефон:',
+    'ask_date': 'На какую дату бронируем?',
+    'ask_time': 'На какое время?',
+    'ask_guests': 'Сколько будет гостей?',
+    'ask_bar': 'Выберите бар:',
+    'booking_success': '✅ Бронирование успешно создано!',
+    'booking_cancelled': 'Бронирование отменено.',
+    'unknown_command': 'Неизвестная команда',
+    'no_access': 'У вас нет доступа к этой функции',
+    'system_error': 'Произошла ошибка. Попробуйте позже.'
+}
+
+DEFAULT_BARS = [
+    {'name': 'СПб, Невский 53', 'code': 'ЕВГ_СПБ', 'emoji': '🍷', 'callback_id': 'bar_nevsky', 'tag': '', 'phone': '', 'menu_url': ''},
+    {'name': 'СПб, Рубинштейна 9', 'code': 'ЕВГ_СПБ_РУБ', 'emoji': '💎', 'callback_id': 'bar_rubinstein', 'tag': '', 'phone': '', 'menu_url': ''},
+    {'name': 'МСК, Пятницкая 30', 'code': 'ЕВГ_МСК_ПЯТ', 'emoji': '🏛️', 'callback_id': 'bar_pyatnitskaya', 'tag': '', 'phone': '', 'menu_url': ''},
+    {'name': 'МСК, Цветной бульвар', 'code': 'ЕВГ_МСК_ЦВЕТ', 'emoji': '🌸', 'callback_id': 'bar_tsvetnoj', 'tag': '', 'phone': '', 'menu_url': ''}
+]
+
+DEFAULT_AI_SETTINGS = {
+    'system_prompt': 'Ты - дружелюбный ассистент бара Евгенич.',
+    'tone': 'friendly',
+    'bar_info': 'Бар Евгенич - это уютное место в Санкт-Петербурге.',
+    'menu_info': 'У нас большой выбор настоек.',
+    'rules': 'Бронирование обязательно.',
+    'temperature': 0.7,
+    'max_tokens': 500,
+    'model': 'gpt-3.5-turbo'
+}
+
+DEFAULT_STAFF = {
+    'bosses': [],
+    'admins': [],
+    'smm': []
+}
+
+DEFAULT_LINKS = {
+    'menu_url': 'https://spb.evgenich.bar/menu',
+    'booking_url': '',
+    'contact_phone': '',
+    'whatsapp': '',
+    'telegram': '@evgenichbarspb',
+    'instagram': '',
+    'vk': '',
+    'facebook': '',
+    'youtube': ''
+}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _store(filename, default=None):
+    """Хранилище файла filename (создаётся при первом обращении)."""
+    store = _stores.get(filename)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(filename)
+            if store is None:
+                store = JsonFileStore(os.path.join(CONFIG_DIR, filename), default or {})
+                _stores[filename] = store
+    return store
+
 def load_config(filename, default=None):
-    """Загружает конфиг из JSON файла"""
-    filepath = os.path.join(CONFIG_DIR, filename)
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"Ошибка чтения конфига {filename}: {e}")
-    return default or {}
+    """Загружает конфиг из JSON файла (снимок из памяти, только для чтения)"""
+    return _store(filename, default).get()
+
+def reload_config(filename=None):
+    """Перечитать конфиг (все, если filename не указан), не дожидаясь проверки по времени"""
+    for name, store in list(_stores.items()):
+        if filename is None or name == filename:
+            store.reload()
 
 def get_texts():
     """Получить тексты бота"""
-    return load_config('texts.json', {
-        'greeting_start': 'Привет! 🍷',
-        'main_menu': 'Выберите действие:',
-        'booking_start': 'Отлично! Давайте забронируем стол.',
-        'ask_name': 'Как вас зовут?',
-        'ask_phone': 'Укажите ваш телефон:',
-        'ask_date': 'На какую дату бронируем?',
-        'ask_time': 'На какое время?',
-        'ask_guests': 'Сколько будет гостей?',
-        'ask_bar': 'Выберите бар:',
-        'booking_success': '✅ Бронирование успешно создано!',
-        'booking_cancelled': 'Бронирование отменено.',
-        'unknown_command': 'Неизвестная команда',
-        'no_access': 'У вас нет доступа к этой функции',
-        'system_error': 'Произошла ошибка. Попробуйте позже.'
-    })
+    return load_config('texts.json', DEFAULT_TEXTS)
 
 def get_bars():
     """Получить список баров"""
-    return load_config('bars.json', [
-        {'name': 'СПб, Невский 53', 'code': 'ЕВГ_СПБ', 'emoji': '🍷', 'callback_id': 'bar_nevsky', 'tag': '', 'phone': '', 'menu_url': ''},
-        {'name': 'СПб, Рубинштейна 9', 'code': 'ЕВГ_СПБ_РУБ', 'emoji': '💎', 'callback_id': 'bar_rubinstein', 'tag': '', 'phone': '', 'menu_url': ''},
-        {'name': 'МСК, Пятницкая 30', 'code': 'ЕВГ_МСК_ПЯТ', 'emoji': '🏛️', 'callback_id': 'bar_pyatnitskaya', 'tag': '', 'phone': '', 'menu_url': ''},
-        {'name': 'МСК, Цветной бульвар', 'code': 'ЕВГ_МСК_ЦВЕТ', 'emoji': '🌸', 'callback_id': 'bar_tsvetnoj', 'tag': '', 'phone': '', 'menu_url': ''}
-    ])
+    return load_config('bars.json', DEFAULT_BARS)
+
+def _index_bars_by_callback(bars):
+    index = {}
+    for bar in bars:
+        index.setdefault(bar.get('callback_id'), bar)
+    return index
 
 def get_bar_by_callback(callback_id):
     """Получить бар по callback_id"""
-    bars = get_bars()
-    for bar in bars:
-        if bar.get('callback_id') == callback_id:
-            return bar
-    return None
+    return _store('bars.json', DEFAULT_BARS).index('bar_by_callback', _index_bars_by_callback).get(callback_id)
 
 def get_ai_settings():
     """Получить настройки AI"""
-    return load_config('ai_settings.json', {
-        'system_prompt': 'Ты - дружелюбный ассистент бара Евгенич.',
-        'tone': 'friendly',
-        'bar_info': 'Бар Евгенич - это уютное место в Санкт-Петербурге.',
-        'menu_info': 'У нас большой выбор настоек.',
-        'rules': 'Бронирование обязательно.',
-        'temperature': 0.7,
-        'max_tokens': 500,
-        'model': 'gpt-3.5-turbo'
-    })
+    return load_config('ai_settings.json', DEFAULT_AI_SETTINGS)
 
 def get_staff():
     """Получить список персонала"""
-    return load_config('staff.json', {
-        'bosses': [],
-        'admins': [],
-        'smm': []
-    })
+    return load_config('staff.json', DEFAULT_STAFF)
 
 def get_links():
     """Получить ссылки"""
-    return load_config('links.json', {
-        'menu_url': 'https://spb.evgenich.bar/menu',
-        'booking_url': '',
-        'contact_phone': '',
-        'whatsapp': '',
-        'telegram': '@evgenichbarspb',
-        'instagram': '',
-        'vk': '',
-        'facebook': '',
-        'youtube': ''
-    })
+    return load_config('links.json', DEFAULT_LINKS)
+
+def _index_staff_ids(staff):
+    return {role: frozenset(u['id'] for u in staff.get(role, [])) for role in ('bosses', 'admins', 'smm')}
+
+def _staff_ids(role):
+    return _store('staff.json', DEFAULT_STAFF).index('staff_ids', _index_staff_ids)[role]
 
 def is_boss(user_id):
     """Проверка, является ли пользователь боссом"""
-    staff = get_staff()
-    return any(u['id'] == user_id for u in staff.get('bosses', []))
+    return user_id in _staff_ids('bosses')
 
 def is_admin(user_id):
     """Проверка, является ли пользователь админом"""
-    staff = get_staff()
-    return any(u['id'] == user_id for u in staff.get('admins', []))
+    return user_id in _staff_ids('admins')
 
 def is_smm(user_id):
     """Проверка, является ли пользователь SMM"""
-    staff = get_staff()
-    return any(u['id'] == user_id for u in staff.get('smm', []))
+    return user_id in _staff_ids('smm')
 
 # Для обратной совместимости - функция проверки доступа
 def has_access(user_id, level='admin'):
@@ -0,0 +1,180 @@
+# booking_state.py
+"""
+Состояние пошагового бронирования (FSM) для каждого пользователя.
+
+Раньше состояние лежало в TinyDB (booking_data.json), и каждая проверка
+db.contains(User.user_id == ...) перечитывала и парсила весь JSON-файл —
+в том числе на каждое текстовое сообщение в catch-all AI-хендлере.
+
+Теперь:
+- состояние хранится в словаре user_id → {'user_id', 'step', 'data'},
+  проверки и чтения — O(1) без обращения к диску;
+- каждое изменение сначала записывается в таблицу booking_state SQLite
+  (write-ahead), и только потом применяется в памяти, поэтому незавершённые
+  брони переживают перезапуск бота;
+- веб-панель читает снимок из той же таблицы через read-only соединение
+  (get_all_booking_states), не открывая файл бота и не создавая хранилище.
+
+Семантика шагов не изменилась: upsert/update/remove/get работают так же,
+как одноимённые операции TinyDB с условием User.user_id == user_id.
+"""
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from .config import DATABASE_PATH
+from .sqlite_pool import SQLitePool
+
+LEGACY_JSON_PATH = 'booking_data.json'
+
+
+class BookingStateStore:
+    def __init__(self, db_path: str = DATABASE_PATH, legacy_json_path: Optional[str] = LEGACY_JSON_PATH):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self._pool = SQLitePool(db_path, max_size=2)
+        self._lock = threading.RLock()
+        self._states: Dict[int, Dict[str, Any]] = {}
+
+        self._init_table()
+        self._load()
+        if legacy_json_path:
+            self._migrate_legacy_json(legacy_json_path)
+
+    # --- Публичный API ---
+
+    def contains(self, user_id: int) -> bool:
+        return user_id in self._states
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Копия состояния пользователя (изменения копии не влияют на хранилище)."""
+        with self._lock:
+            state = self._states.get(user_id)
+            return copy.deepcopy(state) if state is not None else None
+
+    def upsert(self, user_id: int, step: str, data: Optional[Dict[str, Any]] = None):
+        """Начинает (или перезапускает) бронирование с шага step."""
+        with self._lock:
+            self._write(user_id, step, data or {})
+
+    def update(self, user_id: int, step: str, data: Dict[str, Any]) -> bool:
+        """Переводит существующее бронирование на шаг step. False, если бронирования нет."""
+        with self._lock:
+            if user_id not in self._states:
+                return False
+            self._write(user_id, step, data)
+            return True
+
+    def remove(self, user_id: int) -> bool:
+        with self._lock:
+            if user_id not in self._states:
+                return False
+            with self._pool.connection() as conn:
+                conn.execute("DELETE FROM booking_state WHERE user_id = ?", (user_id,))
+            del self._states[user_id]
+            return True
+
+    def all(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return copy.deepcopy(list(self._states.values()))
+
+    # --- Внутренняя логика ---
+
+    def _write(self, user_id: int, step: str, data: Dict[str, Any]):
+        # Сначала на диск, потом в память: при ошибке записи состояние не расходится
+        with self._pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO booking_state (user_id, step, data, updated_at) "
+                "VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                (user_id, step, json.dumps(data, ensure_ascii=False, default=str))
+            )
+        self._states[user_id] = {'user_id': user_id, 'step': step, 'data': copy.deepcopy(data)}
+
+    def _init_table(self):
+        with self._pool.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS booking_state (
+                    user_id INTEGER PRIMARY KEY,
+                    step TEXT,
+                    data TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )""")
+
+    def _load(self):
+        with self._pool.connection() as conn:
+            rows = conn.execute("SELECT user_id, step, data FROM booking_state").fetchall()
+        for row in rows:
+            try:
+                data = json.loads(row['data']) if row['data'] else {}
+            except json.JSONDecodeError:
+                data = {}
+            self._states[row['user_id']] = {'user_id': row['user_id'], 'step': row['step'], 'data': data}
+        if rows:
+            logging.info(f"Бронирования | Восстановлено {len(rows)} незавершённых бронирований")
+
+    def _migrate_legacy_json(self, path: str):
+        """Переносит незавершённые бронирования из старого TinyDB-файла (один раз)."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                raw = json.load(f)
+            entries = [doc for table in raw.values() if isinstance(table, dict) for doc in table.values()]
+            migrated = 0
+            with self._lock:
+                for doc in entries:
+                    user_id = doc.get('user_id')
+                    if user_id is None or user_id in self._states:
+                        continue
+                    self._write(int(user_id), doc.get('step'), doc.get('data') or {})
+                    migrated += 1
+            os.replace(path, path + '.migrated')
+            logging.info(f"Бронирования | Перенесено {migrated} записей из {path}")
+        except Exception as e:
+            logging.error(f"Бронирования | Не удалось перенести {path}: {e}")
+
+
+_store: Optional[BookingStateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_booking_store() -> BookingStateStore:
+    """Единое хранилище состояний бронирования для процесса бота."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = BookingStateStore()
+    return _store
+
+
+def get_all_booking_states(db_path: str = DATABASE_PATH) -> List[Dict[str, Any]]:
+    """Снимок незавершённых бронирований для веб-панели (read-only, без хранилища в памяти)."""
+    if not os.path.exists(db_path):
+        return []
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=5)
+        try:
+            rows = conn.execute(
+                "SELECT user_id, step, data, updated_at FROM booking_state ORDER BY updated_at DESC"
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as e:
+        # Таблицы ещё нет — бот не запускался с новым хранилищем
+        logging.warning(f"Бронирования | Снимок недоступен: {e}")
+        return []
+    result = []
+    for user_id, step, data, updated_at in rows:
+        try:
+            data = json.loads(data) if data else {}
+        except json.JSONDecodeError:
+            data = {}
+        result.append({'user_id': user_id, 'step': step, 'data': data, 'updated_at': updated_at})
+    return result
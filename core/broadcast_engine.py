@@ -0,0 +1,305 @@
+# broadcast_engine.py
+"""
+Движок массовых рассылок.
+
+- Глобальный token bucket (~30 сообщений/сек на бота) и ограничение
+  1 сообщение/сек на один чат — лимиты Telegram Bot API.
+- Небольшой пул потоков-отправщиков; получатели ждут в очереди с
+  приоритетом по времени готовности, поэтому 429 с retry_after
+  откладывает только конкретного получателя, а не всю рассылку.
+- Результаты доставки и отметки «заблокировал бота» пишутся пачками
+  через DeliveryLogger (по числу строк или по времени).
+- Прогресс периодически сохраняется в broadcast_runs (last_user_id +
+  счётчики), поэтому после падения или перезапуска бота рассылка
+  продолжается с места остановки, а не с нуля. Получатели после
+  last_user_id, которые уже есть в логе доставки (completed), повторно
+  не отправляются.
+"""
+import heapq
+import itertools
+import threading
+import time
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from core.delivery_logger import DeliveryLogger
+
+logger = logging.getLogger("broadcast")
+
+# Коды ошибок Telegram, после которых повторять отправку бессмысленно
+_PERMANENT_ERROR_CODES = {400, 401, 404}
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0):
+        """Блокирует поток, пока не наберётся нужное число токенов."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                # Допуск на погрешность float: после sleep(wait) refill может дать 0.9999999999
+                if self._tokens + 1e-9 >= tokens:
+                    self._tokens = max(0.0, self._tokens - tokens)
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _extract_retry_after(error) -> Optional[float]:
+    """Достаёт retry_after из ApiTelegramException (или похожей ошибки)."""
+    try:
+        return float(error.result_json.get("parameters", {}).get("retry_after"))
+    except Exception:
+        return None
+
+
+class BroadcastEngine:
+    def __init__(self, broadcast_id: Optional[int], recipients: List[Dict[str, Any]],
+                 send_func: Callable[[int], None], database,
+                 global_rate: float = 30.0, per_chat_interval: float = 1.0,
+                 workers: int = 4, max_attempts: int = 3, max_rate_limit_retries: int = 5,
+                 log_batch_size: int = 500, log_flush_interval: float = 0.5,
+                 checkpoint_interval: float = 5.0,
+                 initial_counts: Optional[Dict[str, int]] = None,
+                 completed: Optional[Dict[int, str]] = None,
+                 progress_callback: Optional[Callable[[Dict[str, int]], None]] = None,
+                 on_blocked: Optional[Callable[[int], None]] = None):
+        """
+        Args:
+            broadcast_id: ID записи в broadcast_runs (None — без логирования)
+            recipients: получатели [{'user_id', 'username', 'first_name'}, ...]
+            send_func: отправляет сообщение одному user_id, бросает исключение при ошибке
+            database: модуль core.database (или объект с теми же функциями)
+            initial_counts: счётчики sent/failed/blocked при возобновлении рассылки
+            completed: {user_id: статус} получателей, обработанных до перезапуска,
+                но ещё не вошедших в чекпоинт: не отправляются, но учитываются в статистике
+            progress_callback: вызывается с текущей статистикой не чаще раза в 3 сек
+            on_blocked: дополнительно вызывается для пользователя, заблокировавшего бота
+                (сама отметка blocked в users делается пачками через DeliveryLogger)
+        """
+        self.broadcast_id = broadcast_id
+        # Порядок по user_id нужен для чекпоинта: всё, что <= last_user_id, уже обработано
+        self.recipients = sorted((r for r in recipients if r.get("user_id")), key=lambda r: int(r["user_id"]))
+        self.send_func = send_func
+        self.database = database
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_callback = progress_callback
+        self.on_blocked = on_blocked
+
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self._chat_next_allowed: Dict[int, float] = {}
+
+        counts = initial_counts or {}
+        self.stats = {
+            "total": len(self.recipients) + sum(counts.get(k, 0) for k in ("sent", "failed", "blocked")),
+            "sent": counts.get("sent", 0),
+            "failed": counts.get("failed", 0),
+            "blocked": counts.get("blocked", 0),
+            "retries": 0,
+        }
+
+        self._cond = threading.Condition()
+        self._heap: List = []
+        self._seq = itertools.count()
+        self._outstanding = 0
+
+        # Чекпоинт: индекс первого необработанного получателя в отсортированном списке
+        # и счётчики только по непрерывно обработанному префиксу (для возобновления)
+        self._statuses: List[Optional[str]] = [None] * len(self.recipients)
+        self._watermark = 0
+        self._committed = {k: counts.get(k, 0) for k in ("sent", "failed", "blocked")}
+        self._last_checkpoint = time.monotonic()
+        self._last_progress = 0.0
+
+        # Уже обработанные до перезапуска — сразу с итоговым статусом, в очередь не попадают
+        for idx, recipient in enumerate(self.recipients):
+            status = (completed or {}).get(int(recipient["user_id"]))
+            if status in self._committed:
+                self._statuses[idx] = status
+                self.stats[status] += 1
+        self._advance_watermark()
+
+        self.delivery_log = DeliveryLogger(database, flush_rows=log_batch_size, flush_interval=log_flush_interval,
+                                           name=f"broadcast-log-{broadcast_id}")
+
+    # --- Публичный API ---
+
+    def run(self) -> Dict[str, int]:
+        """Выполняет рассылку и блокирует поток до её завершения. Возвращает статистику."""
+        now = time.monotonic()
+        with self._cond:
+            for idx, status in enumerate(self._statuses):
+                if status is None:
+                    heapq.heappush(self._heap, (now, next(self._seq), idx, 1))
+            self._outstanding = len(self._heap)
+
+        threads = [threading.Thread(target=self._worker, name=f"broadcast-{self.broadcast_id}-{n}", daemon=True)
+                   for n in range(self.workers)]
+        self.delivery_log.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self._checkpoint(force=True)
+        self.delivery_log.stop()
+        return dict(self.stats)
+
+    # --- Рабочие потоки ---
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._outstanding == 0:
+                    return None
+                if not self._heap:
+                    self._cond.wait(0.5)
+                    continue
+                ready_at, _, idx, attempt = self._heap[0]
+                delay = ready_at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                return idx, attempt
+
+    def _reschedule(self, idx: int, attempt: int, ready_at: float):
+        with self._cond:
+            heapq.heappush(self._heap, (ready_at, next(self._seq), idx, attempt))
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            idx, attempt = job
+            recipient = self.recipients[idx]
+            uid = int(recipient["user_id"])
+
+            # Ограничение на один чат: если рано — возвращаем в очередь, не блокируя поток
+            with self._cond:
+                allowed_at = self._chat_next_allowed.get(uid, 0.0)
+            now = time.monotonic()
+            if allowed_at > now:
+                self._reschedule(idx, attempt, allowed_at)
+                continue
+
+            self.global_bucket.acquire()
+            with self._cond:
+                self._chat_next_allowed[uid] = time.monotonic() + self.per_chat_interval
+
+            try:
+                self.send_func(uid)
+                self._complete(idx, "sent")
+            except Exception as e:
+                self._handle_error(idx, attempt, e)
+
+    def _handle_error(self, idx: int, attempt: int, error: Exception):
+        recipient = self.recipients[idx]
+        uid = int(recipient["user_id"])
+        code = getattr(error, "error_code", None)
+
+        if code == 403:
+            self.delivery_log.mark_blocked(uid)
+            if self.on_blocked:
+                try:
+                    self.on_blocked(uid)
+                except Exception:
+                    pass
+            self._complete(idx, "blocked", 403, "Бот заблокирован пользователем")
+            return
+
+        if code == 429 and attempt <= self.max_rate_limit_retries:
+            retry_after = _extract_retry_after(error) or 1.0
+            logger.warning(f"429 для {uid}, повтор через {retry_after}s")
+            self.stats["retries"] += 1
+            self._reschedule(idx, attempt + 1, time.monotonic() + retry_after)
+            return
+
+        if code not in _PERMANENT_ERROR_CODES and attempt < self.max_attempts:
+            # Сетевые и 5xx ошибки — экспоненциальная задержка только для этого получателя
+            self.stats["retries"] += 1
+            self._reschedule(idx, attempt + 1, time.monotonic() + 2 ** attempt)
+            return
+
+        logger.error(f"Ошибка отправки {uid}: {error}")
+        self._complete(idx, "failed", code, str(error)[:300])
+
+    # --- Результаты, лог и чекпоинты ---
+
+    def _complete(self, idx: int, status: str, error_code: Optional[int] = None,
+                  error_message: Optional[str] = None):
+        recipient = self.recipients[idx]
+        with self._cond:
+            self.stats[status] += 1
+            self._statuses[idx] = status
+            self._advance_watermark()
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._cond.notify_all()
+
+        if self.broadcast_id:
+            self.delivery_log.log(
+                self.broadcast_id, int(recipient["user_id"]),
+                recipient.get("username") or "", recipient.get("first_name") or "",
+                status, error_code, error_message,
+            )
+
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self._checkpoint()
+
+        if self.progress_callback and time.monotonic() - self._last_progress >= 3:
+            self._last_progress = time.monotonic()
+            try:
+                self.progress_callback(self.get_progress())
+            except Exception:
+                pass
+
+    def _advance_watermark(self):
+        """Сдвигает watermark по непрерывно обработанному префиксу (под self._cond)."""
+        while self._watermark < len(self._statuses) and self._statuses[self._watermark]:
+            self._committed[self._statuses[self._watermark]] += 1
+            self._watermark += 1
+
+    def _checkpoint(self, force: bool = False):
+        """Сохраняет прогресс. Перед чекпоинтом сбрасываем лог, чтобы не потерять строки."""
+        if not self.broadcast_id:
+            return
+        with self._cond:
+            if not force and time.monotonic() - self._last_checkpoint < self.checkpoint_interval:
+                return
+            self._last_checkpoint = time.monotonic()
+            if self._watermark == 0:
+                last_user_id = None
+            else:
+                last_user_id = int(self.recipients[self._watermark - 1]["user_id"])
+            # Счётчики только по префиксу до watermark — при возобновлении не будет двойного счёта
+            counts = dict(self._committed)
+        self.delivery_log.flush()
+        if last_user_id is not None:
+            self.database.checkpoint_broadcast_run(
+                self.broadcast_id, last_user_id, counts["sent"], counts["failed"], counts["blocked"]
+            )
+
+    def get_progress(self) -> Dict[str, int]:
+        with self._cond:
+            processed = self.stats["sent"] + self.stats["failed"] + self.stats["blocked"]
+            return dict(self.stats, processed=processed)
@@ -27,6 +27,22 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@evgenichbarspb")  # СПб канал (по умолчанию)
 CHANNEL_ID_MSK = os.getenv("CHANNEL_ID_MSK", "@evgenichmoscow")  # Москва канал
 
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # Публичный адрес сервиса бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))  # Воркеров обработки обновлений в режиме webhook
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # Максимум обновлений в очереди
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "30"))  # Сколько ждать обработки очереди при остановке, сек
+
+# Ночной аудитор подписок
+AUDITOR_RATE = float(os.getenv("AUDITOR_RATE", "20"))  # Проверок get_chat_member в секунду
+AUDITOR_WORKERS = int(os.getenv("AUDITOR_WORKERS", "8"))  # Потоков проверки
+AUDITOR_MAX_DURATION = float(os.getenv("AUDITOR_MAX_DURATION", "9000"))  # Лимит прогона, сек (0 — без лимита); остаток — в следующую ночь
+
 # === НОВАЯ СИСТЕМА РОЛЕЙ ===
 # Теперь роли также можно управлять через админ-панель (web/admin_config/staff.json)
 # Переменные окружения используются как фоллбэк
@@ -105,6 +121,8 @@ NASTOYKA_NOTIFICATIONS_CHAT_ID = -1002813620544  # Чат для уведомл
 # --- Google Sheets ---
 GOOGLE_SHEET_KEY = os.getenv("GOOGLE_SHEET_KEY")  # Основная таблица
 GOOGLE_SHEET_KEY_SECONDARY = os.getenv("GOOGLE_SHEET_KEY_SECONDARY")  # Дополнительная таблица
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "5"))  # Как часто отправлять очередь в таблицу, сек
+SHEETS_FLUSH_MAX_ROWS = int(os.getenv("SHEETS_FLUSH_MAX_ROWS", "50"))  # Досрочная отправка при стольких изменённых строках
 
 # Обработка GOOGLE_CREDENTIALS_JSON: поддержка многострочного JSON из Railway raw editor
 _raw_creds = os.getenv("GOOGLE_CREDENTIALS_JSON", "")
@@ -112,6 +130,10 @@ GOOGLE_CREDENTIALS_JSON = _parse_json_safe(_raw_creds) if _raw_creds else None
 
 # --- Нейросеть (Новое) ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))  # Одновременных запросов к OpenAI
+AI_REQUEST_DEADLINE = float(os.getenv("AI_REQUEST_DEADLINE", "20"))  # Общий дедлайн запроса с повторами, сек
+AI_HEDGE_REQUESTS = os.getenv("AI_HEDGE_REQUESTS", "false").lower() in ("true", "1", "yes")  # Дублирующий запрос после p95
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", "3000"))  # Бюджет токенов промпта (0 — без ограничения)
 
 # --- Стикеры ---
 HELLO_STICKER_ID = os.getenv("HELLO_STICKER_ID")
@@ -128,10 +150,14 @@ GMB_SPASIBO_BOT_TOKEN = os.getenv("GMB_SPASIBO_BOT_TOKEN", "")  # Токен @sp
 
 # --- База данных ---
 DATABASE_PATH = os.getenv("DATABASE_PATH", "data/evgenich_data.db")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))  # Размер пула соединений SQLite
 
 # PostgreSQL
 USE_POSTGRES = os.getenv("USE_POSTGRES", "false").lower() in ("true", "1", "yes")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# При PostgreSQL — асинхронно повторять записи пользователей в локальную SQLite (db/repository.py)
+DUAL_WRITE_SQLITE = os.getenv("DUAL_WRITE_SQLITE", "false").lower() in ("true", "1", "yes")
+DUAL_WRITE_QUEUE_SIZE = int(os.getenv("DUAL_WRITE_QUEUE_SIZE", "10000"))  # Максимум записей в очереди зеркала
 POSTGRES_DB = os.getenv("POSTGRES_DB", "railway")
 POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
@@ -0,0 +1,196 @@
+# config_store.py
+"""
+JSON-конфиги в памяти: bot_settings.json (settings_manager) и
+web/admin_config/*.json (admin_config).
+
+Файл читается один раз; дальше вызывающие получают один и тот же
+неизменяемый снимок (FrozenDict / FrozenList — подклассы dict и list,
+запись в них бросает TypeError). Изменения файла другим процессом
+(веб-панель) подхватываются по os.stat не чаще раза в check_interval:
+меняется mtime, inode или размер — файл перечитывается. Недописанный или
+битый JSON не заменяет последний удачный снимок.
+
+Запись — во временный файл рядом и os.replace, читатель никогда не видит
+файл наполовину. Производные структуры (например, бар по callback_id)
+строятся один раз на снимок через index().
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class FrozenDict(dict):
+    """dict только для чтения (снимок конфига общий для всех потоков)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Снимок конфига только для чтения — используйте update() хранилища")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    """list только для чтения (снимок конфига общий для всех потоков)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Снимок конфига только для чтения — используйте update() хранилища")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value: Any) -> Any:
+    """Рекурсивно превращает dict/list в FrozenDict/FrozenList."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """Изменяемая копия снимка (обычные dict и list)."""
+    if isinstance(value, dict):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    return value
+
+
+def write_json_atomic(path: str, data: Any, indent: int = 2):
+    """Пишет JSON во временный файл в той же папке и атомарно подменяет им path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonFileStore:
+    def __init__(self, path: str, default: Any, check_interval: float = 1.0,
+                 create_if_missing: bool = False, indent: int = 2):
+        """
+        Args:
+            path: путь к JSON-файлу
+            default: значение, если файла нет или он не читается (пока не было удачного чтения)
+            check_interval: как часто (сек) сверять os.stat файла
+            create_if_missing: создать файл со значением default при первом обращении
+            indent: отступ при записи
+        """
+        self.path = str(path)
+        self.default = freeze(default)
+        self.check_interval = check_interval
+        self.create_if_missing = create_if_missing
+        self.indent = indent
+
+        self._lock = threading.RLock()
+        self._snapshot = self.default
+        self._signature: Optional[Tuple[int, int, int]] = None  # (st_ino, st_mtime_ns, st_size)
+        self._bad_signature: Optional[Tuple[int, int, int]] = None  # файл, который не прочитался
+        self._loaded = False
+        self._next_check = 0.0
+        self._indexes: Dict[str, Any] = {}
+        self.reloads = 0
+
+    def get(self) -> Any:
+        """Текущий неизменяемый снимок."""
+        if time.monotonic() >= self._next_check:
+            self._refresh()
+        return self._snapshot
+
+    def reload(self):
+        """Сверить файл сейчас, не дожидаясь check_interval."""
+        self._next_check = 0.0
+        return self.get()
+
+    def index(self, name: str, build: Callable[[Any], Any]) -> Any:
+        """Производная структура build(снимок), строится один раз на снимок."""
+        snapshot = self.get()
+        cached = self._indexes.get(name)
+        if cached is not None and cached[0] is snapshot:
+            return cached[1]
+        value = build(snapshot)
+        self._indexes[name] = (snapshot, value)
+        return value
+
+    def update(self, mutate: Callable[[Any], Any]) -> Any:
+        """
+        Изменяет конфиг: mutate получает изменяемую копию и правит её на месте
+        (или возвращает новое значение). Результат пишется атомарно и сразу
+        становится снимком. Возвращает новый снимок.
+        """
+        with self._lock:
+            data = thaw(self.reload())
+            result = mutate(data)
+            if result is not None:
+                data = result
+            write_json_atomic(self.path, data, self.indent)
+            self._set_snapshot(freeze(data), self._stat())
+            return self._snapshot
+
+    # --- Внутреннее ---
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _set_snapshot(self, snapshot: Any, signature: Optional[Tuple[int, int, int]]):
+        self._snapshot = snapshot
+        self._signature = signature
+        self._loaded = True
+        self.reloads += 1
+
+    def _refresh(self):
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            self._next_check = time.monotonic() + self.check_interval
+            signature = self._stat()
+            if signature is None:
+                if self.create_if_missing:
+                    logging.info(f"Файл настроек {self.path} не найден. Создаю новый.")
+                    try:
+                        write_json_atomic(self.path, thaw(self.default), self.indent)
+                    except OSError as e:
+                        logging.error(f"Не удалось создать {self.path}: {e}")
+                    self._set_snapshot(self.default, self._stat())
+                elif self._signature is not None or not self._loaded:
+                    # Файл удалён — как и раньше, работаем со значениями по умолчанию
+                    self._set_snapshot(self.default, None)
+                return
+            if signature == self._signature or signature == self._bad_signature:
+                return
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                # Файл дописывается не атомарно или повреждён: оставляем прежний снимок
+                # и ждём следующего изменения файла
+                logging.error(f"Ошибка чтения конфига {self.path}: {e}")
+                self._bad_signature = signature
+                if not self._loaded:
+                    self._set_snapshot(self.default, None)
+                return
+            self._set_snapshot(freeze(data), signature)
@@ -4,7 +4,7 @@
 """
 import sqlite3
 import logging
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, Callable
 import datetime
 import pytz
 import os
@@ -12,9 +12,18 @@ import json
 import gspread
 import gspread.exceptions
 import threading
+import atexit
 from collections import defaultdict
 from google.oauth2.service_account import Credentials
-from .config import GOOGLE_SHEET_KEY, GOOGLE_CREDENTIALS_JSON, DATABASE_PATH, USE_POSTGRES, DATABASE_URL
+from .config import GOOGLE_SHEET_KEY, GOOGLE_CREDENTIALS_JSON, DATABASE_PATH, USE_POSTGRES, DATABASE_URL, SQLITE_POOL_SIZE, SHEETS_FLUSH_INTERVAL, SHEETS_FLUSH_MAX_ROWS
+from .config import DUAL_WRITE_SQLITE, DUAL_WRITE_QUEUE_SIZE
+from .sqlite_pool import SQLitePool
+from .sheets_writer import SheetsWriter
+from . import report_rollup
+from db.indexes import SQLITE_INDEXES, index_statements
+from db.repository import (Repository, SQLiteRepository, PostgresRepository, DualWriteRepository,
+                           RollupHooks, UserRecord)
+from db.pagination import encode_cursor, decode_cursor, escape_like, user_id_prefix_ranges, USERS_PAGE_MAX_LIMIT
 
 # Импортируем PostgreSQL клиент, если включен режим PostgreSQL
 if USE_POSTGRES:
@@ -128,113 +137,115 @@ def _get_sheets_worksheet():
         logging.error("G-Sheets | Ошибка подключения: %s", str(e))
         return None
 
-def _add_user_to_sheets_in_background(row_data: List[Any]):
-    """(Фоновая задача) Добавляет строку с данными пользователя в таблицу (только если пользователя еще нет)."""
-    user_id = row_data[1]
-    logging.info(f"G-Sheets (фон) | Попытка добавления пользователя {user_id}")
-    if not GOOGLE_SHEETS_ENABLED:
-        logging.warning(f"G-Sheets (фон) | Google Sheets отключен!")
-        return
-    try:
-        worksheet = _get_sheets_worksheet()
-        if not worksheet:
-            logging.error(f"G-Sheets (фон) | ❌ Не удалось получить worksheet!")
-            return
-        
-        # Проверяем, существует ли уже пользователь с таким ID
-        logging.debug(f"G-Sheets (фон) | Ищу пользователя {user_id} в колонке B...")
-        try:
-            existing_cell = worksheet.find(str(user_id), in_column=2)
-            if existing_cell:
-                logging.warning(f"G-Sheets (фон) | ⚠️  Пользователь {user_id} уже в таблице (строка {existing_cell.row}). Пропускаю.")
-                return
-        except gspread.exceptions.CellNotFound:
-            logging.debug(f"G-Sheets (фон) | Пользователь {user_id} не найден - добавляю")
-        
-        # Добавляем новую строку в конец
-        logging.info(f"G-Sheets (фон) | Добавляю новую строку: {row_data}")
-        worksheet.append_row(row_data)
-        logging.info(f"G-Sheets (фон) | ✅ Пользователь {user_id} добавлен в конец таблицы (новая строка).")
-    except Exception as e:
-        logging.error(f"G-Sheets (фон) | ❌ Ошибка добавления пользователя {user_id}: {e}", exc_info=True)
+# Единый фоновый писатель: склеивает изменения и отправляет их пачками
+_sheets_writer = SheetsWriter(
+    _get_sheets_worksheet,
+    spool_path=os.path.join(os.path.dirname(DB_FILE) or '.', 'sheets_spool.jsonl'),
+    flush_interval=SHEETS_FLUSH_INTERVAL,
+    flush_max_rows=SHEETS_FLUSH_MAX_ROWS,
+)
+if GOOGLE_SHEETS_ENABLED and _sheets_writer.get_stats()['pending']:
+    _sheets_writer.start()
+atexit.register(_sheets_writer.stop)
+
+# Номера колонок листа «Выгрузка Пользователей»
+SHEET_COL_PHONE = 5         # E - номер телефона
+SHEET_COL_REAL_NAME = 6     # F - настоящее имя
+SHEET_COL_BIRTH_DATE = 7    # G - дата рождения
+SHEET_COL_STATUS = 8        # H - статус
+SHEET_COL_REDEEM_DATE = 11  # K - дата погашения
+
+def _queue_sheets_update(user_id: int, cells: Dict[int, Any]):
+    """Ставит обновление ячеек пользователя в очередь фонового писателя."""
+    if GOOGLE_SHEETS_ENABLED:
+        _sheets_writer.enqueue_update(user_id, cells)
 
-def _update_contact_in_sheets_in_background(user_id: int, phone_number: str, contact_shared_date: datetime.datetime):
-    """(Фоновая задача) Обновляет контактную информацию пользователя в таблице."""
-    if not GOOGLE_SHEETS_ENABLED:
-        return
-    try:
-        worksheet = _get_sheets_worksheet()
-        if worksheet:
-            cell = worksheet.find(str(user_id), in_column=2)
-            if cell:
-                worksheet.update_cell(cell.row, 5, phone_number)  # Колонка E - номер телефона
-                logging.info(f"G-Sheets (фон) | Контакт пользователя {user_id} успешно обновлен: {phone_number}")
-            else:
-                logging.warning(f"G-Sheets (фон) | Не удалось найти пользователя {user_id} для обновления контакта.")
-    except Exception as e:
-        logging.error(f"G-Sheets (фон) | Ошибка обновления контакта для {user_id}: {e}")
+def pause_sheets_writer():
+    """Контекст: отправка фонового писателя Google Sheets приостановлена (для выгрузки)."""
+    return _sheets_writer.paused()
 
-def _update_name_in_sheets_in_background(user_id: int, real_name: str):
-    """(Фоновая задача) Обновляет настоящее имя пользователя в таблице."""
-    if not GOOGLE_SHEETS_ENABLED:
-        return
-    try:
-        worksheet = _get_sheets_worksheet()
-        if worksheet:
-            cell = worksheet.find(str(user_id), in_column=2)
-            if cell:
-                worksheet.update_cell(cell.row, 6, real_name)  # Колонка F - настоящее имя
-                logging.info(f"G-Sheets (фон) | Имя пользователя {user_id} успешно обновлено: {real_name}")
-            else:
-                logging.warning(f"G-Sheets (фон) | Не удалось найти пользователя {user_id} для обновления имени.")
-    except Exception as e:
-        logging.error(f"G-Sheets (фон) | Ошибка обновления имени для {user_id}: {e}")
+def get_sheets_writer_stats() -> Dict[str, Any]:
+    """Статистика фонового писателя Google Sheets."""
+    return _sheets_writer.get_stats()
 
-def _update_birth_date_in_sheets_in_background(user_id: int, birth_date: str):
-    """(Фоновая задача) Обновляет дату рождения пользователя в таблице."""
-    if not GOOGLE_SHEETS_ENABLED:
-        return
-    try:
-        worksheet = _get_sheets_worksheet()
-        if worksheet:
-            cell = worksheet.find(str(user_id), in_column=2)
-            if cell:
-                worksheet.update_cell(cell.row, 7, birth_date)  # Колонка G - дата рождения
-                logging.info(f"G-Sheets (фон) | Дата рождения пользователя {user_id} успешно обновлена: {birth_date}")
-            else:
-                logging.warning(f"G-Sheets (фон) | Не удалось найти пользователя {user_id} для обновления даты рождения.")
-    except Exception as e:
-        logging.error(f"G-Sheets (фон) | Ошибка обновления даты рождения для {user_id}: {e}")
+# --- Подписка на изменения пользователя ---
+# Кеши поверх таблицы users (например, снимок контекста AI) подписываются
+# здесь и сбрасывают запись пользователя после каждой записи в его строку.
+_user_change_listeners: List[Callable[[int], None]] = []
 
-def _update_status_in_sheets_in_background(user_id: int, new_status: str, redeem_time: Optional[datetime.datetime]):
-    """(Фоновая задача) Обновляет статус пользователя в таблице."""
-    if not GOOGLE_SHEETS_ENABLED:
-        return
-    try:
-        worksheet = _get_sheets_worksheet()
-        if worksheet:
-            cell = worksheet.find(str(user_id), in_column=2)
-            if cell:
-                russian_status = _translate_status_to_russian(new_status)
-                worksheet.update_cell(cell.row, 8, russian_status)  # Статус в колонке H (8)
-                if redeem_time:
-                    worksheet.update_cell(cell.row, 11, redeem_time.strftime('%Y-%m-%d %H:%M:%S'))  # Дата погашения в колонке K (11)
-                logging.info(f"G-Sheets (фон) | Статус пользователя {user_id} успешно обновлен на '{russian_status}'.")
-            else:
-                logging.warning(f"G-Sheets (фон) | Не удалось найти пользователя {user_id} для обновления.")
-    except Exception as e:
-        logging.error(f"G-Sheets (фон) | Ошибка обновления статуса для {user_id}: {e}")
+def add_user_change_listener(callback: Callable[[int], None]):
+    """callback(user_id) вызывается после изменения данных пользователя."""
+    _user_change_listeners.append(callback)
+
+def _notify_user_changed(user_id: int):
+    for callback in _user_change_listeners:
+        try:
+            callback(user_id)
+        except Exception as e:
+            logging.error(f"Ошибка обработчика изменения пользователя {user_id}: {e}")
 
 # --- Секция работы с локальной базой SQLite ---
+# Общий пул соединений: PRAGMA настраиваются один раз на соединение,
+# кеш подготовленных выражений переиспользуется между вызовами.
+_sqlite_pool = SQLitePool(DB_FILE, max_size=SQLITE_POOL_SIZE)
+
 def get_db_connection():
-    # Создаем директорию для базы данных если её нет
-    db_dir = os.path.dirname(DB_FILE)
-    if db_dir and not os.path.exists(db_dir):
-        os.makedirs(db_dir, exist_ok=True)
-    
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Выдаёт соединение из пула. conn.close() возвращает его обратно в пул."""
+    return _sqlite_pool.checkout()
+
+def db_connection():
+    """
+    Контекстный менеджер для работы с SQLite:
+
+        with db_connection() as conn:
+            conn.execute(...)
+
+    Коммитит при успехе, откатывает при исключении и возвращает соединение в пул.
+    """
+    return _sqlite_pool.connection()
+
+def get_db_pool_stats() -> Dict[str, Any]:
+    """Счётчики пула SQLite: число выдач, ожидания, открытые соединения."""
+    return _sqlite_pool.get_stats()
+
+def close_db_pool():
+    """Закрывает свободные соединения пула (вызывается при остановке бота)."""
+    _sqlite_pool.close_all()
+
+atexit.register(close_db_pool)
+
+# --- Слой доступа к данным (db/repository.py) ---
+_repository: Optional[Repository] = None
+_repository_lock = threading.Lock()
+
+def get_repository() -> Repository:
+    """
+    Хранилище основной БД: PostgreSQL (общий engine pg_client) или SQLite (общий пул).
+    При DUAL_WRITE_SQLITE записи в PostgreSQL фоновым потоком повторяются в SQLite.
+    """
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                # Каждое хранилище ведёт свои агрегаты отчётов (report_hourly_rollup)
+                sqlite_rollup = RollupHooks(_rollup_snapshot, _rollup_commit)
+                if USE_POSTGRES and pg_client:
+                    repository = PostgresRepository(
+                        pg_client.engine, RollupHooks(pg_client._rollup_snapshot, pg_client._rollup_commit))
+                    if DUAL_WRITE_SQLITE:
+                        repository = DualWriteRepository(repository, SQLiteRepository(db_connection, sqlite_rollup),
+                                                         queue_size=DUAL_WRITE_QUEUE_SIZE)
+                else:
+                    repository = SQLiteRepository(db_connection, sqlite_rollup)
+                _repository = repository
+    return _repository
+
+def close_repository():
+    """Дописывает очередь двойной записи (вызывается при остановке, до закрытия пула)."""
+    if _repository is not None:
+        _repository.close()
+
+atexit.register(close_repository)
 
 def init_db():
     """Инициализирует/обновляет структуру базы данных."""
@@ -328,6 +339,28 @@ def init_db():
             cur.execute("ALTER TABLE users ADD COLUMN block_date TEXT")
             logging.info("База данных обновлена: добавлена колонка block_date")
 
+        # Время последнего изменения строки — для инкрементальной выгрузки в Google Sheets
+        # (utils/export_to_sheets.py). Ставится триггерами, поэтому его не пропустит ни один
+        # путь записи; строкам до миграции — условная «давняя» отметка
+        try:
+            cur.execute("SELECT updated_at FROM users LIMIT 1")
+        except sqlite3.OperationalError:
+            cur.execute("ALTER TABLE users ADD COLUMN updated_at TEXT")
+            cur.execute("UPDATE users SET updated_at = '1970-01-01 00:00:00.000'")
+            logging.info("База данных обновлена: добавлена колонка updated_at")
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS users_touch_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE users SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE user_id = NEW.user_id;
+            END""")
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS users_touch_update AFTER UPDATE ON users
+            WHEN NEW.updated_at IS OLD.updated_at
+            BEGIN
+                UPDATE users SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE user_id = NEW.user_id;
+            END""")
+
+
         # --- НОВАЯ ТАБЛИЦА: Персонал (staff) ---
         cur.execute("""
             CREATE TABLE IF NOT EXISTS staff (
@@ -346,6 +379,7 @@ def init_db():
                 id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, role TEXT,
                 text TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )""")
+        # Последние реплики пользователя читаются на каждое сообщение AI
         cur.execute("""
             CREATE TABLE IF NOT EXISTS feedback (
                 id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
@@ -362,6 +396,20 @@ def init_db():
                 status TEXT DEFAULT 'pending',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )""")
+        # Колонки планировщика (core/delayed_tasks_processor.py): время запуска в UTC
+        # одним форматом, параметры задачи, аренда захвата и повторы
+        for column, column_type in (("next_run_at", "TEXT"), ("payload", "TEXT"), ("attempts", "INTEGER DEFAULT 0"),
+                                    ("claimed_by", "TEXT"), ("claimed_until", "TEXT"), ("last_error", "TEXT"),
+                                    ("completed_at", "TEXT")):
+            try:
+                cur.execute(f"SELECT {column} FROM delayed_tasks LIMIT 1")
+            except sqlite3.OperationalError:
+                cur.execute(f"ALTER TABLE delayed_tasks ADD COLUMN {column} {column_type}")
+        for task_id, scheduled_time in cur.execute(
+                "SELECT id, scheduled_time FROM delayed_tasks WHERE next_run_at IS NULL AND status = 'pending'"
+        ).fetchall():
+            run_at = _parse_task_time(scheduled_time) or datetime.datetime.now(pytz.utc)
+            cur.execute("UPDATE delayed_tasks SET next_run_at = ? WHERE id = ?", (_task_time(run_at), task_id))
         
         # --- НОВАЯ ТАБЛИЦА: Данные iiko (iiko_data) ---
         cur.execute("""
@@ -441,6 +489,14 @@ def init_db():
                 status TEXT DEFAULT 'running'
             )""")
 
+        # Колонки для возобновления рассылки после перезапуска
+        for column, col_type in (("payload", "TEXT"), ("last_user_id", "INTEGER"), ("checkpoint_at", "TIMESTAMP")):
+            try:
+                cur.execute(f"SELECT {column} FROM broadcast_runs LIMIT 1")
+            except sqlite3.OperationalError:
+                cur.execute(f"ALTER TABLE broadcast_runs ADD COLUMN {column} {col_type}")
+                logging.info(f"База данных обновлена: добавлена колонка broadcast_runs.{column}")
+
         cur.execute("""
             CREATE TABLE IF NOT EXISTS broadcast_delivery_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -454,13 +510,212 @@ def init_db():
                 delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (broadcast_id) REFERENCES broadcast_runs (id)
             )""")
-            
+
+        # Прогоны ночного аудитора подписок (чекпоинт для продолжения после перезапуска)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS audit_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at TEXT NOT NULL,
+                finished_at TEXT,
+                total_users INTEGER DEFAULT 0,
+                checked_count INTEGER DEFAULT 0,
+                left_count INTEGER DEFAULT 0,
+                error_count INTEGER DEFAULT 0,
+                checkpoint_at TEXT,
+                status TEXT DEFAULT 'running'
+            )""")
+
+        # --- Агрегаты метрик AI (дневные и по пользователям) ---
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ai_metrics_daily (
+                date TEXT PRIMARY KEY,
+                total_requests INTEGER DEFAULT 0,
+                successful_requests INTEGER DEFAULT 0,
+                failed_requests INTEGER DEFAULT 0,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                total_tokens INTEGER DEFAULT 0,
+                cost_usd REAL DEFAULT 0,
+                response_time_sum_ms REAL DEFAULT 0,
+                response_time_count INTEGER DEFAULT 0,
+                unique_users INTEGER DEFAULT 0,
+                cache_lookups INTEGER DEFAULT 0,
+                cache_hits INTEGER DEFAULT 0,
+                cache_saved_tokens INTEGER DEFAULT 0,
+                cache_saved_cost_usd REAL DEFAULT 0
+            )""")
+        for column, column_type in (('cache_lookups', 'INTEGER'), ('cache_hits', 'INTEGER'),
+                                    ('cache_saved_tokens', 'INTEGER'), ('cache_saved_cost_usd', 'REAL')):
+            try:
+                cur.execute(f"SELECT {column} FROM ai_metrics_daily LIMIT 1")
+            except sqlite3.OperationalError:
+                cur.execute(f"ALTER TABLE ai_metrics_daily ADD COLUMN {column} {column_type} DEFAULT 0")
+                logging.info(f"База данных обновлена: добавлена колонка ai_metrics_daily.{column}")
+        # --- Долгосрочная память AI о пользователях (профиль — JSON) ---
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ai_user_memory (
+                user_id INTEGER PRIMARY KEY,
+                profile TEXT NOT NULL,
+                has_name INTEGER DEFAULT 0,
+                has_preferred_bar INTEGER DEFAULT 0,
+                has_favorite_drinks INTEGER DEFAULT 0,
+                bookings_count INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ai_metrics_user_daily (
+                date TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                requests INTEGER DEFAULT 0,
+                tokens INTEGER DEFAULT 0,
+                cost_usd REAL DEFAULT 0,
+                PRIMARY KEY (date, user_id)
+            )""")
+
+        # --- Почасовые агрегаты для отчётов (см. core/report_rollup.py) ---
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS report_hourly_rollup (
+                hour TEXT NOT NULL,
+                source TEXT NOT NULL DEFAULT '',
+                staff_id INTEGER NOT NULL DEFAULT 0,
+                signups INTEGER DEFAULT 0,
+                issued INTEGER DEFAULT 0,
+                left_by_signup INTEGER DEFAULT 0,
+                redeemed INTEGER DEFAULT 0,
+                redeem_seconds INTEGER DEFAULT 0,
+                left_by_redeem INTEGER DEFAULT 0,
+                PRIMARY KEY (hour, source, staff_id)
+            )""")
+
+        # --- Отметки фоновых сверок: докуда уже просмотрены данные ---
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS job_watermarks (
+                name TEXT PRIMARY KEY,
+                value TEXT,
+                updated_at TEXT
+            )""")
+
+        # --- Индексы горячих запросов (список — в db/indexes.py) ---
+        for statement in index_statements(SQLITE_INDEXES):
+            cur.execute(statement)
+        # Обновляет статистику планировщика, если индексы появились или данные заметно выросли
+        cur.execute("PRAGMA optimize")
+
+        rollup_empty = cur.execute("SELECT 1 FROM report_hourly_rollup LIMIT 1").fetchone() is None
+        has_users = cur.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+
         conn.commit()
         conn.close()
+        if rollup_empty and has_users:
+            # Первый запуск после миграции — заполняем агрегаты по истории
+            rebuild_report_rollup()
+        if USE_POSTGRES and pg_client:
+            migrate_conversation_history_to_postgres()
         logging.info("База данных SQLite успешно инициализирована/обновлена.")
     except Exception as e:
         logging.critical(f"Не удалось инициализировать базу данных SQLite: {e}")
 
+# --- Почасовые агрегаты отчётов (report_hourly_rollup) ---
+# Каждая запись в users, меняющая статус, источник или даты, снимает
+# состояние пользователя до и после изменения в той же транзакции и
+# добавляет разницу в агрегатные строки (см. core/report_rollup.py).
+
+_ROLLUP_STATE_SQL = (
+    "SELECT user_id, status, source, brought_by_staff_id, signup_date, redeem_date "
+    "FROM users WHERE user_id IN ({ids})"
+)
+
+def _rollup_snapshot(conn, user_ids) -> Dict[int, Optional[Dict[str, Any]]]:
+    """Состояние пользователей для агрегатов: {user_id: состояние или None, если записи нет}."""
+    user_ids = sorted({int(uid) for uid in user_ids})
+    states: Dict[int, Optional[Dict[str, Any]]] = dict.fromkeys(user_ids)
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        for row in conn.execute(_ROLLUP_STATE_SQL.format(ids=','.join('?' * len(chunk))), chunk):
+            states[row['user_id']] = dict(row)
+    return states
+
+def _rollup_write(conn, deltas):
+    if deltas:
+        conn.executemany(report_rollup.UPSERT_SQL, report_rollup.to_rows(deltas))
+
+# Инкремент агрегатов не записался — отчёт перед чтением пересчитает их
+# (флаг процесса и отметка report_rollup.DIRTY_MARK в job_watermarks)
+_rollup_dirty = False
+
+def _mark_rollup_dirty(conn):
+    """Помечает агрегаты устаревшими в той же транзакции, что и запись пользователя."""
+    global _rollup_dirty
+    _rollup_dirty = True
+    try:
+        conn.execute(
+            "INSERT INTO job_watermarks (name, value, updated_at) VALUES (?, NULL, ?) ON CONFLICT(name) DO NOTHING",
+            (report_rollup.DIRTY_MARK, str(datetime.datetime.now(pytz.utc))))
+    except Exception as e:
+        logging.error(f"Агрегаты отчётов | Не удалось сохранить отметку пересчёта: {e}")
+
+def _rollup_commit(conn, before: Dict[int, Optional[Dict[str, Any]]]):
+    """
+    Сравнивает снимок before с текущим состоянием и дописывает разницу в агрегаты.
+    Ошибка не ломает запись пользователя: частичная разница откатывается до
+    точки сохранения, а агрегаты помечаются для пересчёта перед следующим отчётом.
+    """
+    try:
+        conn.execute("SAVEPOINT report_rollup")
+        try:
+            after = _rollup_snapshot(conn, before.keys())
+            _rollup_write(conn, report_rollup.diff_many(before, after))
+        except Exception:
+            conn.execute("ROLLBACK TO report_rollup")
+            raise
+        finally:
+            conn.execute("RELEASE report_rollup")
+    except Exception as e:
+        logging.error(f"Агрегаты отчётов | Ошибка обновления ({len(before)} польз.), "
+                      f"пересчёт при следующем отчёте: {e}")
+        _mark_rollup_dirty(conn)
+
+def rebuild_report_rollup() -> Tuple[int, int]:
+    """
+    Полный пересчёт report_hourly_rollup по таблице users.
+    Возвращает (пользователей, строк агрегатов); (-1, 0) при ошибке.
+    """
+    global _rollup_dirty
+    try:
+        if USE_POSTGRES and pg_client:
+            return pg_client.rebuild_report_rollup()
+
+        # Сбрасываем флаг до пересчёта: ошибка во время него выставит его снова
+        _rollup_dirty = False
+        with db_connection() as conn:
+            # Блокировка записи: пользователи не меняются между чтением и записью агрегатов
+            conn.execute("BEGIN IMMEDIATE")
+            states = [dict(row) for row in conn.execute(
+                "SELECT status, source, brought_by_staff_id, signup_date, redeem_date FROM users")]
+            deltas = report_rollup.aggregate(states)
+            conn.execute("DELETE FROM report_hourly_rollup")
+            _rollup_write(conn, deltas)
+            conn.execute("DELETE FROM job_watermarks WHERE name = ?", (report_rollup.DIRTY_MARK,))
+        logging.info(f"Агрегаты отчётов | Пересчитано: {len(states)} пользователей, {len(deltas)} строк")
+        return len(states), len(deltas)
+    except Exception as e:
+        _rollup_dirty = True
+        logging.error(f"Агрегаты отчётов | Ошибка пересчёта: {e}")
+        return -1, 0
+
+def _load_report_rollup(start_key: str, end_key: str) -> List[Dict[str, Any]]:
+    if USE_POSTGRES and pg_client:
+        return pg_client.load_report_rollup(start_key, end_key)
+    with db_connection() as conn:
+        dirty = _rollup_dirty or conn.execute(
+            "SELECT 1 FROM job_watermarks WHERE name = ?", (report_rollup.DIRTY_MARK,)).fetchone() is not None
+    if dirty:
+        logging.warning("Агрегаты отчётов | Помечены устаревшими после ошибки — пересчитываю")
+        rebuild_report_rollup()
+    with db_connection() as conn:
+        return [dict(row) for row in conn.execute(
+            "SELECT * FROM report_hourly_rollup WHERE hour BETWEEN ? AND ?", (start_key, end_key))]
+
 # --- Функции для работы с Пользователями (users) ---
 
 def add_new_user(user_id: int, username: str, first_name: str, source: str, referrer_id: Optional[int] = None, brought_by_staff_id: Optional[int] = None):
@@ -482,6 +737,9 @@ def add_new_user(user_id: int, username: str, first_name: str, source: str, refe
             if not success:
                 logging.warning(f"PostgreSQL | Пользователь {user_id} уже существует или произошла ошибка")
                 return
+            get_repository().mirror('add_user', UserRecord(
+                user_id, username or "N/A", first_name, 'registered', source,
+                referrer_id, brought_by_staff_id, signup_time))
         except Exception as e:
             logging.error(f"PostgreSQL | Ошибка добавления пользователя {user_id}: {e}")
             return
@@ -490,16 +748,20 @@ def add_new_user(user_id: int, username: str, first_name: str, source: str, refe
         try:
             conn = get_db_connection()
             cur = conn.cursor()
+            before = _rollup_snapshot(conn, [user_id])
             cur.execute(
                 "INSERT OR IGNORE INTO users (user_id, username, first_name, source, referrer_id, brought_by_staff_id, signup_date) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (user_id, username or "N/A", first_name, source, referrer_id, brought_by_staff_id, signup_time)
             )
+            if cur.rowcount > 0:
+                _rollup_commit(conn, before)
             conn.commit()
             conn.close()
             logging.info(f"SQLite | Пользователь {user_id} добавлен. Источник: {source}, Сотрудник: {brought_by_staff_id}")
         except Exception as e:
             logging.error(f"SQLite | Ошибка добавления пользователя {user_id}: {e}")
             return
+    _notify_user_changed(user_id)
     # Логика для Google Sheets
     logging.info(f"📝 Подготовка данных пользователя {user_id} для Google Sheets...")
     row_data = [
@@ -510,8 +772,8 @@ def add_new_user(user_id: int, username: str, first_name: str, source: str, refe
     ]
     logging.info(f"📝 GOOGLE_SHEETS_ENABLED={GOOGLE_SHEETS_ENABLED}, GOOGLE_SHEET_KEY={bool(GOOGLE_SHEET_KEY)}, GOOGLE_CREDENTIALS_JSON={bool(GOOGLE_CREDENTIALS_JSON)}")
     if GOOGLE_SHEETS_ENABLED:
-        logging.info(f"✅ Запускаю фоновую задачу добавления пользователя {user_id} в Google Sheets...")
-        threading.Thread(target=_add_user_to_sheets_in_background, args=(row_data,)).start()
+        logging.info(f"✅ Ставлю пользователя {user_id} в очередь добавления в Google Sheets...")
+        _sheets_writer.enqueue_append(row_data)
     else:
         logging.warning(f"⚠️  Google Sheets отключен для пользователя {user_id}!")
 
@@ -524,10 +786,11 @@ def update_status(user_id: int, new_status: str) -> bool:
         try:
             updated = pg_client.update_status(user_id, new_status)
             
-            if updated and new_status == 'redeemed':
+            if updated:
                 # Дата погашения сохранена, сообщение о лояльности
-                # отправляется через threading.Timer в callback_query.py
-                pass
+                # отправляет задача 'loyalty_offer' (delayed_tasks_processor)
+                fields = {'redeem_date': redeem_time} if redeem_time else {}
+                get_repository().mirror('update_user', user_id, status=new_status, **fields)
         except Exception as e:
             logging.error(f"PostgreSQL | Ошибка обновления статуса для {user_id}: {e}")
             return False
@@ -536,12 +799,15 @@ def update_status(user_id: int, new_status: str) -> bool:
         try:
             conn = get_db_connection()
             cur = conn.cursor()
+            before = _rollup_snapshot(conn, [user_id])
             if redeem_time:
                 # При погашении сразу ставим дату проверки, чтобы аудитор его проверил
                 cur.execute("UPDATE users SET status = ?, redeem_date = ?, last_check_date = ? WHERE user_id = ?", (new_status, redeem_time, datetime.datetime.now(pytz.utc), user_id))
             else:
                 cur.execute("UPDATE users SET status = ? WHERE user_id = ?", (new_status, user_id))
             updated = cur.rowcount > 0
+            if updated:
+                _rollup_commit(conn, before)
             conn.commit()
             conn.close()
             if updated:
@@ -549,8 +815,12 @@ def update_status(user_id: int, new_status: str) -> bool:
         except Exception as e:
             logging.error(f"SQLite | Ошибка обновления статуса для {user_id}: {e}")
             return False
-    if updated and GOOGLE_SHEETS_ENABLED:
-        threading.Thread(target=_update_status_in_sheets_in_background, args=(user_id, new_status, redeem_time)).start()
+    if updated:
+        _notify_user_changed(user_id)
+        cells = {SHEET_COL_STATUS: _translate_status_to_russian(new_status)}
+        if redeem_time:
+            cells[SHEET_COL_REDEEM_DATE] = redeem_time.strftime('%Y-%m-%d %H:%M:%S')
+        _queue_sheets_update(user_id, cells)
     return updated
 
 def update_user_contact(user_id: int, phone_number: str) -> bool:
@@ -570,6 +840,7 @@ def update_user_contact(user_id: int, phone_number: str) -> bool:
                 "INSERT INTO users (user_id, username, first_name, source, signup_date, phone_number, contact_shared_date) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (user_id, "N/A", "N/A", "contact_direct", contact_time, phone_number, contact_time)
             )
+            _rollup_commit(conn, {user_id: None})
             logging.info(f"SQLite | Создан новый пользователь {user_id} с контактом: {phone_number}")
         else:
             # Если пользователь существует, обновляем его контакт
@@ -581,10 +852,10 @@ def update_user_contact(user_id: int, phone_number: str) -> bool:
         
         conn.commit()
         conn.close()
+        _notify_user_changed(user_id)
         
-        # Обновляем в Google Sheets в фоновом режиме
-        if GOOGLE_SHEETS_ENABLED:
-            threading.Thread(target=_update_contact_in_sheets_in_background, args=(user_id, phone_number, contact_time)).start()
+        # Обновляем в Google Sheets через фоновую очередь
+        _queue_sheets_update(user_id, {SHEET_COL_PHONE: phone_number})
         
         return True
     except Exception as e:
@@ -623,6 +894,7 @@ def update_user_name(user_id: int, real_name: str) -> bool:
                 "INSERT INTO users (user_id, username, first_name, source, signup_date, real_name) VALUES (?, ?, ?, ?, ?, ?)",
                 (user_id, "N/A", real_name, "name_direct", current_time, real_name)
             )
+            _rollup_commit(conn, {user_id: None})
             logging.info(f"SQLite | Создан новый пользователь {user_id} с именем: {real_name}")
         else:
             # Если пользователь существует, обновляем его имя
@@ -634,10 +906,10 @@ def update_user_name(user_id: int, real_name: str) -> bool:
         
         conn.commit()
         conn.close()
+        _notify_user_changed(user_id)
         
-        # Обновляем в Google Sheets в фоновом режиме
-        if GOOGLE_SHEETS_ENABLED:
-            threading.Thread(target=_update_name_in_sheets_in_background, args=(user_id, real_name)).start()
+        # Обновляем в Google Sheets через фоновую очередь
+        _queue_sheets_update(user_id, {SHEET_COL_REAL_NAME: real_name})
         
         return True
     except Exception as e:
@@ -661,6 +933,7 @@ def update_user_birth_date(user_id: int, birth_date: str) -> bool:
                 "INSERT INTO users (user_id, username, first_name, source, signup_date, birth_date, profile_completed) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (user_id, "N/A", "N/A", "birth_direct", current_time, birth_date, 1)
             )
+            _rollup_commit(conn, {user_id: None})
             logging.info(f"SQLite | Создан новый пользователь {user_id} с датой рождения: {birth_date}")
         else:
             # Если пользователь существует, обновляем его дату рождения
@@ -672,10 +945,10 @@ def update_user_birth_date(user_id: int, birth_date: str) -> bool:
         
         conn.commit()
         conn.close()
+        _notify_user_changed(user_id)
         
-        # Обновляем в Google Sheets в фоновом режиме
-        if GOOGLE_SHEETS_ENABLED:
-            threading.Thread(target=_update_birth_date_in_sheets_in_background, args=(user_id, birth_date)).start()
+        # Обновляем в Google Sheets через фоновую очередь
+        _queue_sheets_update(user_id, {SHEET_COL_BIRTH_DATE: birth_date})
         
         return True
     except Exception as e:
@@ -689,6 +962,7 @@ def update_user_source(user_id: int, source: str) -> bool:
         try:
             success = pg_client.update_user_source(user_id, source)
             if success:
+                get_repository().mirror('update_user', user_id, source=source)
                 return True
         except Exception as e:
             logging.error(f"PostgreSQL | Ошибка обновления источника: {e}")
@@ -697,11 +971,13 @@ def update_user_source(user_id: int, source: str) -> bool:
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        before = _rollup_snapshot(conn, [user_id])
         
         cur.execute(
             "UPDATE users SET source = ? WHERE user_id = ?",
             (source, user_id)
         )
+        _rollup_commit(conn, before)
         
         conn.commit()
         conn.close()
@@ -760,11 +1036,13 @@ def get_reward_status(user_id: int) -> str:
     return user['status'] if user else 'not_found'
 
 def delete_user(user_id: int) -> Tuple[bool, str]:
+    _notify_user_changed(user_id)
     # Сначала пробуем PostgreSQL
     if USE_POSTGRES and pg_client:
         try:
             success, msg = pg_client.delete_user(user_id)
             if success:
+                get_repository().mirror('delete_user', user_id)
                 return success, msg
         except Exception as e:
             logging.error(f"PostgreSQL | Ошибка удаления пользователя: {e}")
@@ -773,8 +1051,11 @@ def delete_user(user_id: int) -> Tuple[bool, str]:
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        before = _rollup_snapshot(conn, [user_id])
         cur.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
         deleted = cur.rowcount > 0
+        if deleted:
+            _rollup_commit(conn, before)
         conn.commit()
         conn.close()
         if deleted:
@@ -850,6 +1131,7 @@ def update_user_concept(user_id: int, concept: str) -> bool:
         cur.execute("UPDATE users SET ai_concept = ? WHERE user_id = ?", (concept, user_id))
         conn.commit()
         conn.close()
+        _notify_user_changed(user_id)
         
         logging.info(f"Концепция пользователя {user_id} обновлена на {concept}")
         return True
@@ -858,14 +1140,22 @@ def update_user_concept(user_id: int, concept: str) -> bool:
         logging.error(f"Ошибка при обновлении концепции пользователя {user_id}: {e}")
         return False
 
-def get_redeemed_users_for_audit() -> List[sqlite3.Row]:
+def get_redeemed_users_for_audit(checked_before: Optional[str] = None) -> List[sqlite3.Row]:
+    """
+    Погасившие купон для проверки подписки: сначала никогда не проверенные,
+    затем по давности last_check_date.
+
+    checked_before — пропустить проверенных начиная с этого момента
+    (при продолжении прерванного прогона аудитора).
+    """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE status = 'redeemed'")
-        users = cur.fetchall()
-        conn.close()
-        return users
+        with db_connection() as conn:
+            return conn.execute("""
+                SELECT user_id, source, last_check_date FROM users
+                WHERE status = 'redeemed'
+                  AND (? IS NULL OR last_check_date IS NULL OR last_check_date < ?)
+                ORDER BY last_check_date IS NOT NULL, last_check_date, user_id
+            """, (checked_before, checked_before)).fetchall()
     except Exception as e:
         logging.error(f"Аудитор | Ошибка получения пользователей для проверки: {e}")
         return []
@@ -875,36 +1165,112 @@ def mark_user_as_left(user_id: int):
         conn = get_db_connection()
         cur = conn.cursor()
         now = datetime.datetime.now(pytz.utc)
+        before = _rollup_snapshot(conn, [user_id])
         cur.execute("UPDATE users SET status = ?, last_check_date = ? WHERE user_id = ?", ('redeemed_and_left', now, user_id))
+        _rollup_commit(conn, before)
         conn.commit()
         conn.close()
+        _notify_user_changed(user_id)
         logging.info(f"Аудитор | Пользователь {user_id} помечен как отписавшийся.")
     except Exception as e:
         logging.error(f"Аудитор | Ошибка при обновлении статуса пользователя {user_id}: {e}")
 
+def _audit_update_in(sql: str, user_ids, *params, track_rollup: bool = False) -> int:
+    """UPDATE ... WHERE user_id IN (...) пачками по 500 (лимит параметров SQLite)."""
+    user_ids = sorted({int(uid) for uid in user_ids})
+    updated = 0
+    with db_connection() as conn:
+        before = _rollup_snapshot(conn, user_ids) if track_rollup else None
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cur = conn.execute(sql.format(ids=','.join('?' * len(chunk))), [*params, *chunk])
+            updated += cur.rowcount
+        if before is not None:
+            _rollup_commit(conn, before)
+    return updated
+
+def mark_users_as_left(user_ids) -> int:
+    """Помечает пачку пользователей как отписавшихся. Возвращает число обновлённых (-1 при ошибке)."""
+    if not user_ids:
+        return 0
+    try:
+        now = datetime.datetime.now(pytz.utc)
+        updated = _audit_update_in(
+            "UPDATE users SET status = 'redeemed_and_left', last_check_date = ? "
+            "WHERE status = 'redeemed' AND user_id IN ({ids})", user_ids, now, track_rollup=True)
+        for user_id in user_ids:
+            _notify_user_changed(user_id)
+        logging.info(f"Аудитор | Помечено отписавшихся: {updated}")
+        return updated
+    except Exception as e:
+        logging.error(f"Аудитор | Ошибка пакетного обновления отписавшихся ({len(user_ids)}): {e}")
+        return -1
+
+def touch_users_audit_checked(user_ids) -> int:
+    """Обновляет last_check_date у проверенных и оставшихся подписанными (-1 при ошибке)."""
+    if not user_ids:
+        return 0
+    try:
+        now = datetime.datetime.now(pytz.utc)
+        return _audit_update_in("UPDATE users SET last_check_date = ? WHERE user_id IN ({ids})", user_ids, now)
+    except Exception as e:
+        logging.error(f"Аудитор | Ошибка обновления даты проверки ({len(user_ids)}): {e}")
+        return -1
+
+def start_audit_run(resume_within_hours: float = 20) -> Optional[Dict[str, Any]]:
+    """
+    Начинает прогон аудитора или продолжает прерванный (status='running',
+    начатый не раньше resume_within_hours назад). Более старые прерванные
+    прогоны помечаются 'aborted'.
+
+    Returns:
+        {'id', 'started_at', 'checked_count', 'left_count', 'error_count', 'resumed'}
+    """
+    try:
+        now = datetime.datetime.now(pytz.utc)
+        cutoff = str(now - datetime.timedelta(hours=resume_within_hours))
+        with db_connection() as conn:
+            row = conn.execute("""
+                SELECT id, started_at, checked_count, left_count, error_count FROM audit_runs
+                WHERE status = 'running' ORDER BY id DESC LIMIT 1
+            """).fetchone()
+            if row and row['started_at'] >= cutoff:
+                return {'id': row['id'], 'started_at': row['started_at'],
+                        'checked_count': row['checked_count'] or 0, 'left_count': row['left_count'] or 0,
+                        'error_count': row['error_count'] or 0, 'resumed': True}
+            conn.execute("UPDATE audit_runs SET status = 'aborted' WHERE status = 'running'")
+            started_at = str(now)
+            cur = conn.execute("INSERT INTO audit_runs (started_at, status) VALUES (?, 'running')", (started_at,))
+            return {'id': cur.lastrowid, 'started_at': started_at,
+                    'checked_count': 0, 'left_count': 0, 'error_count': 0, 'resumed': False}
+    except Exception as e:
+        logging.error(f"Аудитор | Ошибка создания прогона: {e}")
+        return None
+
+def checkpoint_audit_run(run_id: int, total: int, checked: int, left: int, errors: int, status: str = 'running'):
+    """Сохраняет прогресс прогона аудитора; status != 'running' завершает прогон."""
+    try:
+        now = str(datetime.datetime.now(pytz.utc))
+        with db_connection() as conn:
+            conn.execute("""
+                UPDATE audit_runs
+                SET total_users = ?, checked_count = ?, left_count = ?, error_count = ?,
+                    checkpoint_at = ?, status = ?,
+                    finished_at = CASE WHEN ? = 'running' THEN finished_at ELSE ? END
+                WHERE id = ?
+            """, (total, checked, left, errors, now, status, status, now, run_id))
+    except Exception as e:
+        logging.error(f"Аудитор | Ошибка сохранения чекпоинта прогона {run_id}: {e}")
+
 def get_daily_churn_data(start_time: datetime, end_time: datetime) -> Tuple[int, int]:
+    """(погашено за период, из них отписались) — по почасовым агрегатам, с точностью до часа."""
     try:
         # Используем PostgreSQL если включен
         if USE_POSTGRES and pg_client:
             return pg_client.get_daily_churn_data(start_time, end_time)
         
-        # Иначе используем SQLite
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Конвертируем datetime в строку формата, подходящего для текущей БД
-        start_str = _format_dt_for_db(start_time)
-        end_str = _format_dt_for_db(end_time)
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE redeem_date BETWEEN ? AND ? AND status IN ('redeemed', 'redeemed_and_left')", (start_str, end_str))
-        redeemed_total = cur.fetchone()[0]
-        cur.execute(
-            "SELECT COUNT(*) FROM users WHERE redeem_date BETWEEN ? AND ? AND status = 'redeemed_and_left'",
-            (start_str, end_str)
-        )
-        left_count = cur.fetchone()[0]
-        conn.close()
-        return redeemed_total, left_count
+        start_key, end_key = report_rollup.hour_range(start_time, end_time)
+        return report_rollup.summarize_churn(_load_report_rollup(start_key, end_key), start_key, end_key)
     except Exception as e:
         logging.error(f"Отчет | Ошибка получения данных о дневном оттоке: {e}")
         return 0, 0
@@ -933,74 +1299,121 @@ def get_full_churn_analysis() -> Tuple[int, Dict[str, int]]:
         return 0, {}
 
 def get_report_data_for_period(start_time: datetime, end_time: datetime) -> tuple:
+    """
+    (выдано, погашено, [], источники, суммарное время до погашения) за период —
+    сумма строк report_hourly_rollup за часы периода (с точностью до часа).
+    """
     try:
         # Используем PostgreSQL если включен
         if USE_POSTGRES and pg_client:
             return pg_client.get_report_data_for_period(start_time, end_time)
         
-        # Иначе используем SQLite
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Конвертируем datetime в строку формата, подходящего для текущей БД
-        start_str = _format_dt_for_db(start_time)
-        end_str = _format_dt_for_db(end_time)
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE signup_date BETWEEN ? AND ? AND status IN ('issued', 'redeemed', 'redeemed_and_left')", (start_str, end_str))
-        issued_count = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users WHERE redeem_date BETWEEN ? AND ?", (start_str, end_str))
-        redeemed_count = cur.fetchone()[0]
-        cur.execute("SELECT source, COUNT(*) FROM users WHERE signup_date BETWEEN ? AND ? GROUP BY source", (start_str, end_str))
-        all_sources = {row['source']: row['COUNT(*)'] for row in cur.fetchall()}
-        
-        # Фильтруем источники: все обычные источники
-        sources = {k: v for k, v in all_sources.items() if k != "staff"}
-        
-        # Подсчитываем переходы от сотрудников отдельно
-        staff_count = all_sources.get("staff", 0)
-        if staff_count > 0:
-            sources["staff"] = staff_count
-        total_redeem_time_seconds = 0
-        if redeemed_count > 0:
-            cur.execute("SELECT SUM(strftime('%s', redeem_date) - strftime('%s', signup_date)) FROM users WHERE redeem_date BETWEEN ? AND ? AND status IN ('redeemed', 'redeemed_and_left')", (start_str, end_str))
-            total_redeem_time_seconds_row = cur.fetchone()[0]
-            total_redeem_time_seconds = total_redeem_time_seconds_row or 0
-        conn.close()
-        return issued_count, redeemed_count, [], sources, total_redeem_time_seconds
+        start_key, end_key = report_rollup.hour_range(start_time, end_time)
+        return report_rollup.summarize_report(_load_report_rollup(start_key, end_key), start_key, end_key)
     except Exception as e:
         logging.error(f"Ошибка сбора данных для отчета: {e}")
         return 0, 0, [], {}, 0
 
 def log_conversation_turn(user_id: int, role: str, text: str):
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO conversation_history (user_id, role, text) VALUES (?, ?, ?)",
-            (user_id, role, text)
-        )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logging.error(f"Ошибка логирования диалога для {user_id}: {e}")
+    get_repository().log_conversation_turn(user_id, role, text)
 
 def get_conversation_history(user_id: int, limit: int = 10) -> List[Dict[str, str]]:
-    history = []
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT role, text FROM conversation_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, limit)
-        )
-        rows = cur.fetchall()
-        conn.close()
-        for row in reversed(rows):
-            history.append({"role": row['role'], "content": row['text']})
-        return history
-    except Exception as e:
-        logging.error(f"Ошибка получения истории диалога для {user_id}: {e}")
-        return history
+    return [{"role": turn.role, "content": turn.text}
+            for turn in get_repository().conversation_history(user_id, limit)]
+
+# Реплики из SQLite получают в PostgreSQL id «SQLite id - сдвиг»: отрицательные,
+# поэтому порядок сохраняется и все они старше реплик, записанных уже в PostgreSQL
+_HISTORY_PG_ID_SHIFT = 10 ** 15
+_HISTORY_MIGRATION_MARK = 'conversation_history_to_postgres'
+
+def migrate_conversation_history_to_postgres(batch_size: int = 1000) -> int:
+    """
+    Однократный перенос истории диалогов AI из SQLite в PostgreSQL: в режиме
+    PostgreSQL история читается из основной БД, и без переноса гости потеряли
+    бы контекст. Граница (последний id SQLite на первом запуске) и ход переноса
+    хранятся в job_watermarks: прерванный перенос продолжается с места остановки,
+    а реплики, которые двойная запись позже дописывает в SQLite, не копируются.
+    Возвращает число перенесённых реплик.
+    """
+    mark = get_job_watermark(_HISTORY_MIGRATION_MARK) or {}
+    if mark.get('done'):
+        return 0
+    moved = 0
+    try:
+        with db_connection() as conn:
+            upto = mark.get('upto') or conn.execute("SELECT MAX(id) FROM conversation_history").fetchone()[0] or 0
+        last_id = mark.get('last_id', 0)
+        while last_id < upto:
+            with db_connection() as conn:
+                rows = [dict(row) for row in conn.execute(
+                    "SELECT id, user_id, role, text, timestamp FROM conversation_history "
+                    "WHERE id > ? AND id <= ? ORDER BY id LIMIT ?", (last_id, upto, batch_size))]
+            if not rows:
+                break
+            pg_client.import_conversation_history(
+                [dict(row, id=row['id'] - _HISTORY_PG_ID_SHIFT) for row in rows])
+            last_id = rows[-1]['id']
+            moved += len(rows)
+            set_job_watermark(_HISTORY_MIGRATION_MARK, {'upto': upto, 'last_id': last_id})
+    except Exception as e:
+        logging.error(f"PostgreSQL | Перенос истории диалогов прерван ({moved} реплик), "
+                      f"продолжится при следующем запуске: {e}")
+        return moved
+    set_job_watermark(_HISTORY_MIGRATION_MARK, {'upto': upto, 'last_id': last_id, 'done': True})
+    if moved:
+        logging.info(f"PostgreSQL | История диалогов перенесена из SQLite: {moved} реплик")
+    return moved
+
+def get_user_ai_context(user_id: int, history_limit: int = 12) -> Dict[str, Any]:
+    """
+    Всё, что нужно AI-хендлеру о пользователе, за один запрос к основной БД:
+    строка users (вместе с ai_concept) и последние history_limit реплик диалога.
+    В users PostgreSQL нет ai_concept и профиля — они читаются из локальной
+    SQLite по первичному ключу (как в get_user_concept и find_user_by_id).
+
+    Returns:
+        {'user': dict | None, 'concept': str, 'history': [{'role', 'content'}, ...]}
+    """
+    if USE_POSTGRES and pg_client:
+        context = pg_client.get_user_ai_context(user_id, history_limit)
+        sqlite_user = None
+        try:
+            with db_connection() as conn:
+                row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            sqlite_user = dict(row) if row else None
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка поиска пользователя {user_id}: {e}")
+        concept = (context['user'] or {}).get('ai_concept') or (sqlite_user or {}).get('ai_concept')
+        context['user'] = context['user'] or sqlite_user
+        context['concept'] = concept or 'evgenich'
+        return context
+
+    context = {'user': None, 'concept': 'evgenich', 'history': []}
+    try:
+        with db_connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT u.*, h.id AS _history_id, h.role AS _history_role, h.text AS _history_text
+                FROM (SELECT ? AS uid) q
+                LEFT JOIN users u ON u.user_id = q.uid
+                LEFT JOIN (
+                    SELECT id, role, text FROM conversation_history
+                    WHERE user_id = ? ORDER BY id DESC LIMIT ?
+                ) h ON 1 = 1
+                ORDER BY h.id DESC
+                """,
+                (user_id, user_id, history_limit)
+            ).fetchall()
+        if rows and rows[0]['user_id'] is not None:
+            context['user'] = {key: rows[0][key] for key in rows[0].keys() if not key.startswith('_history_')}
+            context['concept'] = context['user'].get('ai_concept') or 'evgenich'
+        context['history'] = [
+            {"role": row['_history_role'], "content": row['_history_text']}
+            for row in reversed(rows) if row['_history_id'] is not None
+        ]
+    except Exception as e:
+        logging.error(f"Ошибка получения контекста AI для {user_id}: {e}")
+    return context
 
 def log_ai_feedback(user_id: int, query: str, response: str, rating: str):
     try:
@@ -1017,6 +1430,10 @@ def log_ai_feedback(user_id: int, query: str, response: str, rating: str):
         
 def get_top_referrers_for_month(limit: int = 5) -> List[Tuple[str, int]]:
     try:
+        # Границы текущего месяца (UTC, как хранится redeem_date) — диапазон по индексу idx_users_redeem_date
+        now = datetime.datetime.now(pytz.utc)
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        next_month = (month_start + datetime.timedelta(days=32)).replace(day=1)
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute("""
@@ -1024,11 +1441,12 @@ def get_top_referrers_for_month(limit: int = 5) -> List[Tuple[str, int]]:
             FROM users
             WHERE status IN ('redeemed', 'redeemed_and_left')
               AND referrer_id IS NOT NULL
-              AND strftime('%Y-%m', redeem_date) = strftime('%Y-%m', 'now')
+              AND redeem_date IS NOT NULL
+              AND redeem_date >= ? AND redeem_date < ?
             GROUP BY referrer_id
             ORDER BY ref_count DESC
             LIMIT ?
-        """, (limit,))
+        """, (month_start.strftime('%Y-%m-%d %H:%M:%S'), next_month.strftime('%Y-%m-%d %H:%M:%S'), limit))
         top_referrers_ids = cur.fetchall()
         if not top_referrers_ids:
             conn.close()
@@ -1050,6 +1468,14 @@ def get_daily_updates() -> dict:
 
 # --- Функции для реферальной системы наград ---
 
+# Причины отказа check_referral_reward_eligibility (те же строки — в PostgresClient).
+# Окончательные: награду за этого реферала выдавать не нужно
+REFERRAL_NOT_FOUND = "Реферал не найден"
+REFERRAL_ALREADY_REWARDED = "Награда уже была выдана"
+REFERRAL_NOT_REDEEMED = "Реферал еще не получил настойку"
+# Временная: проверка не удалась (ошибка БД), повторить позже
+REFERRAL_CHECK_ERROR = "Ошибка проверки"
+
 def check_referral_reward_eligibility(referrer_id: int, referred_id: int):
     """
     Проверяет, можно ли выдать награду за реферала.
@@ -1076,19 +1502,19 @@ def check_referral_reward_eligibility(referrer_id: int, referred_id: int):
         result = cur.fetchone()
         if not result:
             conn.close()
-            return False, "Реферал не найден"
+            return False, REFERRAL_NOT_FOUND
         
         signup_date_str, redeem_date, referrer_rewarded = result
         
         # Проверяем, была ли уже выдана награда
         if referrer_rewarded:
             conn.close()
-            return False, "Награда уже была выдана"
+            return False, REFERRAL_ALREADY_REWARDED
         
         # Проверяем, получил ли реферал настойку
         if not redeem_date:
             conn.close()
-            return False, "Реферал еще не получил настойку"
+            return False, REFERRAL_NOT_REDEEMED
         
         # Проверяем, прошло ли 48 часов с момента регистрации
         if signup_date_str:
@@ -1106,11 +1532,12 @@ def check_referral_reward_eligibility(referrer_id: int, referred_id: int):
         
     except Exception as e:
         logging.error(f"Ошибка проверки права на награду: {e}")
-        return False, "Ошибка проверки"
+        return False, REFERRAL_CHECK_ERROR
 
 def mark_referral_rewarded(referrer_id: int, referred_id: int):
     """
-    Отмечает, что награда за реферала была выдана
+    Отмечает, что награда за реферала была выдана.
+    True — только если отметил именно этот вызов (награда выдаётся один раз).
     """
     try:
         if USE_POSTGRES and pg_client:
@@ -1124,7 +1551,7 @@ def mark_referral_rewarded(referrer_id: int, referred_id: int):
             UPDATE users 
             SET referrer_rewarded = 1,
                 referrer_rewarded_date = ?
-            WHERE user_id = ? AND referrer_id = ?
+            WHERE user_id = ? AND referrer_id = ? AND COALESCE(referrer_rewarded, 0) = 0
         """, (datetime.datetime.now(pytz.utc).isoformat(), referred_id, referrer_id))
         
         conn.commit()
@@ -1207,145 +1634,237 @@ def get_referral_stats(user_id: int):
         logging.error(f"Ошибка получения статистики рефералов: {e}")
         return None
 
-def get_users_with_pending_rewards():
+def get_referrals_redeemed_since(after_redeem_date: Optional[str] = None, after_user_id: int = 0,
+                                 limit: int = 500) -> List[Dict[str, Any]]:
     """
-    Возвращает список user_id пользователей, у которых есть рефералы,
-    готовые к получению награды
+    Рефералы без награды рефереру, погасившие купон после отметки
+    (after_redeem_date, after_user_id), по возрастанию (redeem_date, user_id).
+    Сверка utils/referral_notifications идёт по ним страницами, а не сканом всех.
+    Returns:
+        [{'user_id', 'referrer_id', 'redeem_date'}]; redeem_date — строка, годная как следующая отметка
     """
     try:
         if USE_POSTGRES and pg_client:
-            return pg_client.get_users_with_pending_rewards()
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Находим всех пользователей с рефералами, которые:
-        # 1. Получили настойку
-        # 2. Зарегистрированы более 48 часов назад
-        # 3. Еще не получили награду
-        cur.execute("""
-            SELECT DISTINCT referrer_id
-            FROM users
-            WHERE referrer_id IS NOT NULL
-            AND redeem_date IS NOT NULL
-            AND referrer_rewarded = 0
-            AND julianday('now') - julianday(signup_date) > 2
-        """)
-        
-        users = [row[0] for row in cur.fetchall()]
-        conn.close()
-        
-        return users
-        
-    except Exception as e:
-        logging.error(f"Ошибка получения пользователей с наградами: {e}")
+            return pg_client.get_referrals_redeemed_since(after_redeem_date, after_user_id, limit)
+
+        with db_connection() as conn:
+            rows = conn.execute("""
+                SELECT user_id, referrer_id, redeem_date FROM users
+                WHERE referrer_id IS NOT NULL AND redeem_date IS NOT NULL AND referrer_rewarded = 0
+                  AND (redeem_date > ? OR (redeem_date = ? AND user_id > ?))
+                ORDER BY redeem_date, user_id LIMIT ?
+            """, (after_redeem_date or '', after_redeem_date or '', after_user_id, limit)).fetchall()
+        return [{'user_id': row['user_id'], 'referrer_id': row['referrer_id'], 'redeem_date': str(row['redeem_date'])}
+                for row in rows]
+    except Exception as e:
+        logging.error(f"Ошибка получения погасивших рефералов: {e}")
         return []
 
-def get_recently_redeemed_referrals(hours: int = 2):
-    """
-    Возвращает список рефералов, которые получили настойку в последние N часов
-    """
+def get_job_watermark(name: str) -> Optional[Dict[str, Any]]:
+    """Отметка фоновой сверки name (докуда просмотрены данные) или None."""
     try:
-        if USE_POSTGRES and pg_client:
-            return pg_client.get_recently_redeemed_referrals(hours)
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Находим рефералов, получивших настойку в последние N часов
-        hours_ago = datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=hours)
-        
-        cur.execute("""
-            SELECT user_id, username, first_name, referrer_id, redeem_date
-            FROM users
-            WHERE referrer_id IS NOT NULL
-            AND redeem_date IS NOT NULL
-            AND datetime(redeem_date) >= datetime(?)
-            AND referrer_rewarded = 0
-            ORDER BY redeem_date DESC
-        """, (hours_ago.isoformat(),))
-        
-        recent_referrals = []
-        for row in cur.fetchall():
-            user_id, username, first_name, referrer_id, redeem_date = row
-            recent_referrals.append({
-                'user_id': user_id,
-                'username': username,
-                'first_name': first_name,
-                'referrer_id': referrer_id,
-                'redeem_date': redeem_date
-            })
-        
-        conn.close()
-        return recent_referrals
-        
+        with db_connection() as conn:
+            row = conn.execute("SELECT value FROM job_watermarks WHERE name = ?", (name,)).fetchone()
+        return json.loads(row['value']) if row and row['value'] else None
     except Exception as e:
-        logging.error(f"Ошибка получения недавних активаций рефералов: {e}")
-        return []
+        logging.error(f"Ошибка чтения отметки '{name}': {e}")
+        return None
+
+def set_job_watermark(name: str, value: Dict[str, Any]):
+    """Сохраняет отметку фоновой сверки name."""
+    try:
+        with db_connection() as conn:
+            conn.execute(
+                "INSERT INTO job_watermarks (name, value, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (name, json.dumps(value, ensure_ascii=False, default=str), str(datetime.datetime.now(pytz.utc)))
+            )
+    except Exception as e:
+        logging.error(f"Ошибка сохранения отметки '{name}': {e}")
 
 # --- Функции для работы с отложенными задачами (delayed_tasks) ---
 
+def _task_time(moment: datetime.datetime) -> str:
+    """Время задачи для next_run_at / claimed_until: UTC без tz, сортируется как строка."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(pytz.utc).replace(tzinfo=None)
+    return moment.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def _parse_task_time(value) -> Optional[datetime.datetime]:
+    """Обратное к _task_time (и разбор старых scheduled_time): aware datetime в UTC."""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, datetime.datetime):
+        try:
+            value = datetime.datetime.fromisoformat(str(value).strip())
+        except ValueError:
+            return None
+    return pytz.utc.localize(value) if value.tzinfo is None else value.astimezone(pytz.utc)
+
+def _delayed_task_dict(row) -> Dict[str, Any]:
+    task = dict(row)
+    try:
+        task['payload'] = json.loads(task.get('payload') or '{}')
+    except (TypeError, ValueError):
+        task['payload'] = {}
+    return task
+
+def schedule_delayed_task(user_id: int, task_type: str, run_at: datetime.datetime,
+                          payload: Optional[Dict[str, Any]] = None) -> Optional[int]:
+    """Сохраняет отложенную задачу. Возвращает её id (None при ошибке)."""
+    try:
+        with db_connection() as conn:
+            cur = conn.execute(
+                "INSERT INTO delayed_tasks (user_id, task_type, scheduled_time, next_run_at, payload) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, task_type, _parse_task_time(run_at), _task_time(run_at),
+                 json.dumps(payload, ensure_ascii=False) if payload else None)
+            )
+            task_id = cur.lastrowid
+        logging.info(f"Отложенная задача '{task_type}' #{task_id} запланирована для пользователя {user_id} на {run_at}")
+        return task_id
+    except Exception as e:
+        logging.error(f"Ошибка планирования отложенной задачи для {user_id}: {e}")
+        return None
+
 def schedule_delayed_message(user_id: int, task_type: str, delay_minutes: int = 10):
     """Планирует отложенное сообщение для пользователя."""
+    run_at = datetime.datetime.now(pytz.utc) + datetime.timedelta(minutes=delay_minutes)
+    return schedule_delayed_task(user_id, task_type, run_at)
+
+def get_pending_delayed_tasks() -> List[Dict[str, Any]]:
+    """Получает все отложенные задачи, готовые к выполнению (без захвата)."""
     try:
-        scheduled_time = datetime.datetime.now(pytz.utc) + datetime.timedelta(minutes=delay_minutes)
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO delayed_tasks (user_id, task_type, scheduled_time) VALUES (?, ?, ?)",
-            (user_id, task_type, scheduled_time)
-        )
-        conn.commit()
-        conn.close()
-        logging.info(f"Отложенная задача '{task_type}' запланирована для пользователя {user_id} на {scheduled_time}")
+        with db_connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM delayed_tasks WHERE status = 'pending' AND next_run_at <= ? ORDER BY next_run_at",
+                (_task_time(datetime.datetime.now(pytz.utc)),)
+            ).fetchall()
+        return [_delayed_task_dict(row) for row in rows]
     except Exception as e:
-        logging.error(f"Ошибка планирования отложенной задачи для {user_id}: {e}")
+        logging.error(f"Ошибка получения отложенных задач: {e}")
+        return []
+
+def get_next_delayed_task_time() -> Optional[datetime.datetime]:
+    """
+    Когда в следующий раз будет что захватить: ближайшая ожидающая задача или
+    окончание аренды выполняемой (задачу упавшего экземпляра подхватят вовремя).
+    Каждая половина идёт по своему частичному индексу. None — задач нет.
+    """
+    try:
+        with db_connection() as conn:
+            row = conn.execute(
+                "SELECT MIN(moment) FROM ("
+                "SELECT MIN(next_run_at) AS moment FROM delayed_tasks WHERE status = 'pending' "
+                "UNION ALL "
+                "SELECT MIN(claimed_until) FROM delayed_tasks WHERE status = 'running')"
+            ).fetchone()
+        return _parse_task_time(row[0]) if row else None
+    except Exception as e:
+        logging.error(f"Ошибка получения времени ближайшей отложенной задачи: {e}")
+        return None
 
-def get_pending_delayed_tasks() -> List[sqlite3.Row]:
-    """Получает все отложенные задачи, готовые к выполнению."""
+def delayed_task_exists(user_id: int, task_type: str, payload_match: Optional[Dict[str, Any]] = None) -> bool:
+    """Есть ли у пользователя ожидающая или выполняемая задача task_type, payload которой содержит payload_match."""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        now = datetime.datetime.now(pytz.utc)
-        cur.execute(
-            "SELECT * FROM delayed_tasks WHERE status = 'pending' AND scheduled_time <= ?",
-            (now,)
-        )
-        tasks = cur.fetchall()
-        conn.close()
-        return tasks
+        with db_connection() as conn:
+            rows = conn.execute(
+                "SELECT payload FROM delayed_tasks WHERE user_id = ? AND task_type = ? "
+                "AND status IN ('pending', 'running')",
+                (user_id, task_type)
+            ).fetchall()
+        for row in rows:
+            payload = json.loads(row['payload']) if row['payload'] else {}
+            if all(payload.get(key) == value for key, value in (payload_match or {}).items()):
+                return True
+        return False
     except Exception as e:
-        logging.error(f"Ошибка получения отложенных задач: {e}")
+        logging.error(f"Ошибка поиска отложенной задачи '{task_type}' для {user_id}: {e}")
+        return False
+
+def claim_due_delayed_tasks(worker_id: str, limit: int, lease_seconds: float = 300) -> List[Dict[str, Any]]:
+    """
+    Атомарно захватывает до limit наступивших задач: status = 'running' и аренда
+    на lease_seconds. BEGIN IMMEDIATE берёт блокировку записи сразу, поэтому
+    два процесса (или экземпляра бота) одну задачу не захватят. Задачи упавшего
+    экземпляра (аренда истекла) захватываются повторно.
+    """
+    if limit <= 0:
+        return []
+    now = datetime.datetime.now(pytz.utc)
+    now_text = _task_time(now)
+    claimed_until = _task_time(now + datetime.timedelta(seconds=lease_seconds))
+    try:
+        with db_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM delayed_tasks WHERE status = 'pending' AND next_run_at <= ? "
+                "ORDER BY next_run_at LIMIT ?", (now_text, limit))]
+            if len(ids) < limit:
+                ids += [row[0] for row in conn.execute(
+                    "SELECT id FROM delayed_tasks WHERE status = 'running' AND claimed_until <= ? "
+                    "ORDER BY claimed_until LIMIT ?", (now_text, limit - len(ids)))]
+            if not ids:
+                return []
+            placeholders = ','.join('?' * len(ids))
+            conn.execute(
+                f"UPDATE delayed_tasks SET status = 'running', claimed_by = ?, claimed_until = ?, "
+                f"attempts = COALESCE(attempts, 0) + 1 WHERE id IN ({placeholders})",
+                (worker_id, claimed_until, *ids)
+            )
+            rows = conn.execute(
+                f"SELECT * FROM delayed_tasks WHERE id IN ({placeholders}) ORDER BY next_run_at", ids
+            ).fetchall()
+        return [_delayed_task_dict(row) for row in rows]
+    except Exception as e:
+        logging.error(f"Ошибка захвата отложенных задач: {e}")
         return []
 
 def mark_delayed_task_completed(task_id: int):
     """Помечает отложенную задачу как выполненную."""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE delayed_tasks SET status = 'completed' WHERE id = ?",
-            (task_id,)
-        )
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            conn.execute(
+                "UPDATE delayed_tasks SET status = 'completed', completed_at = ?, claimed_until = NULL WHERE id = ?",
+                (_task_time(datetime.datetime.now(pytz.utc)), task_id)
+            )
         logging.info(f"Отложенная задача {task_id} помечена как выполненная")
     except Exception as e:
         logging.error(f"Ошибка обновления статуса задачи {task_id}: {e}")
 
+def retry_delayed_task(task_id: int, run_at: datetime.datetime, error: str):
+    """Возвращает задачу в очередь на повтор в run_at."""
+    try:
+        with db_connection() as conn:
+            conn.execute(
+                "UPDATE delayed_tasks SET status = 'pending', next_run_at = ?, claimed_by = NULL, "
+                "claimed_until = NULL, last_error = ? WHERE id = ?",
+                (_task_time(run_at), error[:500], task_id)
+            )
+    except Exception as e:
+        logging.error(f"Ошибка переноса задачи {task_id}: {e}")
+
+def fail_delayed_task(task_id: int, error: str):
+    """Помечает задачу как окончательно невыполненную."""
+    try:
+        with db_connection() as conn:
+            conn.execute(
+                "UPDATE delayed_tasks SET status = 'failed', completed_at = ?, claimed_until = NULL, "
+                "last_error = ? WHERE id = ?",
+                (_task_time(datetime.datetime.now(pytz.utc)), error[:500], task_id)
+            )
+    except Exception as e:
+        logging.error(f"Ошибка обновления статуса задачи {task_id}: {e}")
+
 def cleanup_old_delayed_tasks(days_old: int = 7):
-    """Удаляет старые выполненные задачи."""
+    """Удаляет старые выполненные и окончательно невыполненные задачи."""
     try:
         cutoff_date = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=days_old)
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "DELETE FROM delayed_tasks WHERE status = 'completed' AND created_at < ?",
-            (cutoff_date,)
-        )
-        deleted_count = cur.rowcount
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            deleted_count = conn.execute(
+                "DELETE FROM delayed_tasks WHERE status IN ('completed', 'failed') AND created_at < ?",
+                (cutoff_date.strftime('%Y-%m-%d %H:%M:%S'),)
+            ).rowcount
         if deleted_count > 0:
             logging.info(f"Удалено {deleted_count} старых отложенных задач")
     except Exception as e:
@@ -1395,18 +1914,8 @@ def is_waiting_for_iiko_data(report_date: datetime.date) -> bool:
 # --- Функции для работы с рассылками ---
 
 def get_newsletter_audience_count() -> int:
-    """Возвращает количество активных пользователей для рассылки."""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # Считаем всех зарегистрированных пользователей (исключаем только полностью отписавшихся)
-        cur.execute("SELECT COUNT(*) FROM users WHERE status != 'redeemed_and_left'")
-        count = cur.fetchone()[0]
-        conn.close()
-        return count
-    except Exception as e:
-        logging.error(f"Ошибка подсчета аудитории рассылки: {e}")
-        return 0
+    """Возвращает количество активных пользователей для рассылки (все, кроме отписавшихся)."""
+    return get_repository().count_active_users()
 
 def create_newsletter(title: str, content: str, created_by: int, media_type: str = None, media_file_id: str = None) -> int:
     """Создает новую рассылку и возвращает ее ID."""
@@ -1604,16 +2113,7 @@ def get_newsletter_analytics(newsletter_id: int) -> Dict[str, Any]:
 
 def get_active_users_for_newsletter() -> List[int]:
     """Получает список ID активных пользователей для рассылки."""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE status != 'redeemed_and_left'")
-        user_ids = [row[0] for row in cur.fetchall()]
-        conn.close()
-        return user_ids
-    except Exception as e:
-        logging.error(f"Ошибка получения списка пользователей для рассылки: {e}")
-        return []
+    return get_repository().active_user_ids()
 
 # --- Функции для работы с Персоналом (staff) ---
 
@@ -1707,46 +2207,15 @@ def update_staff_status(staff_id: int, new_status: str) -> bool:
         return False
         
 def get_staff_performance_for_period(start_time: datetime, end_time: datetime) -> Dict[str, List[Dict]]:
-    """Собирает статистику по персоналу за период."""
+    """Собирает статистику по персоналу за период (по почасовым агрегатам)."""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Конвертируем datetime в строку формата, подходящего для текущей БД
-        start_str = _format_dt_for_db(start_time)
-        end_str = _format_dt_for_db(end_time)
-        
-        cur.execute("""
-            SELECT s.short_name, s.position, u.status
-            FROM users u
-            JOIN staff s ON u.brought_by_staff_id = s.staff_id
-            WHERE u.signup_date BETWEEN ? AND ?
-        """, (start_str, end_str))
-        
-        results = cur.fetchall()
-        conn.close()
-
-        performance = {}
-        for row in results:
-            name = row['short_name']
-            if name not in performance:
-                performance[name] = {'position': row['position'], 'brought': 0, 'churn': 0}
-            
-            performance[name]['brought'] += 1
-            if row['status'] == 'redeemed_and_left':
-                performance[name]['churn'] += 1
-        
-        grouped_performance = {}
-        for name, data in performance.items():
-            position = data['position']
-            if position not in grouped_performance:
-                grouped_performance[position] = []
-            grouped_performance[position].append({'name': name, 'brought': data['brought'], 'churn': data['churn']})
-            
-        for position in grouped_performance:
-            grouped_performance[position].sort(key=lambda x: x['brought'], reverse=True)
-        
-        return grouped_performance
+        start_key, end_key = report_rollup.hour_range(start_time, end_time)
+        # Сотрудники хранятся в SQLite, агрегаты — в основной БД (в PostgreSQL при USE_POSTGRES)
+        with db_connection() as conn:
+            staff = {row['staff_id']: (row['short_name'], row['position'])
+                     for row in conn.execute("SELECT staff_id, short_name, position FROM staff")}
+        rows = _load_report_rollup(start_key, end_key)
+        return report_rollup.summarize_staff(rows, start_key, end_key, staff)
     except Exception as e:
         logging.error(f"Ошибка получения статистики по персоналу: {e}")
         return {}
@@ -1906,45 +2375,113 @@ def get_staff_period_stats(start_time: datetime, end_time: datetime) -> dict:
         return {}
 
 
+# Профиль пользователя хранится только в SQLite (в PostgreSQL этих колонок нет)
+_SQLITE_PROFILE_FIELDS = ('real_name', 'phone_number', 'birth_date', 'contact_shared_date',
+                          'profile_completed', 'ai_concept')
+
 def get_all_users() -> List[Dict[str, Any]]:
     """
-    Получает всех пользователей из базы данных.
+    Получает всех пользователей из основной БД (от новых к старым) с профилем из SQLite.
     Возвращает список словарей с данными пользователей.
     """
+    records = get_repository().list_users()
+    profiles = {}
     try:
-        conn = get_db_connection()
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT 
-                user_id,
-                first_name,
-                username, 
-                real_name,
-                phone_number,
-                birth_date,
-                status,
-                source,
-                signup_date,
-                contact_shared_date,
-                redeem_date,
-                profile_completed,
-                ai_concept
-            FROM users 
-            ORDER BY signup_date DESC
-        """)
-        
-        users = []
-        for row in cur.fetchall():
-            users.append(dict(row))
-        
-        conn.close()
-        return users
-        
+        with db_connection() as conn:
+            profiles = {row[0]: row[1:] for row in conn.execute(
+                f"SELECT user_id, {', '.join(_SQLITE_PROFILE_FIELDS)} FROM users")}
     except Exception as e:
-        logging.error(f"Ошибка получения всех пользователей: {e}")
-        return []
+        logging.error(f"Ошибка получения профилей пользователей: {e}")
+
+    empty_profile = (None,) * len(_SQLITE_PROFILE_FIELDS)
+    users = []
+    for record in records:
+        user = record._asdict()
+        user.update(zip(_SQLITE_PROFILE_FIELDS, profiles.get(record.user_id, empty_profile)))
+        users.append(user)
+    return users
+
+
+def get_users_page(limit: int = 50, cursor: Optional[str] = None, status: Optional[str] = None,
+                   search: Optional[str] = None, page: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Постраничная выборка пользователей для админ-панели.
+
+    Сортировка — signup_date DESC, user_id DESC. Следующая страница берётся по
+    курсору (keyset), переход на произвольную страницу — через page (OFFSET).
+    search — префиксный поиск по username, first_name или user_id.
+
+    Returns:
+        {'users': [...], 'next_cursor': str|None, 'total': int, 'status_counts': {status: count}}
+    """
+    limit = max(1, min(int(limit), USERS_PAGE_MAX_LIMIT))
+    if USE_POSTGRES and pg_client:
+        return pg_client.get_users_page(limit=limit, cursor=cursor, status=status, search=search, page=page)
+
+    result = {'users': [], 'next_cursor': None, 'total': 0, 'status_counts': {}}
+    try:
+        filters, params = [], []
+        if status:
+            filters.append("status = ?")
+            params.append(status)
+        if search:
+            pattern = escape_like(search.lstrip('@')) + '%'
+            search_parts = ["username LIKE ? ESCAPE '\\'", "first_name LIKE ? ESCAPE '\\'"]
+            search_params = [pattern, pattern]
+            for lo, hi in user_id_prefix_ranges(search):
+                search_parts.append("user_id BETWEEN ? AND ?")
+                search_params.extend((lo, hi))
+            filters.append("(" + " OR ".join(search_parts) + ")")
+            params.extend(search_params)
+
+        with db_connection() as conn:
+            # Счётчики по статусам — один GROUP BY по всей таблице
+            result['status_counts'] = {
+                (row[0] or 'unknown'): row[1]
+                for row in conn.execute("SELECT status, COUNT(*) FROM users GROUP BY status")
+            }
+            if search:
+                where_sql = " WHERE " + " AND ".join(filters)
+                result['total'] = conn.execute(f"SELECT COUNT(*) FROM users{where_sql}", params).fetchone()[0]
+            elif status:
+                result['total'] = result['status_counts'].get(status, 0)
+            else:
+                result['total'] = sum(result['status_counts'].values())
+
+            page_filters, page_params = list(filters), list(params)
+            position = decode_cursor(cursor)
+            offset = 0
+            if position:
+                last_signup, last_uid = position
+                if last_signup is None:
+                    page_filters.append("(signup_date IS NULL AND user_id < ?)")
+                    page_params.append(last_uid)
+                else:
+                    page_filters.append(
+                        "(signup_date < ? OR (signup_date = ? AND user_id < ?) OR signup_date IS NULL)"
+                    )
+                    page_params.extend((last_signup, last_signup, last_uid))
+            elif page and page > 1:
+                offset = (page - 1) * limit
+
+            where_sql = (" WHERE " + " AND ".join(page_filters)) if page_filters else ""
+            rows = conn.execute(f"""
+                SELECT user_id, first_name, username, real_name, phone_number, birth_date,
+                       status, source, signup_date, contact_shared_date, redeem_date,
+                       profile_completed, ai_concept
+                FROM users{where_sql}
+                ORDER BY signup_date DESC, user_id DESC
+                LIMIT ? OFFSET ?
+            """, page_params + [limit + 1, offset]).fetchall()
+
+        users = [dict(row) for row in rows[:limit]]
+        result['users'] = users
+        if len(rows) > limit and users:
+            result['next_cursor'] = encode_cursor(users[-1]['signup_date'], users[-1]['user_id'])
+        return result
+    except Exception as e:
+        logging.error(f"Ошибка постраничной выборки пользователей: {e}")
+        return result
 
 
 def get_all_users_for_report() -> List[Dict[str, Any]]:
@@ -1953,8 +2490,7 @@ def get_all_users_for_report() -> List[Dict[str, Any]]:
     Возвращает список словарей с данными пользователей.
     """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -2063,6 +2599,40 @@ def mark_user_blocked(user_id):
         return False
 
 
+def mark_users_blocked(user_ids) -> int:
+    """
+    Отмечает пачку пользователей как заблокировавших бота (один UPDATE ... IN
+    на пачку вместо отдельного UPDATE и коммита на каждого).
+    Возвращает число обновлённых строк (-1 при ошибке).
+    """
+    user_ids = sorted({int(uid) for uid in user_ids})
+    if not user_ids:
+        return 0
+    try:
+        if USE_POSTGRES and pg_client:
+            return pg_client.mark_users_blocked(user_ids)
+
+        now = datetime.datetime.now(pytz.utc).isoformat()
+        updated = 0
+        with db_connection() as conn:
+            # Лимит параметров SQLite — 999, режем на пачки
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                cur = conn.execute(f"""
+                    UPDATE users
+                    SET blocked = 1, block_date = ?
+                    WHERE user_id IN ({','.join('?' * len(chunk))})
+                      AND (blocked IS NULL OR blocked = 0)
+                """, [now, *chunk])
+                updated += cur.rowcount
+        logging.info(f"Отмечено заблокировавших бота: {updated} из {len(user_ids)}")
+        return updated
+
+    except Exception as e:
+        logging.error(f"Ошибка пакетной отметки блокировки ({len(user_ids)} польз.): {e}")
+        return -1
+
+
 def get_broadcast_statistics():
     """
     Получает статистику для рассылок
@@ -2079,14 +2649,13 @@ def get_broadcast_statistics():
         cur.execute("SELECT COUNT(*) FROM users WHERE user_id IS NOT NULL")
         total_users = cur.fetchone()[0]
         
-        # Активные пользователи (не заблокировавшие бота)
-        cur.execute("SELECT COUNT(*) FROM users WHERE (blocked IS NULL OR blocked = 0) AND user_id IS NOT NULL")
-        active_users = cur.fetchone()[0]
-        
         # Заблокировавшие бота
         cur.execute("SELECT COUNT(*) FROM users WHERE blocked = 1")
         blocked_users = cur.fetchone()[0]
         
+        # Активные пользователи (не заблокировавшие бота) — без отдельного полного скана users
+        active_users = total_users - blocked_users
+        
         # Пользователи за последние 30 дней
         cur.execute("""
             SELECT COUNT(*) FROM users 
@@ -2113,18 +2682,23 @@ def get_broadcast_statistics():
 #  Функции логирования рассылок (broadcast_runs + broadcast_delivery_log)
 # ═══════════════════════════════════════════
 
-def create_broadcast_run(total_users: int, text_preview: str, source: str = 'bot') -> Optional[int]:
-    """Создаёт запись о запуске рассылки. Возвращает broadcast_id."""
+def create_broadcast_run(total_users: int, text_preview: str, source: str = 'bot',
+                         payload: Optional[dict] = None) -> Optional[int]:
+    """Создаёт запись о запуске рассылки. Возвращает broadcast_id.
+
+    payload — содержимое рассылки (JSON), нужно для возобновления после перезапуска.
+    """
     try:
         if USE_POSTGRES and pg_client:
-            return pg_client.create_broadcast_run(total_users, text_preview, source)
+            return pg_client.create_broadcast_run(total_users, text_preview, source, payload)
 
         conn = get_db_connection()
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO broadcast_runs (total_users, text_preview, source, status)
-            VALUES (?, ?, ?, 'running')
-        """, (total_users, (text_preview or '')[:500], source))
+            INSERT INTO broadcast_runs (total_users, text_preview, source, status, payload)
+            VALUES (?, ?, ?, 'running', ?)
+        """, (total_users, (text_preview or '')[:500], source,
+              json.dumps(payload, ensure_ascii=False) if payload else None))
         conn.commit()
         bid = cur.lastrowid
         conn.close()
@@ -2158,6 +2732,96 @@ def log_broadcast_delivery(broadcast_id: int, user_id: int, username: str,
         logging.error(f"Ошибка логирования broadcast delivery: {e}")
 
 
+def log_broadcast_deliveries(broadcast_id: int, rows: List[Dict[str, Any]]) -> bool:
+    """Записывает пачку результатов доставки одним запросом.
+
+    rows — [{'user_id', 'username', 'first_name', 'status', 'error_code', 'error_message'}, ...]
+    Возвращает False при ошибке записи (строки можно отправить повторно).
+    """
+    if not rows:
+        return True
+    try:
+        if USE_POSTGRES and pg_client:
+            return pg_client.log_broadcast_deliveries(broadcast_id, rows)
+
+        params = [
+            (broadcast_id, r['user_id'], r.get('username') or '', r.get('first_name') or '',
+             r['status'], r.get('error_code'), (r.get('error_message') or '')[:500])
+            for r in rows
+        ]
+        with db_connection() as conn:
+            conn.executemany("""
+                INSERT INTO broadcast_delivery_log
+                    (broadcast_id, user_id, username, first_name, status, error_code, error_message)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, params)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка пакетного логирования broadcast delivery ({len(rows)} строк): {e}")
+        return False
+
+
+def checkpoint_broadcast_run(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+    """Сохраняет прогресс рассылки: все получатели с user_id <= last_user_id обработаны."""
+    try:
+        if USE_POSTGRES and pg_client:
+            return pg_client.checkpoint_broadcast_run(broadcast_id, last_user_id, sent, failed, blocked)
+
+        with db_connection() as conn:
+            conn.execute("""
+                UPDATE broadcast_runs
+                SET last_user_id = ?, sent_count = ?, failed_count = ?, blocked_count = ?,
+                    checkpoint_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (last_user_id, sent, failed, blocked, broadcast_id))
+    except Exception as e:
+        logging.error(f"Ошибка сохранения чекпоинта рассылки {broadcast_id}: {e}")
+
+
+def get_broadcast_completed_after(broadcast_id: int, last_user_id: int) -> Dict[int, str]:
+    """
+    Получатели рассылки с user_id > last_user_id, уже обработанные до перезапуска:
+    {user_id: статус из лога доставки}. Чекпоинт хранит только непрерывный префикс,
+    а потоки успевают отправить и дальше — их при возобновлении пропускаем.
+    Ошибка чтения не глушится: без лога возобновление разослало бы повторно.
+    """
+    if USE_POSTGRES and pg_client:
+        return pg_client.get_broadcast_completed_after(broadcast_id, last_user_id)
+
+    with db_connection() as conn:
+        rows = conn.execute(
+            "SELECT user_id, status FROM broadcast_delivery_log "
+            "WHERE broadcast_id = ? AND user_id > ? ORDER BY id",
+            (broadcast_id, last_user_id)
+        ).fetchall()
+    return {int(r['user_id']): r['status'] for r in rows}
+
+
+def get_unfinished_broadcast_runs() -> List[Dict[str, Any]]:
+    """Возвращает рассылки, прерванные перезапуском (status='running' и есть payload)."""
+    try:
+        if USE_POSTGRES and pg_client:
+            return pg_client.get_unfinished_broadcast_runs()
+
+        with db_connection() as conn:
+            rows = conn.execute("""
+                SELECT id, total_users, sent_count, failed_count, blocked_count,
+                       source, payload, last_user_id
+                FROM broadcast_runs
+                WHERE status = 'running' AND payload IS NOT NULL
+                ORDER BY id
+            """).fetchall()
+        return [{
+            'id': r['id'], 'total_users': r['total_users'],
+            'sent_count': r['sent_count'] or 0, 'failed_count': r['failed_count'] or 0,
+            'blocked_count': r['blocked_count'] or 0, 'source': r['source'],
+            'payload': json.loads(r['payload']), 'last_user_id': r['last_user_id'],
+        } for r in rows]
+    except Exception as e:
+        logging.error(f"Ошибка получения незавершённых рассылок: {e}")
+        return []
+
+
 def finish_broadcast_run(broadcast_id: int, sent: int, failed: int, blocked: int):
     """Завершает запись о рассылке."""
     try:
@@ -2276,3 +2940,130 @@ def get_broadcast_details(broadcast_id: int) -> dict:
     except Exception as e:
         logging.error(f"Ошибка получения деталей рассылки {broadcast_id}: {e}")
         return {}
+
+
+# =============================================
+#  Агрегаты метрик AI (ai_metrics_daily + ai_metrics_user_daily)
+# =============================================
+
+AI_METRICS_DAILY_FIELDS = (
+    'total_requests', 'successful_requests', 'failed_requests', 'prompt_tokens',
+    'completion_tokens', 'total_tokens', 'cost_usd', 'response_time_sum_ms',
+    'response_time_count', 'unique_users',
+    'cache_lookups', 'cache_hits', 'cache_saved_tokens', 'cache_saved_cost_usd',
+)
+AI_METRICS_USER_FIELDS = ('requests', 'tokens', 'cost_usd')
+
+
+def save_ai_metrics_rollup(daily_rows: List[Dict[str, Any]], user_rows: List[Dict[str, Any]]):
+    """Сохраняет агрегаты метрик AI (значения целиком заменяют строку за дату/пользователя).
+
+    Ошибки пробрасываются: AIMetrics вернёт агрегаты в очередь и повторит запись.
+    """
+    if not daily_rows and not user_rows:
+        return
+    if USE_POSTGRES and pg_client:
+        return pg_client.save_ai_metrics_rollup(daily_rows, user_rows)
+
+    with db_connection() as conn:
+        if daily_rows:
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO ai_metrics_daily (date, {', '.join(AI_METRICS_DAILY_FIELDS)})
+                VALUES (?{', ?' * len(AI_METRICS_DAILY_FIELDS)})
+            """, [(r['date'], *(r[f] for f in AI_METRICS_DAILY_FIELDS)) for r in daily_rows])
+        if user_rows:
+            conn.executemany("""
+                INSERT OR REPLACE INTO ai_metrics_user_daily (date, user_id, requests, tokens, cost_usd)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(r['date'], r['user_id'], r['requests'], r['tokens'], r['cost_usd']) for r in user_rows])
+
+
+def load_ai_metrics_rollup(date_from: str, date_to: Optional[str] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Загружает агрегаты метрик AI за период [date_from, date_to] (даты в ISO-формате).
+
+    Ошибка чтения пробрасывается: её нельзя путать с «агрегатов нет» — иначе
+    счётчики с нуля затрут сохранённые при следующей записи.
+    """
+    date_to = date_to or '9999-12-31'
+    if USE_POSTGRES and pg_client:
+        return pg_client.load_ai_metrics_rollup(date_from, date_to)
+
+    with db_connection() as conn:
+        daily = [dict(row) for row in conn.execute(
+            "SELECT * FROM ai_metrics_daily WHERE date BETWEEN ? AND ?", (date_from, date_to)
+        )]
+        users = [dict(row) for row in conn.execute(
+            "SELECT * FROM ai_metrics_user_daily WHERE date BETWEEN ? AND ?", (date_from, date_to)
+        )]
+    return daily, users
+
+
+# =============================================
+#  Долгосрочная память AI о пользователях (ai_user_memory)
+# =============================================
+
+def _user_memory_row(user_id: int, profile: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'user_id': user_id,
+        'profile': json.dumps(profile, ensure_ascii=False),
+        'has_name': int(bool(profile.get('name'))),
+        'has_preferred_bar': int(bool(profile.get('preferred_bar'))),
+        'has_favorite_drinks': int(bool(profile.get('favorite_drinks'))),
+        'bookings_count': int(profile.get('bookings_count') or 0),
+    }
+
+
+def load_user_memory_profile(user_id: int) -> Optional[Dict[str, Any]]:
+    """Профиль пользователя из памяти AI или None, если его ещё нет.
+
+    Ошибка чтения пробрасывается: её нельзя путать с «профиля нет» — иначе
+    профиль по умолчанию затрёт сохранённый при следующей записи.
+    """
+    if USE_POSTGRES and pg_client:
+        return pg_client.load_user_memory_profile(user_id)
+
+    with db_connection() as conn:
+        row = conn.execute("SELECT profile FROM ai_user_memory WHERE user_id = ?", (user_id,)).fetchone()
+    return json.loads(row['profile']) if row else None
+
+
+def save_user_memory_profiles(profiles: Dict[int, Dict[str, Any]]):
+    """Сохраняет пачку профилей памяти AI одним запросом (upsert).
+
+    Ошибки пробрасываются: UserMemory вернёт профили в очередь и повторит запись.
+    """
+    if not profiles:
+        return
+    rows = [_user_memory_row(user_id, profile) for user_id, profile in profiles.items()]
+    if USE_POSTGRES and pg_client:
+        return pg_client.save_user_memory_profiles(rows)
+
+    with db_connection() as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO ai_user_memory
+                (user_id, profile, has_name, has_preferred_bar, has_favorite_drinks, bookings_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, [(r['user_id'], r['profile'], r['has_name'], r['has_preferred_bar'],
+               r['has_favorite_drinks'], r['bookings_count']) for r in rows])
+
+
+def get_user_memory_stats() -> Dict[str, int]:
+    """Статистика памяти AI одним агрегирующим запросом."""
+    stats = {"total_users": 0, "with_names": 0, "with_preferred_bar": 0,
+             "with_favorite_drinks": 0, "vip_guests": 0}
+    try:
+        if USE_POSTGRES and pg_client:
+            return pg_client.get_user_memory_stats() or stats
+
+        with db_connection() as conn:
+            row = conn.execute("""
+                SELECT COUNT(*), SUM(has_name), SUM(has_preferred_bar), SUM(has_favorite_drinks),
+                       SUM(CASE WHEN bookings_count >= 10 THEN 1 ELSE 0 END)
+                FROM ai_user_memory
+            """).fetchone()
+        for key, value in zip(stats, row):
+            stats[key] = value or 0
+        return stats
+    except Exception as e:
+        logging.error(f"Ошибка получения статистики памяти AI: {e}")
+        return stats
@@ -1,141 +1,314 @@
 # delayed_tasks_processor.py
 """
-Обработчик отложенных задач для бота Евгенич.
-Запускается в фоновом режиме и отправляет запланированные сообщения.
+Планировщик отложенных задач бота Евгенич (таблица delayed_tasks).
+
+Раньше задачи опрашивались раз в 30 секунд и выполнялись по одной, очистка
+старых шла на каждой итерации, а предложение карты лояльности после
+погашения купона жило в threading.Timer и терялось при перезапуске.
+Теперь:
+
+- задачи хранятся в delayed_tasks (next_run_at — UTC, частичный индекс по
+  ожидающим), поэтому переживают перезапуск;
+- в памяти — куча (heapq) времён пробуждения: поток планировщика спит ровно
+  до ближайшей задачи, а schedule_task() из этого же процесса будит его сразу;
+  задачи других процессов (веб-панель, второй экземпляр) подхватываются при
+  сверке с БД раз в resync_interval;
+- наступившие задачи захватываются атомарно (claim_due_delayed_tasks, BEGIN
+  IMMEDIATE + аренда) — несколько экземпляров не выполнят задачу дважды,
+  а задачи упавшего экземпляра после истечения аренды выполнит другой;
+- выполнение — на ограниченном пуле потоков, захватывается не больше задач,
+  чем свободных потоков;
+- ошибка — повтор с экспоненциальной задержкой (до max_attempts), ответ
+  Telegram 400/403 (бот заблокирован, чат не найден) — сразу отказ;
+- очистка старых задач — раз в cleanup_interval.
+
+Обработчики типов задач регистрируются через register_handler(task_type, func),
+func получает задачу-словарь (id, user_id, task_type, payload, attempts, ...).
 """
-import time
-import threading
+import heapq
 import logging
-from typing import TYPE_CHECKING
-from .database import get_pending_delayed_tasks, mark_delayed_task_completed, cleanup_old_delayed_tasks
-from texts import DELAYED_ENGAGEMENT_TEXT
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+import pytz
+
+from . import database
+from texts import DELAYED_ENGAGEMENT_TEXT, LOYALTY_OFFER_TEXT
 
 if TYPE_CHECKING:
     import telebot
 
+# Запущенный в этом процессе планировщик — его будит schedule_task()
+_active_processor: Optional["DelayedTasksProcessor"] = None
+
+# Ответы Telegram, после которых повторять отправку бессмысленно
+PERMANENT_ERROR_CODES = (400, 403)
+
+
+def schedule_task(user_id: int, task_type: str, delay_seconds: float = 0,
+                  payload: Optional[Dict[str, Any]] = None) -> Optional[int]:
+    """
+    Сохраняет задачу в delayed_tasks и будит планировщик этого процесса.
+    Без запущенного планировщика задачу выполнит тот экземпляр, где он работает.
+    """
+    run_at = datetime.now(pytz.utc) + timedelta(seconds=delay_seconds)
+    task_id = database.schedule_delayed_task(user_id, task_type, run_at, payload)
+    processor = _active_processor
+    if task_id is not None and processor is not None:
+        processor.wake_at(run_at)
+    return task_id
+
+
 class DelayedTasksProcessor:
-    def __init__(self, bot: "telebot.TeleBot"):
+    def __init__(self, bot: "telebot.TeleBot", workers: int = 4, resync_interval: float = 60.0,
+                 lease_seconds: float = 300.0, max_attempts: int = 3, retry_delay: float = 30.0,
+                 cleanup_interval: float = 3600.0):
+        """
+        Args:
+            bot: экземпляр TeleBot для отправки сообщений
+            workers: потоков выполнения задач
+            resync_interval: как часто сверяться с БД (задачи других процессов), сек
+            lease_seconds: аренда захваченной задачи; после неё задачу может взять другой экземпляр
+            max_attempts: попыток выполнения до статуса 'failed'
+            retry_delay: задержка первого повтора, сек (дальше удваивается)
+            cleanup_interval: как часто удалять старые выполненные задачи, сек
+        """
         self.bot = bot
+        self.workers = max(1, workers)
+        self.resync_interval = resync_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.cleanup_interval = cleanup_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
         self.running = False
         self.thread = None
-        
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._cond = threading.Condition()
+        self._wakeups: List[float] = []  # куча unix-времён пробуждения
+        self._in_flight = 0
+        self._backlog = False  # при последнем захвате свободных потоков не хватило
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {
+            'engagement_after_redeem': self._send_engagement_message,
+            'loyalty_offer': self._send_loyalty_offer,
+            'send_newsletter': self._send_newsletter_message,
+        }
+        self.stats = {'completed': 0, 'retried': 0, 'failed': 0}
+
+    def register_handler(self, task_type: str, func: Callable[[Dict[str, Any]], None]):
+        """Регистрирует обработчик типа задачи (исключение в нём — повтор задачи)."""
+        self._handlers[task_type] = func
+
     def start(self):
         """Запускает обработчик отложенных задач."""
+        global _active_processor
         if self.running:
             return
-            
+
         self.running = True
-        self.thread = threading.Thread(target=self._process_tasks_loop, daemon=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="delayed-task")
+        self.thread = threading.Thread(target=self._scheduler_loop, name="delayed-tasks", daemon=True)
         self.thread.start()
-        logging.info("Обработчик отложенных задач запущен")
-        
+        _active_processor = self
+        logging.info(f"Обработчик отложенных задач запущен ({self.workers} потоков, {self.worker_id})")
+
     def stop(self):
-        """Останавливает обработчик отложенных задач."""
-        self.running = False
+        """Останавливает обработчик отложенных задач (выполняемые задачи дорабатываются)."""
+        global _active_processor
+        if _active_processor is self:
+            _active_processor = None
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
         if self.thread:
             self.thread.join(timeout=5)
+        if self._executor:
+            self._executor.shutdown(wait=True)
         logging.info("Обработчик отложенных задач остановлен")
-        
-    def _process_tasks_loop(self):
-        """Основной цикл обработки задач."""
+
+    def wake_at(self, run_at: datetime):
+        """Будит планировщик к моменту run_at (если он раньше уже известных)."""
+        with self._cond:
+            heapq.heappush(self._wakeups, run_at.timestamp())
+            self._cond.notify()
+
+    # --- Поток планировщика ---
+
+    def _scheduler_loop(self):
+        next_resync = 0.0
+        next_cleanup = time.monotonic() + self.cleanup_interval
         while self.running:
             try:
-                # Проверяем отложенные задачи каждые 30 секунд
-                self._process_pending_tasks()
-                
-                # Раз в час очищаем старые задачи
-                cleanup_old_delayed_tasks()
-                
-                time.sleep(30)
+                if time.monotonic() >= next_resync:
+                    # Ближайшая задача по БД: после перезапуска и для задач других процессов
+                    self._wake_at_next_from_db()
+                    next_resync = time.monotonic() + self.resync_interval
+
+                if self._pop_due():
+                    self._dispatch_due()
+                    self._wake_at_next_from_db()
+
+                if time.monotonic() >= next_cleanup:
+                    database.cleanup_old_delayed_tasks()
+                    next_cleanup = time.monotonic() + self.cleanup_interval
             except Exception as e:
                 logging.error(f"Ошибка в цикле обработки отложенных задач: {e}")
-                time.sleep(60)  # При ошибке ждем дольше
-                
-    def _process_pending_tasks(self):
-        """Обрабатывает все готовые к выполнению задачи."""
-        pending_tasks = get_pending_delayed_tasks()
-        
-        for task in pending_tasks:
-            try:
-                self._execute_task(task)
-                mark_delayed_task_completed(task['id'])
-            except Exception as e:
-                logging.error(f"Ошибка выполнения задачи {task['id']}: {e}")
-                
-    def _execute_task(self, task):
-        """Выполняет конкретную задачу."""
+
+            with self._cond:
+                if not self.running:
+                    break
+                timeout = min(next_resync, next_cleanup) - time.monotonic()
+                if self._wakeups:
+                    timeout = min(timeout, self._wakeups[0] - time.time())
+                if timeout > 0:
+                    self._cond.wait(timeout)
+
+    def _pop_due(self) -> bool:
+        """Снимает с кучи наступившие пробуждения. True — пора захватывать задачи."""
+        now = time.time()
+        due = False
+        with self._cond:
+            while self._wakeups and self._wakeups[0] <= now:
+                heapq.heappop(self._wakeups)
+                due = True
+        return due
+
+    def _wake_at_next_from_db(self):
+        next_time = database.get_next_delayed_task_time()
+        if next_time is None:
+            return
+        with self._cond:
+            # Не дублируем пробуждение, если куча уже проснётся не позже
+            if not self._wakeups or self._wakeups[0] > next_time.timestamp():
+                heapq.heappush(self._wakeups, next_time.timestamp())
+
+    def _dispatch_due(self):
+        """Захватывает наступившие задачи по числу свободных потоков и отдаёт их пулу."""
+        while self.running:
+            with self._cond:
+                free = self.workers - self._in_flight
+            if free <= 0:
+                with self._cond:
+                    self._backlog = True
+                return
+            tasks = database.claim_due_delayed_tasks(self.worker_id, free, self.lease_seconds)
+            with self._cond:
+                self._in_flight += len(tasks)
+                self._backlog = len(tasks) == free
+            for task in tasks:
+                self._executor.submit(self._run_task, task)
+            if len(tasks) < free:
+                return
+
+    # --- Выполнение ---
+
+    def _run_task(self, task: Dict[str, Any]):
+        task_id = task['id']
+        try:
+            handler = self._handlers.get(task['task_type'])
+            if handler is None:
+                logging.warning(f"Неизвестный тип задачи: {task['task_type']}")
+                database.fail_delayed_task(task_id, f"unknown task type {task['task_type']}")
+                self._count('failed')
+                return
+            handler(task)
+            database.mark_delayed_task_completed(task_id)
+            self._count('completed')
+        except Exception as e:
+            attempts = task.get('attempts') or 1
+            permanent = getattr(e, 'error_code', None) in PERMANENT_ERROR_CODES
+            if permanent or attempts >= self.max_attempts:
+                logging.error(f"Задача {task_id} ({task['task_type']}) не выполнена, попыток {attempts}: {e}")
+                database.fail_delayed_task(task_id, str(e))
+                self._count('failed')
+            else:
+                run_at = datetime.now(pytz.utc) + timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))
+                logging.warning(f"Задача {task_id} ({task['task_type']}) будет повторена в {run_at}: {e}")
+                database.retry_delayed_task(task_id, run_at, str(e))
+                self._count('retried')
+                self.wake_at(run_at)
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                if self._backlog:
+                    # Свободный поток — можно захватить следующие наступившие задачи
+                    self._backlog = False
+                    heapq.heappush(self._wakeups, time.time())
+                    self._cond.notify()
+
+    def _count(self, key: str):
+        with self._cond:
+            self.stats[key] += 1
+
+    def _send_engagement_message(self, task: Dict[str, Any]):
+        """Отправляет вовлекающее сообщение с картой лояльности после погашения купона."""
+        import keyboards
+        self.bot.send_message(
+            task['user_id'],
+            DELAYED_ENGAGEMENT_TEXT,
+            parse_mode='Markdown',
+            reply_markup=keyboards.get_loyalty_keyboard()
+        )
+        logging.info(f"Отправлено вовлекающее сообщение с картой лояльности пользователю {task['user_id']}")
+
+    def _send_loyalty_offer(self, task: Dict[str, Any]):
+        """Предложение карты лояльности через несколько секунд после погашения купона."""
+        import keyboards
+        self.bot.send_message(
+            task['user_id'],
+            LOYALTY_OFFER_TEXT,
+            reply_markup=keyboards.get_loyalty_keyboard(),
+            parse_mode="Markdown"
+        )
+        logging.info(f"💳 Отправлено предложение карты лояльности пользователю {task['user_id']}")
+
+    def _send_newsletter_message(self, task: Dict[str, Any]):
+        """Отправляет рассылку пользователю."""
+        import keyboards
+
         user_id = task['user_id']
-        task_type = task['task_type']
-        
-        if task_type == 'engagement_after_redeem':
-            self._send_engagement_message(user_id)
-        elif task_type == 'send_newsletter':
-            self._send_newsletter_message(user_id, task)
+        newsletter_id = task['payload'].get('newsletter_id')
+        if not newsletter_id:
+            raise ValueError("Newsletter ID не указан в задаче")
+
+        newsletter = database.get_newsletter_by_id(newsletter_id)
+        if not newsletter:
+            raise ValueError(f"Рассылка {newsletter_id} не найдена")
+
+        buttons = database.get_newsletter_buttons(newsletter_id)
+        keyboard = keyboards.create_newsletter_inline_keyboard(buttons) if buttons else None
+
+        # Отправляем в зависимости от типа медиа
+        if newsletter['media_type'] == 'photo':
+            self.bot.send_photo(
+                user_id,
+                newsletter['media_file_id'],
+                caption=newsletter['content'],
+                reply_markup=keyboard,
+                parse_mode="Markdown"
+            )
+        elif newsletter['media_type'] == 'video':
+            self.bot.send_video(
+                user_id,
+                newsletter['media_file_id'],
+                caption=newsletter['content'],
+                reply_markup=keyboard,
+                parse_mode="Markdown"
+            )
         else:
-            logging.warning(f"Неизвестный тип задачи: {task_type}")
-            
-    def _send_engagement_message(self, user_id: int):
-        """Отправляет вовлекающее сообщение с картой лояльности после погашения купона."""
-        try:
-            import keyboards
             self.bot.send_message(
                 user_id,
-                DELAYED_ENGAGEMENT_TEXT,
-                parse_mode='Markdown',
-                reply_markup=keyboards.get_loyalty_keyboard()
+                newsletter['content'],
+                reply_markup=keyboard,
+                parse_mode="Markdown"
             )
-            logging.info(f"Отправлено вовлекающее сообщение с картой лояльности пользователю {user_id}")
-        except Exception as e:
-            logging.error(f"Ошибка отправки вовлекающего сообщения пользователю {user_id}: {e}")
-    
-    def _send_newsletter_message(self, user_id: int, task):
-        """Отправляет рассылку пользователю."""
-        try:
-            from . import database
-            import keyboards
-            
-            # Получаем данные рассылки
-            newsletter_id = task.get('newsletter_id')
-            if not newsletter_id:
-                logging.error("Newsletter ID не указан в задаче")
-                return
-                
-            newsletter = database.get_newsletter_by_id(newsletter_id)
-            if not newsletter:
-                logging.error(f"Рассылка {newsletter_id} не найдена")
-                return
-            
-            buttons = database.get_newsletter_buttons(newsletter_id)
-            keyboard = keyboards.create_newsletter_inline_keyboard(buttons) if buttons else None
-            
-            # Отправляем в зависимости от типа медиа
-            if newsletter['media_type'] == 'photo':
-                self.bot.send_photo(
-                    user_id,
-                    newsletter['media_file_id'],
-                    caption=newsletter['content'],
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-            elif newsletter['media_type'] == 'video':
-                self.bot.send_video(
-                    user_id,
-                    newsletter['media_file_id'],
-                    caption=newsletter['content'],
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-            else:
-                self.bot.send_message(
-                    user_id,
-                    newsletter['content'],
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-            
-            # Фиксируем доставку
-            database.track_newsletter_delivery(newsletter_id, user_id)
-            logging.info(f"Отправлена рассылка {newsletter_id} пользователю {user_id}")
-            
-        except Exception as e:
-            logging.error(f"Ошибка отправки рассылки пользователю {user_id}: {e}")
+
+        # Фиксируем доставку
+        database.track_newsletter_delivery(newsletter_id, user_id)
+        logging.info(f"Отправлена рассылка {newsletter_id} пользователю {user_id}")
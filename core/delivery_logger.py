@@ -0,0 +1,175 @@
+# delivery_logger.py
+"""
+Буферизованная запись результатов рассылки.
+
+Раньше каждый получатель давал отдельный INSERT в broadcast_delivery_log
+и отдельный UPDATE users при блокировке — на рассылку в 50 тысяч человек
+это 50+ тысяч коммитов (в PostgreSQL — по транзакции на строку). Теперь:
+
+- строки копятся в памяти и уходят пачкой (executemany в SQLite, COPY
+  в PostgreSQL) при накоплении flush_rows строк или раз в flush_interval;
+- заблокировавшие бота собираются в множество и отмечаются одним
+  UPDATE ... WHERE user_id IN (...) на пачку;
+- неудачная пачка возвращается в очередь и повторяется ограниченное
+  число раз;
+- stop() (и выход процесса) дописывают всё, что осталось в буфере.
+"""
+import atexit
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+class DeliveryLogger:
+    def __init__(self, store, flush_rows: int = 500, flush_interval: float = 0.5,
+                 max_retries: int = 3, name: str = 'delivery-log'):
+        """
+        Args:
+            store: core.database (или объект с log_broadcast_deliveries и mark_users_blocked)
+            flush_rows: сколько строк вызывает досрочную запись
+            flush_interval: максимальная задержка записи, секунд
+            max_retries: сколько раз подряд повторять неудачную запись пачки
+        """
+        self.store = store
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.name = name
+
+        self._lock = threading.Lock()
+        # Сериализует запись: фоновый поток и явный flush() не пишут одновременно
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._failures = 0
+
+        self._rows: List[Tuple[int, Dict[str, Any]]] = []
+        self._blocked: Set[int] = set()
+
+        self.stats = {'rows_logged': 0, 'blocked_marked': 0, 'flushes': 0,
+                      'errors': 0, 'dropped': 0, 'flush_ms_total': 0.0}
+
+    # --- Жизненный цикл ---
+
+    def start(self):
+        """Запускает фоновый поток (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float = 10.0):
+        """Останавливает поток и записывает остаток буфера."""
+        with self._lock:
+            was_running, self._running = self._running, False
+        if was_running:
+            self._wakeup.set()
+            if self._thread:
+                self._thread.join(timeout=timeout)
+            atexit.unregister(self.stop)
+        self.flush()
+
+    # --- Публичный API ---
+
+    def log(self, broadcast_id: int, user_id: int, username: str = '', first_name: str = '',
+            status: str = 'sent', error_code: Optional[int] = None, error_message: Optional[str] = None):
+        """Ставит в буфер результат доставки одному получателю."""
+        row = {
+            'user_id': int(user_id),
+            'username': username or '',
+            'first_name': first_name or '',
+            'status': status,
+            'error_code': error_code,
+            'error_message': error_message,
+        }
+        with self._lock:
+            self._rows.append((broadcast_id, row))
+            size = len(self._rows)
+        if size >= self.flush_rows:
+            self._wakeup.set()
+
+    def mark_blocked(self, user_id: int):
+        """Ставит пользователя в очередь на отметку blocked = 1."""
+        with self._lock:
+            self._blocked.add(int(user_id))
+            size = len(self._blocked)
+        if size >= self.flush_rows:
+            self._wakeup.set()
+
+    def flush(self) -> bool:
+        """Синхронно записывает буфер. Возвращает True, если всё записано."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                blocked, self._blocked = self._blocked, set()
+            if not rows and not blocked:
+                return True
+
+            started = time.monotonic()
+            by_broadcast: Dict[int, List[Dict[str, Any]]] = {}
+            for broadcast_id, row in rows:
+                by_broadcast.setdefault(broadcast_id, []).append(row)
+
+            failed_rows: List[Tuple[int, Dict[str, Any]]] = []
+            for broadcast_id, batch in by_broadcast.items():
+                if self.store.log_broadcast_deliveries(broadcast_id, batch) is False:
+                    failed_rows.extend((broadcast_id, row) for row in batch)
+                else:
+                    self.stats['rows_logged'] += len(batch)
+
+            failed_blocked: Set[int] = set()
+            if blocked:
+                updated = self.store.mark_users_blocked(blocked)
+                if updated is not None and updated < 0:
+                    failed_blocked = blocked
+                else:
+                    self.stats['blocked_marked'] += len(blocked)
+
+            self.stats['flushes'] += 1
+            self.stats['flush_ms_total'] += (time.monotonic() - started) * 1000
+            if not failed_rows and not failed_blocked:
+                self._failures = 0
+                return True
+
+            self.stats['errors'] += 1
+            self._failures += 1
+            if self._failures > self.max_retries:
+                dropped = len(failed_rows) + len(failed_blocked)
+                self.stats['dropped'] += dropped
+                self._failures = 0
+                logging.error(f"Лог рассылки | Запись не удалась {self.max_retries + 1} раз подряд, "
+                              f"отбрасываю {dropped} записей")
+                return False
+            # Возвращаем неудачную пачку в начало очереди — порядок строк сохраняется
+            with self._lock:
+                self._rows = failed_rows + self._rows
+                self._blocked |= failed_blocked
+            return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._rows)
+            pending_blocked = len(self._blocked)
+        stats = dict(self.stats)
+        stats['pending'] = pending
+        stats['pending_blocked'] = pending_blocked
+        stats['avg_flush_ms'] = round(stats.pop('flush_ms_total') / stats['flushes'], 1) if stats['flushes'] else 0.0
+        return stats
+
+    # --- Фоновый поток ---
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                if not self.flush() and self._running:
+                    # Пауза перед повтором, чтобы не долбить недоступную БД
+                    time.sleep(min(5.0, self.flush_interval * 4))
+            except Exception as e:
+                logging.error(f"Лог рассылки | Ошибка фоновой записи: {e}")
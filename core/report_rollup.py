@@ -0,0 +1,253 @@
+# report_rollup.py
+"""
+Почасовые агрегаты для отчётов (таблица report_hourly_rollup).
+
+Отчёты за смену, дневной отток и статистика персонала раньше считались
+COUNT(*) / GROUP BY по всей таблице users на каждый запрос. Теперь на
+каждое событие пользователя (регистрация, выдача, погашение, отписка,
+удаление) в агрегатную строку (час, источник, сотрудник) добавляется
+разница «было — стало», а отчёт складывает несколько десятков строк
+за нужные часы.
+
+Вклад пользователя в агрегаты определяется его состоянием:
+
+    signups         +1 в час регистрации
+    issued          +1 в час регистрации, если купон выдан (issued/redeemed/redeemed_and_left)
+    left_by_signup  +1 в час регистрации, если погасил и отписался
+    redeemed        +1 в час погашения
+    redeem_seconds  время от регистрации до погашения — в час погашения
+    left_by_redeem  +1 в час погашения, если отписался
+
+Часы — московские, ключ 'YYYY-MM-DD HH:00'. Если даты погашения нет
+(старые записи PostgreSQL), погашение относится к часу регистрации.
+
+Полный пересчёт по таблице users (после миграции или для проверки):
+
+    python -m core.report_rollup --backfill
+"""
+import datetime
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import pytz
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+ROLLUP_MEASURES = ('signups', 'issued', 'left_by_signup', 'redeemed', 'redeem_seconds', 'left_by_redeem')
+ISSUED_STATUSES = ('issued', 'redeemed', 'redeemed_and_left')
+REDEEMED_STATUSES = ('redeemed', 'redeemed_and_left')
+LEFT_STATUS = 'redeemed_and_left'
+
+RollupKey = Tuple[str, str, int]  # (час, источник, staff_id)
+
+# Поля users, от которых зависят агрегаты: запись без них агрегаты не меняет
+STATE_FIELDS = ('status', 'source', 'brought_by_staff_id', 'signup_date', 'redeem_date')
+
+# Отметка в job_watermarks: инкремент не записался, агрегаты нужно пересчитать
+DIRTY_MARK = 'report_rollup_dirty'
+
+# Прибавляет разницу к строке агрегата (одинаково для SQLite и PostgreSQL)
+UPSERT_SQL = (
+    f"INSERT INTO report_hourly_rollup (hour, source, staff_id, {', '.join(ROLLUP_MEASURES)}) "
+    f"VALUES (:hour, :source, :staff_id, {', '.join(':' + m for m in ROLLUP_MEASURES)}) "
+    f"ON CONFLICT (hour, source, staff_id) DO UPDATE SET "
+    + ', '.join(f"{m} = report_hourly_rollup.{m} + excluded.{m}" for m in ROLLUP_MEASURES)
+)
+
+
+def to_moscow(value: Any) -> Optional[datetime.datetime]:
+    """Приводит дату из БД (datetime или строку) к московскому времени; наивные считаются московскими."""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, datetime.datetime):
+        try:
+            value = datetime.datetime.fromisoformat(str(value).strip())
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        return MOSCOW_TZ.localize(value)
+    return value.astimezone(MOSCOW_TZ)
+
+
+def hour_key(moment: datetime.datetime) -> str:
+    return moment.strftime('%Y-%m-%d %H:00')
+
+
+def hour_range(start_time: datetime.datetime, end_time: datetime.datetime) -> Tuple[str, str]:
+    """
+    Ключи первого и последнего часа периода (оба включительно).
+    Начало округляется вниз до часа; конец, попавший ровно на границу часа,
+    этот час не захватывает (смена 12:00–06:00 — это часы 12:00 ... 05:00).
+    """
+    start = to_moscow(start_time)
+    end = to_moscow(end_time)
+    if end.minute == 0 and end.second == 0 and end.microsecond == 0 and end > start:
+        end -= datetime.timedelta(hours=1)
+    return hour_key(start), hour_key(end)
+
+
+def contributions(state: Optional[Mapping[str, Any]]) -> Dict[RollupKey, Dict[str, int]]:
+    """
+    Вклад одного пользователя в агрегаты.
+    state — {'status', 'source', 'brought_by_staff_id', 'signup_date', 'redeem_date'}.
+    """
+    result: Dict[RollupKey, Dict[str, int]] = {}
+    if not state:
+        return result
+    status = state.get('status')
+    source = state.get('source') or ''
+    staff_id = int(state.get('brought_by_staff_id') or 0)
+    signup = to_moscow(state.get('signup_date'))
+    redeem = to_moscow(state.get('redeem_date'))
+
+    def add(moment: datetime.datetime, measure: str, value: int):
+        bucket = result.setdefault((hour_key(moment), source, staff_id), {})
+        bucket[measure] = bucket.get(measure, 0) + value
+
+    if signup:
+        add(signup, 'signups', 1)
+        if status in ISSUED_STATUSES:
+            add(signup, 'issued', 1)
+        if status == LEFT_STATUS:
+            add(signup, 'left_by_signup', 1)
+
+    redeem_moment = redeem or (signup if status in REDEEMED_STATUSES else None)
+    if redeem_moment:
+        add(redeem_moment, 'redeemed', 1)
+        if redeem and signup and status in REDEEMED_STATUSES:
+            add(redeem_moment, 'redeem_seconds', int((redeem - signup).total_seconds()))
+        if status == LEFT_STATUS:
+            add(redeem_moment, 'left_by_redeem', 1)
+    return result
+
+
+def diff(old_state: Optional[Mapping[str, Any]],
+         new_state: Optional[Mapping[str, Any]]) -> Dict[RollupKey, Dict[str, int]]:
+    """Изменение агрегатов при переходе пользователя из old_state в new_state (None — нет пользователя)."""
+    result = contributions(new_state)
+    for key, measures in contributions(old_state).items():
+        bucket = result.setdefault(key, {})
+        for measure, value in measures.items():
+            bucket[measure] = bucket.get(measure, 0) - value
+    return {key: measures for key, measures in result.items() if any(measures.values())}
+
+
+def diff_many(before: Mapping[int, Optional[Mapping[str, Any]]],
+              after: Mapping[int, Optional[Mapping[str, Any]]]) -> Dict[RollupKey, Dict[str, int]]:
+    """Суммарное изменение агрегатов по снимкам {user_id: состояние} до и после записи."""
+    result: Dict[RollupKey, Dict[str, int]] = defaultdict(dict)
+    for user_id, old_state in before.items():
+        for key, measures in diff(old_state, after.get(user_id)).items():
+            bucket = result[key]
+            for measure, value in measures.items():
+                bucket[measure] = bucket.get(measure, 0) + value
+    return dict(result)
+
+
+def aggregate(states: Iterable[Mapping[str, Any]]) -> Dict[RollupKey, Dict[str, int]]:
+    """Агрегаты по набору пользователей (полный пересчёт)."""
+    result: Dict[RollupKey, Dict[str, int]] = defaultdict(dict)
+    for state in states:
+        for key, measures in contributions(state).items():
+            bucket = result[key]
+            for measure, value in measures.items():
+                bucket[measure] = bucket.get(measure, 0) + value
+    return dict(result)
+
+
+def to_rows(deltas: Mapping[RollupKey, Mapping[str, int]]) -> List[Dict[str, Any]]:
+    """Строки для записи в report_hourly_rollup (все показатели, недостающие — 0)."""
+    return [
+        {'hour': hour, 'source': source, 'staff_id': staff_id,
+         **{measure: measures.get(measure, 0) for measure in ROLLUP_MEASURES}}
+        for (hour, source, staff_id), measures in sorted(deltas.items())
+    ]
+
+
+def summarize_report(rows: Iterable[Mapping[str, Any]], start_key: str, end_key: str,
+                     empty_source: Optional[str] = None) -> tuple:
+    """
+    Данные отчёта в формате get_report_data_for_period:
+    (выдано, погашено, [], источники, суммарное время до погашения в секундах).
+    """
+    issued = redeemed = redeem_seconds = 0
+    all_sources: Dict[Optional[str], int] = {}
+    for row in rows:
+        if not start_key <= row['hour'] <= end_key:
+            continue
+        issued += row['issued'] or 0
+        redeemed += row['redeemed'] or 0
+        redeem_seconds += row['redeem_seconds'] or 0
+        if row['signups']:
+            source = row['source'] or empty_source
+            all_sources[source] = all_sources.get(source, 0) + row['signups']
+
+    # Переходы от сотрудников — последними, как в прежних отчётах
+    sources = {k: v for k, v in all_sources.items() if k != "staff"}
+    if all_sources.get("staff", 0) > 0:
+        sources["staff"] = all_sources["staff"]
+    return issued, redeemed, [], sources, redeem_seconds
+
+
+def summarize_churn(rows: Iterable[Mapping[str, Any]], start_key: str, end_key: str) -> Tuple[int, int]:
+    """(погашено за период, из них отписались) — по часу погашения."""
+    redeemed = left = 0
+    for row in rows:
+        if start_key <= row['hour'] <= end_key:
+            redeemed += row['redeemed'] or 0
+            left += row['left_by_redeem'] or 0
+    return redeemed, left
+
+
+def summarize_staff(rows: Iterable[Mapping[str, Any]], start_key: str, end_key: str,
+                    staff: Mapping[int, Tuple[str, str]]) -> Dict[str, List[Dict]]:
+    """
+    Статистика персонала в формате get_staff_performance_for_period.
+    staff — {staff_id: (short_name, position)}.
+    """
+    performance: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        staff_id = row['staff_id']
+        if not staff_id or staff_id not in staff or not start_key <= row['hour'] <= end_key:
+            continue
+        if not row['signups'] and not row['left_by_signup']:
+            continue
+        name, position = staff[staff_id]
+        data = performance.setdefault(name, {'position': position, 'brought': 0, 'churn': 0})
+        data['brought'] += row['signups'] or 0
+        data['churn'] += row['left_by_signup'] or 0
+
+    grouped: Dict[str, List[Dict]] = {}
+    for name, data in performance.items():
+        grouped.setdefault(data['position'], []).append(
+            {'name': name, 'brought': data['brought'], 'churn': data['churn']})
+    for position in grouped:
+        grouped[position].sort(key=lambda x: x['brought'], reverse=True)
+    return grouped
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+    import sys
+    import os
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Почасовые агрегаты отчётов")
+    parser.add_argument('--backfill', action='store_true',
+                        help="пересчитать report_hourly_rollup по всей таблице users")
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.print_help()
+        sys.exit(1)
+
+    from core import database
+    database.init_db()
+    started = datetime.datetime.now()
+    users, buckets = database.rebuild_report_rollup()
+    if users < 0:
+        sys.exit(1)
+    print(f"Пересчитано: {users} пользователей -> {buckets} строк агрегатов "
+          f"за {(datetime.datetime.now() - started).total_seconds():.1f}s")
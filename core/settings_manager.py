@@ -1,9 +1,10 @@
 # settings_manager.py
-import json
 import logging
 from pathlib import Path
 from typing import Dict, Any, Optional
 
+from .config_store import JsonFileStore
+
 # Файл для хранения настроек будет создан в той же папке, где и скрипт
 SETTINGS_FILE = Path("bot_settings.json")
 
@@ -31,31 +32,23 @@ DEFAULT_SETTINGS = {
     }
 }
 
+# Файл читается один раз и перечитывается, только если изменился (см. core/config_store.py)
+_store = JsonFileStore(SETTINGS_FILE, DEFAULT_SETTINGS, create_if_missing=True, indent=4)
+
 def _load_settings() -> Dict[str, Any]:
     """
-    Загружает настройки из JSON-файла.
-    Если файл не найден или содержит ошибку, создает новый с дефолтными настройками.
+    Текущие настройки (неизменяемый снимок из памяти).
+    Если файла нет, создаёт его с дефолтными настройками; если он повреждён —
+    остаются последние прочитанные (или дефолтные) настройки.
     """
-    if not SETTINGS_FILE.exists():
-        logging.info(f"Файл настроек {SETTINGS_FILE} не найден. Создаю новый.")
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(DEFAULT_SETTINGS, f, ensure_ascii=False, indent=4)
-        return DEFAULT_SETTINGS
-    
-    with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            logging.error(f"Ошибка чтения {SETTINGS_FILE}. Возвращаю дефолтные настройки.")
-            return DEFAULT_SETTINGS
+    return _store.get()
 
 def _save_settings(settings: Dict[str, Any]):
-    """Сохраняет переданный словарь настроек в JSON-файл."""
-    with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(settings, f, ensure_ascii=False, indent=4)
+    """Атомарно сохраняет переданный словарь настроек в JSON-файл."""
+    _store.update(lambda current: settings)
 
 def get_all_settings() -> Dict[str, Any]:
-    """Возвращает все текущие настройки из файла."""
+    """Возвращает все текущие настройки (только для чтения)."""
     return _load_settings()
 
 def update_setting(path: str, value: Any) -> bool:
@@ -63,8 +56,7 @@ def update_setting(path: str, value: Any) -> bool:
     Обновляет одну конкретную настройку по указанному пути.
     Путь указывается через точку, например: "promotions.group_bonus.is_active"
     """
-    try:
-        settings = _load_settings()
+    def apply(settings: Dict[str, Any]):
         keys = path.split('.')
         current_level = settings
         # Проходим по вложенности словаря до предпоследнего ключа
@@ -73,7 +65,9 @@ def update_setting(path: str, value: Any) -> bool:
         
         # Обновляем значение по последнему ключу
         current_level[keys[-1]] = value
-        _save_settings(settings)
+
+    try:
+        _store.update(apply)
         logging.info(f"Настройка '{path}' обновлена на значение: {value}")
         return True
     except KeyError:
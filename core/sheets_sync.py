@@ -0,0 +1,172 @@
+# sheets_sync.py
+"""
+Синхронизация пользователей Google Sheets → PostgreSQL (веб-панель, /sync).
+
+Раньше на каждую строку листа шло до трёх запросов: get_user_by_id,
+add_new_user и update_status. Теперь:
+
+- лист читается одним get_all_values(), колонки сопоставляются по шапке один раз;
+- пользователи из БД загружаются одним запросом ({user_id: status});
+- разница считается в памяти: новые пользователи вставляются многострочным
+  INSERT ... ON CONFLICT DO NOTHING (bulk_insert_users), изменения статусов —
+  одним UPDATE по набору (bulk_update_statuses);
+- статус меняется только вперёд (registered → issued → redeemed →
+  redeemed_and_left): лист — копия данных бота и может отставать от БД;
+- обратной записи в Google Sheets нет: пакетные методы PostgresClient не
+  ставят строки в очередь выгрузки, в отличие от add_new_user/update_status
+  модуля core.database.
+
+Модуль не импортирует core.config — веб-панель работает без токена бота.
+"""
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Заголовки колонок: старые названия листа и подписи из utils/export_to_sheets
+COLUMN_ALIASES = {
+    'user_id': ('user_id', 'Telegram ID', 'ID', 'ID Пользователя'),
+    'username': ('username', 'Username', 'Юзернейм в Telegram'),
+    'first_name': ('first_name', 'Имя', 'Имя в Telegram'),
+    'source': ('source', 'Источник'),
+    'status': ('status', 'Статус', 'Статус Награды'),
+}
+
+DEFAULT_SOURCE = 'google_sheets_sync'
+
+# Порядок статусов: синхронизация двигает статус только вперёд
+STATUS_RANK = {'registered': 0, 'issued': 1, 'redeemed': 2, 'redeemed_and_left': 3}
+
+# Русские подписи статусов в таблице (см. _translate_status_to_russian в core.database)
+STATUS_FROM_SHEET = {
+    'зарегистрирован': 'registered',
+    'купон выдан': 'issued',
+    'купон погашен': 'redeemed',
+    'погашен и отписался': 'redeemed_and_left',
+}
+
+
+def normalize_status(value: Any) -> Optional[str]:
+    """Статус из ячейки листа ('Купон выдан' или 'issued') → код; неизвестный → None."""
+    text = str(value or '').strip().lower()
+    if text in STATUS_RANK:
+        return text
+    return STATUS_FROM_SHEET.get(text)
+
+
+def _column_map(header: Sequence[str]) -> Dict[str, int]:
+    """Поле → номер колонки по первой подходящей подписи в шапке."""
+    positions = {str(title).strip(): i for i, title in reversed(list(enumerate(header)))}
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in positions:
+                columns[field] = positions[alias]
+                break
+    return columns
+
+
+def parse_rows(values: Sequence[Sequence[Any]]) -> Tuple[Dict[int, Dict[str, Any]], int, int]:
+    """
+    Строки листа (первая — шапка) → ({user_id: пользователь}, пустых строк, некорректных).
+    Строка без user_id пропускается, с нечисловым — считается ошибкой;
+    при повторе user_id берётся последняя строка.
+    """
+    if not values:
+        return {}, 0, 0
+    columns = _column_map(values[0])
+    if 'user_id' not in columns:
+        return {}, len(values) - 1, 0
+
+    def cell(row, field):
+        index = columns.get(field)
+        if index is None or index >= len(row):
+            return ''
+        return str(row[index]).strip()
+
+    users: Dict[int, Dict[str, Any]] = {}
+    skipped = invalid = 0
+    for row in values[1:]:
+        raw_id = cell(row, 'user_id')
+        if not raw_id:
+            skipped += 1
+            continue
+        try:
+            uid = int(float(raw_id))
+        except ValueError:
+            uid = 0
+        if uid <= 0:
+            invalid += 1
+            continue
+        users[uid] = {
+            'user_id': uid,
+            'username': cell(row, 'username'),
+            'first_name': cell(row, 'first_name'),
+            'source': cell(row, 'source') or DEFAULT_SOURCE,
+            'status': normalize_status(cell(row, 'status')),
+        }
+    return users, skipped, invalid
+
+
+def plan(sheet_users: Dict[int, Dict[str, Any]],
+         existing: Dict[int, Optional[str]]) -> Tuple[List[Dict[str, Any]], List[Tuple[int, Optional[str], str]]]:
+    """
+    Разница листа и БД: (новые пользователи, [(user_id, статус в БД, новый статус)]).
+    Статус существующего пользователя меняется, только если в листе он дальше.
+    """
+    to_insert = []
+    to_update = []
+    for uid, user in sheet_users.items():
+        if uid not in existing:
+            to_insert.append(dict(user, status=user['status'] or 'registered'))
+            continue
+        new_status = user['status']
+        old_status = existing[uid]
+        if new_status and STATUS_RANK[new_status] > STATUS_RANK.get(old_status, -1):
+            to_update.append((uid, old_status, new_status))
+    return to_insert, to_update
+
+
+def sync_users(values: Sequence[Sequence[Any]], backend,
+               progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """
+    Синхронизирует строки листа с БД.
+
+    Args:
+        values: ws.get_all_values() — шапка и строки
+        backend: PostgresClient (get_user_statuses, bulk_insert_users, bulk_update_statuses)
+        progress: функция для текста прогресса
+
+    Returns:
+        dict: total, synced (добавлено), updated, skipped, errors, seconds, rows_per_sec
+    """
+    report = progress or (lambda text: None)
+    started = time.monotonic()
+    total = max(len(values) - 1, 0)
+
+    sheet_users, _, invalid = parse_rows(values)
+    report(f'Строк: {total}, пользователей: {len(sheet_users)}. Загрузка пользователей из БД...')
+    existing = backend.get_user_statuses()
+
+    to_insert, to_update = plan(sheet_users, existing)
+    report(f'Новых: {len(to_insert)}, смена статуса: {len(to_update)}. Запись в БД...')
+
+    inserted = backend.bulk_insert_users(to_insert)
+    updated = backend.bulk_update_statuses(to_update)
+
+    seconds = time.monotonic() - started
+    result = {
+        'total': total,
+        'synced': len(inserted),
+        'updated': updated,
+        # Уже были в БД (в т.ч. добавленные или изменённые ботом параллельно),
+        # повторы user_id и строки без ID
+        'skipped': total - len(inserted) - updated - invalid,
+        'errors': invalid,
+        'seconds': round(seconds, 2),
+        'rows_per_sec': round(total / seconds) if seconds > 0 else total,
+    }
+    logging.info(
+        f"Синхронизация Sheets → БД: {total} строк за {seconds:.2f} с ({result['rows_per_sec']} строк/с), "
+        f"добавлено {result['synced']}, статусов обновлено {updated}, пропущено {result['skipped']}"
+    )
+    return result
@@ -0,0 +1,409 @@
+# sheets_writer.py
+"""
+Единый фоновый писатель в Google Sheets (write-behind очередь).
+
+Раньше каждая запись в БД запускала отдельный поток, который заново
+авторизовался в gspread, открывал таблицу и искал строку пользователя
+через worksheet.find() по всей колонке. Теперь:
+
+- один долгоживущий поток держит открытый worksheet;
+- индекс user_id → номер строки строится один раз (col_values) и
+  поддерживается при добавлении строк;
+- несколько изменений полей одного пользователя склеиваются, а новые
+  строки и обновления отправляются пачкой (append_rows / batch_update)
+  раз в N секунд или при накоплении M строк;
+- перед обновлением ячеек ID в найденных строках сверяется одним
+  batch_get: если строки вставили, удалили или отсортировали вручную или
+  из другого процесса, индекс перестраивается, а не пишется в чужую строку;
+- неудачная отправка повторяется ограниченное число раз, затем записи
+  отправляются по одной: отбрасываются только те, что API отвергает
+  (4xx), остальное остаётся в очереди и spool;
+- очередь дублируется в spool-файл (JSONL), поэтому записи, не успевшие
+  уйти в таблицу, переживают перезапуск бота;
+- на время выгрузки utils/export_to_sheets отправка приостанавливается
+  (paused()), после неё индекс строк перестраивается.
+"""
+import json
+import os
+import re
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+# Номер колонки с user_id в листе «Выгрузка Пользователей» (B)
+USER_ID_COLUMN = 2
+
+
+def parse_start_row(response) -> Optional[int]:
+    """Номер первой добавленной строки из ответа append_rows ('Лист'!A101:K103)."""
+    try:
+        updated_range = response['updates']['updatedRange']
+        match = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(match.group(1)) if match else None
+    except (KeyError, TypeError):
+        return None
+
+
+def _first_cell(value_range) -> str:
+    """Текст первой ячейки диапазона из batch_get ('' для пустого)."""
+    if value_range and value_range[0]:
+        return str(value_range[0][0]).strip()
+    return ''
+
+
+def _is_item_error(error: Exception) -> bool:
+    """Ошибка самой записи (4xx, кроме 429): повтор не поможет, в отличие от сети, 429 и 5xx."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def _col_to_letter(col: int) -> str:
+    letters = ""
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+class SheetsWriter:
+    def __init__(self, worksheet_factory: Callable[[], Any], spool_path: str,
+                 flush_interval: float = 5.0, flush_max_rows: int = 50,
+                 max_retries: int = 5):
+        """
+        Args:
+            worksheet_factory: функция, открывающая рабочий лист (или None при ошибке)
+            spool_path: путь к файлу, в котором хранится неотправленная очередь
+            flush_interval: максимальная задержка отправки, секунд
+            flush_max_rows: сколько изменённых строк вызывает досрочную отправку
+            max_retries: сколько раз повторять неудачную отправку пачки,
+                прежде чем отправлять записи по одной
+        """
+        self.worksheet_factory = worksheet_factory
+        self.spool_path = spool_path
+        self.flush_interval = flush_interval
+        self.flush_max_rows = flush_max_rows
+        self.max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # одна отправка за раз; paused() держит его
+        self._index_stale = False
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+        # Очередь: новые строки и обновления ячеек, склеенные по user_id
+        self._pending_appends: Dict[str, List[Any]] = {}
+        self._pending_updates: Dict[str, Dict[int, Any]] = {}
+        self._failures = 0
+
+        self._worksheet = None
+        self._row_index: Dict[str, int] = {}
+
+        # Статистика
+        self.stats = {'flushes': 0, 'rows_appended': 0, 'cells_updated': 0,
+                      'errors': 0, 'dropped': 0}
+
+        self._load_spool()
+
+    # --- Публичный API ---
+
+    def start(self):
+        """Запускает фоновый поток (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="sheets-writer", daemon=True)
+        self._thread.start()
+        logging.info("G-Sheets writer | Фоновый писатель запущен")
+
+    def stop(self, timeout: float = 10.0):
+        """Останавливает поток, предварительно попытавшись отправить очередь."""
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        logging.info("G-Sheets writer | Фоновый писатель остановлен")
+
+    def enqueue_append(self, row_data: List[Any]):
+        """Ставит в очередь добавление строки пользователя (если её ещё нет в таблице)."""
+        key = str(row_data[USER_ID_COLUMN - 1])
+        with self._lock:
+            self._pending_appends.setdefault(key, list(row_data))
+            self._spool_write({'op': 'append', 'row': row_data})
+            size = len(self._pending_appends) + len(self._pending_updates)
+        self._ensure_started()
+        if size >= self.flush_max_rows:
+            self._wakeup.set()
+
+    def enqueue_update(self, user_id: int, cells: Dict[int, Any]):
+        """
+        Ставит в очередь обновление ячеек пользователя.
+
+        Args:
+            cells: {номер колонки (1-based): значение}
+        """
+        key = str(user_id)
+        with self._lock:
+            self._merge_update(key, cells)
+            self._spool_write({'op': 'update', 'user_id': key,
+                               'cells': {str(c): v for c, v in cells.items()}})
+            size = len(self._pending_appends) + len(self._pending_updates)
+        self._ensure_started()
+        if size >= self.flush_max_rows:
+            self._wakeup.set()
+
+    @contextmanager
+    def paused(self):
+        """
+        Приостанавливает отправку (дожидается текущей), очередь продолжает копиться.
+        После выхода индекс строк перестраивается: лист могли дописать.
+        """
+        with self._send_lock:
+            try:
+                yield
+            finally:
+                self._index_stale = True
+
+    def flush(self) -> bool:
+        """Синхронно отправляет накопленную очередь. Возвращает True при успехе."""
+        with self._send_lock:
+            return self._flush_locked()
+
+    def _flush_locked(self) -> bool:
+        with self._lock:
+            appends = self._pending_appends
+            updates = self._pending_updates
+            self._pending_appends = {}
+            self._pending_updates = {}
+        if not appends and not updates:
+            return True
+
+        try:
+            self._send(appends, updates)
+        except Exception as e:
+            self.stats['errors'] += 1
+            self._failures += 1
+            self._worksheet = None  # при следующей попытке переподключаемся
+            if _is_item_error(e) or self._failures > self.max_retries:
+                logging.warning(f"G-Sheets writer | Пачка не отправлена ({self._failures} раз подряд), "
+                                f"отправляю записи по одной: {e}")
+                self._send_each(appends, updates)
+            else:
+                logging.warning(f"G-Sheets writer | Ошибка отправки (попытка {self._failures}/{self.max_retries}): {e}")
+                with self._lock:
+                    self._requeue(appends, updates)
+            with self._lock:
+                self._spool_rewrite()
+            return False
+
+        self._failures = 0
+        self.stats['flushes'] += 1
+        with self._lock:
+            self._spool_rewrite()
+        return True
+
+    def _send_each(self, appends: Dict[str, List[Any]], updates: Dict[str, Dict[int, Any]]):
+        """
+        Отправляет записи пачки по одной. Запись, которую API отвергает (4xx),
+        отбрасывается; на ошибке сети, 429 или 5xx отправка прекращается и всё
+        неотправленное возвращается в очередь — чужие записи из-за неё не теряются.
+        """
+        keys = list(dict.fromkeys([*appends, *updates]))
+        for position, key in enumerate(keys):
+            item_appends = {key: appends[key]} if key in appends else {}
+            item_updates = {key: updates[key]} if key in updates else {}
+            try:
+                self._send(item_appends, item_updates)
+            except Exception as e:
+                self.stats['errors'] += 1
+                self._worksheet = None
+                if not _is_item_error(e):
+                    rest = keys[position:]
+                    with self._lock:
+                        self._requeue({k: appends[k] for k in rest if k in appends},
+                                      {k: updates[k] for k in rest if k in updates})
+                    logging.warning(f"G-Sheets writer | Таблица недоступна, {len(rest)} записей остаются в очереди: {e}")
+                    return
+                self.stats['dropped'] += 1
+                logging.error(f"G-Sheets writer | Запись пользователя {key} отвергнута таблицей, отбрасываю: {e}")
+        # Всё, что можно было отправить, отправлено — следующая пачка с чистого счёта
+        self._failures = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._pending_appends) + len(self._pending_updates)
+        return dict(self.stats, pending=pending, indexed_rows=len(self._row_index))
+
+    # --- Внутренняя логика ---
+
+    def _ensure_started(self):
+        if not self._running:
+            self.start()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self._retry_delay() if self._failures else self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"G-Sheets writer | Непредвиденная ошибка цикла: {e}", exc_info=True)
+        # Финальная попытка при остановке
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+    def _retry_delay(self) -> float:
+        return min(self.flush_interval * (2 ** min(self._failures, 10)), 300)
+
+    def _get_worksheet(self):
+        if self._worksheet is None:
+            worksheet = self.worksheet_factory()
+            if worksheet is None:
+                raise RuntimeError("Не удалось получить worksheet")
+            self._worksheet = worksheet
+            self._rebuild_index()
+        elif self._index_stale:
+            self._rebuild_index()
+        return self._worksheet
+
+    def _rebuild_index(self):
+        self._index_stale = False
+        values = self._worksheet.col_values(USER_ID_COLUMN)
+        self._row_index = {str(v).strip(): i for i, v in enumerate(values, start=1) if v}
+        logging.info(f"G-Sheets writer | Индекс строк построен: {len(self._row_index)} пользователей")
+
+    def _send(self, appends: Dict[str, List[Any]], updates: Dict[str, Dict[int, Any]]):
+        worksheet = self._get_worksheet()
+
+        # 1. Новые строки — одним append_rows, пропуская уже существующих пользователей
+        new_keys = [k for k in appends if k not in self._row_index]
+        skipped = len(appends) - len(new_keys)
+        if skipped:
+            logging.info(f"G-Sheets writer | {skipped} пользователей уже в таблице, пропускаю добавление")
+        if new_keys:
+            rows = [appends[k] for k in new_keys]
+            response = worksheet.append_rows(rows)
+            start_row = parse_start_row(response)
+            if start_row:
+                for offset, key in enumerate(new_keys):
+                    self._row_index[key] = start_row + offset
+            else:
+                self._rebuild_index()
+            self.stats['rows_appended'] += len(rows)
+
+        # 2. Обновления ячеек — одним batch_update
+        if updates:
+            rows = self._verified_rows(worksheet, updates)
+            if len(rows) < len(updates):
+                # Строку добавили, или строки сдвинули (вставка, удаление, сортировка)
+                # вручную или из другого процесса — индекс устарел
+                self._rebuild_index()
+                rows = {k: self._row_index[k] for k in updates if k in self._row_index}
+            data = []
+            for key, cells in updates.items():
+                row = rows.get(key)
+                if not row:
+                    logging.warning(f"G-Sheets writer | Не удалось найти пользователя {key} для обновления.")
+                    continue
+                for col, value in cells.items():
+                    data.append({'range': f"{_col_to_letter(int(col))}{row}", 'values': [[value]]})
+            if data:
+                worksheet.batch_update(data, value_input_option='USER_ENTERED')
+                self.stats['cells_updated'] += len(data)
+
+        if appends or updates:
+            logging.info(f"G-Sheets writer | Отправлено: {len(new_keys)} новых строк, {len(updates)} обновлений")
+
+    def _verified_rows(self, worksheet, keys) -> Dict[str, int]:
+        """Строки из индекса, в колонке user_id которых действительно ID пользователя (один batch_get)."""
+        rows = {k: self._row_index[k] for k in keys if k in self._row_index}
+        if not rows:
+            return {}
+        letter = _col_to_letter(USER_ID_COLUMN)
+        cells = worksheet.batch_get([f"{letter}{row}" for row in rows.values()])
+        return {key: row for (key, row), value in zip(rows.items(), cells) if _first_cell(value) == key}
+
+    def _merge_update(self, key: str, cells: Dict[int, Any]):
+        pending_row = self._pending_appends.get(key)
+        if pending_row is not None:
+            # Строка ещё не отправлена — просто правим её содержимое
+            for col, value in cells.items():
+                while len(pending_row) < col:
+                    pending_row.append("")
+                pending_row[col - 1] = value
+        else:
+            self._pending_updates.setdefault(key, {}).update(cells)
+
+    def _requeue(self, appends, updates):
+        """Возвращает неотправленное в очередь, не затирая более свежие значения."""
+        for key, row in appends.items():
+            self._pending_appends.setdefault(key, row)
+        for key, cells in updates.items():
+            merged = dict(cells)
+            merged.update(self._pending_updates.get(key, {}))
+            self._pending_updates[key] = merged
+
+    # --- Spool-файл ---
+
+    def _spool_write(self, record: Dict[str, Any]):
+        try:
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            logging.error(f"G-Sheets writer | Не удалось записать spool: {e}")
+
+    def _spool_rewrite(self):
+        """Перезаписывает spool текущим содержимым очереди (атомарно)."""
+        try:
+            if not self._pending_appends and not self._pending_updates:
+                if os.path.exists(self.spool_path):
+                    os.remove(self.spool_path)
+                return
+            tmp_path = self.spool_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for row in self._pending_appends.values():
+                    f.write(json.dumps({'op': 'append', 'row': row}, ensure_ascii=False, default=str) + "\n")
+                for key, cells in self._pending_updates.items():
+                    f.write(json.dumps({'op': 'update', 'user_id': key,
+                                        'cells': {str(c): v for c, v in cells.items()}},
+                                       ensure_ascii=False, default=str) + "\n")
+            os.replace(tmp_path, self.spool_path)
+        except Exception as e:
+            logging.error(f"G-Sheets writer | Не удалось перезаписать spool: {e}")
+
+    def _load_spool(self):
+        """Восстанавливает очередь из spool-файла после перезапуска."""
+        spool_dir = os.path.dirname(self.spool_path)
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        if not os.path.exists(self.spool_path):
+            return
+        restored = 0
+        try:
+            with open(self.spool_path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('op') == 'append':
+                        row = record['row']
+                        self._pending_appends.setdefault(str(row[USER_ID_COLUMN - 1]), row)
+                    elif record.get('op') == 'update':
+                        cells = {int(c): v for c, v in record['cells'].items()}
+                        self._merge_update(str(record['user_id']), cells)
+                    restored += 1
+        except Exception as e:
+            logging.error(f"G-Sheets writer | Не удалось прочитать spool: {e}")
+            return
+        if restored:
+            logging.info(f"G-Sheets writer | Восстановлено {restored} записей из spool, отправлю при запуске")
@@ -0,0 +1,248 @@
+# sqlite_pool.py
+"""
+Пул соединений SQLite для core/database.py.
+
+Вместо того чтобы на каждый запрос проверять каталог и открывать новый
+sqlite3.connect, соединения создаются один раз, настраиваются PRAGMA
+(WAL, synchronous=NORMAL, busy_timeout, mmap_size, cache_size) и
+переиспользуются между вызовами. Благодаря долгоживущим соединениям
+работает и встроенный кеш подготовленных выражений sqlite3
+(cached_statements), так что одинаковый SQL не компилируется повторно.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any
+
+# PRAGMA, которые применяются к каждому новому соединению ровно один раз
+DEFAULT_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", "5000"),
+    ("mmap_size", str(256 * 1024 * 1024)),
+    ("cache_size", str(-16000)),  # отрицательное значение — размер в KiB (~16 МБ)
+    ("temp_store", "MEMORY"),
+)
+
+
+class PooledConnection:
+    """
+    Обёртка над sqlite3.Connection, выдаваемая пулом.
+
+    Ведёт себя как обычное соединение (cursor, execute, commit, row_factory ...),
+    но close() не закрывает его, а возвращает в пул. Это позволяет старому коду
+    вида `conn = get_db_connection(); ...; conn.close()` работать без изменений.
+    """
+
+    __slots__ = ("_conn", "_pool", "_released")
+
+    def __init__(self, conn: sqlite3.Connection, pool: "SQLitePool"):
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_released", False)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    def __del__(self):
+        # Старый код часто не доходит до close() при исключении — не теряем соединение
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Возвращает соединение в пул (повторный вызов безопасен)."""
+        if self._released:
+            return
+        object.__setattr__(self, "_released", True)
+        self._pool.release(self._conn)
+
+
+class SQLitePool:
+    """
+    Ограниченный пул соединений SQLite с переполнением.
+
+    Свободные соединения хранятся в LIFO-очереди (чтобы «горячее» соединение с
+    прогретым кешем страниц использовалось первым). Если все соединения заняты,
+    checkout ждёт до wait_timeout секунд, после чего открывает временное
+    соединение сверх лимита, — так вложенные вызовы из одного потока никогда
+    не блокируют друг друга.
+    """
+
+    def __init__(self, db_path: str, max_size: int = 8, wait_timeout: float = 0.5,
+                 cached_statements: int = 256, pragmas=DEFAULT_PRAGMAS):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._dir_checked = False
+
+        # Счетчики для мониторинга
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._overflow_opened = 0
+        self._in_use = 0
+
+    # --- Создание соединений ---
+
+    def _ensure_dir(self):
+        if self._dir_checked:
+            return
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._dir_checked = True
+
+    def _open(self) -> sqlite3.Connection:
+        self._ensure_dir()
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            try:
+                conn.execute(f"PRAGMA {name}={value}")
+            except sqlite3.DatabaseError as e:
+                logging.warning(f"SQLite pool | Не удалось применить PRAGMA {name}={value}: {e}")
+        return conn
+
+    # --- Checkout / release ---
+
+    def _acquire_raw(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Пул исчерпан — ждём освобождения соединения
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.wait_timeout)
+        except queue.Empty:
+            conn = None
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._waits += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+        if conn is not None:
+            return conn
+
+        # Таймаут — открываем соединение сверх лимита (закроется при возврате)
+        with self._lock:
+            self._overflow_opened += 1
+            self._created += 1
+        logging.debug("SQLite pool | Пул исчерпан, открыто дополнительное соединение")
+        return self._open()
+
+    def checkout(self) -> PooledConnection:
+        """Выдаёт соединение из пула. Вызывающий обязан вызвать close()."""
+        conn = self._acquire_raw()
+        # Соединение могло вернуться с незавершённой транзакцией (код упал до commit)
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+        return PooledConnection(conn, self)
+
+    def release(self, conn: sqlite3.Connection):
+        """Возвращает соединение в пул или закрывает его, если пул переполнен."""
+        with self._lock:
+            self._in_use -= 1
+            keep = self._idle.qsize() < self.max_size
+            if not keep:
+                self._created -= 1
+        if keep:
+            self._idle.put(conn)
+        else:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Контекстный менеджер: commit при успехе, rollback при исключении,
+        соединение в любом случае возвращается в пул.
+        """
+        pooled = self.checkout()
+        try:
+            yield pooled
+            if pooled.in_transaction:
+                pooled.commit()
+        except Exception:
+            if pooled.in_transaction:
+                pooled.rollback()
+            raise
+        finally:
+            pooled.close()
+
+    def close_all(self):
+        """Закрывает все свободные соединения (например, при остановке бота)."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики пула для мониторинга."""
+        with self._lock:
+            return {
+                "checkouts": self._checkouts,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "opened": self._created,
+                "max_size": self.max_size,
+                "waits": self._waits,
+                "wait_time_total_ms": round(self._wait_time_total * 1000, 2),
+                "wait_time_max_ms": round(self._wait_time_max * 1000, 2),
+                "overflow_opened": self._overflow_opened,
+            }
@@ -0,0 +1,214 @@
+# subscription_auditor.py
+"""
+Ночной аудитор подписок: проверяет, что погасившие купон остались в канале.
+
+Раньше проверка шла строго по одному пользователю с time.sleep(1) между
+вызовами get_chat_member и отдельным UPDATE на каждого отписавшегося —
+20 тысяч пользователей проверялись больше 5 часов. Теперь:
+
+- проверки выполняет небольшой пул потоков, общий темп ограничен
+  token bucket (лимиты Telegram Bot API делятся с работающим ботом);
+- первыми проверяются никогда не проверенные, затем давно проверенные;
+- результаты копятся и пишутся пачками: отписавшиеся — одним
+  UPDATE ... WHERE user_id IN (...), оставшиеся — обновлением last_check_date;
+- прогресс сохраняется в audit_runs: после перезапуска прогон продолжается,
+  уже проверенные в нём пользователи пропускаются;
+- прогон можно ограничить по времени (max_duration) — непроверенные
+  останутся самыми «старыми» и пойдут первыми в следующую ночь;
+- в лог пишутся скорость проверки и оценка оставшегося времени.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from core.broadcast_engine import TokenBucket, _extract_retry_after
+
+logger = logging.getLogger("auditor")
+
+
+class SubscriptionAuditor:
+    def __init__(self, check_func: Callable[[Any], bool], database,
+                 rate: float = 20.0, workers: int = 8, batch_size: int = 200,
+                 checkpoint_interval: float = 10.0, progress_interval: float = 60.0,
+                 max_duration: Optional[float] = None, max_rate_limit_retries: int = 3):
+        """
+        Args:
+            check_func: проверяет одного пользователя (строку из БД), True — подписан,
+                False — отписался; исключение — проверить не удалось
+            database: модуль core.database (или объект с теми же функциями)
+            rate: проверок в секунду на весь пул
+            workers: потоков проверки
+            batch_size: сколько результатов копить до записи в БД
+            checkpoint_interval: как часто сохранять прогресс, секунд
+            progress_interval: как часто писать в лог скорость и ETA, секунд
+            max_duration: ограничение длительности прогона, секунд (None — без ограничения)
+        """
+        self.check_func = check_func
+        self.database = database
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_interval = progress_interval
+        self.max_duration = max_duration
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.bucket = TokenBucket(rate)
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._members: List[int] = []
+        self._left: List[int] = []
+        self._run: Optional[Dict[str, Any]] = None
+        self._started = 0.0
+        self._last_checkpoint = 0.0
+        self._last_progress = 0.0
+        self.stats = {'total': 0, 'checked': 0, 'left': 0, 'errors': 0, 'rate_limited': 0,
+                      'checked_this_session': 0, 'remaining': 0}
+
+    # --- Публичный API ---
+
+    def run(self) -> Dict[str, Any]:
+        """Выполняет (или продолжает) прогон и блокирует поток до его завершения."""
+        self._run = self.database.start_audit_run()
+        if self._run is None:
+            logger.error("Аудитор: не удалось создать прогон, проверка отменена")
+            return self.get_progress()
+
+        users = self.database.get_redeemed_users_for_audit(
+            checked_before=self._run['started_at'] if self._run['resumed'] else None
+        )
+        # Не проверенные из-за ошибок снова попадут в выборку — их ошибки не переносим
+        self.stats.update(
+            checked=self._run['checked_count'], left=self._run['left_count'], remaining=len(users),
+        )
+        self.stats['total'] = self.stats['checked'] + len(users)
+        if self._run['resumed']:
+            logger.info(f"Аудитор: продолжаю прогон {self._run['id']}, уже проверено {self.stats['checked']}, "
+                        f"осталось {len(users)}")
+        else:
+            logger.info(f"Аудитор: прогон {self._run['id']}, к проверке {len(users)} пользователей")
+
+        for user in users:
+            self._queue.put((user, 1))
+
+        self._started = self._last_checkpoint = self._last_progress = time.monotonic()
+        threads = [threading.Thread(target=self._worker, name=f"auditor-{n}", daemon=True)
+                   for n in range(self.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self._flush()
+        timed_out = self._stop.is_set() and self.stats['remaining'] > 0
+        self._checkpoint(status='partial' if timed_out else 'done')
+        self._log_progress(final=True)
+        if timed_out:
+            logger.warning(f"Аудитор: остановлен по лимиту времени, не проверено {self.stats['remaining']} — "
+                           f"они будут первыми в следующий прогон")
+        return self.get_progress()
+
+    def get_progress(self) -> Dict[str, Any]:
+        with self._lock:
+            progress = dict(self.stats)
+        elapsed = max(time.monotonic() - self._started, 1e-6) if self._started else 0.0
+        rate = progress['checked_this_session'] / elapsed if elapsed else 0.0
+        progress['elapsed_sec'] = round(elapsed, 1)
+        progress['per_sec'] = round(rate, 2)
+        progress['eta_sec'] = round(progress['remaining'] / rate) if rate else None
+        return progress
+
+    # --- Потоки проверки ---
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                user, attempt = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if self.max_duration and time.monotonic() - self._started >= self.max_duration:
+                self._stop.set()
+                return
+
+            self.bucket.acquire()
+            user_id = int(user['user_id'])
+            try:
+                is_member = self.check_func(user)
+            except Exception as e:
+                if getattr(e, 'error_code', None) == 429 and attempt <= self.max_rate_limit_retries:
+                    # Лимит Telegram: ждём сколько просят и проверяем этого пользователя ещё раз
+                    retry_after = _extract_retry_after(e) or 1.0
+                    with self._lock:
+                        self.stats['rate_limited'] += 1
+                    time.sleep(retry_after)
+                    self._queue.put((user, attempt + 1))
+                    continue
+                logger.error(f"Аудитор: ошибка проверки {user_id}: {e}")
+                self._record(user_id, None)
+                continue
+            self._record(user_id, is_member)
+
+    def _record(self, user_id: int, is_member: Optional[bool]):
+        with self._lock:
+            self.stats['remaining'] -= 1
+            if is_member is None:
+                # Не проверен — last_check_date не трогаем, в следующий раз он пойдёт первым
+                self.stats['errors'] += 1
+            else:
+                self.stats['checked'] += 1
+                self.stats['checked_this_session'] += 1
+                if is_member:
+                    self._members.append(user_id)
+                else:
+                    self._left.append(user_id)
+                    self.stats['left'] += 1
+            need_flush = len(self._members) + len(self._left) >= self.batch_size
+            now = time.monotonic()
+            need_checkpoint = now - self._last_checkpoint >= self.checkpoint_interval
+            need_progress = now - self._last_progress >= self.progress_interval
+            if need_checkpoint:
+                self._last_checkpoint = now
+            if need_progress:
+                self._last_progress = now
+
+        if need_flush or need_checkpoint:
+            self._flush()
+        if need_checkpoint:
+            self._checkpoint()
+        if need_progress:
+            self._log_progress()
+
+    # --- Запись результатов ---
+
+    def _flush(self):
+        with self._lock:
+            members, self._members = self._members, []
+            left, self._left = self._left, []
+        if left:
+            self.database.mark_users_as_left(left)
+        if members:
+            self.database.touch_users_audit_checked(members)
+
+    def _checkpoint(self, status: str = 'running'):
+        with self._lock:
+            stats = dict(self.stats)
+        self.database.checkpoint_audit_run(
+            self._run['id'], stats['total'], stats['checked'], stats['left'], stats['errors'], status
+        )
+
+    def _log_progress(self, final: bool = False):
+        progress = self.get_progress()
+        done = progress['total'] - progress['remaining']
+        if final:
+            timing = f"за {progress['elapsed_sec']}s"
+        elif progress['eta_sec'] is not None:
+            timing = f"осталось ~{progress['eta_sec'] // 60} мин {progress['eta_sec'] % 60} с"
+        else:
+            timing = "оценка времени недоступна"
+        logger.info(
+            f"Аудитор: {'итог' if final else 'прогресс'} {done}/{progress['total']}, "
+            f"отписались {progress['left']}, ошибок {progress['errors']}, "
+            f"{progress['per_sec']} проверок/с, {timing}"
+        )
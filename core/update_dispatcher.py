@@ -0,0 +1,229 @@
+# update_dispatcher.py
+"""
+Многопоточная обработка входящих обновлений Telegram.
+
+При long polling бот (TeleBot(threaded=False)) обрабатывает обновления строго
+по одному: медленный ответ нейросети задерживает все кнопки и погашения
+купонов, пришедшие после него. Диспетчер раздаёт обновления пулу воркеров:
+
+- обновления одного чата (пользователя) обрабатываются строго по порядку
+  и никогда не параллельно — шаги бронирования и FSM не перемешиваются;
+- обновления разных чатов идут параллельно;
+- очередь ограничена: при переполнении submit ждёт до timeout и возвращает
+  False — вебхук отвечает Telegram ошибкой, и тот повторит доставку позже;
+- stop() перестаёт принимать новые обновления и дорабатывает уже принятые.
+
+Устройство: у каждого ключа (chat_id) своя FIFO-очередь, а в общую очередь
+готовых попадает ключ, у которого есть работа и который сейчас не занят
+воркером. Воркер берёт один ключ, обрабатывает одно обновление и, если
+у ключа осталось что-то ещё, возвращает ключ в конец очереди готовых —
+так один «болтливый» чат не может занять воркер надолго.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+_UPDATE_KINDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'callback_query', 'inline_query', 'chosen_inline_result',
+    'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+
+def update_key(update) -> Any:
+    """Ключ упорядочивания: чат сообщения, иначе пользователь, иначе update_id."""
+    for kind in _UPDATE_KINDS:
+        event = getattr(update, kind, None)
+        if event is None:
+            continue
+        chat = getattr(event, 'chat', None)
+        if chat is None and kind == 'callback_query' and getattr(event, 'message', None) is not None:
+            chat = event.message.chat
+        if chat is not None:
+            return chat.id
+        user = getattr(event, 'from_user', None)
+        if user is not None:
+            return user.id
+        break
+    return ('update', getattr(update, 'update_id', id(update)))
+
+
+class UpdateDispatcher:
+    def __init__(self, bot, workers: int = 8, queue_size: int = 1000, name: str = 'updates',
+                 on_submit: Optional[Callable[[Any], None]] = None):
+        self.bot = bot
+        # Вызывается для каждого входящего обновления до постановки в очередь
+        # (например, чтобы снять из очереди AI устаревший запрос того же пользователя)
+        self.on_submit = on_submit
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._pending: Dict[Any, Deque[Tuple[Any, float]]] = {}
+        self._ready: Deque[Any] = deque()
+        self._busy = set()
+        self._queued = 0
+        self._accepting = False
+        self._running = False
+        self._threads = []
+
+        self._stats = {
+            'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0,
+            'max_queued': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+            'handle_total': 0.0, 'handle_max': 0.0,
+        }
+
+    # --- Жизненный цикл ---
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._accepting = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Диспетчер обновлений | Запущено воркеров: {self.workers}, очередь до {self.queue_size}")
+
+    def stop(self, drain_timeout: float = 30.0) -> bool:
+        """
+        Останавливает приём и ждёт, пока воркеры обработают принятые обновления.
+        Возвращает False, если за drain_timeout очередь не опустела.
+        """
+        deadline = time.monotonic() + drain_timeout
+        with self._cond:
+            self._accepting = False
+            self._cond.notify_all()
+            while self._queued or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            drained = not self._queued and not self._busy
+            left = self._queued
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()) + 1)
+        self._threads = []
+        if drained:
+            logging.info("Диспетчер обновлений | Очередь обработана, воркеры остановлены")
+        else:
+            logging.warning(f"Диспетчер обновлений | Остановлен по таймауту, не обработано: {left}")
+        return drained
+
+    # --- Приём обновлений ---
+
+    def submit(self, update, timeout: float = 0.0) -> bool:
+        """
+        Ставит обновление в очередь. Если очередь заполнена, ждёт до timeout
+        секунд; False — обновление не принято (переполнение или остановка).
+        """
+        key = update_key(update)
+        deadline = time.monotonic() + timeout
+        # До постановки в очередь: иначе воркер мог бы успеть начать обработку
+        if self.on_submit is not None:
+            try:
+                self.on_submit(update)
+            except Exception as e:
+                logging.error(f"Диспетчер обновлений | Ошибка on_submit: {e}")
+        with self._cond:
+            while self._accepting and self._queued >= self.queue_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not self._accepting or self._queued >= self.queue_size:
+                self._stats['rejected'] += 1
+                return False
+
+            queue = self._pending.get(key)
+            if queue is None:
+                queue = self._pending[key] = deque()
+                if key not in self._busy:
+                    self._ready.append(key)
+            queue.append((update, time.monotonic()))
+            self._queued += 1
+            self._stats['accepted'] += 1
+            if self._queued > self._stats['max_queued']:
+                self._stats['max_queued'] = self._queued
+            self._cond.notify_all()
+            return True
+
+    # --- Воркеры ---
+
+    def _next_task(self) -> Optional[Tuple[Any, Any, float]]:
+        with self._cond:
+            while not self._ready:
+                if not self._running or (not self._accepting and not self._queued):
+                    return None
+                self._cond.wait()
+            key = self._ready.popleft()
+            queue = self._pending[key]
+            update, enqueued_at = queue.popleft()
+            if not queue:
+                del self._pending[key]
+            self._busy.add(key)
+            self._queued -= 1
+            # Освободилось место — будим ждущие submit
+            self._cond.notify_all()
+            return key, update, enqueued_at
+
+    def _finish_task(self, key, wait: float, handle: float, ok: bool):
+        with self._cond:
+            self._busy.discard(key)
+            if key in self._pending:
+                self._ready.append(key)
+            stats = self._stats
+            stats['processed' if ok else 'failed'] += 1
+            stats['wait_total'] += wait
+            stats['handle_total'] += handle
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            stats['handle_max'] = max(stats['handle_max'], handle)
+            self._cond.notify_all()
+
+    def _worker_loop(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            key, update, enqueued_at = task
+            started = time.monotonic()
+            ok = True
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                ok = False
+                logging.error(f"Диспетчер обновлений | Ошибка обработки update {getattr(update, 'update_id', '?')}: {e}")
+            finally:
+                finished = time.monotonic()
+                self._finish_task(key, started - enqueued_at, finished - started, ok)
+
+    # --- Метрики ---
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            done = stats['processed'] + stats['failed']
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queued': self._queued,
+                'in_flight': len(self._busy),
+                'chats_waiting': len(self._pending),
+                'accepting': self._accepting,
+                'accepted': stats['accepted'],
+                'rejected': stats['rejected'],
+                'processed': stats['processed'],
+                'failed': stats['failed'],
+                'max_queued': stats['max_queued'],
+                'avg_wait_ms': round(stats['wait_total'] / done * 1000, 1) if done else 0.0,
+                'max_wait_ms': round(stats['wait_max'] * 1000, 1),
+                'avg_handle_ms': round(stats['handle_total'] / done * 1000, 1) if done else 0.0,
+                'max_handle_ms': round(stats['handle_max'] * 1000, 1),
+            }
@@ -0,0 +1,81 @@
+# webhook_server.py
+"""
+Приём обновлений Telegram через вебхук.
+
+Небольшое Flask-приложение в процессе бота: POST {WEBHOOK_PATH} разбирает
+обновление и отдаёт его UpdateDispatcher, не дожидаясь обработки, поэтому
+Telegram получает ответ сразу, а медленные хендлеры работают в пуле воркеров.
+
+- Заголовок X-Telegram-Bot-Api-Secret-Token сверяется с WEBHOOK_SECRET.
+- Если очередь диспетчера переполнена, отвечаем 503 — Telegram повторит
+  доставку позже (естественное обратное давление вместо потери обновлений).
+- GET {WEBHOOK_PATH}/stats — метрики очереди (только с тем же секретом;
+  без WEBHOOK_SECRET — 404).
+"""
+import hmac
+import logging
+import threading
+
+import telebot
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import make_server
+
+from .update_dispatcher import UpdateDispatcher
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_webhook_app(dispatcher: UpdateDispatcher, path: str, secret: str = '',
+                       submit_timeout: float = 2.0) -> Flask:
+    app = Flask(__name__)
+
+    def _check_secret():
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            abort(403)
+
+    @app.route(path, methods=['POST'])
+    def telegram_webhook():
+        _check_secret()
+        try:
+            update = telebot.types.Update.de_json(request.get_data(as_text=True))
+        except Exception as e:
+            logging.warning(f"Вебхук | Не удалось разобрать обновление: {e}")
+            return '', 400
+        if update is None:
+            return '', 400
+        if not dispatcher.submit(update, timeout=submit_timeout):
+            logging.warning(f"Вебхук | Очередь переполнена, update {update.update_id} отклонён")
+            return '', 503
+        return '', 200
+
+    @app.route(path.rstrip('/') + '/stats', methods=['GET'])
+    def webhook_stats():
+        if not secret:
+            abort(404)
+        _check_secret()
+        return jsonify(dispatcher.get_stats())
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'status': 'ok', 'accepting': dispatcher.get_stats()['accepting']})
+
+    return app
+
+
+class WebhookServer:
+    """WSGI-сервер вебхука в отдельном потоке с корректной остановкой."""
+
+    def __init__(self, app: Flask, host: str, port: int):
+        self._server = make_server(host, port, app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook-server', daemon=True)
+        self.host = host
+        self.port = port
+
+    def start(self):
+        self._thread.start()
+        logging.info(f"Вебхук | Сервер слушает {self.host}:{self.port}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join(timeout=10)
+        logging.info("Вебхук | Сервер остановлен")
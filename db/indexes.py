@@ -0,0 +1,70 @@
+"""
+Управляемые индексы для SQLite (core/database.py) и PostgreSQL (PostgresClient).
+
+Все вторичные индексы горячих запросов описаны здесь, а не разбросаны по
+init_db: init_db и PostgresClient.create_tables создают недостающие при
+каждом старте (CREATE INDEX IF NOT EXISTS), а db/query_plan_check.py
+проверяет по EXPLAIN, что горячие запросы действительно их используют.
+
+Частичные индексы (WHERE ...) SQLite и PostgreSQL применяют, только если
+условие запроса содержит условие индекса, — запросы, на которые они
+рассчитаны, должны повторять его дословно (например, referrer_rewarded = 0).
+"""
+from typing import Iterable, List, Tuple
+
+# (имя, DDL). Таблицы должны существовать к моменту вызова apply_*
+SQLITE_INDEXES: List[Tuple[str, str]] = [
+    # Постраничный список пользователей, отчёты персонала по signup_date
+    ("idx_users_signup_user", "ON users (signup_date DESC, user_id DESC)"),
+    ("idx_users_status", "ON users (status)"),
+    # Ночной аудитор: погасившие купон от давно не проверенных
+    ("idx_users_status_last_check", "ON users (status, last_check_date)"),
+    ("idx_users_username_nocase", "ON users (username COLLATE NOCASE)"),
+    ("idx_users_first_name_nocase", "ON users (first_name COLLATE NOCASE)"),
+    # Погашения за период (топ рефереров месяца, недавние погашения)
+    ("idx_users_redeem_date", "ON users (redeem_date) WHERE redeem_date IS NOT NULL"),
+    # Статистика рефералов одного пользователя — покрывающий, без чтения строк
+    ("idx_users_referrer", "ON users (referrer_id, referrer_rewarded, redeem_date) WHERE referrer_id IS NOT NULL"),
+    # Рефералы, ждущие награды: маленький частичный индекс вместо скана users
+    ("idx_users_referral_pending",
+     "ON users (referrer_id, signup_date, redeem_date) "
+     "WHERE referrer_id IS NOT NULL AND redeem_date IS NOT NULL AND referrer_rewarded = 0"),
+    # Приведённые сотрудником за период
+    ("idx_users_staff_signup", "ON users (brought_by_staff_id, signup_date) WHERE brought_by_staff_id IS NOT NULL"),
+    # Заблокировавшие бота (их единицы процентов)
+    ("idx_users_blocked", "ON users (user_id) WHERE blocked = 1"),
+    # Выгрузка в Google Sheets: строки, изменённые после отметки
+    ("idx_users_updated", "ON users (updated_at, user_id)"),
+    # История диалога: последние реплики пользователя
+    ("idx_conversation_history_user", "ON conversation_history (user_id, id)"),
+    ("idx_conversation_history_user_ts", "ON conversation_history (user_id, timestamp)"),
+    # Планировщик отложенных задач: ближайшая ожидающая и истёкшие аренды
+    ("idx_delayed_tasks_due", "ON delayed_tasks (next_run_at) WHERE status = 'pending'"),
+    ("idx_delayed_tasks_lease", "ON delayed_tasks (claimed_until) WHERE status = 'running'"),
+    # Есть ли уже задача пользователя этого типа (сверка реферальных наград)
+    ("idx_delayed_tasks_user_type", "ON delayed_tasks (user_id, task_type)"),
+    # Возобновление рассылки: кто уже получил её после чекпоинта
+    ("idx_broadcast_delivery_run_user", "ON broadcast_delivery_log (broadcast_id, user_id)"),
+]
+
+POSTGRES_INDEXES: List[Tuple[str, str]] = [
+    ("idx_users_register_user", "ON users (register_date DESC NULLS LAST, user_id DESC)"),
+    ("idx_users_status", "ON users (status)"),
+    ("idx_users_username_lower", "ON users (lower(username) text_pattern_ops)"),
+    ("idx_users_first_name_lower", "ON users (lower(first_name) text_pattern_ops)"),
+    ("idx_users_redeem_date", "ON users (redeem_date) WHERE redeem_date IS NOT NULL"),
+    ("idx_users_referrer",
+     "ON users (referrer_id) INCLUDE (referrer_rewarded, redeem_date) WHERE referrer_id IS NOT NULL"),
+    # referrer_rewarded в старых базах бывает и integer, и boolean — в условие индекса не входит
+    ("idx_users_referral_pending",
+     "ON users (referrer_id, register_date) INCLUDE (redeem_date, referrer_rewarded) "
+     "WHERE referrer_id IS NOT NULL AND redeem_date IS NOT NULL"),
+    ("idx_users_staff_register",
+     "ON users (brought_by_staff_id, register_date) WHERE brought_by_staff_id IS NOT NULL"),
+    ("idx_users_blocked", "ON users (user_id) WHERE blocked = 1"),
+    ("idx_conversation_history_user", "ON conversation_history (user_id, id)"),
+]
+
+
+def index_statements(indexes: Iterable[Tuple[str, str]]) -> List[str]:
+    return [f"CREATE INDEX IF NOT EXISTS {name} {definition}" for name, definition in indexes]
@@ -0,0 +1,53 @@
+"""
+Общие помощники для постраничной выборки пользователей (SQLite и PostgreSQL).
+
+Keyset-пагинация идёт по паре (signup_date DESC, user_id DESC): курсор —
+это значения последней строки предыдущей страницы, закодированные в строку
+"<signup_date>|<user_id>". В отличие от OFFSET такой запрос читает из
+индекса только нужные строки, сколько бы страниц ни было до текущей.
+"""
+from typing import List, Optional, Tuple
+
+# Максимальная длина Telegram user_id в цифрах (с запасом)
+_MAX_USER_ID_DIGITS = 13
+
+USERS_PAGE_MAX_LIMIT = 500
+
+
+def encode_cursor(signup_date, user_id) -> str:
+    """Кодирует позицию последней строки страницы в строковый курсор."""
+    return f"{signup_date if signup_date is not None else ''}|{user_id}"
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[Optional[str], int]]:
+    """Разбирает курсор. Возвращает (signup_date или None, user_id) либо None."""
+    if not cursor or '|' not in cursor:
+        return None
+    signup_date, _, user_id = cursor.rpartition('|')
+    try:
+        return (signup_date or None), int(user_id)
+    except ValueError:
+        return None
+
+
+def escape_like(value: str) -> str:
+    """Экранирует спецсимволы LIKE (используется с ESCAPE '\\')."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def user_id_prefix_ranges(prefix: str) -> List[Tuple[int, int]]:
+    """
+    Превращает префиксный поиск по user_id в набор диапазонов.
+
+    «user_id начинается с 123» == user_id в [123, 123] или [1230, 1239] или
+    [12300, 12399] ... — каждый диапазон обслуживается первичным ключом,
+    тогда как CAST(user_id AS TEXT) LIKE '123%' требует полного скана.
+    """
+    if not prefix.isdigit() or prefix.startswith('0'):
+        return []
+    base = int(prefix)
+    ranges = []
+    for extra in range(0, _MAX_USER_ID_DIGITS - len(prefix) + 1):
+        scale = 10 ** extra
+        ranges.append((base * scale, (base + 1) * scale - 1))
+    return ranges
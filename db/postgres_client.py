@@ -1,15 +1,21 @@
 """
 Модуль для работы с базой данных PostgreSQL.
 """
+import io
 import logging
 import sqlalchemy as sa
 from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Text, DateTime, Float, Boolean, ForeignKey
 from sqlalchemy.sql import select, insert, update, delete
 from sqlalchemy.exc import SQLAlchemyError
 import datetime
+import json
 import pytz
 import os
 
+from db.indexes import POSTGRES_INDEXES, index_statements
+from db.pagination import encode_cursor, decode_cursor, escape_like, user_id_prefix_ranges
+from core import report_rollup
+
 try:
     from core.config import DATABASE_URL, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_DB
 except Exception:
@@ -19,6 +25,16 @@ except Exception:
     POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', '')
     POSTGRES_DB = os.getenv('POSTGRES_DB', 'railway')
 
+
+def _copy_csv_field(value) -> str:
+    """Поле для COPY ... FORMAT csv: None — пустое без кавычек (NULL), строка — в кавычках."""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
 class PostgresClient:
     def __init__(self, db_url=None):
         """
@@ -30,6 +46,8 @@ class PostgresClient:
         self.db_url = db_url or DATABASE_URL
         self.engine = None
         self.metadata = MetaData()
+        # Инкремент агрегатов отчётов не записался — пересчитать перед отчётом
+        self._rollup_dirty = False
         
         # Определяем таблицы
         self.users_table = None
@@ -148,6 +166,10 @@ class PostgresClient:
             logging.info("PostgreSQL tables created successfully")
             # Миграция: добавляем недостающие колонки
             self._ensure_broadcast_columns()
+            self._ensure_conversation_history_table()
+            self._ensure_user_list_indexes()
+            self._ensure_ai_metrics_tables()
+            self._ensure_report_rollup_table()
             return True
         except SQLAlchemyError as e:
             logging.error(f"Failed to create PostgreSQL tables: {e}")
@@ -172,6 +194,98 @@ class PostgresClient:
         except Exception as e:
             logging.warning(f"PostgreSQL | Не удалось проверить/добавить колонки blocked: {e}")
     
+    def _ensure_conversation_history_table(self):
+        """История диалогов с AI (db/repository.py пишет её в основную БД)."""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(sa.text("""
+                    CREATE TABLE IF NOT EXISTS conversation_history (
+                        id BIGSERIAL PRIMARY KEY,
+                        user_id BIGINT NOT NULL,
+                        role TEXT NOT NULL,
+                        text TEXT,
+                        timestamp TIMESTAMP DEFAULT NOW()
+                    )
+                """))
+                conn.commit()
+        except Exception as e:
+            logging.warning(f"PostgreSQL | Не удалось создать таблицу conversation_history: {e}")
+
+    def import_conversation_history(self, rows):
+        """
+        Вставляет перенесённые из SQLite реплики ({'id', 'user_id', 'role', 'text', 'timestamp'})
+        с заданными id; уже перенесённые пропускаются (повторный запуск безопасен).
+        """
+        if not rows:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(sa.text(
+                "INSERT INTO conversation_history (id, user_id, role, text, timestamp) "
+                "VALUES (:id, :user_id, :role, :text, :timestamp) ON CONFLICT (id) DO NOTHING"
+            ), rows)
+
+    def _ensure_user_list_indexes(self):
+        """Индексы горячих запросов: список пользователей, рефералы, персонал (см. db/indexes.py)."""
+        for statement in index_statements(POSTGRES_INDEXES):
+            try:
+                with self.engine.connect() as conn:
+                    conn.execute(sa.text(statement))
+                    conn.commit()
+            except Exception as e:
+                logging.warning(f"PostgreSQL | Не удалось создать индекс ({statement}): {e}")
+
+    def _ensure_ai_metrics_tables(self):
+        """Таблицы агрегатов метрик AI и долгосрочной памяти о пользователях."""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(sa.text("""
+                    CREATE TABLE IF NOT EXISTS ai_metrics_daily (
+                        date DATE PRIMARY KEY,
+                        total_requests INTEGER DEFAULT 0,
+                        successful_requests INTEGER DEFAULT 0,
+                        failed_requests INTEGER DEFAULT 0,
+                        prompt_tokens BIGINT DEFAULT 0,
+                        completion_tokens BIGINT DEFAULT 0,
+                        total_tokens BIGINT DEFAULT 0,
+                        cost_usd DOUBLE PRECISION DEFAULT 0,
+                        response_time_sum_ms DOUBLE PRECISION DEFAULT 0,
+                        response_time_count INTEGER DEFAULT 0,
+                        unique_users INTEGER DEFAULT 0
+                    )
+                """))
+                # Счётчики кеша ответов AI (добавлены позже — для уже созданной таблицы)
+                conn.execute(sa.text("""
+                    ALTER TABLE ai_metrics_daily
+                        ADD COLUMN IF NOT EXISTS cache_lookups INTEGER DEFAULT 0,
+                        ADD COLUMN IF NOT EXISTS cache_hits INTEGER DEFAULT 0,
+                        ADD COLUMN IF NOT EXISTS cache_saved_tokens BIGINT DEFAULT 0,
+                        ADD COLUMN IF NOT EXISTS cache_saved_cost_usd DOUBLE PRECISION DEFAULT 0
+                """))
+                conn.execute(sa.text("""
+                    CREATE TABLE IF NOT EXISTS ai_user_memory (
+                        user_id BIGINT PRIMARY KEY,
+                        profile TEXT NOT NULL,
+                        has_name INTEGER DEFAULT 0,
+                        has_preferred_bar INTEGER DEFAULT 0,
+                        has_favorite_drinks INTEGER DEFAULT 0,
+                        bookings_count INTEGER DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT NOW()
+                    )
+                """))
+                conn.execute(sa.text("""
+                    CREATE TABLE IF NOT EXISTS ai_metrics_user_daily (
+                        date DATE NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        requests INTEGER DEFAULT 0,
+                        tokens BIGINT DEFAULT 0,
+                        cost_usd DOUBLE PRECISION DEFAULT 0,
+                        PRIMARY KEY (date, user_id)
+                    )
+                """))
+                conn.commit()
+        except Exception as e:
+            logging.warning(f"PostgreSQL | Не удалось создать таблицы метрик AI: {e}")
+
     def add_new_user(self, user_id, username, first_name, source, referrer_id=None, brought_by_staff_id=None):
         """
         Добавляет нового пользователя в базу данных.
@@ -218,6 +332,7 @@ class PostgresClient:
                 )
                 
                 connection.execute(stmt)
+                self._rollup_commit(connection, {user_id: None})
                 logging.info(f"✅ PostgreSQL | Пользователь {user_id} успешно добавлен в БД. Источник: {source}, Время: {now}")
                 return True
                 
@@ -241,13 +356,16 @@ class PostgresClient:
         """
         try:
             with self.engine.connect() as connection:
+                now = datetime.datetime.now(pytz.timezone('Europe/Moscow'))
+                values = {'status': new_status, 'last_activity': now}
+                if new_status == 'redeemed':
+                    values['redeem_date'] = now
+                before = self._rollup_snapshot(connection, [user_id])
                 stmt = update(self.users_table).where(
                     self.users_table.c.user_id == user_id
-                ).values(
-                    status=new_status,
-                    last_activity=datetime.datetime.now(pytz.timezone('Europe/Moscow'))
-                )
+                ).values(**values)
                 connection.execute(stmt)
+                self._rollup_commit(connection, before)
                 connection.commit()
                 
                 logging.info(f"PostgreSQL | Статус пользователя {user_id} обновлен на {new_status}.")
@@ -256,6 +374,93 @@ class PostgresClient:
             logging.error(f"PostgreSQL | Ошибка обновления статуса для {user_id}: {e}")
             return False
 
+    def get_user_statuses(self):
+        """Все пользователи одним запросом: {user_id: status}."""
+        with self.engine.connect() as connection:
+            rows = connection.execute(sa.text("SELECT user_id, status FROM users"))
+            return {row.user_id: row.status for row in rows}
+
+    def bulk_insert_users(self, users, chunk_size=1000):
+        """
+        Добавляет пользователей многострочными INSERT ... ON CONFLICT DO NOTHING
+        в одной транзакции (по chunk_size строк в запросе).
+
+        Args:
+            users (list): словари с ключами user_id, username, first_name, source, status
+            chunk_size (int): строк в одном INSERT
+
+        Returns:
+            list: user_id действительно добавленных (уже существующие пропускаются)
+        """
+        if not users:
+            return []
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+        now = datetime.datetime.now(pytz.timezone('Europe/Moscow'))
+        inserted = []
+        with self.engine.begin() as connection:
+            for start in range(0, len(users), chunk_size):
+                values = []
+                for user in users[start:start + chunk_size]:
+                    status = user.get('status') or 'registered'
+                    values.append({
+                        'user_id': user['user_id'],
+                        'username': user.get('username') or '',
+                        'first_name': user.get('first_name') or '',
+                        'source': user.get('source'),
+                        'register_date': now,
+                        'last_activity': now,
+                        'status': status,
+                        'redeem_date': now if status in ('redeemed', 'redeemed_and_left') else None,
+                        'referrer_rewarded': False,
+                        'blocked': 0,
+                    })
+                stmt = pg_insert(self.users_table).values(values).on_conflict_do_nothing(
+                    index_elements=['user_id']
+                ).returning(self.users_table.c.user_id)
+                inserted.extend(row.user_id for row in connection.execute(stmt))
+            if inserted:
+                self._rollup_commit(connection, dict.fromkeys(inserted))
+        logging.info(f"PostgreSQL | Пакетно добавлено пользователей: {len(inserted)} из {len(users)}")
+        return inserted
+
+    def bulk_update_statuses(self, changes):
+        """
+        Меняет статусы одним UPDATE ... FROM unnest(...).
+
+        Args:
+            changes (list): кортежи (user_id, ожидаемый_текущий_статус, новый_статус);
+                строка меняется, только если статус в БД всё ещё ожидаемый
+                (параллельное изменение ботом не перетирается)
+
+        Returns:
+            int: число изменённых пользователей
+        """
+        if not changes:
+            return 0
+        now = datetime.datetime.now(pytz.timezone('Europe/Moscow'))
+        with self.engine.begin() as connection:
+            before = self._rollup_snapshot(connection, [uid for uid, _, _ in changes])
+            result = connection.execute(sa.text("""
+                UPDATE users AS u
+                SET status = v.new_status,
+                    last_activity = :now,
+                    redeem_date = CASE WHEN v.new_status IN ('redeemed', 'redeemed_and_left')
+                                       THEN COALESCE(u.redeem_date, :now) ELSE u.redeem_date END
+                FROM unnest(CAST(:uids AS BIGINT[]), CAST(:old AS TEXT[]), CAST(:new AS TEXT[]))
+                     AS v(user_id, old_status, new_status)
+                WHERE u.user_id = v.user_id AND u.status IS NOT DISTINCT FROM v.old_status
+            """), {
+                'now': now,
+                'uids': [uid for uid, _, _ in changes],
+                'old': [old for _, old, _ in changes],
+                'new': [new for _, _, new in changes],
+            })
+            updated = result.rowcount
+            self._rollup_commit(connection, before)
+        logging.info(f"PostgreSQL | Пакетно обновлено статусов: {updated} из {len(changes)}")
+        return updated
+
     def add_booking(self, user_id, date, time, guests, name, phone, comment, source="bot", source_detail=None):
         """
         Добавляет новое бронирование в базу данных.
@@ -320,6 +525,39 @@ class PostgresClient:
             logging.error(f"PostgreSQL | Ошибка получения пользователя {user_id}: {e}")
             return None
 
+    def get_user_ai_context(self, user_id, history_limit=12):
+        """
+        Строка users и последние history_limit реплик диалога одним запросом
+        (LATERAL-подзапрос по индексу conversation_history).
+
+        Returns:
+            {'user': dict | None, 'history': [{'role', 'content'}, ...]}
+        """
+        context = {'user': None, 'history': []}
+        try:
+            with self.engine.connect() as connection:
+                rows = connection.execute(sa.text("""
+                    SELECT u.*, h.id AS _history_id, h.role AS _history_role, h.text AS _history_text
+                    FROM (SELECT CAST(:user_id AS BIGINT) AS uid) q
+                    LEFT JOIN users u ON u.user_id = q.uid
+                    LEFT JOIN LATERAL (
+                        SELECT id, role, text FROM conversation_history
+                        WHERE user_id = q.uid ORDER BY id DESC LIMIT :limit
+                    ) h ON TRUE
+                    ORDER BY h.id DESC
+                """), {'user_id': user_id, 'limit': history_limit}).fetchall()
+        except SQLAlchemyError as e:
+            logging.error(f"PostgreSQL | Ошибка получения контекста AI для {user_id}: {e}")
+            return context
+        if rows and rows[0]._mapping['user_id'] is not None:
+            context['user'] = {key: value for key, value in rows[0]._mapping.items()
+                               if not key.startswith('_history_')}
+        context['history'] = [
+            {"role": row._mapping['_history_role'], "content": row._mapping['_history_text']}
+            for row in reversed(rows) if row._mapping['_history_id'] is not None
+        ]
+        return context
+
     def get_all_users(self):
         """
         Получает список всех пользователей.
@@ -337,6 +575,87 @@ class PostgresClient:
             logging.error(f"PostgreSQL | Ошибка получения списка пользователей: {e}")
             return []
     
+    def get_users_page(self, limit=50, cursor=None, status=None, search=None, page=None):
+        """
+        Постраничная выборка пользователей (keyset по register_date DESC, user_id DESC).
+
+        Returns:
+            dict: {'users': [...], 'next_cursor': str|None, 'total': int, 'status_counts': {...}}
+        """
+        result = {'users': [], 'next_cursor': None, 'total': 0, 'status_counts': {}}
+        try:
+            filters, params = [], {}
+            if status:
+                filters.append("status = :status")
+                params['status'] = status
+            if search:
+                params['pattern'] = escape_like(search.lstrip('@').lower()) + '%'
+                search_parts = [
+                    "lower(username) LIKE :pattern ESCAPE '\\'",
+                    "lower(first_name) LIKE :pattern ESCAPE '\\'",
+                ]
+                for n, (lo, hi) in enumerate(user_id_prefix_ranges(search)):
+                    search_parts.append(f"user_id BETWEEN :lo{n} AND :hi{n}")
+                    params[f'lo{n}'] = lo
+                    params[f'hi{n}'] = hi
+                filters.append("(" + " OR ".join(search_parts) + ")")
+
+            with self.engine.connect() as conn:
+                rows = conn.execute(sa.text("SELECT status, COUNT(*) FROM users GROUP BY status")).fetchall()
+                result['status_counts'] = {(row[0] or 'unknown'): row[1] for row in rows}
+                if search:
+                    where_sql = " WHERE " + " AND ".join(filters)
+                    result['total'] = conn.execute(
+                        sa.text(f"SELECT COUNT(*) FROM users{where_sql}"), params
+                    ).scalar() or 0
+                elif status:
+                    result['total'] = result['status_counts'].get(status, 0)
+                else:
+                    result['total'] = sum(result['status_counts'].values())
+
+                page_filters, page_params = list(filters), dict(params)
+                position = decode_cursor(cursor)
+                offset = 0
+                if position:
+                    last_date, last_uid = position
+                    page_params['last_uid'] = last_uid
+                    if last_date is None:
+                        page_filters.append("(register_date IS NULL AND user_id < :last_uid)")
+                    else:
+                        page_filters.append(
+                            "(register_date < CAST(:last_date AS TIMESTAMP) "
+                            "OR (register_date = CAST(:last_date AS TIMESTAMP) AND user_id < :last_uid) "
+                            "OR register_date IS NULL)"
+                        )
+                        page_params['last_date'] = last_date
+                elif page and page > 1:
+                    offset = (page - 1) * limit
+                page_params['limit'] = limit + 1
+                page_params['offset'] = offset
+
+                where_sql = (" WHERE " + " AND ".join(page_filters)) if page_filters else ""
+                rows = conn.execute(sa.text(f"""
+                    SELECT * FROM users{where_sql}
+                    ORDER BY register_date DESC NULLS LAST, user_id DESC
+                    LIMIT :limit OFFSET :offset
+                """), page_params).fetchall()
+
+            users = []
+            for row in rows[:limit]:
+                user = dict(row._mapping)
+                user['signup_date'] = user.get('register_date')
+                users.append(user)
+            result['users'] = users
+            if len(rows) > limit and users:
+                last_date = users[-1]['register_date']
+                result['next_cursor'] = encode_cursor(
+                    last_date.isoformat(sep=' ') if last_date else None, users[-1]['user_id']
+                )
+            return result
+        except SQLAlchemyError as e:
+            logging.error(f"PostgreSQL | Ошибка постраничной выборки пользователей: {e}")
+            return result
+
     def add_event(self, user_id, event_type, event_data=None):
         """
         Добавляет новое событие в базу данных.
@@ -531,11 +850,13 @@ class PostgresClient:
         """
         try:
             with self.engine.connect() as connection:
+                before = self._rollup_snapshot(connection, [user_id])
                 stmt = update(self.users_table).where(
                     self.users_table.c.user_id == user_id
                 ).values(source=source)
                 
                 connection.execute(stmt)
+                self._rollup_commit(connection, before)
                 connection.commit()
                 
                 logging.info(f"PostgreSQL | Источник пользователя {user_id} обновлен на: {source}")
@@ -556,10 +877,13 @@ class PostgresClient:
         """
         try:
             with self.engine.connect() as connection:
+                before = self._rollup_snapshot(connection, [user_id])
                 stmt = self.users_table.delete().where(
                     self.users_table.c.user_id == user_id
                 )
                 result = connection.execute(stmt)
+                if result.rowcount > 0:
+                    self._rollup_commit(connection, before)
                 connection.commit()
                 
                 if result.rowcount > 0:
@@ -575,92 +899,147 @@ class PostgresClient:
             return False, error_msg
 
     def get_report_data_for_period(self, start_time: datetime.datetime, end_time: datetime.datetime) -> tuple:
-        """Получает данные для отчета за период из PostgreSQL."""
+        """Данные для отчета за период — сумма почасовых агрегатов (с точностью до часа)."""
         try:
-            with self.engine.connect() as connection:
-                # Количество выданных подарков (issued)
-                # В PostgreSQL используется register_date вместо signup_date
-                issued_stmt = select(sa.func.count()).select_from(self.users_table).where(
-                    sa.and_(
-                        self.users_table.c.register_date >= start_time,
-                        self.users_table.c.register_date <= end_time,
-                        self.users_table.c.status.in_(['issued', 'redeemed', 'redeemed_and_left'])
-                    )
-                )
-                issued_count = connection.execute(issued_stmt).scalar() or 0
-                
-                # Количество активированных подарков (redeemed)
-                # Пока используем register_date, так как redeem_date может отсутствовать
-                redeemed_stmt = select(sa.func.count()).select_from(self.users_table).where(
-                    sa.and_(
-                        self.users_table.c.register_date >= start_time,
-                        self.users_table.c.register_date <= end_time,
-                        self.users_table.c.status.in_(['redeemed', 'redeemed_and_left'])
-                    )
-                )
-                redeemed_count = connection.execute(redeemed_stmt).scalar() or 0
-                
-                # Источники трафика
-                sources_stmt = select(
-                    self.users_table.c.source,
-                    sa.func.count().label('count')
-                ).select_from(self.users_table).where(
-                    sa.and_(
-                        self.users_table.c.register_date >= start_time,
-                        self.users_table.c.register_date <= end_time
-                    )
-                ).group_by(self.users_table.c.source)
-                
-                sources_result = connection.execute(sources_stmt).fetchall()
-                all_sources = {(row.source or 'direct'): row.count for row in sources_result}
-                
-                # Фильтруем источники
-                sources = {k: v for k, v in all_sources.items() if k != "staff"}
-                staff_count = all_sources.get("staff", 0)
-                if staff_count > 0:
-                    sources["staff"] = staff_count
-                
-                # Общее время до активации (пока 0, так как нет redeem_date)
-                total_redeem_time_seconds = 0
-                
-                logging.info(f"PostgreSQL | Отчет за период: выдано {issued_count}, активировано {redeemed_count}")
-                return issued_count, redeemed_count, [], sources, total_redeem_time_seconds
-                
+            start_key, end_key = report_rollup.hour_range(start_time, end_time)
+            issued_count, redeemed_count, _, sources, total_redeem_time_seconds = report_rollup.summarize_report(
+                self.load_report_rollup(start_key, end_key), start_key, end_key, empty_source='direct'
+            )
+            logging.info(f"PostgreSQL | Отчет за период: выдано {issued_count}, активировано {redeemed_count}")
+            return issued_count, redeemed_count, [], sources, total_redeem_time_seconds
         except SQLAlchemyError as e:
             logging.error(f"PostgreSQL | Ошибка получения данных отчета: {e}")
             return 0, 0, [], {}, 0
 
     def get_daily_churn_data(self, start_time: datetime.datetime, end_time: datetime.datetime) -> tuple:
-        """Получает данные об оттоке за период из PostgreSQL."""
+        """Отток за период (по часу погашения) — сумма почасовых агрегатов."""
         try:
-            with self.engine.connect() as connection:
-                # Всего активировано (используем register_date)
-                redeemed_stmt = select(sa.func.count()).select_from(self.users_table).where(
-                    sa.and_(
-                        self.users_table.c.register_date >= start_time,
-                        self.users_table.c.register_date <= end_time,
-                        self.users_table.c.status.in_(['redeemed', 'redeemed_and_left'])
-                    )
-                )
-                redeemed_total = connection.execute(redeemed_stmt).scalar() or 0
-                
-                # Покинуло заведение (используем register_date)
-                left_stmt = select(sa.func.count()).select_from(self.users_table).where(
-                    sa.and_(
-                        self.users_table.c.register_date >= start_time,
-                        self.users_table.c.register_date <= end_time,
-                        self.users_table.c.status == 'redeemed_and_left'
-                    )
-                )
-                left_count = connection.execute(left_stmt).scalar() or 0
-                
-                logging.info(f"PostgreSQL | Отток за период: активировано {redeemed_total}, ушло {left_count}")
-                return redeemed_total, left_count
-                
+            start_key, end_key = report_rollup.hour_range(start_time, end_time)
+            redeemed_total, left_count = report_rollup.summarize_churn(
+                self.load_report_rollup(start_key, end_key), start_key, end_key
+            )
+            logging.info(f"PostgreSQL | Отток за период: активировано {redeemed_total}, ушло {left_count}")
+            return redeemed_total, left_count
         except SQLAlchemyError as e:
             logging.error(f"PostgreSQL | Ошибка получения данных об оттоке: {e}")
             return 0, 0
 
+    # --- Почасовые агрегаты отчётов (report_hourly_rollup) ---
+
+    _ROLLUP_STATE_SQL = (
+        "SELECT user_id, status, source, brought_by_staff_id, register_date AS signup_date, redeem_date "
+        "FROM users"
+    )
+
+    def _ensure_report_rollup_table(self):
+        """Таблица почасовых агрегатов; при первом создании заполняется по истории."""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(sa.text("""
+                    CREATE TABLE IF NOT EXISTS report_hourly_rollup (
+                        hour VARCHAR(16) NOT NULL,
+                        source VARCHAR(50) NOT NULL DEFAULT '',
+                        staff_id INTEGER NOT NULL DEFAULT 0,
+                        signups INTEGER DEFAULT 0,
+                        issued INTEGER DEFAULT 0,
+                        left_by_signup INTEGER DEFAULT 0,
+                        redeemed INTEGER DEFAULT 0,
+                        redeem_seconds BIGINT DEFAULT 0,
+                        left_by_redeem INTEGER DEFAULT 0,
+                        PRIMARY KEY (hour, source, staff_id)
+                    )
+                """))
+                # Отметки фоновых задач (как в SQLite): здесь — «агрегаты нужно пересчитать»
+                conn.execute(sa.text("""
+                    CREATE TABLE IF NOT EXISTS job_watermarks (
+                        name VARCHAR(100) PRIMARY KEY,
+                        value TEXT,
+                        updated_at TEXT
+                    )
+                """))
+                conn.commit()
+                rollup_empty = conn.execute(sa.text("SELECT 1 FROM report_hourly_rollup LIMIT 1")).fetchone() is None
+                has_users = conn.execute(sa.text("SELECT 1 FROM users LIMIT 1")).fetchone() is not None
+            if rollup_empty and has_users:
+                self.rebuild_report_rollup()
+        except Exception as e:
+            logging.warning(f"PostgreSQL | Не удалось создать таблицу агрегатов отчётов: {e}")
+
+    def _rollup_snapshot(self, conn, user_ids):
+        """Состояние пользователей для агрегатов: {user_id: состояние или None}."""
+        user_ids = sorted({int(uid) for uid in user_ids})
+        states = dict.fromkeys(user_ids)
+        rows = conn.execute(sa.text(self._ROLLUP_STATE_SQL + " WHERE user_id = ANY(:uids)"), {'uids': user_ids})
+        for row in rows:
+            states[row.user_id] = dict(row._mapping)
+        return states
+
+    def _rollup_commit(self, conn, before):
+        """
+        Дописывает в агрегаты разницу между снимком before и текущим состоянием (в той же транзакции).
+        Ошибка не откатывает запись пользователя: агрегаты помечаются для пересчёта
+        перед следующим отчётом (load_report_rollup).
+        """
+        try:
+            # Точка сохранения: ошибка агрегатов не откатывает саму запись пользователя
+            with conn.begin_nested():
+                deltas = report_rollup.diff_many(before, self._rollup_snapshot(conn, before.keys()))
+                if deltas:
+                    conn.execute(sa.text(report_rollup.UPSERT_SQL), report_rollup.to_rows(deltas))
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка обновления агрегатов отчётов, пересчёт при следующем отчёте: {e}")
+            self._mark_rollup_dirty(conn)
+
+    def _mark_rollup_dirty(self, conn):
+        """Помечает агрегаты устаревшими: в памяти процесса и отметкой в той же транзакции."""
+        self._rollup_dirty = True
+        try:
+            with conn.begin_nested():
+                conn.execute(sa.text(
+                    "INSERT INTO job_watermarks (name, value, updated_at) VALUES (:name, NULL, :now) "
+                    "ON CONFLICT (name) DO NOTHING"
+                ), {'name': report_rollup.DIRTY_MARK, 'now': str(datetime.datetime.now(pytz.utc))})
+        except Exception as e:
+            logging.error(f"PostgreSQL | Не удалось сохранить отметку пересчёта агрегатов: {e}")
+
+    def load_report_rollup(self, start_key, end_key):
+        """Строки агрегатов за часы [start_key, end_key]; устаревшие агрегаты сначала пересчитываются."""
+        with self.engine.connect() as conn:
+            dirty = self._rollup_dirty or conn.execute(sa.text(
+                "SELECT 1 FROM job_watermarks WHERE name = :name"
+            ), {'name': report_rollup.DIRTY_MARK}).fetchone() is not None
+        if dirty:
+            logging.warning("PostgreSQL | Агрегаты отчётов помечены устаревшими после ошибки — пересчитываю")
+            self.rebuild_report_rollup()
+        with self.engine.connect() as conn:
+            return [dict(row._mapping) for row in conn.execute(sa.text(
+                "SELECT * FROM report_hourly_rollup WHERE hour BETWEEN :start_key AND :end_key"
+            ), {'start_key': start_key, 'end_key': end_key})]
+
+    def rebuild_report_rollup(self):
+        """Полный пересчёт агрегатов по таблице users. Возвращает (пользователей, строк); (-1, 0) при ошибке."""
+        # Сбрасываем флаг до пересчёта: ошибка во время него выставит его снова
+        self._rollup_dirty = False
+        try:
+            with self.engine.connect() as conn:
+                # Ждём транзакции, уже дописавшие разницу, и не даём новым дописать её
+                # до конца пересчёта — иначе их вклад потеряется или учтётся дважды
+                conn.execute(sa.text("LOCK TABLE report_hourly_rollup IN SHARE ROW EXCLUSIVE MODE"))
+                states = [dict(row._mapping) for row in conn.execute(sa.text(self._ROLLUP_STATE_SQL))]
+                deltas = report_rollup.aggregate(states)
+                conn.execute(sa.text("DELETE FROM report_hourly_rollup"))
+                if deltas:
+                    conn.execute(sa.text(report_rollup.UPSERT_SQL), report_rollup.to_rows(deltas))
+                conn.execute(sa.text("DELETE FROM job_watermarks WHERE name = :name"),
+                             {'name': report_rollup.DIRTY_MARK})
+                conn.commit()
+            logging.info(f"PostgreSQL | Агрегаты отчётов пересчитаны: {len(states)} пользователей, {len(deltas)} строк")
+            return len(states), len(deltas)
+        except Exception as e:
+            self._rollup_dirty = True
+            logging.error(f"PostgreSQL | Ошибка пересчёта агрегатов отчётов: {e}")
+            return -1, 0
+
     # --- Методы для реферальной системы наград ---
 
     def check_referral_reward_eligibility(self, referrer_id, referred_id):
@@ -723,7 +1102,9 @@ class PostgresClient:
                 stmt = update(self.users_table).where(
                     sa.and_(
                         self.users_table.c.user_id == referred_id,
-                        self.users_table.c.referrer_id == referrer_id
+                        self.users_table.c.referrer_id == referrer_id,
+                        # Только ещё не награждённых: награда выдаётся один раз
+                        sa.func.coalesce(sa.cast(self.users_table.c.referrer_rewarded, sa.Integer), 0) == 0
                     )
                 ).values(
                     referrer_rewarded=True,
@@ -817,75 +1198,24 @@ class PostgresClient:
             logging.error(f"PostgreSQL | Ошибка получения статистики рефералов: {e}")
             return None
 
-    def get_users_with_pending_rewards(self):
+    def get_referrals_redeemed_since(self, after_redeem_date=None, after_user_id=0, limit=500):
         """
-        Возвращает список user_id пользователей, у которых есть рефералы,
-        готовые к получению награды
+        Рефералы без награды рефереру, погасившие купон после отметки
+        (after_redeem_date, after_user_id), по возрастанию (redeem_date, user_id)
         """
         try:
-            with self.engine.connect() as connection:
-                # Находим всех пользователей с рефералами, которые:
-                # 1. Получили настойку
-                # 2. Зарегистрированы более 48 часов назад
-                # 3. Еще не получили награду
-                hours_48_ago = datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=48)
-                
-                stmt = select(self.users_table.c.referrer_id.distinct()).where(
-                    sa.and_(
-                        self.users_table.c.referrer_id.isnot(None),
-                        self.users_table.c.redeem_date.isnot(None),
-                        self.users_table.c.referrer_rewarded == False,
-                        self.users_table.c.register_date <= hours_48_ago
-                    )
-                )
-                
-                result = connection.execute(stmt).fetchall()
-                return [row[0] for row in result]
-                
-        except Exception as e:
-            logging.error(f"PostgreSQL | Ошибка получения пользователей с наградами: {e}")
-            return []
-
-    def get_recently_redeemed_referrals(self, hours=2):
-        """
-        Возвращает список рефералов, которые получили настойку в последние N часов
-        """
-        try:
-            with self.engine.connect() as connection:
-                hours_ago = datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=hours)
-                
-                stmt = select(
-                    self.users_table.c.user_id,
-                    self.users_table.c.username,
-                    self.users_table.c.first_name,
-                    self.users_table.c.referrer_id,
-                    self.users_table.c.redeem_date
-                ).where(
-                    sa.and_(
-                        self.users_table.c.referrer_id.isnot(None),
-                        self.users_table.c.redeem_date.isnot(None),
-                        self.users_table.c.redeem_date >= hours_ago,
-                        self.users_table.c.referrer_rewarded == False
-                    )
-                ).order_by(self.users_table.c.redeem_date.desc())
-                
-                result = connection.execute(stmt).fetchall()
-                
-                recent_referrals = []
-                for row in result:
-                    user_id, username, first_name, referrer_id, redeem_date = row
-                    recent_referrals.append({
-                        'user_id': user_id,
-                        'username': username, 
-                        'first_name': first_name,
-                        'referrer_id': referrer_id,
-                        'redeem_date': redeem_date
-                    })
-                
-                return recent_referrals
-                
+            with self.engine.connect() as conn:
+                rows = conn.execute(sa.text("""
+                    SELECT user_id, referrer_id, redeem_date FROM users
+                    WHERE referrer_id IS NOT NULL AND redeem_date IS NOT NULL
+                      AND CAST(referrer_rewarded AS INTEGER) = 0
+                      AND (redeem_date, user_id) > (CAST(:after AS TIMESTAMP), :after_user_id)
+                    ORDER BY redeem_date, user_id LIMIT :limit
+                """), {'after': after_redeem_date or '1970-01-01', 'after_user_id': after_user_id,
+                       'limit': limit}).fetchall()
+                return [{'user_id': row[0], 'referrer_id': row[1], 'redeem_date': str(row[2])} for row in rows]
         except Exception as e:
-            logging.error(f"PostgreSQL | Ошибка получения недавних активаций рефералов: {e}")
+            logging.error(f"PostgreSQL | Ошибка получения погасивших рефералов: {e}")
             return []
 
     def _has_blocked_column(self, connection):
@@ -968,6 +1298,28 @@ class PostgresClient:
             logging.error(f"PostgreSQL | Ошибка отметки блокировки пользователя {user_id}: {e}")
             return False
 
+    def mark_users_blocked(self, user_ids) -> int:
+        """
+        Отмечает пачку пользователей как заблокировавших бота одним UPDATE.
+        Возвращает число обновлённых строк (-1 при ошибке).
+        """
+        user_ids = sorted({int(uid) for uid in user_ids})
+        if not user_ids:
+            return 0
+        try:
+            with self.engine.connect() as connection:
+                result = connection.execute(
+                    sa.text("UPDATE users SET blocked = 1, block_date = NOW() "
+                            "WHERE user_id = ANY(:uids) AND (blocked IS NULL OR blocked = 0)"),
+                    {"uids": user_ids}
+                )
+                connection.commit()
+                logging.info(f"PostgreSQL | Отмечено заблокировавших бота: {result.rowcount} из {len(user_ids)}")
+                return result.rowcount
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка пакетной отметки блокировки ({len(user_ids)} польз.): {e}")
+            return -1
+
     def get_broadcast_statistics(self):
         """
         Получает статистику для рассылок
@@ -988,15 +1340,12 @@ class PostgresClient:
                 has_blocked = self._has_blocked_column(connection)
                 if has_blocked:
                     try:
-                        result = connection.execute(sa.text(
-                            "SELECT COUNT(*) FROM users WHERE user_id IS NOT NULL AND (blocked IS NULL OR blocked = 0)"
-                        ))
-                        active_users = result.scalar() or 0
-
                         result = connection.execute(sa.text(
                             "SELECT COUNT(*) FROM users WHERE blocked = 1"
                         ))
                         blocked_users = result.scalar() or 0
+                        # Без отдельного полного скана users
+                        active_users = total_users - blocked_users
                     except Exception as e:
                         logging.warning(f"PostgreSQL | Ошибка подсчёта blocked: {e}")
                         active_users = total_users
@@ -1060,6 +1409,10 @@ class PostgresClient:
                         status TEXT DEFAULT 'running'
                     )
                 """))
+                # Колонки для возобновления рассылки после перезапуска
+                conn.execute(sa.text("ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS payload TEXT"))
+                conn.execute(sa.text("ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS last_user_id BIGINT"))
+                conn.execute(sa.text("ALTER TABLE broadcast_runs ADD COLUMN IF NOT EXISTS checkpoint_at TIMESTAMP"))
                 conn.execute(sa.text("""
                     CREATE TABLE IF NOT EXISTS broadcast_delivery_log (
                         id SERIAL PRIMARY KEY,
@@ -1073,19 +1426,25 @@ class PostgresClient:
                         delivered_at TIMESTAMP DEFAULT NOW()
                     )
                 """))
+                # Возобновление рассылки: кто уже получил её после чекпоинта
+                conn.execute(sa.text(
+                    "CREATE INDEX IF NOT EXISTS idx_broadcast_delivery_run_user "
+                    "ON broadcast_delivery_log (broadcast_id, user_id)"
+                ))
                 conn.commit()
         except Exception as e:
             logging.warning(f"PostgreSQL | Ошибка создания таблиц broadcast_logs: {e}")
 
-    def create_broadcast_run(self, total_users: int, text_preview: str, source: str = 'bot'):
+    def create_broadcast_run(self, total_users: int, text_preview: str, source: str = 'bot', payload=None):
         """Создаёт запись о запуске рассылки. Возвращает broadcast_id."""
         try:
             self._ensure_broadcast_log_tables()
             with self.engine.connect() as conn:
                 result = conn.execute(sa.text(
-                    "INSERT INTO broadcast_runs (total_users, text_preview, source, status) "
-                    "VALUES (:total, :preview, :src, 'running') RETURNING id"
-                ), {'total': total_users, 'preview': (text_preview or '')[:500], 'src': source})
+                    "INSERT INTO broadcast_runs (total_users, text_preview, source, status, payload) "
+                    "VALUES (:total, :preview, :src, 'running', :payload) RETURNING id"
+                ), {'total': total_users, 'preview': (text_preview or '')[:500], 'src': source,
+                    'payload': json.dumps(payload, ensure_ascii=False) if payload else None})
                 conn.commit()
                 row = result.fetchone()
                 return row[0] if row else None
@@ -1112,6 +1471,98 @@ class PostgresClient:
         except Exception as e:
             logging.error(f"PostgreSQL | Ошибка логирования broadcast delivery: {e}")
 
+    def log_broadcast_deliveries(self, broadcast_id: int, rows) -> bool:
+        """Записывает пачку результатов доставки через COPY (при ошибке — многострочным INSERT)."""
+        if not rows:
+            return True
+        values = [
+            (broadcast_id, r['user_id'], r.get('username') or '', r.get('first_name') or '',
+             r['status'], r.get('error_code'), (r.get('error_message') or '')[:500])
+            for r in rows
+        ]
+        try:
+            buffer = io.StringIO()
+            for row in values:
+                buffer.write(",".join(_copy_csv_field(v) for v in row) + "\n")
+            buffer.seek(0)
+            raw = self.engine.raw_connection()
+            try:
+                cur = raw.cursor()
+                cur.copy_expert(
+                    "COPY broadcast_delivery_log "
+                    "(broadcast_id, user_id, username, first_name, status, error_code, error_message) "
+                    "FROM STDIN WITH (FORMAT csv)", buffer
+                )
+                raw.commit()
+            finally:
+                raw.close()
+            return True
+        except Exception as e:
+            logging.warning(f"PostgreSQL | COPY в broadcast_delivery_log не удался, пробую INSERT: {e}")
+        try:
+            with self.engine.connect() as conn:
+                # Многострочный INSERT ... VALUES по 500 строк
+                for start in range(0, len(values), 500):
+                    chunk = values[start:start + 500]
+                    params = {}
+                    placeholders = []
+                    for i, row in enumerate(chunk):
+                        names = [f"{col}{i}" for col in ('bid', 'uid', 'uname', 'fname', 'status', 'ecode', 'emsg')]
+                        params.update(zip(names, row))
+                        placeholders.append("(" + ", ".join(f":{n}" for n in names) + ")")
+                    conn.execute(sa.text(
+                        "INSERT INTO broadcast_delivery_log "
+                        "(broadcast_id, user_id, username, first_name, status, error_code, error_message) "
+                        "VALUES " + ", ".join(placeholders)
+                    ), params)
+                conn.commit()
+            return True
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка пакетного логирования broadcast delivery: {e}")
+            return False
+
+    def checkpoint_broadcast_run(self, broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+        """Сохраняет прогресс рассылки для возобновления после перезапуска."""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(sa.text(
+                    "UPDATE broadcast_runs SET last_user_id = :last_uid, sent_count = :sent, "
+                    "failed_count = :failed, blocked_count = :blocked, checkpoint_at = NOW() "
+                    "WHERE id = :bid"
+                ), {'last_uid': last_user_id, 'sent': sent, 'failed': failed,
+                    'blocked': blocked, 'bid': broadcast_id})
+                conn.commit()
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка сохранения чекпоинта рассылки {broadcast_id}: {e}")
+
+    def get_broadcast_completed_after(self, broadcast_id: int, last_user_id: int):
+        """{user_id: статус} получателей с user_id > last_user_id, уже записанных в лог доставки."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(sa.text(
+                "SELECT user_id, status FROM broadcast_delivery_log "
+                "WHERE broadcast_id = :bid AND user_id > :last_uid ORDER BY id"
+            ), {'bid': broadcast_id, 'last_uid': last_user_id}).fetchall()
+        return {int(r[0]): r[1] for r in rows}
+
+    def get_unfinished_broadcast_runs(self):
+        """Возвращает рассылки, прерванные перезапуском (status='running' и есть payload)."""
+        try:
+            self._ensure_broadcast_log_tables()
+            with self.engine.connect() as conn:
+                rows = conn.execute(sa.text(
+                    "SELECT id, total_users, sent_count, failed_count, blocked_count, "
+                    "source, payload, last_user_id "
+                    "FROM broadcast_runs WHERE status = 'running' AND payload IS NOT NULL ORDER BY id"
+                )).fetchall()
+                return [{
+                    'id': r[0], 'total_users': r[1], 'sent_count': r[2] or 0,
+                    'failed_count': r[3] or 0, 'blocked_count': r[4] or 0, 'source': r[5],
+                    'payload': json.loads(r[6]), 'last_user_id': r[7],
+                } for r in rows]
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка получения незавершённых рассылок: {e}")
+            return []
+
     def finish_broadcast_run(self, broadcast_id: int, sent: int, failed: int, blocked: int):
         """Завершает запись о рассылке."""
         try:
@@ -1211,3 +1662,92 @@ class PostgresClient:
         except Exception as e:
             logging.error(f"PostgreSQL | Ошибка получения деталей рассылки {broadcast_id}: {e}")
             return {}
+
+    # ═══════════════════════════════════════════
+    #  Агрегаты метрик AI
+    # ═══════════════════════════════════════════
+
+    _AI_DAILY_FIELDS = (
+        'total_requests', 'successful_requests', 'failed_requests', 'prompt_tokens',
+        'completion_tokens', 'total_tokens', 'cost_usd', 'response_time_sum_ms',
+        'response_time_count', 'unique_users',
+        'cache_lookups', 'cache_hits', 'cache_saved_tokens', 'cache_saved_cost_usd',
+    )
+
+    def save_ai_metrics_rollup(self, daily_rows, user_rows):
+        """Upsert агрегатов метрик AI (исключения пробрасываются — вызывающий повторит запись)."""
+        with self.engine.connect() as conn:
+            if daily_rows:
+                fields = self._AI_DAILY_FIELDS
+                conn.execute(sa.text(
+                    f"INSERT INTO ai_metrics_daily (date, {', '.join(fields)}) "
+                    f"VALUES (CAST(:date AS DATE), {', '.join(':' + f for f in fields)}) "
+                    f"ON CONFLICT (date) DO UPDATE SET "
+                    f"{', '.join(f'{f} = EXCLUDED.{f}' for f in fields)}"
+                ), [dict(r) for r in daily_rows])
+            if user_rows:
+                conn.execute(sa.text(
+                    "INSERT INTO ai_metrics_user_daily (date, user_id, requests, tokens, cost_usd) "
+                    "VALUES (CAST(:date AS DATE), :user_id, :requests, :tokens, :cost_usd) "
+                    "ON CONFLICT (date, user_id) DO UPDATE SET requests = EXCLUDED.requests, "
+                    "tokens = EXCLUDED.tokens, cost_usd = EXCLUDED.cost_usd"
+                ), [dict(r) for r in user_rows])
+            conn.commit()
+
+    def load_ai_metrics_rollup(self, date_from, date_to):
+        """Агрегаты метрик AI за период (даты в ISO-формате; ошибки чтения пробрасываются)."""
+        with self.engine.connect() as conn:
+            params = {'date_from': date_from, 'date_to': date_to}
+            daily = []
+            for row in conn.execute(sa.text(
+                "SELECT * FROM ai_metrics_daily WHERE date BETWEEN CAST(:date_from AS DATE) AND CAST(:date_to AS DATE)"
+            ), params):
+                item = dict(row._mapping)
+                item['date'] = item['date'].isoformat()
+                daily.append(item)
+            users = []
+            for row in conn.execute(sa.text(
+                "SELECT * FROM ai_metrics_user_daily WHERE date BETWEEN CAST(:date_from AS DATE) AND CAST(:date_to AS DATE)"
+            ), params):
+                item = dict(row._mapping)
+                item['date'] = item['date'].isoformat()
+                users.append(item)
+            return daily, users
+
+    # ═══════════════════════════════════════════
+    #  Долгосрочная память AI о пользователях
+    # ═══════════════════════════════════════════
+
+    def load_user_memory_profile(self, user_id):
+        """Профиль памяти AI или None, если его нет (ошибки чтения пробрасываются)."""
+        with self.engine.connect() as conn:
+            row = conn.execute(sa.text(
+                "SELECT profile FROM ai_user_memory WHERE user_id = :uid"
+            ), {'uid': user_id}).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def save_user_memory_profiles(self, rows):
+        """Upsert пачки профилей (исключения пробрасываются — вызывающий повторит запись)."""
+        with self.engine.connect() as conn:
+            conn.execute(sa.text(
+                "INSERT INTO ai_user_memory "
+                "(user_id, profile, has_name, has_preferred_bar, has_favorite_drinks, bookings_count, updated_at) "
+                "VALUES (:user_id, :profile, :has_name, :has_preferred_bar, :has_favorite_drinks, :bookings_count, NOW()) "
+                "ON CONFLICT (user_id) DO UPDATE SET profile = EXCLUDED.profile, has_name = EXCLUDED.has_name, "
+                "has_preferred_bar = EXCLUDED.has_preferred_bar, has_favorite_drinks = EXCLUDED.has_favorite_drinks, "
+                "bookings_count = EXCLUDED.bookings_count, updated_at = NOW()"
+            ), rows)
+            conn.commit()
+
+    def get_user_memory_stats(self):
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(sa.text(
+                    "SELECT COUNT(*), SUM(has_name), SUM(has_preferred_bar), SUM(has_favorite_drinks), "
+                    "SUM(CASE WHEN bookings_count >= 10 THEN 1 ELSE 0 END) FROM ai_user_memory"
+                )).fetchone()
+                keys = ("total_users", "with_names", "with_preferred_bar", "with_favorite_drinks", "vip_guests")
+                return {key: int(value or 0) for key, value in zip(keys, row)}
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка получения статистики памяти AI: {e}")
+            return None
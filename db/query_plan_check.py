@@ -0,0 +1,247 @@
+"""
+Проверка планов горячих запросов к users и conversation_history.
+
+Создаёт временную SQLite-базу схемой init_db, наполняет её синтетическими
+пользователями (по умолчанию 500 тысяч), собирает статистику (ANALYZE),
+вызывает реальные функции core/database.py из SQLITE_HOT_CALLS и для каждого
+выполненного ими запроса (перехват через set_trace_callback) смотрит
+EXPLAIN QUERY PLAN. Полный скан большой таблицы (SCAN users без индекса) —
+ошибка, скрипт завершается с кодом 1. Запускать после изменения запросов
+или индексов (db/indexes.py):
+
+    python -m db.query_plan_check            # SQLite, 500k пользователей
+    python -m db.query_plan_check 100000     # поменьше, для быстрой проверки
+    python -m db.query_plan_check --postgres # PostgreSQL из DATABASE_URL
+
+Проверка SQLite на небольшой базе входит в тесты (tests/test_query_plans.py).
+
+В PostgreSQL база не наполняется: запросы методов PostgresClient
+перехватываются событием before_cursor_execute и EXPLAIN-ятся с
+enable_seqscan = off — если Seq Scan по users всё равно остался,
+подходящего индекса нет.
+
+Тексты запросов не копируются: проверяется ровно то, что выполняет код.
+Запросы вне core/database.py берутся из констант модулей, которые их выполняют.
+"""
+import datetime
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, List, Sequence, Tuple
+
+# Таблицы, полный скан которых недопустим
+BIG_TABLES = ('users', 'conversation_history', 'delayed_tasks', 'broadcast_delivery_log')
+
+# Период отчётов и статистики персонала (смена 12:00–06:00)
+PERIOD_START = datetime.datetime(2025, 6, 1, 12, 0)
+PERIOD_END = datetime.datetime(2025, 6, 2, 6, 0)
+
+# (название, вызов реальной функции; аргумент — core.database или PostgresClient)
+SQLITE_HOT_CALLS: List[Tuple[str, Callable[[Any], Any]]] = [
+    ("Список пользователей, первая страница", lambda db: db.get_users_page(50)),
+    ("Список пользователей по статусу", lambda db: db.get_users_page(50, status='issued')),
+    ("Ночной аудитор", lambda db: db.get_redeemed_users_for_audit()),
+    ("Статистика рефералов", lambda db: db.get_referral_stats(42)),
+    ("Сверка реферальных наград по отметке", lambda db: db.get_referrals_redeemed_since('2025-06-01', 0)),
+    ("Топ рефереров месяца", lambda db: db.get_top_referrers_for_month(5)),
+    ("Статистика персонала за период", lambda db: db.get_staff_period_stats(PERIOD_START, PERIOD_END)),
+    ("QR-переходы сотрудников за период",
+     lambda db: db.get_staff_qr_diagnostics_for_period(PERIOD_START, PERIOD_END)),
+    ("Статистика рассылок", lambda db: db.get_broadcast_statistics()),
+    ("Отметка заблокировавших", lambda db: db.mark_users_blocked([1, 2, 3])),
+    ("История диалога", lambda db: db.get_conversation_history(42)),
+    ("Контекст AI", lambda db: db.get_user_ai_context(42)),
+    ("Агрегаты отчёта", lambda db: db.get_report_data_for_period(PERIOD_START, PERIOD_END)),
+    ("Отложенные задачи: ближайшее пробуждение", lambda db: db.get_next_delayed_task_time()),
+    ("Возобновление рассылки", lambda db: db.get_broadcast_completed_after(1, 0)),
+]
+
+POSTGRES_HOT_CALLS: List[Tuple[str, Callable[[Any], Any]]] = [
+    ("Список пользователей, первая страница", lambda pg: pg.get_users_page(50)),
+    ("Статистика рефералов", lambda pg: pg.get_referral_stats(42)),
+    ("Сверка реферальных наград по отметке", lambda pg: pg.get_referrals_redeemed_since('2025-06-01', 0)),
+    ("Статистика рассылок", lambda pg: pg.get_broadcast_statistics()),
+    ("Агрегаты отчёта", lambda pg: pg.get_report_data_for_period(PERIOD_START, PERIOD_END)),
+    ("История диалога", lambda pg: _pg_repository(pg).conversation_history(42, 12)),
+    ("Контекст AI", lambda pg: pg.get_user_ai_context(42)),
+]
+
+
+def _sqlite_extra_queries() -> List[Tuple[str, str, Sequence[Any]]]:
+    """Горячие запросы других модулей: (название, SQL из модуля, параметры)."""
+    from utils.export_to_sheets import EXPORT_PAGE_SQL
+    return [
+        ("Выгрузка в Google Sheets: изменённые после отметки",
+         EXPORT_PAGE_SQL, ('2026-01-01 00:00:00.000', 0, 500)),
+    ]
+
+
+def _pg_repository(pg):
+    from db.repository import PostgresRepository
+    return PostgresRepository(pg.engine)
+
+
+# Служебные выражения, которые не EXPLAIN-ятся
+_SKIP_STATEMENT = re.compile(r"^\s*(PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b", re.IGNORECASE)
+
+_SQLITE_FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+
+def sqlite_full_scans(conn, sql: str, params: Sequence[Any]) -> Tuple[List[str], List[str]]:
+    """(строки плана, полные сканы больших таблиц) для запроса SQLite."""
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    aliases = {alias: table for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)\s+(\w+)", sql)}
+    scans = []
+    for detail in plan:
+        match = _SQLITE_FULL_SCAN.match(detail)
+        if match and aliases.get(match.group(1), match.group(1)) in BIG_TABLES:
+            scans.append(detail)
+    return plan, scans
+
+
+def postgres_full_scans(plan_json: Any) -> List[str]:
+    """Seq Scan по большим таблицам в плане EXPLAIN (FORMAT JSON)."""
+    scans = []
+    stack = [plan_json[0]['Plan']] if isinstance(plan_json, list) else [plan_json['Plan']]
+    while stack:
+        node = stack.pop()
+        if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') in BIG_TABLES:
+            scans.append(f"Seq Scan on {node['Relation Name']}")
+        stack.extend(node.get('Plans', []))
+    return scans
+
+
+def _seed_sqlite(conn, users: int):
+    rnd = random.Random(18)
+    statuses = ['registered'] * 3 + ['issued'] * 3 + ['redeemed'] * 3 + ['redeemed_and_left']
+    sources = ['direct', 'staff', 'qr_tv', 'instagram', 'referral']
+    conn.executemany(
+        "INSERT INTO staff (telegram_id, full_name, short_name, position, unique_code) VALUES (?, ?, ?, ?, ?)",
+        [(10_000 + n, f"Сотрудник {n}", f"С{n}", 'бармен', f"code{n}") for n in range(1, 51)])
+
+    def rows():
+        for user_id in range(1, users + 1):
+            status = rnd.choice(statuses)
+            signup = f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} {rnd.randint(0, 23):02d}:00:00"
+            redeemed = status in ('redeemed', 'redeemed_and_left')
+            referrer = rnd.randint(1, users) if rnd.random() < 0.2 else None
+            staff = rnd.randint(1, 50) if rnd.random() < 0.15 else None
+            yield (user_id, f"user{user_id}", "Гость", status, rnd.choice(sources), referrer, staff, signup,
+                   signup if redeemed else None, 1 if referrer and redeemed and rnd.random() < 0.7 else 0,
+                   1 if rnd.random() < 0.03 else 0)
+
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, status, source, referrer_id, brought_by_staff_id, "
+        "signup_date, redeem_date, referrer_rewarded, blocked) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+    conn.executemany(
+        "INSERT INTO conversation_history (user_id, role, text) VALUES (?, ?, ?)",
+        ((rnd.randint(1, users), rnd.choice(('user', 'assistant')), "текст") for _ in range(users // 2)))
+    conn.commit()
+    conn.execute("ANALYZE")
+
+
+@contextmanager
+def _trace_sqlite(database, statements: List[str]):
+    """Собирает SQL (с подставленными параметрами) всех соединений пула core.database."""
+    pool = database._sqlite_pool
+    checkout = pool.checkout
+    traced = []
+
+    def traced_checkout():
+        pooled = checkout()
+        pooled.set_trace_callback(statements.append)
+        traced.append(pooled)
+        return pooled
+
+    pool.checkout = traced_checkout
+    try:
+        yield statements
+    finally:
+        pool.checkout = checkout
+        for pooled in traced:
+            pooled.set_trace_callback(None)
+
+
+def _report(name: str, plans: List[Tuple[List[str], List[str]]]) -> int:
+    """Печатает планы вызова; возвращает 1, если был полный скан или запрос не выполнился."""
+    failed = not plans or any(scans for _, scans in plans)
+    print(f"{'FAIL' if failed else 'ok  '} {name}" + ("" if plans else ": запросов не выполнено"))
+    for plan, _ in plans:
+        for detail in plan:
+            print(f"       {detail}")
+    return int(failed)
+
+
+def check_sqlite(users: int) -> int:
+    # core.config читает путь к базе из окружения при импорте
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'plan_check.db')
+    from core import database
+
+    database.init_db()
+    started = time.monotonic()
+    conn = database.get_db_connection()
+    try:
+        _seed_sqlite(conn, users)
+        print(f"База: {users} пользователей, наполнение {time.monotonic() - started:.1f}s")
+        failures = 0
+        for name, call in SQLITE_HOT_CALLS:
+            statements: List[str] = []
+            with _trace_sqlite(database, statements):
+                call(database)
+            plans = [sqlite_full_scans(conn, sql, ()) for sql in dict.fromkeys(statements)
+                     if not _SKIP_STATEMENT.match(sql)]
+            failures += _report(name, plans)
+        for name, sql, params in _sqlite_extra_queries():
+            failures += _report(name, [sqlite_full_scans(conn, sql, params)])
+        return failures
+    finally:
+        conn.close()
+
+
+def check_postgres() -> int:
+    import sqlalchemy as sa
+    from db.postgres_client import PostgresClient
+
+    client = PostgresClient()  # create_tables() создаёт недостающие индексы
+    failures = 0
+    for name, call in POSTGRES_HOT_CALLS:
+        statements: List[Tuple[str, Any]] = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE')):
+                statements.append((statement, parameters))
+
+        sa.event.listen(client.engine, 'before_cursor_execute', capture)
+        try:
+            call(client)
+        finally:
+            sa.event.remove(client.engine, 'before_cursor_execute', capture)
+
+        plans = []
+        with client.engine.connect() as conn:
+            conn.exec_driver_sql("SET enable_seqscan = off")
+            for statement, parameters in statements:
+                plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scans = postgres_full_scans(plan)
+                plans.append((scans or [statement.split()[0] + ': индекс'], scans))
+            conn.rollback()
+        failures += _report(name, plans)
+    return failures
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if '--postgres' in sys.argv:
+        failed = check_postgres()
+    else:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        failed = check_sqlite(int(args[0]) if args else 500_000)
+    print(f"Полных сканов: {failed}" if failed else "Все горячие запросы идут по индексам")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,516 @@
+"""
+Слой доступа к данным: один интерфейс (Repository) и два хранилища.
+
+- SQLiteRepository работает через общий пул соединений core/database.py
+  (db_connection): PRAGMA настроены один раз, а постоянные строки SQL
+  попадают в кеш подготовленных выражений sqlite3;
+- PostgresRepository работает через общий engine PostgresClient (пул
+  соединений SQLAlchemy); выражения sa.text созданы один раз на уровне
+  модуля, поэтому SQLAlchemy компилирует их однократно (compiled cache);
+- DualWriteRepository читает из основного хранилища и пишет в него
+  синхронно, а те же записи во второе хранилище отдаёт фоновому потоку —
+  зеркалирование не добавляет задержки обработчикам.
+
+Строки возвращаются лёгкими кортежами (UserRecord, HistoryTurn) с одинаковыми
+полями в обоих хранилищах: register_date PostgreSQL отдаётся как signup_date.
+
+Профиль пользователя (телефон, имя, дата рождения, концепция AI) есть
+только в SQLite — в интерфейс входят общие для обеих схем поля.
+
+Через слой идут общие операции: основные поля пользователей, история
+диалогов AI и аудитория рассылок. Остальные функции core/database.py
+(профиль, рефералы, персонал, рассылки) пока работают с pg_client и SQLite
+напрямую, а записи пользователей повторяют в SQLite через mirror().
+
+Записи пользователей обновляют почасовые агрегаты отчётов так же, как
+core/database.py: снимок состояния до записи и разница после — в той же
+транзакции (RollupHooks передаёт core.database.get_repository).
+"""
+import logging
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+
+from core import report_rollup
+
+USER_FIELDS = ('user_id', 'username', 'first_name', 'status', 'source', 'referrer_id',
+               'brought_by_staff_id', 'signup_date', 'redeem_date')
+UserRecord = namedtuple('UserRecord', USER_FIELDS, defaults=(None,) * (len(USER_FIELDS) - 1))
+HistoryTurn = namedtuple('HistoryTurn', ('role', 'text'))
+
+# Снимок и запись разницы агрегатов отчётов: snapshot(conn, user_ids) -> before,
+# commit(conn, before) (core.database._rollup_* или PostgresClient._rollup_*)
+RollupHooks = namedtuple('RollupHooks', ('snapshot', 'commit'))
+ROLLUP_FIELDS = frozenset(report_rollup.STATE_FIELDS)
+
+# Поля, которые можно менять через update_user
+UPDATABLE_FIELDS = frozenset(USER_FIELDS) - {'user_id'}
+
+LEFT_STATUS = 'redeemed_and_left'
+
+# Значения при добавлении, если в UserRecord передан None
+_INSERT_DEFAULTS = {'status': "'registered'", 'signup_date': 'CURRENT_TIMESTAMP'}
+
+
+def _insert_values(placeholder: Callable[[str], str]) -> str:
+    return ', '.join(
+        f"COALESCE({placeholder(f)}, {_INSERT_DEFAULTS[f]})" if f in _INSERT_DEFAULTS else placeholder(f)
+        for f in USER_FIELDS
+    )
+
+
+class Repository(ABC):
+    """Интерфейс хранилища. Ошибки БД логируются, методы возвращают пустой результат."""
+
+    backend = 'abstract'
+    rollup: Optional[RollupHooks] = None
+
+    def _rollup_before(self, conn, user_id: int, fields=USER_FIELDS):
+        """Снимок для агрегатов, если запись затрагивает их поля; иначе None."""
+        if self.rollup is None or ROLLUP_FIELDS.isdisjoint(fields):
+            return None
+        return self.rollup.snapshot(conn, [user_id])
+
+    def _rollup_after(self, conn, before):
+        if before is not None and self.rollup is not None:
+            self.rollup.commit(conn, before)
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        ...
+
+    @abstractmethod
+    def list_users(self, limit: Optional[int] = None) -> List[UserRecord]:
+        """Пользователи от новых к старым."""
+
+    @abstractmethod
+    def add_user(self, record: UserRecord) -> bool:
+        """Добавляет пользователя; False, если он уже есть или произошла ошибка."""
+
+    @abstractmethod
+    def update_user(self, user_id: int, **fields) -> bool:
+        ...
+
+    @abstractmethod
+    def delete_user(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def active_user_ids(self) -> List[int]:
+        """Все, кроме отписавшихся после погашения (аудитория рассылок)."""
+
+    @abstractmethod
+    def count_active_users(self) -> int:
+        ...
+
+    @abstractmethod
+    def log_conversation_turn(self, user_id: int, role: str, text: str) -> bool:
+        ...
+
+    @abstractmethod
+    def conversation_history(self, user_id: int, limit: int = 10) -> List[HistoryTurn]:
+        """Последние limit реплик, от старых к новым."""
+
+    def mirror(self, method: str, *args, **kwargs):
+        """Повторяет запись во втором хранилище (есть только у DualWriteRepository)."""
+
+    def close(self):
+        pass
+
+
+def _update_fields(fields: Dict[str, Any]) -> Tuple[str, ...]:
+    unknown = set(fields) - UPDATABLE_FIELDS
+    if unknown:
+        raise ValueError(f"Нельзя обновить поля: {', '.join(sorted(unknown))}")
+    return tuple(sorted(fields))
+
+
+# --- SQLite ---
+
+_SQLITE_USER_COLUMNS = ', '.join(USER_FIELDS)
+_SQLITE_GET_USER = f"SELECT {_SQLITE_USER_COLUMNS} FROM users WHERE user_id = ?"
+_SQLITE_LIST_USERS = f"SELECT {_SQLITE_USER_COLUMNS} FROM users ORDER BY signup_date DESC, user_id DESC LIMIT ?"
+_SQLITE_INSERT_USER = (
+    f"INSERT OR IGNORE INTO users ({_SQLITE_USER_COLUMNS}) "
+    f"VALUES ({_insert_values(lambda f: '?')})"
+)
+_SQLITE_DELETE_USER = "DELETE FROM users WHERE user_id = ?"
+_SQLITE_ACTIVE_IDS = f"SELECT user_id FROM users WHERE status != '{LEFT_STATUS}'"
+_SQLITE_COUNT_ACTIVE = f"SELECT COUNT(*) FROM users WHERE status != '{LEFT_STATUS}'"
+_SQLITE_LOG_TURN = "INSERT INTO conversation_history (user_id, role, text) VALUES (?, ?, ?)"
+_SQLITE_HISTORY = "SELECT role, text FROM conversation_history WHERE user_id = ? ORDER BY id DESC LIMIT ?"
+
+
+@lru_cache(maxsize=64)
+def _sqlite_update_sql(fields: Tuple[str, ...]) -> str:
+    return f"UPDATE users SET {', '.join(f'{field} = ?' for field in fields)} WHERE user_id = ?"
+
+
+class SQLiteRepository(Repository):
+    backend = 'sqlite'
+
+    def __init__(self, connection: Callable, rollup: Optional[RollupHooks] = None):
+        """
+        Args:
+            connection: фабрика контекстных менеджеров соединения, коммитящих
+                при выходе (core.database.db_connection или SQLitePool.connection)
+            rollup: обновление агрегатов отчётов в транзакции записи (None — без агрегатов)
+        """
+        self._connection = connection
+        self.rollup = rollup
+
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        try:
+            with self._connection() as conn:
+                row = conn.execute(_SQLITE_GET_USER, (user_id,)).fetchone()
+            return UserRecord(*row) if row else None
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка получения пользователя {user_id}: {e}")
+            return None
+
+    def list_users(self, limit: Optional[int] = None) -> List[UserRecord]:
+        try:
+            with self._connection() as conn:
+                rows = conn.execute(_SQLITE_LIST_USERS, (-1 if limit is None else limit,)).fetchall()
+            return [UserRecord(*row) for row in rows]
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка получения списка пользователей: {e}")
+            return []
+
+    def add_user(self, record: UserRecord) -> bool:
+        try:
+            with self._connection() as conn:
+                added = conn.execute(_SQLITE_INSERT_USER, tuple(record)).rowcount > 0
+                if added:
+                    self._rollup_after(conn, {record.user_id: None})
+                return added
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка добавления пользователя {record.user_id}: {e}")
+            return False
+
+    def update_user(self, user_id: int, **fields) -> bool:
+        names = _update_fields(fields)
+        if not names:
+            return False
+        try:
+            with self._connection() as conn:
+                before = self._rollup_before(conn, user_id, names)
+                cur = conn.execute(_sqlite_update_sql(names), tuple(fields[n] for n in names) + (user_id,))
+                updated = cur.rowcount > 0
+                if updated:
+                    self._rollup_after(conn, before)
+                return updated
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка обновления пользователя {user_id}: {e}")
+            return False
+
+    def delete_user(self, user_id: int) -> bool:
+        try:
+            with self._connection() as conn:
+                before = self._rollup_before(conn, user_id)
+                deleted = conn.execute(_SQLITE_DELETE_USER, (user_id,)).rowcount > 0
+                if deleted:
+                    self._rollup_after(conn, before)
+                return deleted
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка удаления пользователя {user_id}: {e}")
+            return False
+
+    def active_user_ids(self) -> List[int]:
+        try:
+            with self._connection() as conn:
+                return [row[0] for row in conn.execute(_SQLITE_ACTIVE_IDS)]
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка получения активных пользователей: {e}")
+            return []
+
+    def count_active_users(self) -> int:
+        try:
+            with self._connection() as conn:
+                return conn.execute(_SQLITE_COUNT_ACTIVE).fetchone()[0]
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка подсчёта активных пользователей: {e}")
+            return 0
+
+    def log_conversation_turn(self, user_id: int, role: str, text: str) -> bool:
+        try:
+            with self._connection() as conn:
+                conn.execute(_SQLITE_LOG_TURN, (user_id, role, text))
+            return True
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка логирования диалога для {user_id}: {e}")
+            return False
+
+    def conversation_history(self, user_id: int, limit: int = 10) -> List[HistoryTurn]:
+        try:
+            with self._connection() as conn:
+                rows = conn.execute(_SQLITE_HISTORY, (user_id, limit)).fetchall()
+            return [HistoryTurn(*row) for row in reversed(rows)]
+        except Exception as e:
+            logging.error(f"SQLite | Ошибка получения истории диалога для {user_id}: {e}")
+            return []
+
+
+# --- PostgreSQL ---
+
+_PG_COLUMN = {'signup_date': 'register_date'}
+_PG_USER_COLUMNS = ', '.join(
+    f"{_PG_COLUMN[f]} AS {f}" if f in _PG_COLUMN else f for f in USER_FIELDS
+)
+_PG_GET_USER = sa.text(f"SELECT {_PG_USER_COLUMNS} FROM users WHERE user_id = :user_id")
+_PG_LIST_USERS = sa.text(
+    f"SELECT {_PG_USER_COLUMNS} FROM users ORDER BY register_date DESC NULLS LAST, user_id DESC LIMIT :limit"
+)
+_PG_INSERT_USER = sa.text(
+    f"INSERT INTO users ({', '.join(_PG_COLUMN.get(f, f) for f in USER_FIELDS)}) "
+    f"VALUES ({_insert_values(lambda f: ':' + f)}) ON CONFLICT (user_id) DO NOTHING"
+)
+_PG_DELETE_USER = sa.text("DELETE FROM users WHERE user_id = :user_id")
+_PG_ACTIVE_IDS = sa.text(f"SELECT user_id FROM users WHERE status != '{LEFT_STATUS}'")
+_PG_COUNT_ACTIVE = sa.text(f"SELECT COUNT(*) FROM users WHERE status != '{LEFT_STATUS}'")
+_PG_LOG_TURN = sa.text("INSERT INTO conversation_history (user_id, role, text) VALUES (:user_id, :role, :text)")
+_PG_HISTORY = sa.text(
+    "SELECT role, text FROM conversation_history WHERE user_id = :user_id ORDER BY id DESC LIMIT :limit"
+)
+
+
+@lru_cache(maxsize=64)
+def _pg_update_sql(fields: Tuple[str, ...]) -> sa.TextClause:
+    assignments = ', '.join(f"{_PG_COLUMN.get(field, field)} = :{field}" for field in fields)
+    return sa.text(f"UPDATE users SET {assignments} WHERE user_id = :user_id")
+
+
+class PostgresRepository(Repository):
+    backend = 'postgres'
+
+    def __init__(self, engine, rollup: Optional[RollupHooks] = None):
+        """
+        Args:
+            engine: общий SQLAlchemy engine (PostgresClient.engine) — его пул
+                соединений переиспользуется, новых подключений на вызов нет
+            rollup: обновление агрегатов отчётов в транзакции записи (None — без агрегатов)
+        """
+        self.engine = engine
+        self.rollup = rollup
+
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(_PG_GET_USER, {'user_id': user_id}).fetchone()
+            return UserRecord(*row) if row else None
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка получения пользователя {user_id}: {e}")
+            return None
+
+    def list_users(self, limit: Optional[int] = None) -> List[UserRecord]:
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(_PG_LIST_USERS, {'limit': limit}).fetchall()
+            return [UserRecord(*row) for row in rows]
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка получения списка пользователей: {e}")
+            return []
+
+    def add_user(self, record: UserRecord) -> bool:
+        try:
+            with self.engine.connect() as conn:
+                added = conn.execute(_PG_INSERT_USER, record._asdict()).rowcount > 0
+                if added:
+                    self._rollup_after(conn, {record.user_id: None})
+                conn.commit()
+            return added
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка добавления пользователя {record.user_id}: {e}")
+            return False
+
+    def update_user(self, user_id: int, **fields) -> bool:
+        names = _update_fields(fields)
+        if not names:
+            return False
+        try:
+            with self.engine.connect() as conn:
+                before = self._rollup_before(conn, user_id, names)
+                updated = conn.execute(_pg_update_sql(names), {**fields, 'user_id': user_id}).rowcount > 0
+                if updated:
+                    self._rollup_after(conn, before)
+                conn.commit()
+            return updated
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка обновления пользователя {user_id}: {e}")
+            return False
+
+    def delete_user(self, user_id: int) -> bool:
+        try:
+            with self.engine.connect() as conn:
+                before = self._rollup_before(conn, user_id)
+                deleted = conn.execute(_PG_DELETE_USER, {'user_id': user_id}).rowcount > 0
+                if deleted:
+                    self._rollup_after(conn, before)
+                conn.commit()
+            return deleted
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка удаления пользователя {user_id}: {e}")
+            return False
+
+    def active_user_ids(self) -> List[int]:
+        try:
+            with self.engine.connect() as conn:
+                return [row[0] for row in conn.execute(_PG_ACTIVE_IDS)]
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка получения активных пользователей: {e}")
+            return []
+
+    def count_active_users(self) -> int:
+        try:
+            with self.engine.connect() as conn:
+                return conn.execute(_PG_COUNT_ACTIVE).scalar() or 0
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка подсчёта активных пользователей: {e}")
+            return 0
+
+    def log_conversation_turn(self, user_id: int, role: str, text: str) -> bool:
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(_PG_LOG_TURN, {'user_id': user_id, 'role': role, 'text': text})
+                conn.commit()
+            return True
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка логирования диалога для {user_id}: {e}")
+            return False
+
+    def conversation_history(self, user_id: int, limit: int = 10) -> List[HistoryTurn]:
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(_PG_HISTORY, {'user_id': user_id, 'limit': limit}).fetchall()
+            return [HistoryTurn(*row) for row in reversed(rows)]
+        except Exception as e:
+            logging.error(f"PostgreSQL | Ошибка получения истории диалога для {user_id}: {e}")
+            return []
+
+
+# --- Двойная запись ---
+
+_STOP = object()
+
+
+class DualWriteRepository(Repository):
+    """
+    Чтение — из primary. Запись — в primary синхронно (её результат и
+    возвращается), затем та же запись ставится в очередь для secondary.
+    Очередь ограничена: при переполнении запись во второе хранилище
+    пропускается и учитывается в статистике (dropped), обработчики не ждут.
+    """
+
+    _WRITES = ('add_user', 'update_user', 'delete_user', 'log_conversation_turn')
+
+    def __init__(self, primary: Repository, secondary: Repository, queue_size: int = 10000,
+                 name: str = 'dual-write'):
+        self.primary = primary
+        self.secondary = secondary
+        self.backend = f"{primary.backend}+{secondary.backend}"
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._stats = {'mirrored': 0, 'errors': 0, 'dropped': 0}
+        self._thread = threading.Thread(target=self._worker, name=name, daemon=True)
+        self._thread.start()
+
+    # Чтение
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        return self.primary.get_user(user_id)
+
+    def list_users(self, limit: Optional[int] = None) -> List[UserRecord]:
+        return self.primary.list_users(limit)
+
+    def active_user_ids(self) -> List[int]:
+        return self.primary.active_user_ids()
+
+    def count_active_users(self) -> int:
+        return self.primary.count_active_users()
+
+    def conversation_history(self, user_id: int, limit: int = 10) -> List[HistoryTurn]:
+        return self.primary.conversation_history(user_id, limit)
+
+    # Запись
+    def add_user(self, record: UserRecord) -> bool:
+        result = self.primary.add_user(record)
+        self.mirror('add_user', record)
+        return result
+
+    def update_user(self, user_id: int, **fields) -> bool:
+        result = self.primary.update_user(user_id, **fields)
+        self.mirror('update_user', user_id, **fields)
+        return result
+
+    def delete_user(self, user_id: int) -> bool:
+        result = self.primary.delete_user(user_id)
+        self.mirror('delete_user', user_id)
+        return result
+
+    def log_conversation_turn(self, user_id: int, role: str, text: str) -> bool:
+        result = self.primary.log_conversation_turn(user_id, role, text)
+        self.mirror('log_conversation_turn', user_id, role, text)
+        return result
+
+    def mirror(self, method: str, *args, **kwargs):
+        if method not in self._WRITES:
+            raise ValueError(f"Неизвестная операция записи: {method}")
+        try:
+            self._queue.put_nowait((method, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+                dropped = self._stats['dropped']
+            if dropped == 1 or dropped % 1000 == 0:
+                logging.warning(f"Двойная запись: очередь {self.secondary.backend} переполнена, "
+                                f"пропущено записей: {dropped}")
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                method, args, kwargs = item
+                try:
+                    getattr(self.secondary, method)(*args, **kwargs)
+                    key = 'mirrored'
+                except Exception as e:
+                    logging.error(f"Двойная запись: ошибка {method} в {self.secondary.backend}: {e}")
+                    key = 'errors'
+                with self._lock:
+                    self._stats[key] += 1
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Ждёт, пока очередь второго хранилища опустеет. False — не успела за timeout."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        return stats
+
+    def close(self, timeout: float = 5.0):
+        """Дописывает очередь (не дольше timeout) и останавливает поток."""
+        if not self._thread.is_alive():
+            return
+        if not self.flush(timeout):
+            logging.warning(f"Двойная запись: не дописано в {self.secondary.backend}: {self.get_stats()}")
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
@@ -1,33 +1,64 @@
 # /handlers/ai_logic.py
 
 import logging
+import threading
 from telebot import types
 from telebot.apihelper import ApiTelegramException
-from tinydb import TinyDB, Query
 
 from ai.assistant import get_ai_recommendation
 from ai.intent_recognition import detect_intent, detect_emotion, analyze_user_type
 from ai.bar_context import get_current_bar_context, get_bar_info_text, get_location_info, get_working_hours
-from ai.user_preferences import extract_preferences_from_text, get_preferences_text
+from ai.user_preferences import extract_preferences_from_text
+from ai.user_context import user_context
 from ai.proactive_messenger import proactive_messenger
 import core.database as database
 import texts
 import keyboards
 from core.config import REPORT_CHAT_ID, NASTOYKA_NOTIFICATIONS_CHAT_ID, BOOKING_NOTIFICATIONS_CHAT_ID, ALL_ADMINS
+from core.booking_state import get_booking_store
 
-db = TinyDB('booking_data.json')
-User = Query()
+booking_store = get_booking_store()
+
+# Кнопки, которые обрабатываются в других хендлерах
+# ВАЖНО: '🗣 Спроси у Евгенича' сюда не входит - она обрабатывается отдельным хендлером
+KNOWN_BUTTONS = (
+    '🎁 Карта лояльности', '⭐ Оставить отзыв',
+    '🥃 Получить настойку по талону', '📍 Забронировать стол',
+    '👑 Админка', '📨 Отправить БРОНЬ'
+)
+
+# Кнопка-подсказка AI: обрабатывается своим хендлером и вопросом к AI не является
+AI_PROMPT_BUTTON = "🗣 Спроси у Евгенича"
+
+# Чат, в котором у пользователя ждёт ответа AI-запрос: user_id → chat_id.
+# Ставит catch-all перед обращением к AI и снимает после ответа
+_pending_ai_chats = {}
+_pending_ai_lock = threading.Lock()
+
+def is_ai_query(message) -> bool:
+    """
+    Заменяет ли сообщение ждущий AI-запрос пользователя: это свободный текст
+    (не команда и не кнопка) в том же чате, где AI ещё готовит ответ.
+    Обновления одного чата обрабатываются по порядку, поэтому такое сообщение
+    дойдёт до catch-all сразу после текущего запроса; ответ на шаг диалога
+    в другом чате запрос не отменяет.
+    """
+    text = message.text
+    if not text or text.startswith('/') or text in KNOWN_BUTTONS or text == AI_PROMPT_BUTTON:
+        return False
+    with _pending_ai_lock:
+        return _pending_ai_chats.get(message.from_user.id) == message.chat.id
 
 def register_ai_handlers(bot):
     """
     Регистрирует обработчики для AI-ассистента и других текстовых кнопок.
     """
 
-    @bot.message_handler(func=lambda message: message.text == "🗣 Спроси у Евгенича")
+    @bot.message_handler(func=lambda message: message.text == AI_PROMPT_BUTTON)
     def handle_ai_prompt_button(message: types.Message):
         # Эта кнопка просто показывает подсказку как пользоваться AI
         # Реальная логика работы в группах обрабатывается в основном текстовом хендлере
-        if db.contains(User.user_id == message.from_user.id):
+        if booking_store.contains(message.from_user.id):
             bot.reply_to(message, texts.BOOKING_IN_PROGRESS_TEXT)
             return
         bot.reply_to(message, texts.AI_PROMPT_HINT)
@@ -142,15 +173,8 @@ def register_ai_handlers(bot):
         if is_group_chat and not hasattr(message, 'should_attach_booking_button'):
             message.should_attach_booking_button = False
 
-        # Список кнопок, которые обрабатываются в других хендлерах
-        # ВАЖНО: '🗣 Спроси у Евгенича' убрана отсюда - она обрабатывается отдельным хендлером выше!
-        known_buttons = [
-            '🎁 Карта лояльности', '⭐ Оставить отзыв',
-            '🥃 Получить настойку по талону', '📍 Забронировать стол', 
-            '👑 Админка', '📨 Отправить БРОНЬ'
-        ]
         # Изменение: убираем проверку на /admin, так как она теперь по тексту кнопки
-        if user_text.startswith('/') or user_text in known_buttons:
+        if user_text.startswith('/') or user_text in KNOWN_BUTTONS:
             return
 
         logging.info(f"Пользователь {user_id} отправил текстовый запрос AI: '{user_text}'")
@@ -220,24 +244,21 @@ def register_ai_handlers(bot):
                             pass
                     logging.warning(f"⚠️ Получена жалоба от пользователя {user_id}: {user_text}")
             
-            # Логируем диалог
-            database.log_conversation_turn(user_id, "user", user_text)
+            # Снимок контекста: пользователь, концепция и история (12 сообщений) —
+            # из кеша или одним запросом к БД
+            context = user_context.get(user_id)
+
+            # Логируем диалог (реплика сразу попадает и в историю снимка)
+            user_context.log_turn(user_id, "user", user_text)
+            context.history.append({"role": "user", "content": user_text})
+            del context.history[:-user_context.history_limit]
             
             # Извлекаем предпочтения из текста
-            extract_preferences_from_text(user_id, user_text)
-            preferences_text = get_preferences_text(user_id)
+            context.preferences = extract_preferences_from_text(user_id, user_text)
 
-            # Улучшенная история диалога - 12 сообщений для лучшего контекста
-            history = database.get_conversation_history(user_id, limit=12)
             daily_updates = database.get_daily_updates()
-            
-            # Получаем выбранную пользователем концепцию
-            user_concept = database.get_user_concept(user_id)
-            
-            # Получаем информацию о пользователе для персонализации
-            user_info = database.find_user_by_id(user_id)
             visits_count = 0  # Визиты пока не отслеживаются в БД
-            user_type = analyze_user_type(user_info, visits_count)
+            user_type = analyze_user_type(context.user, visits_count)
             
             # Получаем контекст бара
             bar_context = get_current_bar_context()
@@ -245,20 +266,31 @@ def register_ai_handlers(bot):
 
             bot.send_chat_action(message.chat.id, 'typing')
 
-            ai_response = get_ai_recommendation(
-                user_query=user_text,
-                conversation_history=history,
-                user_id=user_id,  # НОВОЕ: передаём user_id для контекста и метрик
-                daily_updates=daily_updates,
-                user_concept=user_concept,
-                user_type=user_type,
-                bar_context=bar_info,
-                emotion=emotion,
-                preferences=preferences_text,
-                is_group_chat=is_group_chat
-            )
+            with _pending_ai_lock:
+                _pending_ai_chats[user_id] = message.chat.id
+            try:
+                ai_response = get_ai_recommendation(
+                    user_query=user_text,
+                    conversation_history=context.history,
+                    user_id=user_id,  # НОВОЕ: передаём user_id для контекста и метрик
+                    daily_updates=daily_updates,
+                    user_concept=context.concept,
+                    user_type=user_type,
+                    bar_context=bar_info,
+                    emotion=emotion,
+                    preferences=context.preferences_text,
+                    is_group_chat=is_group_chat
+                )
+            finally:
+                with _pending_ai_lock:
+                    if _pending_ai_chats.get(user_id) == message.chat.id:
+                        del _pending_ai_chats[user_id]
+
+            if ai_response is None:
+                # Пока запрос ждал очереди, пользователь написал снова — ответим на новое сообщение
+                return
 
-            database.log_conversation_turn(user_id, "assistant", ai_response)
+            user_context.log_turn(user_id, "assistant", ai_response)
 
             if "[START_BOOKING_FLOW]" in ai_response:
                 logging.info(f"AI определил намерение бронирования для пользователя {user_id}.")
@@ -4,7 +4,6 @@ import logging
 import re
 from telebot import types
 from telebot.apihelper import ApiTelegramException
-from tinydb import TinyDB, Query
 
 # Импортируем конфиги, тексты и клавиатуры
 from core.config import BOOKING_NOTIFICATIONS_CHAT_ID, BOOKING_NOTIFICATIONS_CHAT_ID_MSK, REPORT_CHAT_ID
@@ -12,6 +11,7 @@ from core.admin_config import get_bars, get_bar_by_callback
 import texts
 import keyboards
 import core.settings_manager as settings_manager # Наш новый менеджер настроек
+from core.booking_state import get_booking_store
 
 # Импортируем функцию экспорта в соцсети
 from utils.social_bookings_export import (
@@ -21,15 +21,14 @@ from utils.social_bookings_export import (
     parse_booking_time
 )
 
-# Инициализация базы данных для бронирований
-db = TinyDB('booking_data.json')
-User = Query()
+# Состояние пошагового бронирования (в памяти + SQLite)
+booking_store = get_booking_store()
 
 # --- Экспортируемая функция для запуска бронирования извне ---
 
 def start_booking_flow(bot, message, user_id):
     """Запускает процесс бронирования. Может вызываться из других модулей."""
-    db.upsert({'user_id': user_id, 'step': 'name', 'data': {}}, User.user_id == user_id)
+    booking_store.upsert(user_id, 'name', {})
     bot.send_message(message.chat.id, texts.BOOKING_START_PROMPT, parse_mode="Markdown")
 
 # --- Регистрация обработчиков ---
@@ -41,14 +40,14 @@ def register_booking_handlers(bot):
 
     def _start_booking_process(chat_id, user_id):
         """Начинает или перезапускает процесс бронирования для пользователя."""
-        db.upsert({'user_id': user_id, 'step': 'name', 'data': {}}, User.user_id == user_id)
+        booking_store.upsert(user_id, 'name', {})
         bot.send_message(chat_id, texts.BOOKING_START_PROMPT, parse_mode="Markdown")
 
     def _cancel_booking(message):
         """Отменяет процесс бронирования и удаляет данные пользователя из БД."""
         user_id = message.from_user.id
-        if db.contains(User.user_id == user_id):
-            db.remove(User.user_id == user_id)
+        if booking_store.contains(user_id):
+            booking_store.remove(user_id)
             bot.send_message(
                 user_id,
                 texts.BOOKING_CANCELLED_TEXT,
@@ -73,7 +72,7 @@ def register_booking_handlers(bot):
                 bot.reply_to(message, "🔒 Для бронирования используйте закрепленную кнопку в чате или напишите мне в личку: @evgenichspbbot")
                 return
         
-        if db.contains(User.user_id == message.from_user.id):
+        if booking_store.contains(message.from_user.id):
             bot.reply_to(message, texts.BOOKING_IN_PROGRESS_TEXT)
             return
 
@@ -91,12 +90,12 @@ def register_booking_handlers(bot):
             bot.reply_to(message, "❌ У вас нет доступа к созданию броней.")
             return
             
-        if db.contains(User.user_id == message.from_user.id):
+        if booking_store.contains(message.from_user.id):
             bot.reply_to(message, "Уже создаётся бронь. Завершите текущую или /cancel")
             return
 
         logging.info(f"Админ {message.from_user.id} начал создание брони.")
-        db.upsert({'user_id': message.from_user.id, 'step': 'admin_name', 'data': {'is_admin_booking': True}}, User.user_id == message.from_user.id)
+        booking_store.upsert(message.from_user.id, 'admin_name', {'is_admin_booking': True})
         bot.send_message(message.chat.id, texts.ADMIN_BOOKING_START)
 
     # --- Обработчики нажатий на кнопки ---
@@ -112,7 +111,7 @@ def register_booking_handlers(bot):
         except ApiTelegramException:
             pass
 
-        user_entry = db.get(User.user_id == user_id)
+        user_entry = booking_store.get(user_id)
         if not user_entry:
             logging.error(f"❌ Запись о бронировании не найдена для администратора {user_id}")
             bot.send_message(call.message.chat.id, "❌ Ошибка! Начни заново: /send_booking")
@@ -124,7 +123,7 @@ def register_booking_handlers(bot):
         logging.info(f"✅ Источник сохранён: {current_data.get('source')}")
         
         # Переходим к следующему шагу (выбор бара)
-        db.update({'step': 'bar', 'data': current_data}, User.user_id == user_id)
+        booking_store.update(user_id, 'bar', current_data)
         
         if current_data.get('is_admin_booking'):
             bot.send_message(call.message.chat.id, texts.ADMIN_BOOKING_BAR, reply_markup=keyboards.get_bar_selection_keyboard())
@@ -143,7 +142,7 @@ def register_booking_handlers(bot):
         except ApiTelegramException:
             pass
 
-        user_entry = db.get(User.user_id == user_id)
+        user_entry = booking_store.get(user_id)
         if not user_entry:
             logging.error(f"❌ Запись о бронировании не найдена для пользователя {user_id}")
             bot.send_message(call.message.chat.id, "❌ Ошибка! Запись о бронировании потеряна. Начни заново: /book")
@@ -172,7 +171,7 @@ def register_booking_handlers(bot):
         logging.info(f"✅ Сохраняю выбор бара: bar={current_data.get('bar')}, amo_tag={current_data.get('amo_tag')}")
         
         # Переходим к подтверждению
-        db.update({'step': 'confirmation', 'data': current_data}, User.user_id == user_id)
+        booking_store.update(user_id, 'confirmation', current_data)
         confirmation_text = texts.get_booking_confirmation_text(current_data)
         bot.send_message(
             call.message.chat.id,
@@ -204,7 +203,7 @@ def register_booking_handlers(bot):
                 bot.send_message(call.message.chat.id, texts.BOOKING_SECRET_CHAT_TEXT, reply_markup=keyboards.get_secret_chat_keyboard())
             elif call.data == "booking_bot":
                 # Начинаем бронирование для гостя
-                db.upsert({'user_id': call.from_user.id, 'step': 'name', 'data': {'is_guest_booking': True}}, User.user_id == call.from_user.id)
+                booking_store.upsert(call.from_user.id, 'name', {'is_guest_booking': True})
                 bot.send_message(
                     call.message.chat.id, 
                     "🌟 Отлично! Давайте забронируем для вас столик.\n\n"
@@ -228,7 +227,7 @@ def register_booking_handlers(bot):
         except ApiTelegramException:
             pass
 
-        user_entry = db.get(User.user_id == user_id)
+        user_entry = booking_store.get(user_id)
         if not user_entry:
             return
 
@@ -300,7 +299,7 @@ def register_booking_handlers(bot):
                 texts.BOOKING_CONFIRMATION_SUCCESS,
                 reply_markup=keyboards.get_main_menu_keyboard(user_id)
             )
-            db.remove(User.user_id == user_id)
+            booking_store.remove(user_id)
 
             # Предлагаем карту лояльности после успешного бронирования
             try:
@@ -321,10 +320,10 @@ def register_booking_handlers(bot):
             _start_booking_process(call.message.chat.id, user_id)
 
     # --- УЛУЧШЕННЫЙ ОБРАБОТЧИК ВСЕХ ШАГОВ БРОНИРОВАНИЯ ---
-    @bot.message_handler(func=lambda message: db.contains(User.user_id == message.from_user.id) and message.chat.type == 'private', content_types=['text'])
+    @bot.message_handler(func=lambda message: booking_store.contains(message.from_user.id) and message.chat.type == 'private', content_types=['text'])
     def process_booking_step(message: types.Message):
         user_id = message.from_user.id
-        user_entry = db.get(User.user_id == user_id)
+        user_entry = booking_store.get(user_id)
         
         if not user_entry or not user_entry.get('step'):
             return
@@ -474,7 +473,7 @@ def register_booking_handlers(bot):
                 
             # Если это не последний шаг, переводим на следующий
             next_step_info = prompts[step]
-            db.update({'step': next_step_info['next_step'], 'data': current_data}, User.user_id == user_id)
+            booking_store.update(user_id, next_step_info['next_step'], current_data)
             
             # Отправляем сообщение с клавиатурой если есть
             if 'keyboard' in next_step_info:
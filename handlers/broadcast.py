@@ -7,10 +7,9 @@
 """
 import logging
 import threading
-import time
 from telebot import types
-from telebot.apihelper import ApiTelegramException
 import core.database as database
+from core.broadcast_engine import BroadcastEngine
 from core.config import BOSS_IDS
 from datetime import datetime
 import pytz
@@ -389,38 +388,50 @@ def _build_inline_keyboard(buttons: list[dict]) -> types.InlineKeyboardMarkup |
     return kb
 
 
+def _deliver(bot, user_id: int, state: dict):
+    """Отправляет рассылку одному пользователю. Ошибки Telegram пробрасываются."""
+    markup = _build_inline_keyboard(state.get("buttons", []))
+    caption = state.get("content") or None
+
+    if state["type"] == "text":
+        bot.send_message(user_id, state["content"], parse_mode="HTML", reply_markup=markup)
+        return
+
+    media = state["media"]
+    sender = {
+        "photo": bot.send_photo,
+        "video": bot.send_video,
+        "animation": bot.send_animation,
+        "document": bot.send_document,
+        "voice": bot.send_voice,
+        "audio": bot.send_audio,
+    }.get(media["type"])
+    if not sender:
+        raise ValueError(f"Неподдерживаемый тип медиа: {media['type']}")
+    sender(user_id, media["file_id"], caption=caption, parse_mode="HTML", reply_markup=markup)
+
+
 def _send_to_user(bot, user_id: int, state: dict) -> bool:
     """Отправляет рассылку одному пользователю. Возвращает True при успехе."""
     try:
-        markup = _build_inline_keyboard(state.get("buttons", []))
-        caption = state.get("content") or None
-
-        if state["type"] == "text":
-            bot.send_message(user_id, state["content"], parse_mode="HTML", reply_markup=markup)
-        else:
-            media = state["media"]
-            fid = media["file_id"]
-            t = media["type"]
-
-            sender = {
-                "photo": bot.send_photo,
-                "video": bot.send_video,
-                "animation": bot.send_animation,
-                "document": bot.send_document,
-                "voice": bot.send_voice,
-                "audio": bot.send_audio,
-            }.get(t)
-
-            if sender:
-                sender(user_id, fid, caption=caption, parse_mode="HTML", reply_markup=markup)
-            else:
-                return False
+        _deliver(bot, user_id, state)
         return True
     except Exception as e:
         logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
         return False
 
 
+def _progress_text(progress: dict) -> str:
+    total = progress["total"] or 1
+    pct = round(progress["processed"] / total * 100, 1)
+    return (
+        f"📤 <b>Рассылка…</b> {progress['processed']}/{progress['total']} ({pct}%)\n\n"
+        f"✅ Отправлено: {progress['sent']}\n"
+        f"❌ Ошибок: {progress['failed']}\n"
+        f"🚫 Заблокировали: {progress['blocked']}"
+    )
+
+
 def _run_broadcast(bot, boss_id: int, state: dict, status_chat: int, status_msg: int):
     """Запускает массовую рассылку в отдельном потоке."""
     users = database.get_all_users_for_broadcast()
@@ -428,96 +439,43 @@ def _run_broadcast(bot, boss_id: int, state: dict, status_chat: int, status_msg:
         bot.edit_message_text("❌ Нет пользователей для рассылки.", status_chat, status_msg)
         return
 
-    total = len(users)
-    sent = 0
-    failed = 0
-    blocked = 0
+    # Создаём запись о рассылке; payload позволяет продолжить её после перезапуска бота
+    text_preview = state.get("content", "")[:500] if state.get("content") else "[media]"
+    payload = {
+        "state": {k: state.get(k) for k in ("type", "content", "media", "buttons")},
+        "boss_id": boss_id, "status_chat": status_chat, "status_msg": status_msg,
+    }
+    broadcast_id = database.create_broadcast_run(len(users), text_preview, source='bot', payload=payload)
 
-    moscow = pytz.timezone("Europe/Moscow")
-    start_time = datetime.now(moscow)
+    _execute_broadcast(bot, broadcast_id, payload, users)
 
-    # Создаём запись о рассылке для логирования
-    text_preview = state.get("content", "")[:500] if state.get("content") else "[media]"
-    broadcast_id = database.create_broadcast_run(total, text_preview, source='bot')
 
-    for i, user in enumerate(users):
-        uid = user.get("user_id")
-        uname = user.get("username", "")
-        fname = user.get("first_name", "")
-        if not uid:
-            continue
+def _execute_broadcast(bot, broadcast_id, payload: dict, users: list, initial_counts: dict = None,
+                       completed: dict = None):
+    """Прогоняет получателей через BroadcastEngine и отправляет итоговый отчёт."""
+    state = payload["state"]
+    boss_id = payload["boss_id"]
+    status_chat, status_msg = payload["status_chat"], payload["status_msg"]
 
-        try:
-            ok = _send_to_user(bot, uid, state)
-            if ok:
-                sent += 1
-                if broadcast_id:
-                    database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'sent')
-            else:
-                failed += 1
-                if broadcast_id:
-                    database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'failed',
-                                                    error_message='Неизвестная ошибка отправки')
-        except ApiTelegramException as e:
-            if e.error_code == 403:
-                blocked += 1
-                if broadcast_id:
-                    database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'blocked',
-                                                    error_code=403, error_message='Бот заблокирован пользователем')
-                try:
-                    database.mark_user_blocked(uid)
-                except Exception:
-                    pass
-            elif e.error_code == 429:
-                # Too Many Requests — ждём
-                retry_after = 1
-                try:
-                    retry_after = int(e.result_json.get("parameters", {}).get("retry_after", 1))
-                except Exception:
-                    pass
-                logger.warning(f"429 Too Many Requests, ждём {retry_after}s")
-                time.sleep(retry_after)
-                # Повторная попытка
-                try:
-                    _send_to_user(bot, uid, state)
-                    sent += 1
-                    if broadcast_id:
-                        database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'sent')
-                except Exception as e2:
-                    failed += 1
-                    if broadcast_id:
-                        database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'failed',
-                                                        error_code=429, error_message=f'Retry failed: {str(e2)[:200]}')
-            else:
-                failed += 1
-                if broadcast_id:
-                    err_msg = str(e)[:300]
-                    database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'failed',
-                                                    error_code=e.error_code, error_message=err_msg)
-                logger.error(f"Telegram ошибка {e.error_code} для {uid}: {e}")
-        except Exception as e:
-            failed += 1
-            if broadcast_id:
-                database.log_broadcast_delivery(broadcast_id, uid, uname, fname, 'failed',
-                                                error_message=str(e)[:300])
-            logger.error(f"Ошибка отправки {uid}: {e}")
-
-        # Обновление статуса каждые 15 сообщений
-        if (i + 1) % 15 == 0:
-            pct = round((i + 1) / total * 100, 1)
-            try:
-                bot.edit_message_text(
-                    f"📤 <b>Рассылка…</b> {i + 1}/{total} ({pct}%)\n\n"
-                    f"✅ Отправлено: {sent}\n"
-                    f"❌ Ошибок: {failed}\n"
-                    f"🚫 Заблокировали: {blocked}",
-                    status_chat, status_msg, parse_mode="HTML"
-                )
-            except Exception:
-                pass
+    moscow = pytz.timezone("Europe/Moscow")
+    start_time = datetime.now(moscow)
 
-        # Задержка между отправками (~20 msg/sec)
-        time.sleep(0.05)
+    def on_progress(progress):
+        try:
+            bot.edit_message_text(_progress_text(progress), status_chat, status_msg, parse_mode="HTML")
+        except Exception:
+            pass
+
+    engine = BroadcastEngine(
+        broadcast_id, users,
+        send_func=lambda uid: _deliver(bot, uid, state),
+        database=database,
+        initial_counts=initial_counts,
+        completed=completed,
+        progress_callback=on_progress,
+    )
+    result = engine.run()
+    total, sent, failed, blocked = result["total"], result["sent"], result["failed"], result["blocked"]
 
     # ── Финальный отчёт ──
     elapsed = (datetime.now(moscow) - start_time).total_seconds()
@@ -546,5 +504,29 @@ def _run_broadcast(bot, boss_id: int, state: dict, status_chat: int, status_msg:
 
     logger.info(
         f"Рассылка завершена: sent={sent}/{total}, failed={failed}, blocked={blocked}, "
-        f"time={round(elapsed, 1)}s"
+        f"retries={result['retries']}, time={round(elapsed, 1)}s"
     )
+
+
+def resume_unfinished_broadcasts(bot):
+    """Продолжает рассылки, прерванные падением или перезапуском бота (с последнего чекпоинта)."""
+    runs = database.get_unfinished_broadcast_runs()
+    for run in runs:
+        last_user_id = run["last_user_id"] or 0
+        try:
+            # Отправленные после чекпоинта (он хранит только непрерывный префикс)
+            completed = database.get_broadcast_completed_after(run["id"], last_user_id)
+        except Exception as e:
+            logger.error(f"Рассылка {run['id']} не возобновлена — лог доставки недоступен, "
+                         f"повторю при следующем запуске: {e}")
+            continue
+        users = [u for u in database.get_all_users_for_broadcast()
+                 if u.get("user_id") and int(u["user_id"]) > last_user_id]
+        counts = {"sent": run["sent_count"], "failed": run["failed_count"], "blocked": run["blocked_count"]}
+        logger.info(f"Возобновляю рассылку {run['id']} после user_id={last_user_id}: "
+                    f"{len(users)} получателей, из них уже обработано после чекпоинта {len(completed)}")
+        threading.Thread(
+            target=_execute_broadcast,
+            args=(bot, run["id"], run["payload"], users, counts, completed),
+            daemon=True,
+        ).start()
@@ -3,12 +3,13 @@
 import logging
 from telebot import types
 from telebot.apihelper import ApiTelegramException
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz # <--- ИЗМЕНЕНИЕ: Добавили библиотеку для часовых поясов
 
 # Импортируем конфиги, утилиты, тексты и клавиатуры
 from core.config import CHANNEL_ID, CHANNEL_ID_MSK, THANK_YOU_STICKER_ID, get_channel_id_for_user
 import core.database as database
+from core.delayed_tasks_processor import schedule_task
 import texts
 import keyboards
 
@@ -17,12 +18,13 @@ from .user_commands import issue_coupon, user_current_payload, get_channel_for_p
 
 # Импортируем систему уведомлений о рефералах
 try:
-    from utils.referral_notifications import send_immediate_referral_notification
+    from utils.referral_notifications import send_immediate_referral_notification, schedule_referral_reward
 except ImportError:
     logging.warning("Модуль уведомлений о рефералах не найден")
     send_immediate_referral_notification = None
+    schedule_referral_reward = None
 
-def register_callback_handlers(bot, scheduler, send_friend_bonus_func, request_feedback_func):
+def register_callback_handlers(bot):
     """Регистрирует обработчики для всех inline-кнопок."""
 
     # === ВЫБОР ГОРОДА (qr_bar → СПб или Москва) ===
@@ -199,29 +201,8 @@ def register_callback_handlers(bot, scheduler, send_friend_bonus_func, request_f
             )
 
             # --- Через 10 сек — предложение карты лояльности ---
-            import threading
-            def send_loyalty_offer():
-                try:
-                    loyalty_text = (
-                        "🎁 Погоди, это ещё не всё!\n\n"
-                        "Евгенич — щедрая душа. Ловишь *500 рублей на карту лояльности* 💰\n\n"
-                        "Копи бонусы с каждого визита, трать на напитки и еду — "
-                        "как свои, только приятнее 🥃\n\n"
-                        "Жми 👇 и забирай!"
-                    )
-                    bot.send_message(
-                        user_id,
-                        loyalty_text,
-                        reply_markup=keyboards.get_loyalty_keyboard(),
-                        parse_mode="Markdown"
-                    )
-                    logging.info(f"💳 Отправлено предложение карты лояльности пользователю {user_id}")
-                except Exception as e:
-                    logging.error(f"Ошибка отправки предложения лояльности для {user_id}: {e}")
-
-            timer = threading.Timer(10.0, send_loyalty_offer)
-            timer.daemon = True
-            timer.start()
+            # Задача сохраняется в delayed_tasks и переживает перезапуск бота
+            schedule_task(user_id, 'loyalty_offer', delay_seconds=10)
             logging.info(f"💳 Запланировано предложение карты лояльности для {user_id} через 10 сек.")
 
             # --- Уведомления о рефералах ---
@@ -237,14 +218,13 @@ def register_callback_handlers(bot, scheduler, send_friend_bonus_func, request_f
                     except Exception as e:
                         logging.error(f"Ошибка отправки немедленного уведомления рефереру {referrer_id}: {e}")
                 
-                # Старая система (оставим как запасной вариант)
-                run_date_bonus = datetime.now() + timedelta(hours=48)
-                scheduler.add_job(send_friend_bonus_func, 'date', run_date=run_date_bonus, args=[referrer_id, friend_name])
-                logging.info(f"Запланирована отправка бонуса рефереру {referrer_id} на {run_date_bonus} (резерв).")
-
-            run_date_feedback = datetime.now() + timedelta(hours=24)
-            scheduler.add_job(request_feedback_func, 'date', run_date=run_date_feedback, args=[user_id])
-            logging.info(f"Запланирован запрос ОС пользователю {user_id} на {run_date_feedback}.")
+                # Награда рефереру — задача ровно через 48 часов после погашения
+                if schedule_referral_reward:
+                    schedule_referral_reward(referrer_id, user_id)
+                    logging.info(f"Запланирована награда рефереру {referrer_id} за {user_id} через 48 ч.")
+
+            schedule_task(user_id, 'request_feedback', delay_seconds=24 * 3600)
+            logging.info(f"Запланирован запрос ОС пользователю {user_id} через 24 ч.")
 
         else:
             bot.answer_callback_query(call.id, "Эта награда уже была использована.", show_alert=True)
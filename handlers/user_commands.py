@@ -107,14 +107,10 @@ def register_user_command_handlers(bot):
             if len(args) > 1 and args[1] == 'booking':
                 logging.info(f"✅ Пользователь {user_id} запускает быстрое бронирование через deep link")
                 try:
-                    from tinydb import TinyDB, Query
-                    
-                    # Инициализируем базу бронирований
-                    db = TinyDB('booking_data.json')
-                    User = Query()
+                    from core.booking_state import get_booking_store
                     
                     # Сразу начинаем процесс бронирования
-                    db.upsert({'user_id': user_id, 'step': 'name', 'data': {'is_guest_booking': True}}, User.user_id == user_id)
+                    get_booking_store().upsert(user_id, 'name', {'is_guest_booking': True})
                     bot.send_message(
                         message.chat.id, 
                         "🌟 Отлично! Давайте забронируем столик.\n\n"
@@ -216,16 +212,12 @@ def register_user_command_handlers(bot):
                             source = 'Группа бронирования'
                             database.add_new_user(user_id, message.from_user.username, message.from_user.first_name, source, None, None)
                         
-                        # Импортируем TinyDB и сразу запускаем процесс бронирования
+                        # Сразу запускаем процесс бронирования
                         try:
-                            from tinydb import TinyDB, Query
-                            
-                            # Инициализируем базу бронирований (та же что в booking_flow.py)
-                            db = TinyDB('booking_data.json')
-                            User = Query()
+                            from core.booking_state import get_booking_store
                             
                             # Сразу начинаем процесс бронирования (как booking_bot callback)
-                            db.upsert({'user_id': user_id, 'step': 'name', 'data': {'is_guest_booking': True}}, User.user_id == user_id)
+                            get_booking_store().upsert(user_id, 'name', {'is_guest_booking': True})
                             bot.send_message(
                                 message.chat.id, 
                                 "🌟 Отлично! Давайте забронируем для вас столик.\n\n"
@@ -9,6 +9,9 @@ import datetime
 import pytz
 
 from core.config import BOT_TOKEN, FRIEND_BONUS_STICKER_ID, REPORT_CHAT_ID, CHANNEL_ID, NASTOYKA_NOTIFICATIONS_CHAT_ID, USE_POSTGRES, DATABASE_URL, DATABASE_PATH, get_channel_id_for_user
+from core.config import (BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+                         UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_DRAIN_TIMEOUT)
+from core.config import AUDITOR_RATE, AUDITOR_WORKERS, AUDITOR_MAX_DURATION
 import core.database as database
 import keyboards
 import texts
@@ -18,17 +21,19 @@ from handlers.callback_query import register_callback_handlers
 from handlers.booking_flow import register_booking_handlers
 from handlers.admin_panel import register_admin_handlers, init_admin_handlers
 from handlers.reports import send_report
-from handlers.ai_logic import register_ai_handlers
+from handlers.ai_logic import register_ai_handlers, is_ai_query
 from handlers.iiko_data_handler import register_iiko_data_handlers
-from handlers.broadcast import register_broadcast_handlers
+from handlers.broadcast import register_broadcast_handlers, resume_unfinished_broadcasts
 from handlers.chat_booking import register_chat_booking_handlers
 from handlers.admin_content import register_content_handlers  # AI System v3.0
 from handlers.proactive_commands import register_proactive_commands  # Проактивные сообщения
 from core.delayed_tasks_processor import DelayedTasksProcessor
+from core.subscription_auditor import SubscriptionAuditor
 
 # Импортируем службу реферальных уведомлений
 try:
-    from utils.referral_notifications import start_referral_notification_service
+    from utils.referral_notifications import (REFERRAL_REWARD_TASK, process_referral_reward_task,
+                                              start_referral_notification_service)
     REFERRAL_NOTIFICATIONS_AVAILABLE = True
 except ImportError:
     logging.warning("Модуль реферальных уведомлений недоступен")
@@ -50,10 +55,6 @@ bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 scheduler = BackgroundScheduler(timezone="Europe/Moscow")
 delayed_tasks_processor = DelayedTasksProcessor(bot)
 
-def send_friend_bonus(referrer_id, friend_name):
-    # Тут должна быть ваша логика отправки бонуса
-    pass
-
 def check_database_connections():
     """Проверяет подключения к базам данных."""
     logging.info("🔍 Проверка подключений к базам данных...")
@@ -80,13 +81,14 @@ def check_database_connections():
     else:
         logging.warning("⚠️  PostgreSQL не настроен (USE_POSTGRES=false или DATABASE_URL пуст)")
 
-def request_feedback(user_id):
-    """Запрашивает обратную связь у пользователя."""
-    try:
-        bot.send_message(user_id, texts.FEEDBACK_REQUEST_TEXT)
-        logging.info(f"Отправлен запрос обратной связи пользователю {user_id}")
-    except Exception as e:
-        logging.error(f"Ошибка отправки запроса обратной связи пользователю {user_id}: {e}")
+def request_feedback(task):
+    """
+    Обработчик отложенной задачи 'request_feedback': запрашивает обратную
+    связь у пользователя. Ошибка отправки не перехватывается — задача
+    переносится планировщиком и повторяется.
+    """
+    bot.send_message(task['user_id'], texts.FEEDBACK_REQUEST_TEXT)
+    logging.info(f"Отправлен запрос обратной связи пользователю {task['user_id']}")
 
 def manual_feedback_request():
     # Тут должна быть ваша логика запроса обратной связи
@@ -125,46 +127,112 @@ def send_final_report_with_iiko(start_time: datetime.datetime, end_time: datetim
         except Exception as fallback_error:
             logging.error(f"Ошибка отправки в резервный чат: {fallback_error}")
 
+def check_user_subscription(user_row) -> bool:
+    """True — пользователь подписан на канал своего города, False — отписался или удалён."""
+    # Определяем правильный канал для проверки на основе источника пользователя
+    channel_to_check = get_channel_id_for_user(user_row['source'] or '')
+    try:
+        chat_member = bot.get_chat_member(chat_id=channel_to_check, user_id=user_row['user_id'])
+    except telebot.apihelper.ApiTelegramException as e:
+        if 'user not found' in e.description or 'bot was blocked by the user' in e.description:
+            # Пользователь удалил аккаунт или заблокировал бота
+            logging.warning(f"Аудитор: Пользователь {user_row['user_id']} не найден (удалил/заблокировал).")
+            return False
+        raise
+    return chat_member.status in ['member', 'administrator', 'creator']
+
 def run_nightly_auditor_job():
     """
-    Проверяет всех, кто погасил купон, на наличие подписки.
+    Проверяет всех, кто погасил купон, на наличие подписки
+    (параллельно, с ограничением темпа и продолжением прерванного прогона).
     """
     logging.info("Аудитор: Начинаю ночную проверку отписавшихся...")
-    users_to_check = database.get_redeemed_users_for_audit()
-    if not users_to_check:
-        logging.info("Аудитор: Нет пользователей для проверки. Завершаю.")
-        return
-
-    logging.info(f"Аудитор: Найдено {len(users_to_check)} пользователей для проверки.")
-    left_count = 0
-    for user_row in users_to_check:
-        user_id = user_row['user_id']
-        try:
-            # Делаем паузу, чтобы не превышать лимиты Telegram
-            import time
-            time.sleep(1)
-            
-            # Определяем правильный канал для проверки на основе источника пользователя
-            user_source = user_row.get('source', '')
-            channel_to_check = get_channel_id_for_user(user_source)
-            
-            chat_member = bot.get_chat_member(chat_id=channel_to_check, user_id=user_id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                # Пользователь отписался
-                database.mark_user_as_left(user_id)
-                left_count += 1
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'user not found' in e.description or 'bot was blocked by the user' in e.description:
-                # Пользователь удалил аккаунт или заблокировал бота
-                database.mark_user_as_left(user_id)
-                left_count += 1
-                logging.warning(f"Аудитор: Пользователь {user_id} не найден (удалил/заблокировал). Помечен как отписавшийся.")
-            else:
-                logging.error(f"Аудитор: Ошибка API Telegram при проверке {user_id}: {e}")
-        except Exception as e:
-            logging.error(f"Аудитор: Неизвестная ошибка при проверке {user_id}: {e}")
+    auditor = SubscriptionAuditor(
+        check_user_subscription, database,
+        rate=AUDITOR_RATE,
+        workers=AUDITOR_WORKERS,
+        max_duration=AUDITOR_MAX_DURATION or None,
+    )
+    result = auditor.run()
+    logging.info(f"Аудитор: Проверка завершена. Найдено {result['left']} отписавшихся, "
+                 f"проверено {result['checked']}/{result['total']}, {result['per_sec']} проверок/с.")
+
+def register_handlers():
+    """Регистрирует все обработчики бота (порядок важен: catch-all — последними)."""
+    logging.info("🤖 Начинаю регистрацию обработчиков...")
+    # Отложенные задачи, которые ставит callback_query после погашения купона
+    delayed_tasks_processor.register_handler('request_feedback', request_feedback)
+    if REFERRAL_NOTIFICATIONS_AVAILABLE:
+        delayed_tasks_processor.register_handler(REFERRAL_REWARD_TASK, process_referral_reward_task)
+    register_chat_booking_handlers(bot)  # ПЕРВЫМ - для групповых команд
+    register_user_command_handlers(bot)
+    register_callback_handlers(bot)
+    register_booking_handlers(bot)
+    # Инициализируем систему рассылок с планировщиком (ПЕРЕД admin catch-all)
+    init_admin_handlers(bot, scheduler)
+    register_admin_handlers(bot)
+    register_content_handlers(bot)  # AI System v3.0 - управление контентом
+    register_proactive_commands(bot)  # Проактивные команды для админа
+    register_broadcast_handlers(bot)  # ПЕРЕД AI — чтобы broadcast_states ловили текст раньше
+    register_ai_handlers(bot)  # AI catch-all — ПОСЛЕДНИМ среди message handlers
+    register_iiko_data_handlers(bot)
+
+def supersede_ai_request(update):
+    """
+    Новый вопрос к AI делает ещё не начатый AI-запрос пользователя неактуальным.
+    Кнопки, команды и сообщения в других чатах запрос не отменяют.
+    """
+    message = update.message
+    if message is not None and message.from_user is not None and is_ai_query(message):
+        from ai.assistant import ai_gateway
+        ai_gateway.supersede(message.from_user.id)
+
+def run_webhook_mode(allowed_updates):
+    """
+    Режим вебхука: Telegram присылает обновления на WEBHOOK_URL + WEBHOOK_PATH,
+    они обрабатываются пулом воркеров (по порядку внутри каждого чата).
+    Блокирует до SIGTERM/SIGINT, затем дорабатывает принятую очередь.
+    """
+    import signal
+    import threading
+    from core.update_dispatcher import UpdateDispatcher
+    from core.webhook_server import WebhookServer, create_webhook_app
+
+    dispatcher = UpdateDispatcher(bot, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE,
+                                  on_submit=supersede_ai_request)
+    dispatcher.start()
+    server = WebhookServer(create_webhook_app(dispatcher, WEBHOOK_PATH, WEBHOOK_SECRET), WEBHOOK_HOST, WEBHOOK_PORT)
+    server.start()
+
+    # Вебхук ставим после старта сервера, чтобы первые обновления не получили отказ
+    bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=allowed_updates,
+        max_connections=min(100, max(UPDATE_WORKERS * 2, 40)),
+    )
+    logging.info(f"🚀 Бот запущен в режиме webhook: {WEBHOOK_URL}{WEBHOOK_PATH}, воркеров: {UPDATE_WORKERS}")
+
+    stop_event = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+
+    last_stats = None
+    while not stop_event.wait(60):
+        stats = dispatcher.get_stats()
+        counters = (stats['accepted'], stats['rejected'])
+        if counters != last_stats:
+            logging.info(f"Диспетчер обновлений | {stats}")
+            last_stats = counters
+
+    # Вебхук не снимаем: пока бот перезапускается, Telegram копит обновления у себя
+    logging.info("🛑 Остановка: перестаю принимать обновления и дорабатываю очередь...")
+    server.stop()
+    dispatcher.stop(drain_timeout=UPDATE_DRAIN_TIMEOUT)
+    scheduler.shutdown(wait=False)
+    delayed_tasks_processor.stop()
+    logging.info(f"Диспетчер обновлений | Итог: {dispatcher.get_stats()}")
 
-    logging.info(f"Аудитор: Проверка завершена. Найдено {left_count} отписавшихся.")
 
 if __name__ == "__main__":
     # Проверка подключений к базам данных
@@ -188,19 +256,7 @@ if __name__ == "__main__":
     
     database.init_db()
 
-    logging.info("🤖 Начинаю регистрацию обработчиков...")
-    register_chat_booking_handlers(bot)  # ПЕРВЫМ - для групповых команд
-    register_user_command_handlers(bot)
-    register_callback_handlers(bot, scheduler, send_friend_bonus, request_feedback)
-    register_booking_handlers(bot)
-    # Инициализируем систему рассылок с планировщиком (ПЕРЕД admin catch-all)
-    init_admin_handlers(bot, scheduler)
-    register_admin_handlers(bot)
-    register_content_handlers(bot)  # AI System v3.0 - управление контентом
-    register_proactive_commands(bot)  # Проактивные команды для админа
-    register_broadcast_handlers(bot)  # ПЕРЕД AI — чтобы broadcast_states ловили текст раньше
-    register_ai_handlers(bot)  # AI catch-all — ПОСЛЕДНИМ среди message handlers
-    register_iiko_data_handlers(bot)
+    register_handlers()
 
     # Ежедневный отчет в 07:00
     scheduler.add_job(
@@ -220,6 +276,12 @@ if __name__ == "__main__":
 
     scheduler.start()
     delayed_tasks_processor.start()
+
+    # Продолжаем рассылки, прерванные предыдущим перезапуском
+    try:
+        resume_unfinished_broadcasts(bot)
+    except Exception as e:
+        logging.error(f"❌ Ошибка возобновления рассылок: {e}")
     
     # Запускаем службу реферальных уведомлений
     if REFERRAL_NOTIFICATIONS_AVAILABLE:
@@ -233,6 +295,17 @@ if __name__ == "__main__":
     
     logging.info("✅ Все обработчики, планировщик и сервисы успешно запущены.")
 
+    # КРИТИЧНО: указываем allowed_updates с callback_query, иначе кнопки не работают!
+    ALLOWED_UPDATES = ['message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                       'edited_message', 'channel_post', 'edited_channel_post',
+                       'my_chat_member', 'chat_member', 'chat_join_request']
+
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise ValueError("BOT_MODE=webhook требует WEBHOOK_URL")
+        run_webhook_mode(ALLOWED_UPDATES)
+        raise SystemExit(0)
+
     # === КРИТИЧНО: Удаляем webhook ПЕРЕД стартом polling ===
     # Если webhook установлен (например от веб-панели), Telegram НЕ отдаёт
     # updates через polling — все кнопки перестают работать!
@@ -258,10 +331,6 @@ if __name__ == "__main__":
         logging.warning(f"⚠️ Не удалось проверить webhook: {e}")
 
     # Запуск бота с обработкой ошибок
-    # КРИТИЧНО: указываем allowed_updates с callback_query, иначе кнопки не работают!
-    ALLOWED_UPDATES = ['message', 'callback_query', 'inline_query', 'chosen_inline_result',
-                       'edited_message', 'channel_post', 'edited_channel_post',
-                       'my_chat_member', 'chat_member', 'chat_join_request']
     while True:
         try:
             logging.info("🚀 Запуск бота (long polling)...")
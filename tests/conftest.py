@@ -0,0 +1,48 @@
+# conftest.py
+"""
+Общая настройка тестов: окружение для core.config, временная SQLite-база
+и временные файлы для сырых метрик AI и динамического контента.
+
+core.config требует токен бота, канал, админов и стикеры — для тестов
+подставляются заглушки (если переменные не заданы), база — во временной папке.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+_TMP_DIR = tempfile.mkdtemp(prefix="evgenich-tests-")
+
+for _name, _value in {
+    "BOT_TOKEN": "123456:TEST",
+    "CHANNEL_ID": "-1000000000000",
+    "ADMIN_IDS": "1",
+    "HELLO_STICKER_ID": "test",
+    "NASTOYKA_STICKER_ID": "test",
+    "THANK_YOU_STICKER_ID": "test",
+    "FRIEND_BONUS_STICKER_ID": "test",
+}.items():
+    os.environ.setdefault(_name, _value)
+os.environ["DATABASE_PATH"] = os.path.join(_TMP_DIR, "test.db")
+os.environ["USE_POSTGRES"] = "false"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_database():
+    """Схема SQLite во временной базе (метрики AI и др. пишут в неё при выходе)."""
+    from core import database
+    database.init_db()
+    return database
+
+
+@pytest.fixture(autouse=True)
+def isolated_ai_files(tmp_path, monkeypatch):
+    """Сырые JSONL метрик AI и dynamic_content.json — во временной папке, а не в logs/ и data/."""
+    from ai.dynamic_content import dynamic_content
+    from ai.metrics import ai_metrics
+    monkeypatch.setattr(ai_metrics, "log_file", tmp_path / "ai_metrics.jsonl")
+    monkeypatch.setattr(dynamic_content, "storage_file", tmp_path / "dynamic_content.json")
@@ -0,0 +1,129 @@
+"""AIMetrics: неудачная запись агрегатов возвращает их в очередь, старые дни выгружаются из памяти."""
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import pytest
+
+from ai.metrics import AIMetrics
+from core import database
+
+
+class FlakyStore:
+    def __init__(self):
+        self.fail = True
+        self.saved_daily = []
+
+    def load_ai_metrics_rollup(self, date_from, date_to=None):
+        return [], []
+
+    def save_ai_metrics_rollup(self, daily_rows, user_rows):
+        if self.fail:
+            raise ConnectionError("database is locked")
+        self.saved_daily.extend(daily_rows)
+
+
+def test_failed_flush_is_retried(tmp_path):
+    store = FlakyStore()
+    metrics = AIMetrics(log_file=str(tmp_path / "ai_metrics.jsonl"), store=store, flush_interval=3600)
+    metrics.log_request(user_id=1, model="gpt-4o", prompt_tokens=100, completion_tokens=20,
+                        response_time=0.5, success=True)
+
+    metrics.flush()
+    assert store.saved_daily == []
+
+    store.fail = False
+    metrics.flush()
+    assert len(store.saved_daily) == 1
+    assert store.saved_daily[0]["total_requests"] == 1
+
+
+class StoredRollup:
+    """Хранилище с агрегатами за один старый день."""
+
+    def __init__(self, day):
+        self.day = day
+        self.loads = []
+
+    def load_ai_metrics_rollup(self, date_from, date_to=None):
+        self.loads.append((date_from, date_to))
+        if date_from <= self.day and (date_to is None or self.day <= date_to):
+            return ([{"date": self.day, "total_requests": 5, "unique_users": 1}],
+                    [{"date": self.day, "user_id": 7, "requests": 5, "tokens": 500, "cost_usd": 0.01}])
+        return [], []
+
+    def save_ai_metrics_rollup(self, daily_rows, user_rows):
+        pass
+
+
+def test_flushed_old_days_are_unloaded_and_reloaded(tmp_path):
+    old_day = date.today() - timedelta(days=60)
+    store = StoredRollup(old_day.isoformat())
+    metrics = AIMetrics(log_file=str(tmp_path / "ai_metrics.jsonl"), store=store, flush_interval=3600,
+                        memory_days=35)
+    metrics.log_request(user_id=7, model="gpt-4o", prompt_tokens=100, completion_tokens=20,
+                        response_time=0.5, success=True)
+
+    assert metrics.get_daily_stats(old_day)["total_requests"] == 5
+    assert metrics.get_user_stats(7, days=90)["total_requests"] == 6
+    loads = len(store.loads)
+
+    metrics.flush()
+    # Сегодняшние агрегаты остаются в памяти, старый день — только в хранилище
+    assert metrics.get_daily_stats()["total_requests"] == 1
+    assert len(store.loads) == loads
+    assert metrics.get_daily_stats(old_day)["total_requests"] == 5
+    assert len(store.loads) == loads + 1
+
+
+def test_store_raises_on_write_error(monkeypatch):
+    @contextmanager
+    def broken_connection():
+        raise sqlite3.OperationalError("database is locked")
+        yield
+
+    monkeypatch.setattr(database, "db_connection", broken_connection)
+    with pytest.raises(sqlite3.OperationalError):
+        database.save_ai_metrics_rollup([{"date": "2026-01-01"}], [])
+
+
+@pytest.fixture
+def stored_today(test_database):
+    """Сохранённые агрегаты за сегодня: 500 запросов, из них 2 — пользователя 7."""
+    today = date.today().isoformat()
+    daily = dict.fromkeys(test_database.AI_METRICS_DAILY_FIELDS, 0)
+    daily.update(date=today, total_requests=500, unique_users=40)
+    test_database.save_ai_metrics_rollup([daily], [{"date": today, "user_id": 7, "requests": 2,
+                                                    "tokens": 200, "cost_usd": 0.01}])
+    yield today
+    with test_database.db_connection() as conn:
+        conn.execute("DELETE FROM ai_metrics_daily WHERE date = ?", (today,))
+        conn.execute("DELETE FROM ai_metrics_user_daily WHERE date = ?", (today,))
+
+
+def test_failed_load_does_not_overwrite_stored_rollup(tmp_path, monkeypatch, stored_today):
+    real_connection = database.db_connection
+
+    @contextmanager
+    def locked_connection():
+        raise sqlite3.OperationalError("database is locked")
+        yield
+
+    monkeypatch.setattr(database, "db_connection", locked_connection)
+    metrics = AIMetrics(log_file=str(tmp_path / "ai_metrics.jsonl"), store=database, flush_interval=3600)
+    for user_id in (7, 8):
+        metrics.log_request(user_id=user_id, model="gpt-4o", prompt_tokens=100, completion_tokens=20,
+                            response_time=0.5, success=True)
+    metrics.flush()
+
+    monkeypatch.setattr(database, "db_connection", real_connection)
+    [daily], _ = database.load_ai_metrics_rollup(stored_today, stored_today)
+    assert daily["total_requests"] == 500
+
+    # Загрузка повторяется при следующем обращении; накопленное до неё складывается с сохранённым
+    assert metrics.get_daily_stats()["total_requests"] == 502
+    metrics.flush()
+    [daily], users = database.load_ai_metrics_rollup(stored_today, stored_today)
+    assert daily["total_requests"] == 502
+    assert daily["unique_users"] == 41  # пользователь 7 уже был среди сохранённых
+    assert {row["user_id"]: row["requests"] for row in users} == {7: 3, 8: 1}
@@ -0,0 +1,54 @@
+"""Отмена ждущего AI-запроса: только свободный текст в чате, где AI готовит ответ."""
+import pytest
+from telebot import TeleBot, types
+
+from handlers import ai_logic
+
+
+def make_message(text, chat_id=500, user_id=500, message_id=1):
+    return types.Message.de_json({
+        'message_id': message_id, 'date': 0, 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Гость'},
+    })
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    bot = TeleBot('123456:TEST', threaded=False)
+    monkeypatch.setattr(bot, 'send_chat_action', lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, 'reply_to', lambda *args, **kwargs: None)
+    ai_logic.register_ai_handlers(bot)
+    return bot
+
+
+def ask_ai_and_check(bot, monkeypatch, *messages):
+    """Пока catch-all ждёт ответа AI, проверяет is_ai_query для каждого сообщения."""
+    results = []
+
+    def fake_recommendation(**kwargs):
+        results.extend(ai_logic.is_ai_query(message) for message in messages)
+        return 'Ответ'
+
+    monkeypatch.setattr(ai_logic, 'get_ai_recommendation', fake_recommendation)
+    bot.process_new_messages([make_message('Что посоветуешь к пельменям?')])
+    return results
+
+
+def test_free_text_in_same_chat_supersedes_pending_request(bot, monkeypatch):
+    assert ask_ai_and_check(bot, monkeypatch, make_message('А к борщу?', message_id=2)) == [True]
+
+
+@pytest.mark.parametrize('text', ['/start', ai_logic.AI_PROMPT_BUTTON, '🎁 Карта лояльности'])
+def test_commands_and_buttons_do_not_supersede(bot, monkeypatch, text):
+    assert ask_ai_and_check(bot, monkeypatch, make_message(text, message_id=2)) == [False]
+
+
+def test_messages_in_other_chat_do_not_supersede(bot, monkeypatch):
+    # Например, ответ на шаг диалога в личке, пока AI отвечает в группе
+    assert ask_ai_and_check(bot, monkeypatch, make_message('+7 900 000-00-00', chat_id=-100500)) == [False]
+
+
+def test_nothing_to_supersede_after_answer(bot, monkeypatch):
+    ask_ai_and_check(bot, monkeypatch)
+    assert not ai_logic.is_ai_query(make_message('А к борщу?', message_id=2))
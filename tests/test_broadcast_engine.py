@@ -0,0 +1,87 @@
+"""Движок рассылок: token bucket и возобновление после перезапуска без повторной отправки."""
+import pytest
+
+from core import broadcast_engine
+from core.broadcast_engine import BroadcastEngine, TokenBucket
+
+
+class FakeClock:
+    """time.monotonic/time.sleep модуля движка: sleep только двигает часы."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(broadcast_engine.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(broadcast_engine.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_token_bucket_allows_burst_then_waits(clock):
+    bucket = TokenBucket(rate=10, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_token_bucket_does_not_save_more_than_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=2)
+    clock.now += 60  # долгий простой
+    for _ in range(2):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+@pytest.fixture
+def run_id(test_database):
+    return test_database.create_broadcast_run(8, 'тест', source='test', payload={'state': {}})
+
+
+def recipients(*user_ids):
+    return [{'user_id': uid, 'username': '', 'first_name': f'Гость{uid}'} for uid in user_ids]
+
+
+def test_resume_skips_recipients_delivered_after_checkpoint(test_database, run_id):
+    # До падения: чекпоинт на 102, но потоки успели отправить 105 и 106 (и они в логе)
+    test_database.checkpoint_broadcast_run(run_id, 102, 2, 0, 0)
+    test_database.log_broadcast_deliveries(run_id, [
+        {'user_id': uid, 'username': '', 'first_name': '', 'status': status}
+        for uid, status in ((101, 'sent'), (102, 'sent'), (105, 'sent'), (106, 'blocked'))
+    ])
+
+    completed = test_database.get_broadcast_completed_after(run_id, 102)
+    assert completed == {105: 'sent', 106: 'blocked'}
+
+    sent_to = []
+    engine = BroadcastEngine(
+        run_id, recipients(103, 104, 105, 106, 107), send_func=sent_to.append, database=test_database,
+        global_rate=1000, per_chat_interval=0, workers=2,
+        initial_counts={'sent': 2, 'failed': 0, 'blocked': 0}, completed=completed,
+    )
+    result = engine.run()
+
+    assert sorted(sent_to) == [103, 104, 107]
+    assert result['total'] == 7
+    assert (result['sent'], result['blocked']) == (6, 1)
+
+    [run] = [r for r in test_database.get_unfinished_broadcast_runs() if r['id'] == run_id]
+    # Чекпоинт прошёл весь список, включая пропущенных, и не посчитал их дважды
+    assert run['last_user_id'] == 107
+    assert (run['sent_count'], run['blocked_count']) == (6, 1)
@@ -0,0 +1,37 @@
+"""Отложенные задачи: захват с арендой и время следующего пробуждения."""
+import datetime
+
+import pytest
+import pytz
+
+
+@pytest.fixture
+def database(test_database):
+    with test_database.db_connection() as conn:
+        conn.execute("DELETE FROM delayed_tasks")
+    return test_database
+
+
+def now():
+    return datetime.datetime.now(pytz.utc)
+
+
+def test_wakeup_includes_lease_of_running_task(database):
+    database.schedule_delayed_task(1, 'test', now() - datetime.timedelta(seconds=1))
+    database.schedule_delayed_task(2, 'test', now() + datetime.timedelta(hours=1))
+    [task] = database.claim_due_delayed_tasks('worker-a', 10, lease_seconds=60)
+    assert task['user_id'] == 1
+
+    wakeup = database.get_next_delayed_task_time()
+    # Аренда кончается раньше следующей ожидающей задачи — просыпаемся к ней
+    assert now() + datetime.timedelta(seconds=55) < wakeup < now() + datetime.timedelta(seconds=65)
+
+
+def test_expired_lease_is_reclaimed(database):
+    database.schedule_delayed_task(1, 'test', now() - datetime.timedelta(seconds=1))
+    assert database.claim_due_delayed_tasks('worker-a', 10, lease_seconds=0)
+
+    assert database.get_next_delayed_task_time() <= now()
+    [task] = database.claim_due_delayed_tasks('worker-b', 10, lease_seconds=60)
+    assert task['user_id'] == 1
+    assert task['attempts'] == 2
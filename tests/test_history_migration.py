@@ -0,0 +1,49 @@
+"""Перенос истории диалогов AI из SQLite в PostgreSQL при переходе на PG."""
+import pytest
+
+
+class FakePostgres:
+    def __init__(self, fail_after=None):
+        self.rows = {}
+        self.fail_after = fail_after
+
+    def import_conversation_history(self, rows):
+        if self.fail_after is not None and len(self.rows) >= self.fail_after:
+            raise ConnectionError('server closed the connection')
+        for row in rows:
+            self.rows.setdefault(row['id'], row)
+
+
+@pytest.fixture
+def database(test_database):
+    with test_database.db_connection() as conn:
+        conn.execute("DELETE FROM conversation_history")
+        conn.execute("DELETE FROM job_watermarks WHERE name = ?", (test_database._HISTORY_MIGRATION_MARK,))
+        conn.executemany("INSERT INTO conversation_history (user_id, role, text) VALUES (?, ?, ?)",
+                         [(700, 'user' if n % 2 == 0 else 'assistant', f"реплика {n}") for n in range(5)])
+    return test_database
+
+
+def test_history_moved_once_in_order(database, monkeypatch):
+    pg = FakePostgres()
+    monkeypatch.setattr(database, 'pg_client', pg, raising=False)
+
+    assert database.migrate_conversation_history_to_postgres(batch_size=2) == 5
+    ids = sorted(pg.rows)
+    assert all(row_id < 0 for row_id in ids)
+    assert [pg.rows[row_id]['text'] for row_id in ids] == [f"реплика {n}" for n in range(5)]
+
+    # Реплики, дописанные позже (копия двойной записи), повторно не переносятся
+    database.log_conversation_turn(700, 'user', 'новая')
+    assert database.migrate_conversation_history_to_postgres() == 0
+    assert len(pg.rows) == 5
+
+
+def test_interrupted_migration_resumes(database, monkeypatch):
+    pg = FakePostgres(fail_after=2)
+    monkeypatch.setattr(database, 'pg_client', pg, raising=False)
+    assert database.migrate_conversation_history_to_postgres(batch_size=2) == 2
+
+    pg.fail_after = None
+    assert database.migrate_conversation_history_to_postgres(batch_size=2) == 3
+    assert len(pg.rows) == 5
@@ -0,0 +1,66 @@
+"""Скомпилированный матчер намерений даёт те же результаты, что и старый перебор с SequenceMatcher."""
+import random
+
+import pytest
+
+from ai.intent_matcher import CompiledIntentMatcher
+from ai.smart_intent_detector import SmartIntentDetector
+
+MESSAGES = [
+    "привет! хочу забранировать столик на пятницу на 4 человек",
+    "где вы находитесь? как к вам добраться от метро",
+    "до скольки вы сегодня работаете",
+    "было здорово, спасибо большое, придём ещё",
+    "сколько стоит караоке и какой средний чек",
+    "обслуживание ужасное, официант нахамил, хочу пожаловаться",
+    "есть сегодня какие-нибудь мероприятия или концерт?",
+    "можно попеть в кароке вечером?",
+    "расскажите про настойки, какая самая популярная",
+    "ну что там по движухе на выходных, ребят",
+]
+
+
+def legacy_match(detector, message_lower):
+    """Старый путь detect(): фразы и _check_fuzzy_keywords по каждому намерению отдельно."""
+    results = []
+    for intent_name, config in detector.intent_patterns.items():
+        phrase_match = any(phrase in message_lower for phrase in config.get("phrases", []))
+        keyword_match, keyword_score = detector._check_fuzzy_keywords(message_lower, config["keywords"])
+        if phrase_match:
+            confidence = 0.95
+        elif keyword_match:
+            confidence = max(0.7, keyword_score)
+        else:
+            continue
+        results.append({"intent": intent_name, "confidence": confidence, "priority": config["priority"]})
+    return results
+
+
+def typo_corpus(size=500, seed=42):
+    """Случайные сообщения из слов MESSAGES, примерно каждая десятая буква выброшена."""
+    rnd = random.Random(seed)
+    vocab = " ".join(MESSAGES).split()
+    corpus = list(MESSAGES)
+    for _ in range(size):
+        words = [rnd.choice(vocab) for _ in range(rnd.randint(1, 10))]
+        corpus.append(" ".join("".join(c for c in w if rnd.random() > 0.1) for w in words))
+    return corpus
+
+
+@pytest.fixture(scope="module")
+def detector():
+    return SmartIntentDetector()
+
+
+@pytest.fixture(scope="module")
+def legacy_results(detector):
+    return [(m, legacy_match(detector, m)) for m in typo_corpus()]
+
+
+@pytest.mark.parametrize("word_cache_size", [0, 4096])
+def test_matches_legacy_on_typo_corpus(detector, legacy_results, word_cache_size):
+    matcher = CompiledIntentMatcher(detector.intent_patterns, detector.fuzzy_threshold,
+                                    word_cache_size=word_cache_size)
+    mismatches = [(m, expected, matcher.match(m)) for m, expected in legacy_results
+                  if matcher.match(m) != expected]
+    assert mismatches == []
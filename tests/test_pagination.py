@@ -0,0 +1,46 @@
+"""Keyset-пагинация списка пользователей: курсор и обход страниц без пропусков и повторов."""
+import pytest
+
+from db.pagination import decode_cursor, encode_cursor, user_id_prefix_ranges
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor('2026-03-01 12:30:00', 42)) == ('2026-03-01 12:30:00', 42)
+    assert decode_cursor(encode_cursor(None, 42)) == (None, 42)
+
+
+@pytest.mark.parametrize('cursor', [None, '', 'мусор', '2026-03-01|abc'])
+def test_bad_cursor_means_first_page(cursor):
+    assert decode_cursor(cursor) is None
+
+
+def test_user_id_prefix_ranges():
+    assert user_id_prefix_ranges('12')[:3] == [(12, 12), (120, 129), (1200, 1299)]
+    assert user_id_prefix_ranges('0') == []
+    assert user_id_prefix_ranges('ab') == []
+
+
+@pytest.fixture
+def paged_users(test_database):
+    # Одинаковые даты регистрации и пользователи без даты — самые неудобные для курсора
+    signups = ['2026-02-01 10:00:00'] * 3 + ['2026-02-02 10:00:00'] * 2 + [None] * 2
+    users = [(920001 + n, f'pagetest_{n}', signup) for n, signup in enumerate(signups)]
+    with test_database.db_connection() as conn:
+        conn.executemany("INSERT INTO users (user_id, username, signup_date) VALUES (?, ?, ?)", users)
+    yield users
+    with test_database.db_connection() as conn:
+        conn.executemany("DELETE FROM users WHERE user_id = ?", [(uid,) for uid, _, _ in users])
+
+
+def test_cursor_walks_all_pages_in_order(test_database, paged_users):
+    seen, cursor = [], None
+    while True:
+        page = test_database.get_users_page(limit=2, cursor=cursor, search='pagetest_')
+        seen.extend(user['user_id'] for user in page['users'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert page['total'] == len(paged_users)
+    # signup_date DESC (NULL в конце), при равной дате — user_id DESC
+    assert seen == [920005, 920004, 920003, 920002, 920001, 920007, 920006]
@@ -0,0 +1,20 @@
+"""Горячие запросы к users и conversation_history идут по индексам, без полных сканов."""
+from core import database
+from core.sqlite_pool import SQLitePool
+from db import query_plan_check
+
+
+def test_hot_sqlite_queries_use_indexes(tmp_path, monkeypatch, capsys):
+    # Отдельная база: check_sqlite наполняет её синтетическими пользователями
+    path = str(tmp_path / 'plan_check.db')
+    monkeypatch.setenv('DATABASE_PATH', path)
+    pool = SQLitePool(path, max_size=2)
+    monkeypatch.setattr(database, '_sqlite_pool', pool)
+
+    # Для формы плана после ANALYZE хватает нескольких тысяч строк
+    try:
+        failures = query_plan_check.check_sqlite(3000)
+    finally:
+        pool.close_all()
+
+    assert failures == 0, capsys.readouterr().out
@@ -0,0 +1,60 @@
+"""Задача награды рефереру: окончательный отказ, перенос при ошибке, сверка."""
+import datetime
+
+import pytest
+import pytz
+
+from core import database
+from utils import referral_notifications as rn
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+    calls = []
+
+    def fake_schedule(user_id, task_type, delay_seconds=0, payload=None):
+        calls.append((user_id, task_type, delay_seconds, payload))
+        return len(calls)
+
+    monkeypatch.setattr(rn, "schedule_task", fake_schedule)
+    return calls
+
+
+def run_task(monkeypatch, reason, payload=None):
+    monkeypatch.setattr(database, "check_referral_reward_eligibility", lambda referrer, referred: (False, reason))
+    rn.process_referral_reward_task({'user_id': 10, 'payload': payload or {'referred_id': 20}})
+
+
+@pytest.mark.parametrize("reason", [database.REFERRAL_NOT_FOUND, database.REFERRAL_ALREADY_REWARDED,
+                                    database.REFERRAL_NOT_REDEEMED])
+def test_definitive_refusal_completes_task(monkeypatch, scheduled, reason):
+    run_task(monkeypatch, reason)
+    assert scheduled == []
+
+
+def test_check_error_reschedules_with_backoff(monkeypatch, scheduled):
+    run_task(monkeypatch, database.REFERRAL_CHECK_ERROR)
+    run_task(monkeypatch, database.REFERRAL_CHECK_ERROR, {'referred_id': 20, 'retry': 3})
+
+    assert [call[3] for call in scheduled] == [{'referred_id': 20, 'retry': 1}, {'referred_id': 20, 'retry': 4}]
+    assert scheduled[1][2] == 8 * scheduled[0][2]
+
+
+def test_retries_are_bounded(monkeypatch, scheduled):
+    with pytest.raises(RuntimeError):
+        run_task(monkeypatch, database.REFERRAL_CHECK_ERROR, {'referred_id': 20, 'retry': rn.REWARD_MAX_RETRIES})
+
+
+def test_failed_rescheduling_raises_for_processor_retry(monkeypatch):
+    monkeypatch.setattr(rn, "schedule_task", lambda *a, **kw: None)
+    with pytest.raises(RuntimeError):
+        run_task(monkeypatch, database.REFERRAL_CHECK_ERROR)
+
+
+def test_completed_task_does_not_block_reconciliation():
+    run_at = datetime.datetime.now(pytz.utc)
+    task_id = database.schedule_delayed_task(501, rn.REFERRAL_REWARD_TASK, run_at, {'referred_id': 502})
+    assert database.delayed_task_exists(501, rn.REFERRAL_REWARD_TASK, {'referred_id': 502})
+
+    database.mark_delayed_task_completed(task_id)
+    assert not database.delayed_task_exists(501, rn.REFERRAL_REWARD_TASK, {'referred_id': 502})
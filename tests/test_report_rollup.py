@@ -0,0 +1,66 @@
+"""Почасовые агрегаты отчётов: разница при записях и пересчёт после ошибки."""
+import pytest
+
+from core import report_rollup
+from db.repository import RollupHooks, SQLiteRepository, UserRecord
+
+SIGNUP = '2026-03-01 12:30:00'
+
+
+@pytest.fixture
+def repo(test_database):
+    return SQLiteRepository(test_database.db_connection,
+                            RollupHooks(test_database._rollup_snapshot, test_database._rollup_commit))
+
+
+def totals(database):
+    with database.db_connection() as conn:
+        row = conn.execute("SELECT SUM(signups), SUM(issued) FROM report_hourly_rollup "
+                           "WHERE hour = '2026-03-01 12:00'").fetchone()
+    return tuple(value or 0 for value in row)
+
+
+def dirty_mark(database):
+    with database.db_connection() as conn:
+        return conn.execute("SELECT 1 FROM job_watermarks WHERE name = ?",
+                            (report_rollup.DIRTY_MARK,)).fetchone() is not None
+
+
+def test_repository_writes_update_rollup(repo, test_database):
+    signups, issued = totals(test_database)
+
+    assert repo.add_user(UserRecord(910001, source='test', signup_date=SIGNUP))
+    assert totals(test_database) == (signups + 1, issued)
+
+    assert repo.update_user(910001, status='issued')
+    assert totals(test_database) == (signups + 1, issued + 1)
+
+    # Поля вне агрегатов снимок не делают и агрегаты не меняют
+    assert repo.update_user(910001, username='guest')
+    assert totals(test_database) == (signups + 1, issued + 1)
+
+    assert repo.delete_user(910001)
+    assert totals(test_database) == (signups, issued)
+
+
+def test_failed_increment_is_rebuilt_before_report(repo, test_database, monkeypatch):
+    signups, _ = totals(test_database)
+
+    def broken_write(conn, deltas):
+        raise RuntimeError('disk I/O error')
+
+    monkeypatch.setattr(test_database, '_rollup_write', broken_write)
+    assert repo.add_user(UserRecord(910002, source='test', signup_date=SIGNUP))
+    monkeypatch.undo()
+
+    # Пользователь записан, агрегаты отстали и помечены для пересчёта
+    assert repo.get_user(910002) is not None
+    assert totals(test_database)[0] == signups
+    assert dirty_mark(test_database)
+
+    rows = test_database._load_report_rollup('2026-03-01 12:00', '2026-03-01 12:00')
+    assert sum(row['signups'] for row in rows) == signups + 1
+    assert not dirty_mark(test_database)
+    assert not test_database._rollup_dirty
+
+    repo.delete_user(910002)
@@ -0,0 +1,66 @@
+"""Кеш ответов на типовые вопросы: общий промпт, ключ и попадание в пул."""
+from types import SimpleNamespace
+
+import pytest
+
+from ai import assistant
+from ai.response_cache import ResponseCache
+
+
+class FakeGateway:
+    available = True
+
+    def __init__(self):
+        self.calls = []
+
+    def complete_sync(self, messages, **kwargs):
+        self.calls.append(messages)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Мы на Невском, 53 — заходи, товарищ!"))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20),
+        )
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    fake = FakeGateway()
+    monkeypatch.setattr(assistant, "ai_gateway", fake)
+    # Пул из одного варианта и без случайного обновления — второй вопрос сразу из кеша
+    monkeypatch.setattr(assistant, "response_cache", ResponseCache(pool_size=1, refresh_probability=0))
+    monkeypatch.setattr(assistant.user_memory, "extract_info_from_message", lambda *a, **kw: None)
+    monkeypatch.setattr(assistant.user_memory, "get_personalization_context",
+                        lambda user_id: f"Гостя зовут Гость{user_id}, любит хреновуху")
+    monkeypatch.setattr(assistant.conversation_context, "get_context",
+                        lambda user_id: [{"role": "user", "content": f"секрет гостя {user_id}"}])
+    monkeypatch.setattr(assistant.conversation_context, "add_message", lambda *a, **kw: None)
+    return fake
+
+
+def test_second_identical_generic_question_hits_cache(gateway):
+    first = assistant.get_ai_recommendation("Какой у вас адрес?", user_id=101, preferences="любит сидр")
+    second = assistant.get_ai_recommendation("Какой у вас адрес?", user_id=102, preferences="не пьёт")
+
+    assert first == second
+    assert len(gateway.calls) == 1
+    assert assistant.response_cache.get_stats()["hits"] == 1
+
+
+def test_generic_prompt_has_no_personal_context(gateway):
+    assistant.get_ai_recommendation("Какой у вас адрес?", user_id=101, preferences="любит сидр")
+
+    messages = gateway.calls[0]
+    text = "\n".join(message["content"] for message in messages)
+    assert len(messages) == 2  # системный промпт и вопрос, без истории
+    assert "Гость101" not in text
+    assert "секрет гостя" not in text
+    assert "сидр" not in text
+
+
+def test_personal_question_is_not_cached(gateway):
+    question = "Посоветуй что-нибудь под моё настроение, я сегодня грущу после работы"
+    assistant.get_ai_recommendation(question, user_id=101)
+    assistant.get_ai_recommendation(question, user_id=101)
+
+    assert len(gateway.calls) == 2
+    assert "Гость101" in gateway.calls[0][0]["content"]
+    assert assistant.response_cache.get_stats()["keys"] == 0
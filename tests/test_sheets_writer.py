@@ -0,0 +1,94 @@
+"""Фоновый писатель Google Sheets: сверка строк по ID и отбрасывание только плохих записей."""
+from types import SimpleNamespace
+
+import pytest
+
+from core.sheets_writer import SheetsWriter
+
+
+class ApiError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.response = SimpleNamespace(status_code=status)
+
+
+class FakeWorksheet:
+    """Лист: строки — списки ячеек, ID пользователя в колонке B."""
+
+    def __init__(self, rows):
+        self.rows = [list(row) for row in rows]
+        self.fail_for = {}  # user_id → код ошибки batch_update
+
+    def col_values(self, col):
+        return [row[col - 1] if len(row) >= col else '' for row in self.rows]
+
+    def batch_get(self, ranges):
+        result = []
+        for cell in ranges:
+            row = int(cell[1:])
+            value = self.rows[row - 1][1] if row <= len(self.rows) else ''
+            result.append([[value]] if value else [])
+        return result
+
+    def batch_update(self, data, value_input_option=None):
+        for item in data:
+            row = int(item['range'][1:])
+            if self.rows[row - 1][1] in self.fail_for:
+                raise ApiError(self.fail_for[self.rows[row - 1][1]])
+        for item in data:
+            col = ord(item['range'][0]) - 64
+            row = int(item['range'][1:])
+            self.rows[row - 1][col - 1] = item['values'][0][0]
+
+    def append_rows(self, rows):
+        start = len(self.rows) + 1
+        self.rows.extend(list(row) for row in rows)
+        return {'updates': {'updatedRange': f"'Лист'!A{start}:C{len(self.rows)}"}}
+
+
+@pytest.fixture
+def sheet():
+    return FakeWorksheet([['Дата', 'ID', 'Статус'], ['', '101', 'new'], ['', '102', 'new']])
+
+
+@pytest.fixture
+def writer(sheet, tmp_path):
+    # Поток отправки стартует при первой записи; тесты вызывают flush() сами
+    writer = SheetsWriter(lambda: sheet, str(tmp_path / 'spool.jsonl'), flush_interval=60, max_retries=1)
+    yield writer
+    writer.stop()
+
+
+def test_update_follows_user_after_rows_reordered(writer, sheet):
+    writer.enqueue_update(101, {3: 'issued'})
+    assert writer.flush()
+
+    # Лист отсортировали вручную: строки 101 и 102 поменялись местами
+    sheet.rows[1], sheet.rows[2] = sheet.rows[2], sheet.rows[1]
+    writer.enqueue_update(102, {3: 'redeemed'})
+    assert writer.flush()
+
+    assert sheet.rows[1] == ['', '102', 'redeemed']
+    assert sheet.rows[2] == ['', '101', 'issued']
+
+
+def test_rejected_item_dropped_others_sent(writer, sheet):
+    sheet.fail_for['101'] = 400
+    writer.enqueue_update(101, {3: 'bad'})
+    writer.enqueue_update(102, {3: 'issued'})
+
+    assert not writer.flush()
+    assert sheet.rows[2] == ['', '102', 'issued']
+    assert writer.get_stats()['dropped'] == 1
+    assert writer.get_stats()['pending'] == 0
+
+
+def test_outage_keeps_whole_batch_queued(writer, sheet):
+    sheet.fail_for['101'] = 503
+    writer.enqueue_update(101, {3: 'issued'})
+    writer.enqueue_update(102, {3: 'issued'})
+
+    for _ in range(4):
+        assert not writer.flush()
+    assert writer.get_stats()['dropped'] == 0
+    assert writer.get_stats()['pending'] == 2
@@ -0,0 +1,25 @@
+"""Ночной аудитор подписок: поведение при недоступной базе."""
+from core.subscription_auditor import SubscriptionAuditor
+
+
+class FailingDatabase:
+    """Прогон создать не удалось — start_audit_run вернул None."""
+
+    def start_audit_run(self):
+        return None
+
+    def get_redeemed_users_for_audit(self, checked_before=None):
+        raise AssertionError("без прогона пользователи не выбираются")
+
+
+def test_run_without_audit_run_returns_full_progress():
+    checked = []
+    auditor = SubscriptionAuditor(checked.append, FailingDatabase())
+
+    result = auditor.run()
+
+    assert checked == []
+    assert result['checked'] == 0 and result['total'] == 0
+    # Вызывающий код (run_nightly_auditor_job) читает per_sec из результата
+    assert result['per_sec'] == 0.0
+    assert result['eta_sec'] is None
@@ -0,0 +1,50 @@
+"""UserMemory: ошибка чтения профиля не должна затирать сохранённую память."""
+from ai.user_memory import UserMemory
+
+
+class FlakyStore:
+    def __init__(self):
+        self.saved = {}
+        self.fail = True
+
+    def load_user_memory_profile(self, user_id):
+        if self.fail:
+            raise ConnectionError("database is locked")
+        return self.saved.get(user_id)
+
+    def save_user_memory_profiles(self, profiles):
+        self.saved.update(profiles)
+
+
+def make_memory(tmp_path, store):
+    memory = UserMemory(storage_file=str(tmp_path / "user_memory.json"), store=store, flush_interval=3600)
+    memory._ready = True  # без фонового потока и переноса JSON
+    return memory
+
+
+def test_read_error_does_not_overwrite_stored_profile(tmp_path):
+    store = FlakyStore()
+    store.saved[7] = {"name": "Анна", "favorite_drinks": ["хреновуха"], "notes": []}
+    memory = make_memory(tmp_path, store)
+
+    profile = memory.get_user_profile(7)
+    memory.remember_name(7, "Борис")
+    memory.flush()
+
+    assert profile["name"] is None
+    assert store.saved[7]["name"] == "Анна"
+    assert 7 not in memory.memory
+
+    store.fail = False
+    assert memory.get_user_profile(7)["name"] == "Анна"
+
+
+def test_new_user_profile_is_saved(tmp_path):
+    store = FlakyStore()
+    store.fail = False
+    memory = make_memory(tmp_path, store)
+
+    memory.remember_name(8, "Вера")
+    memory.flush()
+
+    assert store.saved[8]["name"] == "Вера"
@@ -0,0 +1,33 @@
+"""Предпочтения гостей: кеш файла и копии для вызывающих."""
+import pytest
+
+from ai import user_preferences
+
+
+@pytest.fixture(autouse=True)
+def preferences_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(user_preferences, "PREFERENCES_FILE", str(tmp_path / "prefs.json"))
+    monkeypatch.setattr(user_preferences, "_cache", {"mtime": None, "data": {}})
+
+
+def test_extracted_preferences_are_saved():
+    prefs = user_preferences.extract_preferences_from_text(1, "Люблю пиво и шашлык")
+
+    assert prefs["favorite_drinks"] == ["пиво"]
+    assert user_preferences.get_user_preferences(1)["favorite_food"] == ["мясо"]
+
+
+def test_callers_cannot_mutate_shared_cache():
+    user_preferences.extract_preferences_from_text(1, "Люблю вино")
+
+    user_preferences.get_user_preferences(1)["favorite_drinks"].append("абсент")
+    user_preferences.load_preferences()["1"]["dislikes"].append("всё")
+    user_preferences.extract_preferences_from_text(1, "как дела")["favorite_food"].append("торт")
+
+    assert user_preferences.get_user_preferences(1)["favorite_drinks"] == ["вино"]
+    assert user_preferences.get_user_preferences(1)["dislikes"] == []
+    assert user_preferences.get_user_preferences(1)["favorite_food"] == []
+
+    default = user_preferences.get_user_preferences(2)
+    default["favorite_drinks"].append("ром")
+    assert user_preferences.get_user_preferences(2)["favorite_drinks"] == []
@@ -0,0 +1,29 @@
+"""Вебхук: метрики очереди доступны только с секретом."""
+import pytest
+
+from core.webhook_server import SECRET_HEADER, create_webhook_app
+
+
+class StubDispatcher:
+    def submit(self, update, timeout=None):
+        return True
+
+    def get_stats(self):
+        return {'accepting': True, 'queued': 0}
+
+
+def make_client(secret):
+    return create_webhook_app(StubDispatcher(), '/webhook', secret).test_client()
+
+
+def test_stats_not_exposed_without_configured_secret():
+    assert make_client('').get('/webhook/stats').status_code == 404
+
+
+@pytest.mark.parametrize('header, status', [(None, 403), ('wrong', 403), ('s3cret', 200)])
+def test_stats_require_secret_header(header, status):
+    headers = {SECRET_HEADER: header} if header else {}
+    response = make_client('s3cret').get('/webhook/stats', headers=headers)
+    assert response.status_code == status
+    if status == 200:
+        assert response.get_json()['queued'] == 0
@@ -151,6 +151,15 @@ DELAYED_ENGAGEMENT_TEXT = (
     "Жми кнопку ниже 👇 регистрируй карту и получай бонусы!"
 )
 
+# === Предложение карты лояльности через 10 сек после погашения ===
+LOYALTY_OFFER_TEXT = (
+    "🎁 Погоди, это ещё не всё!\n\n"
+    "Евгенич — щедрая душа. Ловишь *500 рублей на карту лояльности* 💰\n\n"
+    "Копи бонусы с каждого визита, трать на напитки и еду — "
+    "как свои, только приятнее 🥃\n\n"
+    "Жми 👇 и забирай!"
+)
+
 # === Запрос данных iiko ===
 IIKO_DATA_REQUEST_TEXT = (
     "⚡ ЭЙ БЕДОЛАГА МЕНЕДЖЕР! 🎯\n\n"
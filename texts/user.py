@@ -3,22 +3,15 @@
 Тексты для пользователей.
 Загружаются из админ-панели (web/admin_config/texts.json)
 """
-from core.admin_config import get_texts
-
-# Кэшируем тексты
-_texts_cache = None
+from core.admin_config import get_texts, reload_config
 
 def get_user_texts():
-    """Получить все тексты пользователя"""
-    global _texts_cache
-    if _texts_cache is None:
-        _texts_cache = get_texts()
-    return _texts_cache
+    """Получить все тексты пользователя (снимок из памяти, правки панели подхватываются сами)"""
+    return get_texts()
 
 def reload_texts():
     """Перезагрузить тексты из конфига"""
-    global _texts_cache
-    _texts_cache = None
+    reload_config('texts.json')
     return get_user_texts()
 
 # Функции для быстрого доступа к текстам
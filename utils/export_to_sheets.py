@@ -1,12 +1,15 @@
 # export_to_sheets.py
 import sqlite3
+import time
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
 import json
 import logging
-from typing import Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 from datetime import datetime
 from core.config import GOOGLE_SHEET_KEY, GOOGLE_CREDENTIALS_JSON, DATABASE_PATH
+from core.sheets_writer import parse_start_row
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -59,175 +62,304 @@ COLUMN_CONFIG = {
     "staff_full_name": "Сотрудник (полное имя)"
 }
 
-def do_export() -> Tuple[bool, str]:
+# --- Потоковая выгрузка ---
+# Строк на один диапазон batch_update и на одну страницу чтения из базы
+EXPORT_CHUNK_ROWS = 500
+# Отметка и прогресс выгрузки в job_watermarks
+EXPORT_WATERMARK = 'sheets_export'
+EXPORT_PROGRESS = 'sheets_export_progress'
+
+EXPORT_PAGE_SQL = """
+    SELECT u.*,
+           CASE
+               WHEN u.source = 'staff' AND u.brought_by_staff_id IS NOT NULL
+               THEN 'Сотрудник: ' || s.short_name
+               ELSE u.source
+           END as display_source,
+           s.full_name as staff_full_name
+    FROM users u
+    LEFT JOIN staff s ON u.brought_by_staff_id = s.staff_id
+    WHERE (u.updated_at, u.user_id) > (?, ?)
+    ORDER BY u.updated_at, u.user_id
+    LIMIT ?
+"""
+
+def _open_worksheet():
+    """Открывает лист выгрузки (создаёт при отсутствии). Возвращает (worksheet, сообщение об ошибке)."""
+    success, creds_dict, error_msg = _parse_credentials_json(GOOGLE_CREDENTIALS_JSON)
+    if not success:
+        return None, f"Ошибка парсинга GOOGLE_CREDENTIALS_JSON: {error_msg}"
+    
+    creds = Credentials.from_service_account_info(
+        creds_dict,
+        scopes=['https://www.googleapis.com/auth/spreadsheets']
+    )
+    gc = gspread.authorize(creds)
+    spreadsheet = gc.open_by_key(GOOGLE_SHEET_KEY)
+    
+    # Попытка получить лист по названию
+    try:
+        return spreadsheet.worksheet(EXPORT_SHEET_NAME), ""
+    except gspread.exceptions.WorksheetNotFound:
+        # Лист не найден — логируем доступные и пробуем найти по нечувствительному к регистру
+        logging.warning(f"Лист '{EXPORT_SHEET_NAME}' не найден. Ищу среди доступных вкладок:")
+        for ws in spreadsheet.worksheets():
+            logging.warning(f"  - {ws.title} (id={ws.id})")
+            if ws.title.strip().lower() == EXPORT_SHEET_NAME.strip().lower():
+                logging.info(f"Найдена вкладка по нечувствительному к регистру: {ws.title}")
+                return ws, ""
+    
+    # Не найдена — попробуем создать
+    try:
+        logging.info(f"Пытаюсь создать вкладку '{EXPORT_SHEET_NAME}' автоматически.")
+        worksheet = spreadsheet.add_worksheet(title=EXPORT_SHEET_NAME, rows=200, cols=20)
+        logging.info(f"Вкладка '{EXPORT_SHEET_NAME}' успешно создана")
+        return worksheet, ""
+    except Exception as ce:
+        return None, f"Не удалось создать вкладку '{EXPORT_SHEET_NAME}': {ce}"
+
+def _format_row(user_row) -> List[Any]:
+    """Строка users → значения колонок листа в порядке COLUMN_CONFIG."""
+    ordered_row = []
+    for key in COLUMN_CONFIG:
+        value = user_row[key]
+        if key == 'profile_completed':
+            value = "Да" if value == 1 else "Нет"
+        if isinstance(value, str) and ('-' in value and ':' in value):
+            try:
+                value = datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                pass
+        ordered_row.append(value if value is not None else "")
+    return ordered_row
+
+def _iter_changed_users(conn, after_updated_at: str, after_user_id: int,
+                        page_size: int = EXPORT_CHUNK_ROWS) -> Iterator[List[Tuple[str, int, List[Any]]]]:
     """
-    Экспортирует данные из SQLite в Google Sheets.
-    Возвращает кортеж (успех: bool, сообщение: str).
+    Страницы строк, изменённых после (after_updated_at, after_user_id), по
+    возрастанию (updated_at, user_id): [(updated_at, user_id, значения колонок)].
+    Каждая страница — отдельный короткий запрос, база не держит чтение на время выгрузки.
+    """
+    while True:
+        rows = conn.execute(EXPORT_PAGE_SQL, (after_updated_at, after_user_id, page_size)).fetchall()
+        if not rows:
+            return
+        yield [(row['updated_at'] or '', row['user_id'], _format_row(row)) for row in rows]
+        after_updated_at, after_user_id = rows[-1]['updated_at'] or '', rows[-1]['user_id']
+        if len(rows) < page_size:
+            return
+
+def _with_retry(call, attempts: int = 5):
+    """Вызов Sheets API с повтором при 429 / 5xx (экспоненциальная пауза)."""
+    for attempt in range(attempts):
+        try:
+            return call()
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if attempt == attempts - 1 or not (status == 429 or (status or 0) >= 500):
+                raise
+            delay = 2 ** attempt
+            logging.warning(f"Sheets API ответил {status}, повтор через {delay} с.")
+            time.sleep(delay)
+
+class _SheetUpserter:
     """
-    logging.info(f"Начинаю экспорт данных в Google Sheets, лист '{EXPORT_SHEET_NAME}'...")
+    Пишет строки пользователей в лист: существующие — на место, новые — через
+    append_rows (номера строк берутся из ответа, как в core/sheets_writer).
+    Колонки ищутся по подписям в шапке, поэтому порядок колонок в листе
+    может отличаться от COLUMN_CONFIG; чужие колонки не трогаются.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        header = _with_retry(lambda: worksheet.row_values(1))
+        if not any(str(title).strip() for title in header):
+            header = list(COLUMN_CONFIG.values())
+            self._batch_update([{'range': rowcol_to_a1(1, 1) + ':' + rowcol_to_a1(1, len(header)),
+                                 'values': [header]}])
+        positions = {str(title).strip().lower(): col for col, title in reversed(list(enumerate(header, start=1)))}
+        self.columns = {key: positions[label.strip().lower()]
+                        for key, label in COLUMN_CONFIG.items() if label.strip().lower() in positions}
+        if 'user_id' not in self.columns:
+            raise ValueError(f"В листе '{worksheet.title}' нет колонки '{COLUMN_CONFIG['user_id']}' — "
+                             f"без неё все пользователи были бы добавлены повторно")
+        missing = [label for key, label in COLUMN_CONFIG.items() if key not in self.columns]
+        if missing:
+            logging.warning(f"В листе '{worksheet.title}' нет колонок {missing} — они не выгружаются")
+        self.width = max(self.columns.values())
+        self.last_column = rowcol_to_a1(1, self.width)[:-1]  # 'N1' → 'N'
+        self.row_by_user = {}
+        self._read_ids()
+        self.updated = 0
+        self.appended = 0
+
+    def _read_ids(self):
+        ids = _with_retry(lambda: self.worksheet.col_values(self.columns['user_id']))
+        self.row_by_user = {}
+        for row_number, value in enumerate(ids, start=1):
+            try:
+                self.row_by_user.setdefault(int(value), row_number)
+            except (TypeError, ValueError):
+                pass  # заголовок и пустые ячейки
+
+    def _layout(self, values: List[Any]) -> List[Any]:
+        """Значения в порядке колонок листа; None — ячейка не меняется (чужая колонка)."""
+        row = [None] * self.width
+        for key, value in zip(COLUMN_CONFIG, values):
+            col = self.columns.get(key)
+            if col:
+                row[col - 1] = value
+        return row
+
+    def upsert(self, rows: List[Tuple[int, List[Any]]]):
+        """Существующие строки — одним batch_update, новые — одним append_rows."""
+        data, new_rows = [], []
+        for user_id, values in rows:
+            row_number = self.row_by_user.get(user_id)
+            if row_number:
+                data.append({'range': f"A{row_number}:{self.last_column}{row_number}",
+                             'values': [self._layout(values)]})
+            else:
+                new_rows.append((user_id, values))
+        if data:
+            self._batch_update(data)
+        if new_rows:
+            self._append(new_rows)
+        self.updated += len(data)
+
+    def _append(self, new_rows: List[Tuple[int, List[Any]]], attempts: int = 5):
+        """
+        Дописывает строки в конец таблицы. Лист одновременно дописывают другие
+        (фоновый писатель другого процесса), поэтому номера строк — только из
+        ответа API. Перед повтором после ошибки ID перечитываются: запрос мог
+        пройти, и строки не должны задвоиться.
+        """
+        for attempt in range(attempts):
+            try:
+                response = self.worksheet.append_rows([self._layout(values) for _, values in new_rows],
+                                                      value_input_option='USER_ENTERED')
+                break
+            except gspread.exceptions.APIError as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if attempt == attempts - 1 or not (status == 429 or (status or 0) >= 500):
+                    raise
+                delay = 2 ** attempt
+                logging.warning(f"Sheets API ответил {status}, повтор добавления через {delay} с.")
+                time.sleep(delay)
+                self._read_ids()
+                new_rows = [(user_id, values) for user_id, values in new_rows if user_id not in self.row_by_user]
+                if not new_rows:
+                    return
+        start_row = parse_start_row(response)
+        if start_row:
+            for offset, (user_id, _) in enumerate(new_rows):
+                self.row_by_user[user_id] = start_row + offset
+        else:
+            self._read_ids()
+        self.appended += len(new_rows)
+
+    def _batch_update(self, data):
+        _with_retry(lambda: self.worksheet.batch_update(data, value_input_option='USER_ENTERED'))
+
+def _export_pages(conn, progress: Dict[str, Any]):
+    """Пишет изменённые строки в лист. Возвращает (успех, сообщение, upserter, выгружено строк)."""
+    from core import database
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT u.*, 
-                   CASE 
-                       WHEN u.source = 'staff' AND u.brought_by_staff_id IS NOT NULL 
-                       THEN 'Сотрудник: ' || s.short_name
-                       ELSE u.source 
-                   END as display_source,
-                   s.full_name as staff_full_name
-            FROM users u
-            LEFT JOIN staff s ON u.brought_by_staff_id = s.staff_id
-            ORDER BY u.signup_date DESC
-        """)
-        users = cur.fetchall()
-        conn.close()
-        if not users:
-            msg = "В базе данных нет пользователей для экспорта."
-            logging.info(msg)
-            return True, msg
-        logging.info(f"Получено {len(users)} пользователей из SQLite.")
+        worksheet, error_msg = _open_worksheet()
+        if worksheet is None:
+            logging.error(error_msg)
+            conn.close()
+            return False, error_msg, None, 0
+        upserter = _SheetUpserter(worksheet)
+        logging.info("Успешное подключение к Google Sheets.")
     except Exception as e:
-        msg = f"Не удалось получить данные из SQLite: {e}"
+        conn.close()
+        msg = f"Не удалось подключиться к Google Sheets: {e}"
         logging.error(msg)
-        return False, msg
+        return False, msg, None, 0
 
+    exported = 0
     try:
-        success, creds_dict, error_msg = _parse_credentials_json(GOOGLE_CREDENTIALS_JSON)
-        if not success:
-            msg = f"Ошибка парсинга GOOGLE_CREDENTIALS_JSON: {error_msg}"
-            logging.error(msg)
-            return False, msg
-        
-        creds = Credentials.from_service_account_info(
-            creds_dict,
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
-        )
-        gc = gspread.authorize(creds)
-        spreadsheet = gc.open_by_key(GOOGLE_SHEET_KEY)
-        
-        # Попытка получить лист по названию
-        try:
-            worksheet = spreadsheet.worksheet(EXPORT_SHEET_NAME)
-        except gspread.exceptions.WorksheetNotFound:
-            # Лист не найден — логируем доступные и пробуем найти по нечувствительному к регистру
-            logging.warning(f"Лист '{EXPORT_SHEET_NAME}' не найден. Ищу среди доступных вкладок:")
-            worksheet = None
-            for ws in spreadsheet.worksheets():
-                logging.warning(f"  - {ws.title} (id={ws.id})")
-                # Попробуем найти по нечувствительному к регистру совпадению
-                if ws.title.strip().lower() == EXPORT_SHEET_NAME.strip().lower():
-                    logging.info(f"Найдена вкладка по нечувствительному к регистру: {ws.title}")
-                    worksheet = ws
-                    break
-            
-            if not worksheet:
-                # Не найдена — попробуем создать
-                try:
-                    logging.info(f"Пытаюсь создать вкладку '{EXPORT_SHEET_NAME}' автоматически.")
-                    worksheet = spreadsheet.add_worksheet(title=EXPORT_SHEET_NAME, rows=200, cols=20)
-                    logging.info(f"Вкладка '{EXPORT_SHEET_NAME}' успешно создана")
-                except Exception as ce:
-                    msg = f"Не удалось создать вкладку '{EXPORT_SHEET_NAME}': {ce}"
-                    logging.error(msg)
-                    return False, msg
-        
-        logging.info("Успешное подключение к Google Sheets.")
+        for page in _iter_changed_users(conn, progress['updated_at'], progress['user_id']):
+            upserter.upsert([(user_id, values) for _, user_id, values in page])
+            exported += len(page)
+            progress['updated_at'], progress['user_id'] = page[-1][0], page[-1][1]
+            database.set_job_watermark(EXPORT_PROGRESS, progress)
     except Exception as e:
-        msg = f"Не удалось подключиться к Google Sheets: {e}"
+        msg = (f"Ошибка при выгрузке данных в Google Sheets: {e}. Выгружено {exported} строк, "
+               f"следующий запуск продолжит с места остановки.")
         logging.error(msg)
-        return False, msg
+        return False, msg, upserter, exported
+    finally:
+        conn.close()
+    return True, "", upserter, exported
+
+def do_export(full: bool = False) -> Tuple[bool, str]:
+    """
+    Выгружает пользователей из SQLite в Google Sheets потоково.
+
+    Читает users страницами по EXPORT_CHUNK_ROWS в порядке (updated_at, user_id)
+    и пишет каждую страницу: строки, которые уже есть в листе (по колонке
+    «ID Пользователя»), обновляются на месте одним batch_update, новые
+    дописываются одним append_rows. Фоновый писатель бота
+    (core/sheets_writer.py) на это время приостановлен, после выгрузки он
+    перестраивает индекс строк.
+
+    По умолчанию выгрузка инкрементальная: только строки, изменённые после
+    прошлой успешной выгрузки (отметка в job_watermarks). full=True —
+    все пользователи. Прогресс сохраняется после каждой страницы, и
+    прерванная выгрузка продолжается с места остановки.
+    Возвращает кортеж (успех: bool, сообщение: str).
+    """
+    from core import database
+
+    started = time.monotonic()
+    progress = database.get_job_watermark(EXPORT_PROGRESS)
+    if progress and (progress.get('full') or not full):
+        logging.info(f"Продолжаю прерванную выгрузку в '{EXPORT_SHEET_NAME}' с user_id {progress['user_id']}...")
+    else:
+        watermark = None if full else database.get_job_watermark(EXPORT_WATERMARK)
+        progress = {
+            'full': full,
+            'updated_at': (watermark or {}).get('updated_at', ''),
+            'user_id': 0,
+            'started_at': None,
+        }
+        logging.info(f"Начинаю {'полную' if full else 'инкрементальную'} выгрузку в Google Sheets, "
+                     f"лист '{EXPORT_SHEET_NAME}'...")
 
     try:
-        # Не очищаем существующие строки — будем дописывать только новые записи
-        header_row = list(COLUMN_CONFIG.values())
-        column_order_keys = list(COLUMN_CONFIG.keys())
-
-        # Получим текущие значения листа, чтобы не затирать старые
-        existing_values = worksheet.get_all_values()
-
-        # Если лист пустой или нет заголовка — запишем заголовок и все строки
-        if not existing_values or len(existing_values) == 0:
-            logging.info("Лист пустой — записываю заголовок и все строки.")
-            data_to_upload = [header_row]
-            for user_row in users:
-                ordered_row = []
-                for key in column_order_keys:
-                    value = user_row[key]
-                    if key == 'profile_completed':
-                        value = "Да" if value == 1 else "Нет"
-                    if isinstance(value, str) and ('-' in value and ':' in value):
-                        try:
-                            value = datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
-                        except ValueError:
-                            pass
-                    ordered_row.append(value)
-                data_to_upload.append(ordered_row)
-            worksheet.update(data_to_upload, 'A1')
-            msg = f"УСПЕХ! Данные ({len(data_to_upload)} строк) успешно выгружены."
-            logging.info(msg)
-            return True, msg
-
-        # Есть данные — определим индекс столбца с ID Пользователя и соберём существующие id
-        header_vals = existing_values[0]
-        header_lower = [h.strip().lower() for h in header_vals]
-        id_col_label = COLUMN_CONFIG.get('user_id', 'ID Пользователя')
-        id_col_label_lower = id_col_label.strip().lower()
-        try:
-            id_col_index = header_lower.index(id_col_label_lower)
-        except ValueError:
-            id_col_index = None
-
-        existing_ids = set()
-        if id_col_index is not None:
-            for row in existing_values[1:]:
-                if len(row) > id_col_index and row[id_col_index].strip():
-                    try:
-                        existing_ids.add(int(row[id_col_index]))
-                    except Exception:
-                        pass
-
-        # Подготовим только новые строки (которые ещё не в листе)
-        new_rows = []
-        for user_row in users:
-            uid = user_row['user_id']
-            if uid in existing_ids:
-                continue
-            ordered_row = []
-            for key in column_order_keys:
-                value = user_row[key]
-                if key == 'profile_completed':
-                    value = "Да" if value == 1 else "Нет"
-                if isinstance(value, str) and ('-' in value and ':' in value):
-                    try:
-                        value = datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        pass
-                ordered_row.append(value)
-            new_rows.append(ordered_row)
-
-        if not new_rows:
-            msg = "Нет новых пользователей для добавления — экспорт пропущен."
-            logging.info(msg)
-            return True, msg
-
-        # Дописываем новые строки в конец листа
-        try:
-            worksheet.append_rows(new_rows, value_input_option='USER_ENTERED')
-        except TypeError:
-            # Старые версии gspread могут не поддерживать value_input_option
-            worksheet.append_rows(new_rows)
-
-        msg = f"УСПЕХ! Добавлено {len(new_rows)} новых строк."
-        logging.info(msg)
-        return True, msg
+        conn = sqlite3.connect(DB_FILE)
+        conn.row_factory = sqlite3.Row
+        if not progress['started_at']:
+            # Отметка следующей выгрузки — время базы на старте: изменения во время
+            # выгрузки попадут в следующую
+            progress['started_at'] = conn.execute("SELECT strftime('%Y-%m-%d %H:%M:%f', 'now')").fetchone()[0]
     except Exception as e:
-        msg = f"Ошибка при выгрузке данных в Google Sheets: {e}"
+        msg = f"Не удалось подключиться к SQLite: {e}"
         logging.error(msg)
         return False, msg
 
+    with database.pause_sheets_writer():
+        ok, msg, upserter, exported = _export_pages(conn, progress)
+    if not ok:
+        return False, msg
+
+    database.set_job_watermark(EXPORT_WATERMARK, {'updated_at': progress['started_at']})
+    database.set_job_watermark(EXPORT_PROGRESS, {})
+    elapsed = time.monotonic() - started
+    if not exported:
+        msg = "Нет изменённых пользователей — выгрузка не потребовалась."
+    else:
+        msg = (f"УСПЕХ! Обновлено {upserter.updated}, добавлено {upserter.appended} строк "
+               f"за {elapsed:.1f} с ({exported / max(elapsed, 0.001):.0f} строк/с).")
+    logging.info(msg)
+    return True, msg
+
 if __name__ == '__main__':
-    success, message = do_export()
+    import sys
+    from core import database
+    database.init_db()
+    success, message = do_export(full='--full' in sys.argv)
     print(message)
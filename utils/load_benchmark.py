@@ -0,0 +1,638 @@
+# load_benchmark.py
+"""
+Нагрузочный стенд: прогоняет синтетические обновления Telegram через
+настоящие обработчики бота (main.register_handlers) и UpdateDispatcher.
+
+Сеть подменяется:
+- Telegram Bot API — FakeTelegram (apihelper.CUSTOM_REQUEST_SENDER) с
+  настраиваемой задержкой ответа; getChatMember всегда отвечает «member»;
+- OpenAI — StubOpenAIServer, локальный HTTP-сервер /v1/chat/completions
+  (клиент направляется на него через OPENAI_BASE_URL).
+
+Сценарии пользователей (доли задаются --mix):
+- coupon  — /start (с кодом сотрудника w_<код>, рефералом ref_<id> или без),
+  кнопка «получить настойку», контакт, имя, дата рождения,
+  check_subscription, redeem_reward;
+- booking — /start booking, имя, телефон, дата, время, гости, бар, подтверждение;
+- ai      — /start и несколько вопросов нейросети.
+
+Отчёт: пропускная способность, p50/p95/p99 задержки по шагам сценариев
+(от постановки в очередь до конца обработки) и по функциям-обработчикам,
+доля времени обработчиков в БД (функции core.database) и в Bot API,
+число потоков процесса.
+
+Бот пишет в базу, поэтому стенд работает только со своей временной
+SQLite-базой, а PostgreSQL — только явно указанной (тестовой!) через
+--database-url; .env при этом не читается для БД.
+
+    python -m utils.load_benchmark --users 200
+    python -m utils.load_benchmark --db postgres --database-url postgresql://bench@localhost/bench_db
+    python -m utils.load_benchmark --users 500 --workers 1      # как long polling
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Tuple
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Евгенич", "username": "evgenich_bench_bot"}
+FIRST_USER_ID = 7_000_000_000
+STAFF_COUNT = 5
+
+AI_QUESTIONS = (
+    "Привет! Во сколько вы сегодня открываетесь?",
+    "Какую настойку посоветуешь к мясу?",
+    "Есть ли у вас караоке по пятницам?",
+    "Сколько стоит бронь стола на компанию из 6 человек?",
+    "Расскажи что-нибудь интересное про бар",
+)
+FIRST_NAMES = ("Иван", "Мария", "Алексей", "Ольга", "Дмитрий", "Анна", "Сергей", "Екатерина")
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Перцентиль по методу ближайшего ранга; sorted_values отсортирован."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class _Accounting:
+    """Общие счётчики стенда: времена обработчиков, БД и Bot API внутри обработчиков."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.by_step: Dict[str, List[float]] = defaultdict(list)
+        self.failed_by_step: Dict[str, int] = defaultdict(int)
+        self.by_handler: Dict[str, List[float]] = defaultdict(list)
+        self.handler_total = 0.0
+        self.db_total = 0.0
+        self.db_calls = 0
+        self.api_total = 0.0
+
+    def in_handler(self) -> bool:
+        return getattr(self.local, 'handler_depth', 0) > 0
+
+
+class _ErrorCounter(logging.Handler):
+    """Считает записи лога уровня ERROR и выше (по шаблону сообщения)."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.messages: Dict[str, int] = defaultdict(int)
+
+    def emit(self, record):
+        message = re.sub(r'\d+', 'N', record.getMessage())[:100]
+        self.messages[message] += 1
+
+
+class FakeTelegram:
+    """Подменяет HTTP-запросы pyTelegramBotAPI: задержка + правдоподобный ответ."""
+
+    def __init__(self, accounting: _Accounting, latency: float = 0.05, jitter: float = 0.5):
+        self.accounting = accounting
+        self.latency = latency
+        self.jitter = jitter
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def __call__(self, method, request_url, params=None, files=None, timeout=None, proxies=None):
+        api_method = request_url.rsplit('/', 1)[-1]
+        params = params or {}
+        started = time.perf_counter()
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        with self._lock:
+            self.calls[api_method] += 1
+            self._message_id += 1
+            message_id = self._message_id
+        if self.accounting.in_handler():
+            with self.accounting.lock:
+                self.accounting.api_total += time.perf_counter() - started
+        return _FakeResponse({"ok": True, "result": self._result(api_method, params, message_id)})
+
+    @staticmethod
+    def _result(api_method: str, params: Dict[str, Any], message_id: int) -> Any:
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method == 'getChatMember':
+            user_id = int(params.get('user_id') or 0)
+            return {"user": {"id": user_id, "is_bot": False, "first_name": "Гость"}, "status": "member"}
+        if api_method.startswith('send') and api_method != 'sendChatAction' or api_method == 'copyMessage':
+            chat_id = params.get('chat_id')
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                chat_id = -1
+            return {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                    "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                    "text": str(params.get('text', ''))[:64]}
+        return True
+
+
+class _FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, payload: Dict[str, Any]):
+        self._payload = payload
+        self.text = json.dumps(payload, ensure_ascii=False)
+
+    def json(self):
+        return self._payload
+
+
+class StubOpenAIServer:
+    """Минимальный OpenAI-совместимый сервер: отвечает на chat/completions после задержки."""
+
+    def __init__(self, latency: float = 1.2, jitter: float = 0.5, host: str = '127.0.0.1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    request = {}
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency > 0:
+                    time.sleep(stub.latency * random.uniform(1 - stub.jitter, 1 + stub.jitter))
+                prompt_tokens = sum(len(str(m.get('content', ''))) for m in request.get('messages', [])) // 4
+                body = json.dumps({
+                    "id": f"chatcmpl-bench-{stub.requests}", "object": "chat.completion",
+                    "created": int(time.time()), "model": request.get('model', 'gpt-4o-mini'),
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                        "role": "assistant",
+                        "content": "Заглядывай к нам вечером — нальём настойку и подберём столик!"}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20,
+                              "total_tokens": prompt_tokens + 20},
+                }, ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-openai', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class ThreadSampler:
+    """Периодически замеряет число потоков процесса."""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.samples: List[int] = []
+        self.peak_names: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-thread-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            threads = threading.enumerate()
+            if not self.samples or len(threads) > max(self.samples):
+                self.peak_names = thread_groups(threads)
+            self.samples.append(len(threads))
+
+
+def thread_groups(threads) -> Dict[str, int]:
+    """Потоки по именам без номеров: {'Thread-(_run)': 12, 'updates-worker': 8, ...}."""
+    groups: Dict[str, int] = defaultdict(int)
+    for t in threads:
+        groups[re.sub(r'[-_]?\d+', '', t.name)] += 1
+    return dict(sorted(groups.items(), key=lambda item: -item[1]))
+
+
+# --- Синтетические обновления ---
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_id = 0
+        self._message_id = 0
+        self.steps: Dict[int, str] = {}
+
+    def _next_ids(self) -> Tuple[int, int]:
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(user_id: int, first_name: str) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": first_name,
+                "username": f"bench{user_id}", "language_code": "ru"}
+
+    def message(self, step: str, user_id: int, first_name: str, text: str = None,
+                contact: Dict[str, Any] = None) -> Dict[str, Any]:
+        update_id, message_id = self._next_ids()
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private", "first_name": first_name},
+                   "from": self._user(user_id, first_name)}
+        if contact is not None:
+            message["contact"] = contact
+        else:
+            message["text"] = text
+            if text.startswith('/'):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split(' ')[0])}]
+        self.steps[update_id] = step
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, step: str, user_id: int, first_name: str, data: str) -> Dict[str, Any]:
+        update_id, message_id = self._next_ids()
+        self.steps[update_id] = step
+        return {"update_id": update_id, "callback_query": {
+            "id": f"cb{update_id}", "chat_instance": str(user_id), "data": data,
+            "from": self._user(user_id, first_name),
+            "message": {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                        "chat": {"id": user_id, "type": "private"}, "text": "…"},
+        }}
+
+
+def coupon_scenario(f: UpdateFactory, user_id: int, name: str, payload: str) -> Iterator[Dict[str, Any]]:
+    kind = payload.split('_', 1)[0] if payload else 'plain'
+    yield f.message(f"coupon:/start {kind}", user_id, name, f"/start {payload}".strip())
+    yield f.message("coupon:gift_button", user_id, name, "🥃 Получить настойку по талону")
+    yield f.message("coupon:contact", user_id, name, contact={
+        "phone_number": f"+7999{user_id % 10_000_000:07d}", "first_name": name, "user_id": user_id})
+    yield f.message("coupon:name", user_id, name, name)
+    yield f.message("coupon:birth_date", user_id, name, "15.05.1990")
+    yield f.callback("coupon:check_subscription", user_id, name, "check_subscription")
+    yield f.callback("coupon:redeem_reward", user_id, name, "redeem_reward")
+
+
+def booking_scenario(f: UpdateFactory, user_id: int, name: str, bar_callback: str) -> Iterator[Dict[str, Any]]:
+    yield f.message("booking:/start booking", user_id, name, "/start booking")
+    yield f.message("booking:name", user_id, name, name)
+    yield f.message("booking:phone", user_id, name, "89991234567")
+    yield f.message("booking:date", user_id, name, "завтра")
+    yield f.message("booking:time", user_id, name, "19:30")
+    yield f.message("booking:guests", user_id, name, "4")
+    yield f.callback("booking:bar", user_id, name, bar_callback)
+    yield f.callback("booking:confirm", user_id, name, "confirm_booking")
+
+
+def ai_scenario(f: UpdateFactory, user_id: int, name: str, questions: int) -> Iterator[Dict[str, Any]]:
+    yield f.message("ai:/start", user_id, name, "/start")
+    for _ in range(questions):
+        yield f.message("ai:question", user_id, name, random.choice(AI_QUESTIONS))
+
+
+def build_workload(factory: UpdateFactory, users: int, mix: Dict[str, float], staff_codes: List[str],
+                   bar_callback: str, ai_questions: int, concurrency: int) -> List[Dict[str, Any]]:
+    """
+    Последовательность обновлений: одновременно «активны» concurrency
+    пользователей, их шаги перемежаются (как в реальном потоке обновлений).
+    """
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    coupon_users: List[int] = []
+    scenarios = []
+    for n in range(users):
+        user_id = FIRST_USER_ID + n
+        name = random.choice(FIRST_NAMES)
+        kind = random.choices(kinds, weights)[0]
+        if kind == 'coupon':
+            roll = random.random()
+            if roll < 0.3 and staff_codes:
+                payload = f"w_{random.choice(staff_codes)}"
+            elif roll < 0.6 and coupon_users:
+                payload = f"ref_{random.choice(coupon_users)}"
+            else:
+                payload = ''
+            coupon_users.append(user_id)
+            scenarios.append(coupon_scenario(factory, user_id, name, payload))
+        elif kind == 'booking':
+            scenarios.append(booking_scenario(factory, user_id, name, bar_callback))
+        else:
+            scenarios.append(ai_scenario(factory, user_id, name, ai_questions))
+
+    workload: List[Dict[str, Any]] = []
+    pending = iter(scenarios)
+    active = [s for s in (next(pending, None) for _ in range(max(1, concurrency))) if s is not None]
+    while active:
+        still_active = []
+        for scenario in active:
+            update = next(scenario, None)
+            if update is None:
+                replacement = next(pending, None)
+                if replacement is not None:
+                    still_active.append(replacement)
+                continue
+            workload.append(update)
+            still_active.append(scenario)
+        active = still_active
+    return workload
+
+
+# --- Инструментирование ---
+
+def instrument_handlers(bot, accounting: _Accounting):
+    """Оборачивает функции всех зарегистрированных обработчиков замером времени."""
+    handler_lists = [value for name, value in vars(bot).items()
+                     if name.endswith('_handlers') and isinstance(value, list)]
+    for handlers in handler_lists:
+        for handler in handlers:
+            if isinstance(handler, dict) and callable(handler.get('function')):
+                handler['function'] = _timed_handler(handler['function'], accounting)
+
+
+def _timed_handler(func, accounting: _Accounting):
+    name = getattr(func, '__name__', repr(func))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        local = accounting.local
+        local.handler_depth = getattr(local, 'handler_depth', 0) + 1
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            local.handler_depth -= 1
+            if local.handler_depth == 0:
+                with accounting.lock:
+                    accounting.by_handler[name].append(elapsed)
+                    accounting.handler_total += elapsed
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def instrument_database(database_module, accounting: _Accounting):
+    """
+    Замер времени публичных функций core.database. Вложенные вызовы
+    (функция БД вызывает другую) не считаются повторно. Обработчики,
+    импортировавшие функцию по имени (from core.database import ...), не учитываются.
+    """
+    import inspect
+
+    for name, func in list(vars(database_module).items()):
+        if name.startswith('_') or not inspect.isfunction(func) or func.__module__ != database_module.__name__:
+            continue
+        setattr(database_module, name, _timed_db_call(func, accounting))
+
+
+def _timed_db_call(func, accounting: _Accounting):
+    def wrapper(*args, **kwargs):
+        local = accounting.local
+        depth = getattr(local, 'db_depth', 0)
+        local.db_depth = depth + 1
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.db_depth = depth
+            if depth == 0 and accounting.in_handler():
+                with accounting.lock:
+                    accounting.db_total += time.perf_counter() - started
+                    accounting.db_calls += 1
+
+    wrapper.__name__ = func.__name__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def instrument_updates(bot, factory: UpdateFactory, accounting: _Accounting, submitted: Dict[int, float]):
+    """Замер от постановки обновления в очередь до конца его обработки — по шагам сценариев."""
+    process = bot.process_new_updates
+
+    def wrapper(updates):
+        failed = False
+        try:
+            return process(updates)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            done = time.perf_counter()
+            with accounting.lock:
+                for update in updates:
+                    step = factory.steps.get(update.update_id, 'other')
+                    accounting.by_step[step].append(done - submitted.get(update.update_id, done))
+                    if failed:
+                        accounting.failed_by_step[step] += 1
+
+    bot.process_new_updates = wrapper
+
+
+# --- Запуск ---
+
+def _prepare_environment(args, openai_base_url: str, workdir: str):
+    """Переменные окружения до импорта core.config: свои БД, без Google Sheets и внешних сервисов."""
+    env = {
+        'BOT_TOKEN': '100000:BENCHMARK', 'BOT_MODE': 'polling', 'CHANNEL_ID': '@evgenich_bench',
+        'CHANNEL_ID_MSK': '@evgenich_bench_msk', 'ADMIN_IDS': '1', 'BOSS_ID': '1', 'SMM_IDS': '',
+        'REPORT_CHAT_ID': '-1001', 'NASTOYKA_NOTIFICATIONS_CHAT_ID': '-1002',
+        'HELLO_STICKER_ID': 'bench', 'NASTOYKA_STICKER_ID': 'bench', 'THANK_YOU_STICKER_ID': 'bench',
+        'FRIEND_BONUS_STICKER_ID': 'bench',
+        'GOOGLE_SHEET_KEY': '', 'GOOGLE_SHEET_KEY_SECONDARY': '', 'GOOGLE_CREDENTIALS_JSON': '',
+        'GMB_API_KEY': '', 'GMB_SPASIBO_BOT_TOKEN': '',
+        'OPENAI_API_KEY': 'sk-bench', 'OPENAI_BASE_URL': openai_base_url,
+        'DATABASE_PATH': os.path.join(workdir, 'bench.db'),
+        'UPDATE_WORKERS': str(args.workers), 'UPDATE_QUEUE_SIZE': str(args.queue_size),
+    }
+    if args.db == 'postgres':
+        env.update({'USE_POSTGRES': 'true', 'DATABASE_URL': args.database_url})
+    else:
+        env.update({'USE_POSTGRES': 'false', 'DATABASE_URL': ''})
+    os.environ.update(env)
+
+
+def run(args) -> Dict[str, Any]:
+    random.seed(args.seed)
+    # Без --verbose логи бота не печатаются, но ошибки считаются для отчёта
+    log_errors = _ErrorCounter()
+    root = logging.getLogger()
+    root.addHandler(log_errors)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    else:
+        root.setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='evgenich-bench-')
+    stub = StubOpenAIServer(latency=args.ai_latency)
+    stub.start()
+    _prepare_environment(args, stub.base_url, workdir)
+
+    accounting = _Accounting()
+    telegram = FakeTelegram(accounting, latency=args.tg_latency)
+
+    import telebot
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram
+    # Обработчики и модули пишут относительные пути (logs/, data/) — держим их во временном каталоге
+    os.chdir(workdir)
+
+    import main
+    from core import database
+    from core.admin_config import get_bars
+    from core.update_dispatcher import UpdateDispatcher
+
+    database.init_db()
+    staff_codes = [code for code in (
+        database.add_or_update_staff(900_000 + n, f"{FIRST_NAMES[n % len(FIRST_NAMES)]} Бенчмарков", "Официант")
+        for n in range(STAFF_COUNT)) if code]
+    bars = get_bars()
+    bar_callback = bars[0].get('callback_id', 'bar_unknown') if bars else 'bar_unknown'
+
+    main.register_handlers()
+    instrument_handlers(main.bot, accounting)
+    instrument_database(database, accounting)
+
+    factory = UpdateFactory()
+    mix = {'coupon': args.mix[0], 'booking': args.mix[1], 'ai': args.mix[2]}
+    workload = build_workload(factory, args.users, mix, staff_codes, bar_callback,
+                              args.ai_questions, args.concurrency)
+    submitted: Dict[int, float] = {}
+    instrument_updates(main.bot, factory, accounting, submitted)
+
+    from telebot import types
+    updates = [types.Update.de_json(raw) for raw in workload]
+
+    dispatcher = UpdateDispatcher(main.bot, workers=args.workers, queue_size=args.queue_size,
+                                  on_submit=main.supersede_ai_request)
+    sampler = ThreadSampler()
+    threads_before = threading.active_count()
+    sampler.start()
+    dispatcher.start()
+
+    started = time.perf_counter()
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    rejected = 0
+    for n, update in enumerate(updates):
+        if interval:
+            delay = started + n * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        submitted[update.update_id] = time.perf_counter()
+        if not dispatcher.submit(update, timeout=60):
+            rejected += 1
+    dispatcher.stop(drain_timeout=args.drain_timeout)
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+    threads_after = threading.enumerate()
+    stub.stop()
+
+    stats = dispatcher.get_stats()
+    return {
+        'db': args.db, 'users': args.users, 'updates': len(updates), 'rejected': rejected,
+        'workers': args.workers, 'elapsed': elapsed, 'dispatcher': stats,
+        'accounting': accounting, 'telegram_calls': dict(telegram.calls), 'ai_requests': stub.requests,
+        'log_errors': dict(log_errors.messages),
+        'threads': {'before': threads_before, 'peak': max(sampler.samples or [threads_before]),
+                    'after': len(threads_after), 'peak_groups': sampler.peak_names},
+    }
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    acc: _Accounting = result['accounting']
+    processed = result['dispatcher']['processed'] + result['dispatcher']['failed']
+    lines = [
+        f"БД: {result['db']}, пользователей: {result['users']}, обновлений: {result['updates']}, "
+        f"воркеров: {result['workers']}",
+        f"Время: {result['elapsed']:.1f}s, пропускная способность: {processed / max(result['elapsed'], 1e-9):.1f} обн/с, "
+        f"ошибок: {result['dispatcher']['failed']}, отказов очереди: {result['rejected']}",
+        "",
+    ]
+
+    def table(title: str, data: Dict[str, List[float]], failed: Dict[str, int] = None):
+        lines.append(f"{title:<34} {'n':>6} {'p50,ms':>9} {'p95,ms':>9} {'p99,ms':>9} {'max,ms':>9}"
+                     + (f" {'err':>5}" if failed is not None else ""))
+        for key in sorted(data):
+            values = sorted(data[key])
+            row = (f"{key[:34]:<34} {len(values):>6} {percentile(values, 50) * 1000:>9.1f} "
+                   f"{percentile(values, 95) * 1000:>9.1f} {percentile(values, 99) * 1000:>9.1f} "
+                   f"{values[-1] * 1000:>9.1f}")
+            if failed is not None:
+                row += f" {failed.get(key, 0):>5}"
+            lines.append(row)
+        lines.append("")
+
+    table("Шаг сценария (очередь + обработка)", acc.by_step, acc.failed_by_step)
+    table("Обработчик (только обработка)", acc.by_handler)
+
+    handler_total = max(acc.handler_total, 1e-9)
+    lines.append(f"Время в обработчиках: {acc.handler_total:.2f}s; из них БД: {acc.db_total:.2f}s "
+                 f"({acc.db_total / handler_total:.1%}, {acc.db_calls} вызовов), "
+                 f"Bot API: {acc.api_total:.2f}s ({acc.api_total / handler_total:.1%})")
+    lines.append(f"Запросов к Bot API: {sum(result['telegram_calls'].values())} "
+                 f"({', '.join(f'{k}={v}' for k, v in sorted(result['telegram_calls'].items(), key=lambda i: -i[1])[:6])}); "
+                 f"к OpenAI: {result['ai_requests']}")
+    threads = result['threads']
+    lines.append(f"Потоки: до {threads['before']}, пик {threads['peak']}, после {threads['after']}; "
+                 f"в пике: {', '.join(f'{k}={v}' for k, v in list(threads['peak_groups'].items())[:6])}")
+    if result['log_errors']:
+        lines.append(f"Ошибки в логе ({sum(result['log_errors'].values())}):")
+        for message, count in sorted(result['log_errors'].items(), key=lambda item: -item[1])[:10]:
+            lines.append(f"  {count:>5} × {message}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд обработчиков бота")
+    parser.add_argument('--db', choices=('sqlite', 'postgres'), default='sqlite')
+    parser.add_argument('--database-url', help="тестовая база PostgreSQL (обязательно для --db postgres)")
+    parser.add_argument('--users', type=int, default=200, help="синтетических пользователей")
+    parser.add_argument('--mix', type=float, nargs=3, default=(0.5, 0.2, 0.3),
+                        metavar=('COUPON', 'BOOKING', 'AI'), help="доли сценариев")
+    parser.add_argument('--ai-questions', type=int, default=2, help="вопросов нейросети в сценарии ai")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременно активных пользователей")
+    parser.add_argument('--rate', type=float, default=0.0, help="обновлений в секунду (0 — без ограничения)")
+    parser.add_argument('--workers', type=int, default=8, help="воркеров UpdateDispatcher (1 — как long polling)")
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--tg-latency', type=float, default=0.05, help="задержка ответа Bot API, сек")
+    parser.add_argument('--ai-latency', type=float, default=1.2, help="задержка ответа OpenAI, сек")
+    parser.add_argument('--drain-timeout', type=float, default=300.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help="логи бота уровня INFO")
+    args = parser.parse_args(argv)
+    if args.db == 'postgres' and not args.database_url:
+        parser.error("--db postgres требует --database-url (тестовая база: стенд пишет в неё пользователей)")
+    return args
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    print(format_report(run(parse_args())))
+    # Фоновые потоки (пулы соединений, планировщики) не должны задерживать выход
+    os._exit(0)
@@ -0,0 +1,199 @@
+# micro_benchmarks.py
+"""
+Микробенчмарки отдельных компонентов: старый путь против нового на
+синтетических данных. Сквозная нагрузка на обработчики — utils/load_benchmark.py.
+
+- delivery-log  — построчная запись лога рассылки и отметки заблокировавших
+  против буферизованной (core.delivery_logger);
+- knowledge     — поиск по базе знаний перебором строк против BM25-индекса
+  (ai.knowledge_index);
+- prompt        — сборка промпта PromptBuilder с бюджетом токенов;
+- user-context  — запросы к БД на одно сообщение AI: по отдельности против
+  снимка контекста (ai.user_context).
+
+Стенд работает только со своей временной SQLite-базой; Google Sheets отключены.
+
+    python -m utils.micro_benchmarks delivery-log --count 20000
+    python -m utils.micro_benchmarks knowledge
+    python -m utils.micro_benchmarks prompt
+    python -m utils.micro_benchmarks user-context
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+from typing import List
+
+
+def _prepare_environment():
+    """Переменные окружения до импорта core.config: временная SQLite, без Google Sheets."""
+    for name in ('BOT_TOKEN', 'CHANNEL_ID', 'ADMIN_IDS', 'HELLO_STICKER_ID', 'NASTOYKA_STICKER_ID',
+                 'THANK_YOU_STICKER_ID', 'FRIEND_BONUS_STICKER_ID'):
+        os.environ.setdefault(name, '100000:BENCHMARK' if name == 'BOT_TOKEN' else '1')
+    os.environ.update({
+        'DATABASE_PATH': os.path.join(tempfile.mkdtemp(), 'bench.db'),
+        'USE_POSTGRES': 'false', 'DATABASE_URL': '',
+        'GOOGLE_SHEET_KEY': '', 'GOOGLE_CREDENTIALS_JSON': '',
+    })
+
+
+def _database():
+    from core import database
+    database.init_db()
+    return database
+
+
+def bench_delivery_log(count: int):
+    from core.delivery_logger import DeliveryLogger
+
+    database = _database()
+    with database.db_connection() as conn:
+        conn.executemany("INSERT INTO users (user_id, username, first_name) VALUES (?, '', '')",
+                         [(uid,) for uid in range(1, 2 * count + 1)])
+
+    def row(uid):
+        return {'user_id': uid, 'username': '', 'first_name': '', 'status': 'sent',
+                'error_code': None, 'error_message': None}
+
+    # Каждый десятый получатель заблокировал бота
+    started = time.perf_counter()
+    for uid in range(1, count + 1):
+        database.log_broadcast_deliveries(1, [row(uid)])
+        if uid % 10 == 0:
+            database.mark_users_blocked([uid])
+    per_row = time.perf_counter() - started
+
+    logger = DeliveryLogger(database)
+    logger.start()
+    started = time.perf_counter()
+    for uid in range(count + 1, 2 * count + 1):
+        logger.log(2, uid)
+        if uid % 10 == 0:
+            logger.mark_blocked(uid)
+    logger.stop()
+    buffered = time.perf_counter() - started
+
+    print(f"Построчно:     {per_row:.2f}s ({count / per_row:.0f} строк/с)")
+    print(f"Буферизовано:  {buffered:.2f}s ({count / buffered:.0f} строк/с), {logger.get_stats()}")
+
+
+def bench_knowledge(runs: int):
+    from ai.knowledge_base import KNOWLEDGE_BASE_TEXT
+    from ai.knowledge_index import KnowledgeIndex
+
+    def legacy_find(query: str) -> List[str]:
+        query_words = {word.lower() for word in query.split()}
+        return [line for line in KNOWLEDGE_BASE_TEXT.split('\n')
+                if any(word in line.lower() for word in query_words)][:10]
+
+    build_time = timeit.timeit(
+        lambda: KnowledgeIndex().set_source("base", KNOWLEDGE_BASE_TEXT.split("\n")), number=20) / 20
+    index = KnowledgeIndex()
+    index.set_source("base", KNOWLEDGE_BASE_TEXT.split("\n"))
+    print(f"Индекс: {index.get_stats()}, построение {build_time * 1000:.2f} мс")
+
+    queries = [
+        "Где находится бар на Невском?",
+        "какие у вас настойки",
+        "сколько стоит караоке в пятницу вечером",
+        "можно забронировать стол на компанию",
+        "парковка рядом есть?",
+    ]
+    for query in queries:
+        old = timeit.timeit(lambda: legacy_find(query), number=runs) / runs * 1e6
+        new = timeit.timeit(lambda: index.search(query), number=runs) / runs * 1e6
+        print(f"{query!r:45} старый {old:8.1f} мкс | индекс {new:7.1f} мкс | x{old / new:.1f}")
+        top = index.search(query, top_k=1)
+        print(f"    → {top[0][:90] if top else '—'}")
+
+
+def bench_prompt(runs: int):
+    from ai.prompt_builder import (EMOTION_HINTS, PRIORITY_BAR, PRIORITY_EMOTION, PRIORITY_USER_TYPE,
+                                   USER_TYPE_HINTS, PromptBuilder, PromptSection, tokenizer_name)
+
+    builder = PromptBuilder(token_budget=1200)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Сообщение номер {i} про караоке и бронь столика"}
+               for i in range(20)]
+    knowledge = "\n".join(f"Строка базы знаний {i}: Невский 53, караоке бесплатное, кухня до 5 утра" for i in range(10))
+    sections = [
+        PromptSection("updates", "Спецпредложение сегодня: настойка дня. В стоп‑листе: ничего"),
+        PromptSection("bar", "Контекст бара: Невский 53, пятница, открыто", PRIORITY_BAR),
+        PromptSection("user_type", USER_TYPE_HINTS["regular"], PRIORITY_USER_TYPE),
+        PromptSection("emotion", EMOTION_HINTS["joy"], PRIORITY_EMOTION),
+    ]
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        built = builder.build(user_concept="evgenich", is_group_chat=False, sections=sections,
+                              history=history, question="Где вы находитесь?", knowledge=knowledge)
+    elapsed = time.perf_counter() - started
+    print(f"Токенизатор: {tokenizer_name()}")
+    print(f"Сборка: {elapsed / runs * 1e6:.0f} мкс на промпт")
+    print(f"Токенов: {built.total_tokens} из {built.budget}, по секциям: {built.section_tokens}")
+    print(f"Выброшены: {built.dropped}, укорочены: {built.truncated}, сообщений истории: {len(built.messages) - 2}")
+
+
+def bench_user_context(count: int):
+    from ai.user_context import UserContextService
+
+    database = _database()
+    users = list(range(1, 201))
+    with database.db_connection() as conn:
+        conn.executemany("INSERT INTO users (user_id, username, first_name, status, ai_concept) VALUES (?, ?, ?, 'issued', ?)",
+                         [(u, f"user{u}", f"Гость {u}", "evgenich") for u in users])
+        conn.executemany("INSERT INTO conversation_history (user_id, role, text) VALUES (?, ?, ?)",
+                         [(u, role, f"реплика {i}") for u in users for i in range(40)
+                          for role in ("user", "assistant")])
+
+    rnd = random.Random(1)
+    messages = [rnd.choice(users[:50]) for _ in range(count)]  # активные гости пишут чаще
+
+    def legacy(user_id):
+        database.log_conversation_turn(user_id, "user", "вопрос")
+        database.get_conversation_history(user_id, limit=12)
+        database.get_user_concept(user_id)
+        database.find_user_by_id(user_id)
+        database.log_conversation_turn(user_id, "assistant", "ответ")
+
+    service = UserContextService(store=database)
+
+    def snapshot(user_id):
+        service.get(user_id)
+        service.log_turn(user_id, "user", "вопрос")
+        service.log_turn(user_id, "assistant", "ответ")
+
+    for name, handler in (("старый путь", legacy), ("снимок", snapshot)):
+        started = time.perf_counter()
+        for user_id in messages:
+            handler(user_id)
+        per_message = (time.perf_counter() - started) / len(messages) * 1000
+        print(f"{name:12} {per_message:.3f} мс БД на сообщение")
+    print(f"Статистика снимков: {service.get_stats()}")
+
+
+BENCHMARKS = {
+    'delivery-log': (bench_delivery_log, 20000),
+    'knowledge': (bench_knowledge, 200),
+    'prompt': (bench_prompt, 2000),
+    'user-context': (bench_user_context, 1000),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки компонентов бота")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--count', type=int, help="получателей, сообщений или повторов (по умолчанию свой у каждого)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    args = parse_args()
+    _prepare_environment()
+    func, default_count = BENCHMARKS[args.benchmark]
+    func(args.count or default_count)
+    # Фоновые потоки (пулы соединений, очередь Google Sheets) не должны задерживать выход
+    os._exit(0)
@@ -1,18 +1,42 @@
 #!/usr/bin/env python3
 """
 Система автоматических уведомлений о реферальных наградах
+
+Награда рефереру — событие, а не результат периодического скана всех
+пользователей: когда реферал гасит купон, callback_query вызывает
+schedule_referral_reward(), и в delayed_tasks ставится задача
+'referral_reward' ровно на момент погашения + 48 часов. Её выполняет
+планировщик core/delayed_tasks_processor (process_referral_reward_task).
+
+Погашения, прошедшие мимо события (веб-панель, сбой до постановки задачи,
+история до перехода на события), подбирает сверка reconcile_referral_rewards:
+она читает только рефералов, погасивших купон после сохранённой отметки
+(job_watermarks, ключ (redeem_date, user_id)), и ставит недостающие задачи.
 """
 import logging
 import threading
-import time
 from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 import pytz
 
 import core.database as database
 from core.config import BOT_TOKEN
+from core.delayed_tasks_processor import schedule_task
 import telebot
 from telebot import types
 
+# Награда рефереру — через 48 часов после погашения купона рефералом
+REFERRAL_REWARD_DELAY = timedelta(hours=48)
+REFERRAL_REWARD_TASK = 'referral_reward'
+# Повтор задачи, если проверка не удалась или срок ещё не наступил:
+# первая пауза, удвоение до потолка, число переносов до отказа
+REWARD_RETRY_DELAY = 300
+REWARD_RETRY_MAX_DELAY = 6 * 3600
+REWARD_MAX_RETRIES = 12
+# Отметка сверки в job_watermarks и период сверки
+RECONCILE_WATERMARK = 'referral_rewards'
+RECONCILE_INTERVAL = 1800
+
 # Создаем бота для уведомлений
 notification_bot = None
 
@@ -68,152 +92,126 @@ def send_referral_reward_notification(user_id, reward_count, reward_code):
         logging.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
         return False
 
-def check_and_notify_ready_rewards():
+def schedule_referral_reward(referrer_id: int, referred_id: int,
+                             redeem_date: Optional[datetime] = None) -> Optional[int]:
     """
-    Проверяет всех пользователей на готовые награды и отправляет уведомления
+    Ставит задачу награды рефереру на момент погашения + 48 часов
+    (redeem_date — момент погашения, по умолчанию сейчас).
     """
-    try:
-        # Получаем всех пользователей с потенциально готовыми наградами
-        users_with_referrals = database.get_users_with_pending_rewards()
-        
-        notifications_sent = 0
-        
-        for user_id in users_with_referrals:
-            try:
-                stats = database.get_referral_stats(user_id)
-                
-                if stats and stats['pending']:
-                    # Находим готовые к выдаче награды
-                    ready_rewards = []
-                    
-                    for ref in stats['pending']:
-                        if ref['can_claim']:
-                            # Проверяем точно, что награда готова
-                            eligible, reason = database.check_referral_reward_eligibility(user_id, ref['user_id'])
-                            if eligible:
-                                ready_rewards.append(ref)
-                    
-                    if ready_rewards:
-                        # Выдаем все готовые награды автоматически
-                        total_rewards = 0
-                        for ref in ready_rewards:
-                            success = database.mark_referral_rewarded(user_id, ref['user_id'])
-                            if success:
-                                total_rewards += 1
-                        
-                        if total_rewards > 0:
-                            # Генерируем код награды
-                            reward_code = f"REF{user_id}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                            
-                            # Отправляем уведомление
-                            success = send_referral_reward_notification(user_id, total_rewards, reward_code)
-                            
-                            if success:
-                                notifications_sent += 1
-                                
-                                # Логируем выдачу награды
-                                logging.info(f"Автоматически выдана реферальная награда: пользователь {user_id}, {total_rewards} наград, код {reward_code}")
-                
-            except Exception as e:
-                logging.error(f"Ошибка обработки пользователя {user_id}: {e}")
-                continue
-        
-        if notifications_sent > 0:
-            logging.info(f"Отправлено {notifications_sent} уведомлений о реферальных наградах")
-        
-        return notifications_sent
-        
-    except Exception as e:
-        logging.error(f"Ошибка в проверке готовых наград: {e}")
-        return 0
+    redeemed_at = redeem_date or datetime.now(pytz.utc)
+    if redeemed_at.tzinfo is None:
+        redeemed_at = pytz.utc.localize(redeemed_at)
+    delay = (redeemed_at + REFERRAL_REWARD_DELAY - datetime.now(pytz.utc)).total_seconds()
+    return schedule_task(referrer_id, REFERRAL_REWARD_TASK, delay_seconds=max(0.0, delay),
+                         payload={'referred_id': referred_id})
+
+def process_referral_reward_task(task: Dict[str, Any]):
+    """
+    Обработчик задачи 'referral_reward': выдаёт награду за одного реферала и
+    уведомляет реферера. Повторный запуск (сверка, повтор задачи) награду
+    не дублирует — mark_referral_rewarded отмечает только ещё не награждённых.
+
+    Задача завершается без награды только при окончательном отказе (реферал
+    не найден, награда уже выдана, купон не погашен). Ошибка проверки или
+    «срок ещё не наступил» — задача переносится с нарастающей паузой.
+    """
+    referrer_id = task['user_id']
+    payload = task['payload']
+    referred_id = payload.get('referred_id')
+    if not referred_id:
+        raise ValueError("referred_id не указан в задаче")
+
+    eligible, reason = database.check_referral_reward_eligibility(referrer_id, referred_id)
+    if not eligible:
+        if reason in (database.REFERRAL_NOT_FOUND, database.REFERRAL_ALREADY_REWARDED,
+                      database.REFERRAL_NOT_REDEEMED):
+            logging.info(f"Награда рефереру {referrer_id} за {referred_id} не выдана: {reason}")
+            return
+        retry = payload.get('retry', 0) + 1
+        if retry > REWARD_MAX_RETRIES:
+            raise RuntimeError(f"награда за {referred_id} не выдана после {REWARD_MAX_RETRIES} переносов: {reason}")
+        delay = min(REWARD_RETRY_DELAY * 2 ** (retry - 1), REWARD_RETRY_MAX_DELAY)
+        # Исключение при постановке (БД недоступна) — повтор самой задачи планировщиком
+        if not schedule_task(referrer_id, REFERRAL_REWARD_TASK, delay_seconds=delay,
+                             payload={'referred_id': referred_id, 'retry': retry}):
+            raise RuntimeError(f"не удалось перенести награду за {referred_id}: {reason}")
+        logging.warning(f"Награда рефереру {referrer_id} за {referred_id} перенесена на {delay} с "
+                        f"(перенос {retry}): {reason}")
+        return
+
+    if not database.mark_referral_rewarded(referrer_id, referred_id):
+        return
 
-def check_new_referral_completions():
+    reward_code = f"REF{referrer_id}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    if not notification_bot:
+        init_notification_bot()
+    if send_referral_reward_notification(referrer_id, 1, reward_code):
+        logging.info(f"Автоматически выдана реферальная награда: пользователь {referrer_id}, "
+                     f"реферал {referred_id}, код {reward_code}")
+
+def reconcile_referral_rewards(batch_size: int = 500) -> int:
     """
-    Проверяет новых рефералов, которые только что получили настойку
-    и отправляет уведомления рефереру
+    Ставит задачи наград за погашения после отметки, для которых нет ожидающей
+    или выполняемой задачи (выполненная задача могла завершиться без награды —
+    повторная постановка безопасна, награда не задвоится).
+    Читает только новые погашения (по индексу redeem_date), отметку
+    сохраняет после каждой страницы. Возвращает число поставленных задач.
     """
+    watermark = database.get_job_watermark(RECONCILE_WATERMARK) or {}
+    after_date, after_user_id = watermark.get('redeem_date'), watermark.get('user_id', 0)
+    scheduled = 0
+    while True:
+        rows = database.get_referrals_redeemed_since(after_date, after_user_id, batch_size)
+        for row in rows:
+            if not database.delayed_task_exists(row['referrer_id'], REFERRAL_REWARD_TASK,
+                                                {'referred_id': row['user_id']}):
+                redeem_date = _parse_redeem_date(row['redeem_date'])
+                if schedule_referral_reward(row['referrer_id'], row['user_id'], redeem_date):
+                    scheduled += 1
+        if not rows:
+            break
+        after_date, after_user_id = rows[-1]['redeem_date'], rows[-1]['user_id']
+        database.set_job_watermark(RECONCILE_WATERMARK, {'redeem_date': after_date, 'user_id': after_user_id})
+        if len(rows) < batch_size:
+            break
+
+    if scheduled:
+        logging.info(f"Сверка реферальных наград: поставлено {scheduled} пропущенных задач")
+    return scheduled
+
+def _parse_redeem_date(value: str) -> Optional[datetime]:
     try:
-        # Получаем всех рефералов, которые получили настойку в последние 2 часа
-        recent_redeemed = database.get_recently_redeemed_referrals(hours=2)
-        
-        notifications_sent = 0
-        
-        for referral_info in recent_redeemed:
-            try:
-                referrer_id = referral_info['referrer_id']
-                referral_name = referral_info['first_name'] or referral_info['username'] or f"ID{referral_info['user_id']}"
-                
-                # Отправляем уведомление рефереру
-                notification_text = (
-                    f"🎉 *Отличные новости!*\n\n"
-                    f"Ваш друг **{referral_name}** получил настойку в баре!\n\n"
-                    f"⏰ Через 48 часов вы получите **бесплатную настойку** в качестве награды.\n\n"
-                    f"📍 А пока можете забронировать столик и прийти вместе!"
-                )
-                
-                # Кнопки для действий
-                keyboard = types.InlineKeyboardMarkup()
-                keyboard.row(
-                    types.InlineKeyboardButton("📍 Забронировать стол", callback_data="start_booking")
-                )
-                keyboard.row(
-                    types.InlineKeyboardButton("🤝 Пригласить еще друзей", callback_data="show_referral_link"),
-                )
-                
-                notification_bot.send_message(
-                    referrer_id,
-                    notification_text,
-                    parse_mode="Markdown", 
-                    reply_markup=keyboard
-                )
-                
-                notifications_sent += 1
-                logging.info(f"Уведомление о прогрессе реферала отправлено пользователю {referrer_id}")
-                
-            except Exception as e:
-                logging.error(f"Ошибка отправки уведомления о прогрессе реферала: {e}")
-                continue
-        
-        if notifications_sent > 0:
-            logging.info(f"Отправлено {notifications_sent} уведомлений о прогрессе рефералов")
-            
-        return notifications_sent
-        
-    except Exception as e:
-        logging.error(f"Ошибка проверки новых активаций рефералов: {e}")
-        return 0
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
 
-def start_referral_notification_service():
+def start_referral_notification_service(interval: float = RECONCILE_INTERVAL):
     """
-    Запускает службу уведомлений о реферальных наградах
+    Запускает сверку реферальных наград (раз в interval секунд).
+    Сами награды выдаёт планировщик отложенных задач в срок.
     """
-    def notification_loop():
+    stop_event = threading.Event()
+
+    def reconcile_loop():
         if not init_notification_bot():
             logging.error("Не удалось запустить службу уведомлений - проблема с инициализацией бота")
             return
         
-        logging.info("Запущена служба уведомлений о реферальных наградах")
+        logging.info("Запущена сверка реферальных наград")
         
-        while True:
+        while not stop_event.is_set():
             try:
-                # Проверяем готовые награды (каждые 30 минут)
-                ready_rewards = check_and_notify_ready_rewards()
-                
-                # Проверяем новые активации рефералов (каждые 30 минут)  
-                new_activations = check_new_referral_completions()
-                
-                # Спим 30 минут
-                time.sleep(1800)  # 1800 секунд = 30 минут
-                
+                reconcile_referral_rewards()
             except Exception as e:
-                logging.error(f"Ошибка в цикле уведомлений: {e}")
-                time.sleep(300)  # При ошибке ждем 5 минут
+                logging.error(f"Ошибка сверки реферальных наград: {e}")
+            stop_event.wait(interval)
     
     # Запускаем в отдельном потоке
-    notification_thread = threading.Thread(target=notification_loop, daemon=True)
+    notification_thread = threading.Thread(target=reconcile_loop, name="referral-reconcile", daemon=True)
     notification_thread.start()
     
     logging.info("Служба реферальных уведомлений запущена в фоновом режиме")
+    return stop_event
 
 def send_immediate_referral_notification(referrer_id, referral_name):
     """
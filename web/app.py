@@ -26,6 +26,10 @@ import pytz
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, ROOT_DIR)
 
+from core.config_store import write_json_atomic
+from core import sheets_sync
+from core.delivery_logger import DeliveryLogger
+
 # ── Database (прямое подключение, без core.config) ──
 DATABASE_URL = os.getenv('DATABASE_URL', '')
 USE_POSTGRES = os.getenv('USE_POSTGRES', 'false').lower() in ('true', '1', 'yes')
@@ -118,8 +122,8 @@ def _load(path, default=None):
 
 
 def _save(path, data):
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Атомарно: бот читает эти файлы в любой момент (core/config_store.py)
+    write_json_atomic(path, data)
 
 
 def login_required(f):
@@ -278,36 +282,27 @@ def users_list():
     search = request.args.get('q', '').strip()
     status_filter = request.args.get('status', '')
 
-    all_users = _db_query(db.get_all_users, default=[]) or []
-
-    # Filter
-    if search:
-        q = search.lower()
-        all_users = [u for u in all_users if
-            (str(u.get('user_id', '')).find(q) >= 0) or
-            (u.get('username', '') or '').lower().find(q) >= 0 or
-            (u.get('first_name', '') or '').lower().find(q) >= 0]
+    cursor = request.args.get('after', '').strip() or None
 
-    if status_filter:
-        all_users = [u for u in all_users if u.get('status') == status_filter]
-
-    # Pagination
+    # Фильтрация, счётчики и пагинация — на стороне БД
     per_page = 50
-    total_pages = max(1, (len(all_users) + per_page - 1) // per_page)
-    page = min(page, total_pages)
-    paginated = all_users[(page-1)*per_page : page*per_page]
-
-    # Status counts (из неотфильтрованного списка для корректного подсчёта)
-    all_before_filter = _db_query(db.get_all_users, default=[]) or []
-    status_counts = {}
-    for u in all_before_filter:
-        s = u.get('status', 'unknown')
-        status_counts[s] = status_counts.get(s, 0) + 1
+    result = _db_query(db.get_users_page, limit=per_page, cursor=cursor,
+                       status=status_filter or None, search=search or None,
+                       page=None if cursor else page, default=None) or {}
+
+    total = result.get('total', 0)
+    total_pages = max(1, (total + per_page - 1) // per_page)
+    if not cursor and page > total_pages:
+        page = total_pages
+        result = _db_query(db.get_users_page, limit=per_page, status=status_filter or None,
+                           search=search or None, page=page, default=None) or result
+    page = max(1, min(page, total_pages))
 
     return render_template('full/users.html',
-        users=paginated, page=page, total_pages=total_pages,
-        total_users=len(all_users), search=search,
-        status_filter=status_filter, status_counts=status_counts)
+        users=result.get('users', []), page=page, total_pages=total_pages,
+        total_users=total, search=search,
+        status_filter=status_filter, status_counts=result.get('status_counts', {}),
+        next_cursor=result.get('next_cursor'))
 
 
 @app.route('/users/<int:user_id>')
@@ -824,6 +819,10 @@ def _run_sheets_sync():
     _sync_status = {'running': True, 'progress': 'Подключение к Google Sheets...', 'done': False, 'result': None}
 
     try:
+        if not DB_OK:
+            _sync_status.update(running=False, done=True, result={'error': 'БД не подключена'})
+            return
+
         import gspread
         from google.oauth2.service_account import Credentials
 
@@ -852,53 +851,16 @@ def _run_sheets_sync():
             ws = spreadsheet.sheet1
 
         _sync_status['progress'] = f'Чтение данных из листа «{ws.title}»...'
-        all_rows = ws.get_all_records()
-        total = len(all_rows)
-        _sync_status['progress'] = f'Найдено {total} строк. Синхронизация с PostgreSQL...'
+        values = ws.get_all_values()
 
-        if not DB_OK:
-            _sync_status.update(running=False, done=True, result={'error': 'БД не подключена'})
-            return
-
-        synced = 0
-        skipped = 0
-        errors = 0
-
-        for i, row in enumerate(all_rows):
-            try:
-                uid = row.get('user_id') or row.get('Telegram ID') or row.get('ID')
-                if not uid:
-                    skipped += 1
-                    continue
-                uid = int(uid)
-
-                # Проверяем, есть ли уже в PostgreSQL
-                existing = _db_query(db.get_user_by_id, uid, default=None)
-                if existing:
-                    skipped += 1
-                    continue
-
-                # Добавляем
-                username = row.get('username') or row.get('Username') or ''
-                first_name = row.get('first_name') or row.get('Имя') or ''
-                source = row.get('source') or row.get('Источник') or 'google_sheets_sync'
-                status = row.get('status') or row.get('Статус') or 'registered'
-
-                _db_query(db.add_new_user, uid, username, first_name, source)
-                if status and status != 'registered':
-                    _db_query(db.update_status, uid, status)
-                synced += 1
-
-            except Exception as e:
-                errors += 1
-                logging.error(f"Sync error row {i}: {e}")
-
-            if (i + 1) % 50 == 0:
-                _sync_status['progress'] = f'Обработано {i+1}/{total} (добавлено: {synced}, пропущено: {skipped})'
+        def report(text):
+            _sync_status['progress'] = text
 
+        # Пакетная запись через PostgresClient: без запросов на каждую строку и без обратной записи в лист
+        result = sheets_sync.sync_users(values, _pg, progress=report)
         _sync_status.update(
-            running=False, done=True,
-            result={'total': total, 'synced': synced, 'skipped': skipped, 'errors': errors}
+            running=False, done=True, result=result,
+            progress=f"Готово: {result['total']} строк за {result['seconds']} с ({result['rows_per_sec']} строк/с)"
         )
 
     except Exception as e:
@@ -970,6 +932,14 @@ def _run_web_broadcast(text, btn_text=None, btn_url=None):
 
     api_url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
 
+    # Результаты доставки и блокировки пишутся пачками, а не запросом на каждого
+    delivery_log = DeliveryLogger(db)
+    delivery_log.start()
+
+    def log_delivery(uid, uname, fname, status, error_code=None, error_message=None):
+        if broadcast_id:
+            delivery_log.log(broadcast_id, uid, uname, fname, status, error_code, error_message)
+
     for i, user in enumerate(users):
         uid = user.get('user_id')
         uname = user.get('username', '')
@@ -991,17 +961,14 @@ def _run_web_broadcast(text, btn_text=None, btn_url=None):
 
             if data.get('ok'):
                 sent += 1
-                if broadcast_id:
-                    _db_query(db.log_broadcast_delivery, broadcast_id, uid, uname, fname, 'sent')
+                log_delivery(uid, uname, fname, 'sent')
             else:
                 err_code = data.get('error_code', 0)
                 err_desc = data.get('description', 'Unknown error')
                 if err_code == 403:
                     blocked += 1
-                    _db_query(db.mark_user_blocked, uid)
-                    if broadcast_id:
-                        _db_query(db.log_broadcast_delivery, broadcast_id, uid, uname, fname, 'blocked',
-                                  403, err_desc[:300])
+                    delivery_log.mark_blocked(uid)
+                    log_delivery(uid, uname, fname, 'blocked', 403, err_desc[:300])
                 elif err_code == 429:
                     retry = data.get('parameters', {}).get('retry_after', 1)
                     time.sleep(retry)
@@ -1009,23 +976,17 @@ def _run_web_broadcast(text, btn_text=None, btn_url=None):
                     data2 = resp2.json()
                     if data2.get('ok'):
                         sent += 1
-                        if broadcast_id:
-                            _db_query(db.log_broadcast_delivery, broadcast_id, uid, uname, fname, 'sent')
+                        log_delivery(uid, uname, fname, 'sent')
                     else:
                         failed += 1
-                        if broadcast_id:
-                            _db_query(db.log_broadcast_delivery, broadcast_id, uid, uname, fname, 'failed',
-                                      429, f"Retry failed: {data2.get('description', '')[:200]}")
+                        log_delivery(uid, uname, fname, 'failed',
+                                     429, f"Retry failed: {data2.get('description', '')[:200]}")
                 else:
                     failed += 1
-                    if broadcast_id:
-                        _db_query(db.log_broadcast_delivery, broadcast_id, uid, uname, fname, 'failed',
-                                  err_code, err_desc[:300])
+                    log_delivery(uid, uname, fname, 'failed', err_code, err_desc[:300])
         except Exception as e:
             failed += 1
-            if broadcast_id:
-                _db_query(db.log_broadcast_delivery, broadcast_id, uid, uname, fname, 'failed',
-                          0, str(e)[:300])
+            log_delivery(uid, uname, fname, 'failed', 0, str(e)[:300])
             logging.error(f"Broadcast error {uid}: {e}")
 
         if (i + 1) % 15 == 0:
@@ -1034,6 +995,9 @@ def _run_web_broadcast(text, btn_text=None, btn_url=None):
 
         time.sleep(0.05)  # rate limit ~20 msg/sec
 
+    # Дописываем буфер лога до финальной статистики
+    delivery_log.stop()
+
     # Сохраняем финальную статистику
     if broadcast_id:
         _db_query(db.finish_broadcast_run, broadcast_id, sent, failed, blocked)
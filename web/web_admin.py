@@ -14,6 +14,8 @@ from datetime import timedelta, datetime
 # Добавляем корневую директорию проекта в PYTHONPATH
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from core.config_store import write_json_atomic
+
 # Импортируем database для статистики
 try:
     from core import database as db
@@ -63,9 +65,8 @@ def load_config(filename, default=None):
     return default or {}
 
 def save_config(filename, data):
-    """Сохраняет конфиг в JSON файл"""
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Сохраняет конфиг в JSON файл (атомарно — бот читает его в любой момент)"""
+    write_json_atomic(filename, data)
 
 # Инициализация дефолтных конфигов
 def init_default_configs():
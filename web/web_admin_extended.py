@@ -220,11 +220,9 @@ def bookings():
 @app.route('/api/bookings')
 def api_bookings():
     """API для получения бронирований"""
-    # TODO: Получение данных из TinyDB booking_data.json
     try:
-        from tinydb import TinyDB
-        db = TinyDB('booking_data.json')
-        bookings_list = db.all()
+        from core.booking_state import get_all_booking_states
+        bookings_list = get_all_booking_states()
         return jsonify({'success': True, 'bookings': bookings_list})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
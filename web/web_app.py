@@ -201,22 +201,27 @@ def api_users():
             end = start + per_page
             users_page = test_users[start:end]
             total = len(test_users)
+            next_cursor = None
         else:
-            # Получаем всех пользователей (в реальной жизни тут будет пагинация)
-            all_users = database.get_all_users()
-            
-            # Простая пагинация
-            start = (page - 1) * per_page
-            end = start + per_page
-            users_page = all_users[start:end]
-            total = len(all_users)
+            # Пагинация и фильтры выполняются в БД (keyset-курсор в параметре after)
+            result = database.get_users_page(
+                limit=per_page,
+                cursor=request.args.get('after') or None,
+                status=request.args.get('status') or None,
+                search=request.args.get('q') or None,
+                page=page,
+            )
+            users_page = result['users']
+            total = result['total']
+            next_cursor = result['next_cursor']
         
         return jsonify({
             'success': True,
             'users': users_page,
             'total': total,
             'page': page,
-            'per_page': per_page
+            'per_page': per_page,
+            'next_cursor': next_cursor
         })
     except Exception as e:
         logging.error(f"Ошибка в api_users: {e}")
@@ -403,9 +408,8 @@ def bookings():
 def api_bookings():
     """API для получения бронирований"""
     try:
-        from tinydb import TinyDB
-        db = TinyDB('booking_data.json')
-        bookings_list = db.all()
+        from core.booking_state import get_all_booking_states
+        bookings_list = get_all_booking_states()
         return jsonify({'success': True, 'bookings': bookings_list})
     except Exception as e:
         logger.error(f"Ошибка в api_bookings: {e}")